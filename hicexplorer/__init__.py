@@ -19,4 +19,6 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 
 import multiprocessing as mp
-mp.set_start_method('fork')
+# a process started with spawn has its start method already set when it imports the package
+if mp.get_start_method(allow_none=True) is None:
+    mp.set_start_method('fork')
@@ -3,8 +3,6 @@ import sys
 import errno
 import os
 import math
-from multiprocessing import Process, Queue
-import time
 import traceback
 import logging
 log = logging.getLogger(__name__)
@@ -250,10 +248,7 @@ def call_multi_core(pInteractionFilesList, pTargetFileList, pTargetFType, pTarge
 
     interactionFilesPerThread = len(pInteractionFilesList) // pArgs.threads
 
-    all_data_collected = False
-    queue = [None] * pArgs.threads
-    process = [None] * pArgs.threads
-    thread_done = [False] * pArgs.threads
+    task_arguments = []
     one_target = True if len(pTargetFileList) == 1 else False
     fail_flag = False
     fail_message = ''
@@ -272,40 +267,22 @@ def call_multi_core(pInteractionFilesList, pTargetFileList, pTargetFType, pTarge
             else:
                 targetFileListThread = pTargetFileList[i * interactionFilesPerThread:]
 
-        queue[i] = Queue()
-        process[i] = Process(target=pFunctionName, kwargs=dict(
+        task_arguments.append(dict(
             pInteractionFilesList=interactionFileListThread,
             pTargetList=targetFileListThread,
             pTargetFType=pTargetFType,
             pTargetPosDict=pTargetPosDict,
             pArgs=pArgs,
             pViewpointObj=pViewpointObj,
-            pQueue=queue[i],
             pOneTarget=one_target
-        )
-        )
-
-        process[i].start()
-
-    while not all_data_collected:
-        for i in range(pArgs.threads):
-            if queue[i] is not None and not queue[i].empty():
-                background_data_thread = queue[i].get()
-                if 'Fail:' in background_data_thread:
-                    fail_flag = True
-                    fail_message = background_data_thread[6:]
-                else:
-                    outfile_names_list[i], accepted_scores_list[i] = background_data_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
+        ))
+
+    for i, background_data_thread in utilities.run_tasks(pFunctionName, task_arguments, pThreads=pArgs.threads):
+        if 'Fail:' in background_data_thread:
+            fail_flag = True
+            fail_message = background_data_thread[6:]
+        else:
+            outfile_names_list[i], accepted_scores_list[i] = background_data_thread
     if fail_flag:
         log.error(fail_message)
         exit(1)
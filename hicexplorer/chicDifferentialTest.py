@@ -3,8 +3,6 @@ import sys
 import errno
 import os
 import math
-from multiprocessing import Process, Queue
-import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -367,10 +365,7 @@ def main(args=None):
     rejected_data = [None] * args.threads
 
     aggregatedListPerThread = len(aggregatedList) // args.threads
-    all_data_collected = False
-    queue = [None] * args.threads
-    process = [None] * args.threads
-    thread_done = [False] * args.threads
+    task_arguments = []
     length_of_threads = 0
     for i in range(args.threads):
 
@@ -379,35 +374,17 @@ def main(args=None):
         else:
             aggregatedListThread = aggregatedList[i * aggregatedListPerThread:]
         length_of_threads += len(aggregatedListThread)
-        queue[i] = Queue()
-        process[i] = Process(target=run_statistical_tests, kwargs=dict(
+        task_arguments.append(dict(
             pInteractionFilesList=aggregatedListThread,
             pArgs=args,
-            pViewpointObject=viewpointObj,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-    while not all_data_collected:
-        for i in range(args.threads):
-            if queue[i] is not None and not queue[i].empty():
-                background_data_thread = queue[i].get()
-                if 'Fail:' in background_data_thread:
-                    fail_flag = True
-                    fail_message = background_data_thread[6:]
-                else:
-                    accepted_data[i], rejected_data[i], all_data[i] = background_data_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
+            pViewpointObject=viewpointObj
+        ))
+    for i, background_data_thread in utilities.run_tasks(run_statistical_tests, task_arguments, pThreads=args.threads):
+        if 'Fail:' in background_data_thread:
+            fail_flag = True
+            fail_message = background_data_thread[6:]
+        else:
+            accepted_data[i], rejected_data[i], all_data[i] = background_data_thread
     if fail_flag:
         log.error(fail_message)
         exit(1)
@@ -3,7 +3,6 @@ import sys
 import os
 import errno
 import math
-from multiprocessing import Process, Queue
 import time
 import traceback
 
@@ -443,13 +442,10 @@ def main(args=None):
 
     filesPerThread = len(fileList) // args.threads
 
-    all_data_collected = False
     thread_data = [None] * args.threads
     file_name_list = [None] * args.threads
 
-    queue = [None] * args.threads
-    process = [None] * args.threads
-    thread_done = [False] * args.threads
+    task_arguments = []
     fail_flag = False
     fail_message = ''
 
@@ -459,42 +455,22 @@ def main(args=None):
             fileListPerThread = fileList[i * filesPerThread:(i + 1) * filesPerThread]
         else:
             fileListPerThread = fileList[i * filesPerThread:]
-        queue[i] = Queue()
-
-        process[i] = Process(target=exportData, kwargs=dict(
+        task_arguments.append(dict(
             pFileList=fileListPerThread,
             pArgs=args,
             pViewpointObject=viewpointObj,
             pDecimalPlace=args.decimalPlaces,
             pChromosomeSizes=chromosome_sizes,
             pBackgroundData=background_dict,
-            pFileType=fileType,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-
-    while not all_data_collected:
-        for i in range(args.threads):
-            if queue[i] is not None and not queue[i].empty():
-                return_content = queue[i].get()
-                if 'Fail:' in return_content:
-                    fail_flag = True
-                    fail_message = return_content[6:]
-                else:
-                    file_name_list[i], thread_data[i] = return_content
-
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
+            pFileType=fileType
+        ))
+
+    for i, return_content in utilities.run_tasks(exportData, task_arguments, pThreads=args.threads):
+        if 'Fail:' in return_content:
+            fail_flag = True
+            fail_message = return_content[6:]
+        else:
+            file_name_list[i], thread_data[i] = return_content
     if fail_flag:
         log.error(fail_message)
         exit(1)
@@ -3,7 +3,6 @@ import sys
 import os
 import errno
 import math
-from multiprocessing import Process, Queue
 import time
 import traceback
 
@@ -453,12 +452,9 @@ def main(args=None):
     interactionFilesPerThread = len(interactionFileList) // args.threads
     # highlightSignificantRegionsFileListThread = len(highlightSignificantRegionsFileList) // args.threads
 
-    all_data_collected = False
     images_array = [None] * args.threads
     file_name_list = [None] * args.threads
-    queue = [None] * args.threads
-    process = [None] * args.threads
-    thread_done = [False] * args.threads
+    task_arguments = []
     fail_flag = False
     fail_message = ''
 
@@ -472,41 +468,22 @@ def main(args=None):
             interactionFileListThread = interactionFileList[i * interactionFilesPerThread:]
             highlightDifferentialRegionsFileListThread = highlightDifferentialRegionsFileList[i * interactionFilesPerThread:]
             highlightSignificantRegionsFileListThread = highlightSignificantRegionsFileList[i * interactionFilesPerThread:]
-        queue[i] = Queue()
-
-        process[i] = Process(target=plot_images, kwargs=dict(
+        task_arguments.append(dict(
             pInteractionFileList=interactionFileListThread,
             pHighlightDifferentialRegionsFileList=highlightDifferentialRegionsFileListThread,
             pBackgroundData=background_data,
             pArgs=args,
             pViewpointObj=viewpointObj,
             pSignificantRegionsFileList=highlightSignificantRegionsFileListThread,
-            pResolution=resolution,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-
-    while not all_data_collected:
-        for i in range(args.threads):
-            if queue[i] is not None and not queue[i].empty():
-                return_content = queue[i].get()
-                if 'Fail:' in return_content:
-                    fail_flag = True
-                    fail_message = return_content[6:]
-                else:
-                    images_array[i], file_name_list[i] = return_content
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
+            pResolution=resolution
+        ))
+
+    for i, return_content in utilities.run_tasks(plot_images, task_arguments, pThreads=args.threads):
+        if 'Fail:' in return_content:
+            fail_flag = True
+            fail_message = return_content[6:]
+        else:
+            images_array[i], file_name_list[i] = return_content
     if fail_flag:
         log.error(fail_message)
         exit(1)
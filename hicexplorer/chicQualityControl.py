@@ -1,7 +1,5 @@
 import argparse
 import math
-from multiprocessing import Process, Queue
-import time
 import os
 import logging
 logging.getLogger('hicmatrix').setLevel(logging.CRITICAL)
@@ -12,8 +10,9 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
+from hicexplorer.utilities import run_tasks
+from hicexplorer.utilities import load_matrix
 from .lib import Viewpoint
 
 
@@ -133,18 +132,16 @@ def main(args=None):
     # compute for each viewpoint the sparsity and consider these as bad with a sparsity less than given.
 
     referencePointsPerThread = len(referencePoints) // args.threads
-    queue = [None] * args.threads
-    process = [None] * args.threads
     sparsity = []
     fail_flag = False
     fail_message = ''
     for j, matrix in enumerate(args.matrices):
         sparsity_local = [None] * args.threads
-        hic_ma = hm.hiCMatrix(matrix)
+        hic_ma = load_matrix(matrix)
         viewpointObj.hicMatrix = hic_ma
 
-        all_data_collected = False
-        thread_done = [False] * args.threads
+        task_arguments = []
+        task_thread = []
         for i in range(args.threads):
 
             if i < args.threads - 1:
@@ -152,42 +149,23 @@ def main(args=None):
             else:
                 referencePointsThread = referencePoints[i * referencePointsPerThread:]
             if len(referencePointsThread) == 0:
-                process[i] = None
-                queue[i] = None
                 sparsity_local[i] = []
                 continue
             else:
-                queue[i] = Queue()
-                process[i] = Process(target=compute_sparsity, kwargs=dict(
+                task_arguments.append(dict(
                     pReferencePoints=referencePointsThread,
                     pViewpointObj=viewpointObj,
-                    pArgs=args,
-                    pQueue=queue[i]
-                )
-                )
-
-                process[i].start()
-                log.debug('process started {}'.format(i))
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    sparsity_ = queue[i].get()
-                    if 'Fail:' in sparsity_:
-                        fail_flag = True
-                        fail_message = sparsity_[6:]
-                    log.debug('process computed: {}'.format(i))
-                    sparsity_local[i] = sparsity_
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+                    pArgs=args
+                ))
+                task_thread.append(i)
+
+        for task_index, sparsity_ in run_tasks(compute_sparsity, task_arguments, pThreads=args.threads):
+            i = task_thread[task_index]
+            if 'Fail:' in sparsity_:
+                fail_flag = True
+                fail_message = sparsity_[6:]
+            log.debug('process computed: {}'.format(i))
+            sparsity_local[i] = sparsity_
 
         del hic_ma
         del viewpointObj.hicMatrix
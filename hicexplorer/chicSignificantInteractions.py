@@ -3,8 +3,6 @@ import sys
 import os
 import errno
 import math
-from multiprocessing import Process, Queue
-import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -295,10 +293,7 @@ def call_multi_core(pInteractionFilesList, pArgs, pViewpointObj, pBackground, pF
     reference_points_list_significant = [None] * pArgs.threads
 
     interactionFilesPerThread = len(pInteractionFilesList) // pArgs.threads
-    all_data_collected = False
-    queue = [None] * pArgs.threads
-    process = [None] * pArgs.threads
-    thread_done = [False] * pArgs.threads
+    task_arguments = []
 
     fail_flag = False
     fail_message = ''
@@ -310,39 +305,21 @@ def call_multi_core(pInteractionFilesList, pArgs, pViewpointObj, pBackground, pF
         else:
             interactionFileListThread = pInteractionFilesList[i * interactionFilesPerThread:]
 
-        queue[i] = Queue()
-        process[i] = Process(target=compute_interaction_file, kwargs=dict(
+        task_arguments.append(dict(
             pInteractionFilesList=interactionFileListThread,
             pArgs=pArgs,
             pViewpointObj=pViewpointObj,
             pBackground=pBackground,
             pFilePath=pFilePath,
-            pResolution=pResolution,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-
-    while not all_data_collected:
-        for i in range(pArgs.threads):
-            if queue[i] is not None and not queue[i].empty():
-                background_data_thread = queue[i].get()
-                if 'Fail:' in background_data_thread:
-                    fail_flag = True
-                    fail_message = background_data_thread[6:]
-                else:
-                    significant_data_list[i], significant_key_list[i], target_data_list[i], target_key_list[i], reference_points_list_target[i], reference_points_list_significant[i] = background_data_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
+            pResolution=pResolution
+        ))
+
+    for i, background_data_thread in utilities.run_tasks(compute_interaction_file, task_arguments, pThreads=pArgs.threads):
+        if 'Fail:' in background_data_thread:
+            fail_flag = True
+            fail_message = background_data_thread[6:]
+        else:
+            significant_data_list[i], significant_key_list[i], target_data_list[i], target_key_list[i], reference_points_list_target[i], reference_points_list_significant[i] = background_data_thread
     if fail_flag:
         log.error(fail_message)
         exit(1)
@@ -2,8 +2,6 @@ import argparse
 import sys
 import os
 import errno
-from multiprocessing import Process, Queue
-import time
 import math
 import logging
 log = logging.getLogger(__name__)
@@ -11,7 +9,6 @@ log = logging.getLogger(__name__)
 import h5py
 import numpy as np
 
-import hicmatrix.HiCMatrix as hm
 from hicexplorer import utilities
 from .lib import Viewpoint
 from hicexplorer._version import __version__
@@ -200,8 +197,6 @@ def main(args=None):
 
     referencePointsPerThread = len(referencePoints) // args.threads
 
-    queue = [None] * args.threads
-    process = [None] * args.threads
     background_model = viewpointObj.readBackgroundDataFile(
         args.backgroundModelFile, args.range, args.fixateRange)
     background_model_mean_values = viewpointObj.readBackgroundDataFile(
@@ -221,17 +216,17 @@ def main(args=None):
     matrix_collection = {}
     resolution = 0
     for matrix in args.matrices:
-        hic_ma = hm.hiCMatrix(matrix)
+        hic_ma = utilities.load_matrix(matrix)
         viewpointObj.hicMatrix = hic_ma
         file_list_sample = [None] * args.threads
         interaction_data_list_sample = [None] * args.threads
 
-        all_data_collected = False
-
         if resolution == 0:
             resolution = hic_ma.getBinSize()
             interactionFileH5Object.attrs['resolution'] = resolution
 
+        task_arguments = []
+        task_thread = []
         for i in range(args.threads):
 
             if i < args.threads - 1:
@@ -243,43 +238,24 @@ def main(args=None):
                 geneListThread = gene_list[i * referencePointsPerThread:]
 
             if len(referencePointsThread) == 0:
-                process[i] = None
-                queue[i] = None
                 file_list_sample[i] = []
                 continue
-            queue[i] = Queue()
-            process[i] = Process(target=compute_viewpoint, kwargs=dict(
+            task_arguments.append(dict(
                 pViewpointObj=viewpointObj,
                 pArgs=args,
-                pQueue=queue[i],
                 pReferencePoints=referencePointsThread,
                 pGeneList=geneListThread,
                 pMatrix=matrix,
                 pBackgroundModel=background_model,
                 pBackgroundModelRelativeInteractions=background_model_mean_values
-            )
-            )
-
-            process[i].start()
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    file_list_ = queue[i].get()
-                    if 'Fail:' in file_list_:
-                        fail_flag = True
-                        fail_message = file_list_[6:]
-                    interaction_data_list_sample[i] = file_list_
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-
-            all_data_collected = True
-
-            for i in range(args.threads):
-                if process[i] is not None:
-                    all_data_collected = False
-            time.sleep(1)
+            ))
+            task_thread.append(i)
+
+        for task_index, file_list_ in utilities.run_tasks(compute_viewpoint, task_arguments, pThreads=args.threads):
+            if 'Fail:' in file_list_:
+                fail_flag = True
+                fail_message = file_list_[6:]
+            interaction_data_list_sample[task_thread[task_index]] = file_list_
 
         if fail_flag:
             log.error(fail_message)
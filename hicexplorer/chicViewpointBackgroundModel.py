@@ -1,15 +1,14 @@
 import argparse
 import math
-from multiprocessing import Process, Queue
-import time
 import logging
 log = logging.getLogger(__name__)
 
 import numpy as np
 import fit_nbinom
 
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
+from hicexplorer.utilities import run_tasks
+from hicexplorer.utilities import load_matrix
 from .lib import Viewpoint
 
 
@@ -139,19 +138,16 @@ def main(args=None):
     # - compute nbinom parameters
 
     referencePointsPerThread = len(referencePoints) // args.threads
-    queue = [None] * args.threads
-    process = [None] * args.threads
     background_model_data = None
     fail_flag = False
     fail_message = ''
 
     for matrix in args.matrices:
-        hic_ma = hm.hiCMatrix(matrix)
+        hic_ma = load_matrix(matrix)
         viewpointObj.hicMatrix = hic_ma
 
         bin_size = hic_ma.getBinSize()
-        all_data_collected = False
-        thread_done = [False] * args.threads
+        task_arguments = []
         for i in range(args.threads):
 
             if i < args.threads - 1:
@@ -159,53 +155,30 @@ def main(args=None):
             else:
                 referencePointsThread = referencePoints[i * referencePointsPerThread:]
 
-            queue[i] = Queue()
-            process[i] = Process(target=compute_background, kwargs=dict(
+            task_arguments.append(dict(
                 pReferencePoints=referencePointsThread,
                 pViewpointObj=viewpointObj,
-                pArgs=args,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    background_data_thread = queue[i].get()
-                    if 'Fail:' in background_data_thread:
-                        fail_flag = True
-                        fail_message = background_data_thread[6:]
-                        queue[i] = None
-                        process[i].join()
-                        process[i].terminate()
-                        process[i] = None
-                        thread_done[i] = True
-                        continue
-                    background_model_data_thread, relative_positions_thread = background_data_thread
-                    if background_model_data is None:
-                        background_model_data = background_model_data_thread
+                pArgs=args
+            ))
+
+        for i, background_data_thread in run_tasks(compute_background, task_arguments, pThreads=args.threads):
+            if 'Fail:' in background_data_thread:
+                fail_flag = True
+                fail_message = background_data_thread[6:]
+                continue
+            background_model_data_thread, relative_positions_thread = background_data_thread
+            if background_model_data is None:
+                background_model_data = background_model_data_thread
+            else:
+                for relativePosition in background_model_data_thread:
+                    if relativePosition in background_model_data:
+                        background_model_data[relativePosition].extend(
+                            background_model_data_thread[relativePosition])
                     else:
-                        for relativePosition in background_model_data_thread:
-                            if relativePosition in background_model_data:
-                                background_model_data[relativePosition].extend(
-                                    background_model_data_thread[relativePosition])
-                            else:
-                                background_model_data[relativePosition] = background_model_data_thread[relativePosition]
-
-                    relative_positions = relative_positions.union(
-                        relative_positions_thread)
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+                        background_model_data[relativePosition] = background_model_data_thread[relativePosition]
+
+            relative_positions = relative_positions.union(
+                relative_positions_thread)
 
         del hic_ma
         del viewpointObj.hicMatrix
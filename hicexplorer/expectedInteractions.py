@@ -0,0 +1,192 @@
+import os
+import tempfile
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+
+def distance_sums(pDistances, pValues, pNumberOfBins):
+    """
+    Sum and number of non-zero values per distance to the main diagonal, accumulated
+    with np.bincount in one pass over the values.
+
+    :param pDistances: distance |row - column| of each value
+    :param pValues: the values
+    :param pNumberOfBins: number of bins, i.e. the number of possible distances
+
+    >>> sums, counts = distance_sums(np.array([0, 1, 1, 2]), np.array([4., 2., 0., 3.]), 4)
+    >>> sums, counts
+    (array([4., 2., 3., 0.]), array([1, 1, 1, 0]))
+    """
+    sums = np.bincount(pDistances, weights=pValues, minlength=pNumberOfBins)
+    counts = np.bincount(pDistances[pValues != 0], minlength=pNumberOfBins)
+    return sums, counts
+
+
+def matrix_distance_sums(pSubmatrix):
+    """
+    Sum and number of non-zero values per distance of a sparse matrix, see distance_sums.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> distance_sums_ = matrix_distance_sums(csr_matrix(np.array([[4, 2, 0], [2, 1, 3], [0, 3, 5]])))
+    >>> distance_sums_
+    (array([10., 10.,  0.]), array([3, 4, 0]))
+    """
+    matrix = pSubmatrix.tocoo()
+    distances = np.absolute(matrix.row.astype(np.int64) - matrix.col)
+    return distance_sums(distances, matrix.data, matrix.shape[0])
+
+
+def expected_per_distance(pSums, pCounts, pMethod='mean', pGenomeLength=None, pChromosomeCount=None):
+    """
+    The expected interactions per distance from the sums and counts of distance_sums. Distances
+    without values have an expected value of 0.
+
+    :param pMethod:
+        - 'mean': the sum divided by the number of bins plus one minus the distance, as used by obs_exp_matrix
+        - 'nonzero': the mean of the non-zero values
+        - 'lieberman': the sum divided by pGenomeLength - distance * pChromosomeCount (Lieberman-Aiden 2009),
+          pGenomeLength is the number of bins of all chromosomes, the sums are of one chromosome
+
+    >>> sums, counts = np.array([4., 2., 3., 0.]), np.array([1, 1, 1, 0])
+    >>> expected_per_distance(sums, counts, 'mean')
+    array([0.8, 0.5, 1. , 0. ])
+    >>> expected_per_distance(sums, counts, 'nonzero')
+    array([4., 2., 3., 0.])
+    >>> expected_per_distance(sums, counts, 'lieberman', pGenomeLength=8, pChromosomeCount=2)
+    array([0.5       , 0.33333333, 0.75      , 0.        ])
+    """
+    if pMethod == 'mean':
+        denominator = np.arange(len(pSums) + 1, 1, -1)
+    elif pMethod == 'nonzero':
+        denominator = pCounts
+    elif pMethod == 'lieberman':
+        denominator = pGenomeLength - np.arange(len(pSums), dtype=np.float64) * pChromosomeCount
+    else:
+        raise ValueError('Unknown method for the expected interactions: {}'.format(pMethod))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.divide(pSums, denominator)
+    expected[~np.isfinite(expected)] = 0
+    return expected
+
+
+def smooth_expected(pExpected, pWindowSize):
+    """
+    Running mean of the expected values over pWindowSize distances on each side, for the
+    long distances with only a few values. The window is shortened at both ends.
+
+    >>> smooth_expected(np.array([3., 1., 2., 6.]), 1)
+    array([2., 2., 3., 4.])
+    """
+    kernel = np.ones(2 * pWindowSize + 1)
+    sums = np.convolve(pExpected, kernel, mode='same')
+    window_lengths = np.convolve(np.ones(len(pExpected)), kernel, mode='same')
+    return sums / window_lengths
+
+
+def trans_expected(pMatrix, pChromosomeBoundaries):
+    """
+    The expected inter-chromosomal interactions: the sum of the values between two chromosomes
+    divided by the number of their bin pairs.
+
+    :param pMatrix: sparse matrix of all chromosomes
+    :param pChromosomeBoundaries: (first bin, last bin + 1) per chromosome, in the order of the matrix,
+                                  e.g. hiCMatrix.chrBinBoundaries.values()
+
+    Returns an array of shape (number of chromosomes, number of chromosomes), the intra-chromosomal
+    entries on the diagonal are 0.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[5, 1, 2], [1, 5, 4], [2, 4, 5]]))
+    >>> trans_expected(matrix, [(0, 2), (2, 3)])
+    array([[0., 3.],
+           [3., 0.]])
+    """
+    sizes = np.array([end - start for start, end in pChromosomeBoundaries])
+    chromosome_of_bin = np.repeat(np.arange(len(sizes)), sizes)
+    matrix = pMatrix.tocoo()
+    row_chromosomes = chromosome_of_bin[matrix.row]
+    column_chromosomes = chromosome_of_bin[matrix.col]
+    trans = row_chromosomes != column_chromosomes
+    sums = np.bincount(row_chromosomes[trans] * len(sizes) + column_chromosomes[trans], weights=matrix.data[trans],
+                       minlength=len(sizes) ** 2).reshape(len(sizes), len(sizes))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = sums / np.outer(sizes, sizes)
+    expected[~np.isfinite(expected)] = 0
+    return expected
+
+
+class ExpectedCache():
+    """
+    The per-distance sums and counts of the chromosomes of a matrix. With a cache prefix,
+    e.g. from utilities.get_cache_prefix of the matrix file, they are stored as files, other
+    runs and tools on the same matrix file reuse them instead of computing them again.
+
+    The sums of a chromosome are those of its symmetric intra-chromosomal submatrix, as loaded
+    from the matrix file. The cache must not be used for submatrices that were changed after loading.
+
+    :param pCachePrefix: prefix of the cache files, None to keep the sums in memory only
+    """
+
+    def __init__(self, pCachePrefix=None):
+        self.cachePrefix = pCachePrefix
+        self.distanceSums = {}
+
+    def distance_sums(self, pChromosome, pSubmatrix):
+        """
+        The sums and counts per distance of the chromosome pChromosome, computed from
+        pSubmatrix if they are not cached yet.
+
+        >>> from scipy.sparse import csr_matrix
+        >>> import shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> submatrix = csr_matrix(np.array([[1., 2.], [2., 3.]]))
+        >>> ExpectedCache(os.path.join(directory, 'm')).distance_sums('chr1', submatrix)
+        (array([4., 4.]), array([2, 2]))
+        >>> sorted(os.listdir(directory))
+        ['m_chr1_expected.npz']
+
+        A cache file of a submatrix with other values is not used
+
+        >>> submatrix[0, 1] = 0
+        >>> ExpectedCache(os.path.join(directory, 'm')).distance_sums('chr1', submatrix)
+        (array([4., 2.]), array([2, 1]))
+        >>> shutil.rmtree(directory)
+        """
+        if pChromosome in self.distanceSums:
+            return self.distanceSums[pChromosome]
+        file_name = None
+        distance_sums_ = None
+        if self.cachePrefix is not None:
+            file_name = '{}_{}_expected.npz'.format(self.cachePrefix, pChromosome)
+            nnz = pSubmatrix.nnz
+            total = pSubmatrix.sum()
+            if os.path.isfile(file_name):
+                with np.load(file_name) as data:
+                    # a file of a submatrix with other bins or values, e.g. with removed masked bins
+                    # or a corrected matrix, is not used
+                    if len(data['sums']) == pSubmatrix.shape[0] and 'nnz' in data.files \
+                            and data['nnz'] == nnz and data['total'] == total:
+                        distance_sums_ = data['sums'], data['counts']
+                        log.debug('Expected interactions of {} read from {}'.format(pChromosome, file_name))
+        if distance_sums_ is None:
+            distance_sums_ = matrix_distance_sums(pSubmatrix)
+            if file_name is not None:
+                directory = os.path.dirname(file_name)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory, exist_ok=True)
+                # written to a unique temporary file first, parallel processes never read
+                # or write a partial file
+                file_descriptor, temp_file_name = tempfile.mkstemp(dir=directory or '.', suffix='.tmp')
+                try:
+                    with os.fdopen(file_descriptor, 'wb') as fh:
+                        np.savez(fh, sums=distance_sums_[0], counts=distance_sums_[1],
+                                 nnz=nnz, total=total)
+                    os.replace(temp_file_name, file_name)
+                except BaseException:
+                    if os.path.exists(temp_file_name):
+                        os.unlink(temp_file_name)
+                    raise
+        self.distanceSums[pChromosome] = distance_sums_
+        return distance_sums_
@@ -2,9 +2,10 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import load_matrix, save_matrix, read_correction_factors_only
+from hicexplorer.utilities import match_correction_factors
 import numpy as np
 import cooler
 import logging
@@ -73,12 +74,12 @@ def adjustMatrix(pArgs):
         if check_cooler(pArgs.matrix) and len(pArgs.chromosomes) == 1 and pArgs.action == 'keep':
             chromosomes_list = cooler.Cooler(pArgs.matrix).chromnames
             if pArgs.chromosomes[0] in chromosomes_list:
-                hic_matrix = hm.hiCMatrix(pArgs.matrix, pChrnameList=pArgs.chromosomes)
+                hic_matrix = load_matrix(pArgs.matrix, pApplyCorrection=False, pChrnameList=pArgs.chromosomes)
             else:
                 log.error('Chromosome not available in matrix: {} {}'.format(pArgs.matrix, pArgs.chromosomes[0]))
                 exit(1)
         else:
-            hic_matrix = hm.hiCMatrix(pArgs.matrix)
+            hic_matrix = load_matrix(pArgs.matrix, pApplyCorrection=False)
 
         chromosomes_list = list(hic_matrix.chrBinBoundaries)
         chromosomes_list_to_operate_on = []
@@ -110,7 +111,7 @@ def adjustMatrix(pArgs):
             hic_matrix.maskChromosomes(chromosomes_list_to_operate_on)
 
     elif pArgs.regions:
-        hic_matrix = hm.hiCMatrix(pArgs.matrix)
+        hic_matrix = load_matrix(pArgs.matrix, pApplyCorrection=False)
         chromosomes_list = list(hic_matrix.chrBinBoundaries)
         genomic_regions = []
         with open(pArgs.regions, 'r') as file:
@@ -160,9 +161,9 @@ def adjustMatrix(pArgs):
 
     elif pArgs.maskBadRegions:
         if check_cooler(pArgs.matrix) and len(pArgs.chromosomes) == 1 and pArgs.action == 'keep':
-            hic_matrix = hm.hiCMatrix(pArgs.matrix, pChrnameList=pArgs.chromosomes)
+            hic_matrix = load_matrix(pArgs.matrix, pApplyCorrection=False, pChrnameList=pArgs.chromosomes)
         else:
-            hic_matrix = hm.hiCMatrix(pArgs.matrix)
+            hic_matrix = load_matrix(pArgs.matrix, pApplyCorrection=False)
 
     else:
         log.info('No data to adjust given. Please specify either --chromosomes or --region parameter.')
@@ -198,4 +199,9 @@ def main(args=None):
     hic_matrix = adjustMatrix(args)
 
     if hic_matrix is not None:
-        hic_matrix.save(args.outFileName)
+        # the counts of a matrix stored with correction factors only are adjusted, the factors are kept
+        correction_factors_only = read_correction_factors_only(args.matrix) is not None
+        if correction_factors_only:
+            hic_matrix.restoreMaskedBins()
+            hic_matrix.setCorrectionFactors(match_correction_factors(args.matrix, hic_matrix.cut_intervals))
+        save_matrix(hic_matrix, args.outFileName, pCorrectionFactorsOnly=correction_factors_only)
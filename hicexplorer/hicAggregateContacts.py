@@ -818,7 +818,7 @@ def main(args=None):
     args = parse_arguments().parse_args(args)
     matplotlib.rcParams['pdf.fonttype'] = 42
 
-    ma = hm.hiCMatrix(args.matrix)
+    ma = hicexplorer.utilities.load_matrix(args.matrix)
     ma.maskBins(ma.nan_bins)
     ma.matrix.data[np.isnan(ma.matrix.data)] = 0
     ma.maskBins(ma.nan_bins)
@@ -3,6 +3,7 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 import logging
 log = logging.getLogger(__name__)
@@ -133,7 +134,7 @@ def main(args=None):
 
     args = parse_arguments().parse_args(args)
 
-    hic_ma = hm.hiCMatrix(pMatrixFile=args.matrix)
+    hic_ma = load_matrix(pMatrixFile=args.matrix)
     indices_values = []
 
     with open(args.regions, 'r') as file:
@@ -31,12 +31,22 @@ def parse_arguments(args=None):
     parserRequired = parser.add_argument_group('Required arguments')
 
     # define the arguments
-    parserRequired.add_argument('--samFiles', '-s',
-                                help='The two PE alignment sam files to process',
-                                metavar='two sam files',
-                                nargs=2,
-                                type=argparse.FileType('r'),
-                                required=True)
+    parserInput = parserRequired.add_mutually_exclusive_group(required=True)
+    parserInput.add_argument('--samFiles', '-s',
+                             help='The two PE alignment sam files to process',
+                             metavar='two sam files',
+                             nargs=2,
+                             type=argparse.FileType('r'))
+
+    parserInput.add_argument('--pairsFile', '-p',
+                             help='Instead of two sam files, a file in the 4DN pairs format can be used, plain text or '
+                             'compressed with gzip or bgzip (e.g. indexed by pairix). The alignments are not decoded again, '
+                             'which makes it fast to build a matrix with another resolution or other filters. '
+                             'The chromosome sizes are taken from the header of the file or from --chromosomeSizes. '
+                             'The pairs file does not contain the read sequences and alignment lengths: the reads are '
+                             'placed at their 5\' position, dangling ends are not detected and no bam file is written. '
+                             'If the columns mapq1 and mapq2 are present, --minMappingQuality is applied.',
+                             metavar='pairs file')
 
     parserRequired.add_argument('--outFileName', '-o',
                                 help='Output file name for the Hi-C matrix.',
@@ -70,7 +80,8 @@ def parse_arguments(args=None):
                            help='Size in bp for the bins. The bin size depends '
                            'on the depth of sequencing. Use a larger bin size for '
                            'libraries sequenced with lower depth. If not given, matrices of restriction site resolution will be built. '
-                           'Optionally for mcool file format: Define multiple resolutions which are all a multiple of the first value. '
+                           'Optionally for mcool file format: Define multiple resolutions which are all a multiple of the smallest value. '
+                           'The reads are processed once at the smallest bin size and the other resolutions are computed by summing its bins. '
                            ' Example: --binSize 10000 20000 50000 will create a mcool file formate containing the three defined resolutions.',
                            type=int,
                            nargs='+',
@@ -127,8 +138,9 @@ def parse_arguments(args=None):
                            )
     parserOpt.add_argument('--threads',
                            help='Number of threads. Using the python multiprocessing module. '
-                           'One master process which is used to read the input file into the buffer and one process which is merging '
-                           'the output bam files of the processes into one output bam file. All other threads do the actual computation. '
+                           'Two processes decode the two input files in parallel, each with htslib decompression threads for half of the threads, '
+                           'the master process assembles the read pairs into buffers '
+                           'and merges the results of the other processes, which do the actual computation. '
                            'Minimum value for the \'--thread\' parameter is 2. '
                            'The usage of 8 threads is optimal if you have an HDD. A higher number of threads is only '
                            'useful if you have a fast SSD. Have in mind that the performance of hicBuildMatrix is influenced by '
@@ -172,6 +184,35 @@ def parse_arguments(args=None):
                            'get an estimation of the duplicated reads. ',
                            action='store_true'
                            )
+    parserOpt.add_argument('--duplicationCheckMemory',
+                           help='Maximal memory in MB used by the index of the duplication check. '
+                           'Without this option the index is kept in memory, it needs around 16 bytes per valid read pair. '
+                           'If the limit is reached, the index is written in sorted parts to the temporary folder '
+                           '(as defined by the TMPDIR environment variable, or \'<outFileName>.checkpoint\' if checkpoints are written) '
+                           'and only a small bloom filter is kept in memory.',
+                           required=False,
+                           type=int)
+    parserOpt.add_argument('--matrixMemory',
+                           help='Maximal memory in MB used to accumulate the contacts of the matrix. '
+                           'Without this option all contacts are summed up in memory. If the limit is reached, '
+                           'the summed contacts are written in sorted parts to the temporary folder '
+                           '(as defined by the TMPDIR environment variable, or \'<outFileName>.checkpoint\' if checkpoints are written) '
+                           'and merged when all reads are processed. '
+                           'A cool or mcool file is written from the merged parts, the whole matrix is only kept '
+                           'in memory to save an h5 file.',
+                           required=False,
+                           type=int)
+    parserOpt.add_argument('--checkpointInterval',
+                           help='Write a checkpoint of the computation every given number of minutes to the folder '
+                           '\'<outFileName>.checkpoint\'. It stores the contacts, the QC counters, the index of the '
+                           'duplication check and the position in the input files. The folder is removed after a successful run.',
+                           required=False,
+                           type=float)
+    parserOpt.add_argument('--resume',
+                           help='Continue a killed run from its last checkpoint, see --checkpointInterval. '
+                           'All parameters need to be the same as for the killed run. '
+                           'Checkpoints are written every 30 minutes if --checkpointInterval is not given.',
+                           action='store_true')
     parserOpt.add_argument('--chromosomeSizes', '-cs',
                            help=('File with the chromosome sizes for your genome. A tab-delimited two column layout \"chr_name size\" is expected'
                                  'Usually the sizes can be determined from the SAM/BAM input files, however, '
@@ -212,7 +253,9 @@ def main(args=None):
                  pDoTestRun=args.doTestRun, pOutBam=args.outBam, pChromosomeSizes=args.chromosomeSizes, pRestrictionCutFile=None,
                  pRegion=args.region, pBinSize=args.binSize, pInputBufferSize=args.inputBufferSize, pMinDistance=None,
                  pDoTestRunLines=args.doTestRunLines, pSkipDuplicationCheck=args.skipDuplicationCheck, pMinMappingQuality=args.minMappingQuality,
-                 pKeepSelfCircles=args.keepSelfCircles, pKeepSelfLigation=None, pGenomeAssembly=args.genomeAssembly)
+                 pKeepSelfCircles=args.keepSelfCircles, pKeepSelfLigation=None, pGenomeAssembly=args.genomeAssembly,
+                 pDuplicationCheckMemory=args.duplicationCheckMemory, pPairsFile=args.pairsFile,
+                 pMatrixMemory=args.matrixMemory, pCheckpointInterval=args.checkpointInterval, pResume=args.resume)
 
 
 class Tester(object):
@@ -4,6 +4,7 @@ warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 import numpy as np
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 
 import logging
@@ -59,8 +60,8 @@ def main(args=None):
     if args.operation not in ['diff', 'ratio', 'log2ratio']:
         exit("Operation not found. Please use 'diff', 'ratio' or 'log2ratio'.")
 
-    hic1 = hm.hiCMatrix(args.matrices[0])
-    hic2 = hm.hiCMatrix(args.matrices[1])
+    hic1 = load_matrix(args.matrices[0])
+    hic2 = load_matrix(args.matrices[1])
 
     if hic1.matrix.shape != hic2.matrix.shape:
         exit("The two matrices have different size. Use matrices having the same resolution and created using"
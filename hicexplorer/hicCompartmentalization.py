@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 
 import logging
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 from hicexplorer.utilities import convertNansToZeros
 matplotlib.use('Agg')
@@ -202,7 +203,7 @@ def main(args=None):
     output_matrices = []
     labels = []
     for matrix in args.obsexp_matrices:
-        obs_exp = hm.hiCMatrix(matrix)
+        obs_exp = load_matrix(matrix)
         pc1["bin_id"] = pc1.apply(lambda row: get_indices(obs_exp, row), axis=1)
         name = ".".join(matrix.split("/")[-1].split(".")[0:-1])
         labels.append(name)
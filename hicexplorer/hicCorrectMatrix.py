@@ -1,17 +1,24 @@
 import warnings
 import sys
+import traceback
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 from past.builtins import zip
-from scipy.sparse import lil_matrix
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from queue import SimpleQueue
 
 from hicexplorer.iterativeCorrection import iterativeCorrection
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import run_tasks
+from hicexplorer.utilities import load_matrix, save_matrix, read_correction_factors_only
+from hicexplorer.utilities import read_bins
+from hicexplorer.lib import coolerBalancing
+import cooler
+import tables
 
 # Knight-Ruiz algorithm:
 from krbalancing import *
@@ -156,8 +163,8 @@ def correct_subparser():
 
     parserRequired.add_argument('--outFileName', '-o',
                                 help='File name to save the resulting matrix. '
-                                'The output is a .h5 file.',
-                                required=True)
+                                'The output is a .h5 file. Not used with --inPlace.',
+                                required=False)
 
     parserOpt = parser.add_argument_group('Optional arguments')
 
@@ -238,6 +245,54 @@ def correct_subparser():
     parserOpt.add_argument('--filteredBed',
                            help='Print bins filtered our by  --filterThreshold to this file')
 
+    parserOpt.add_argument('--correctionFactorsOnly',
+                           help='Do not correct the counts, store them unchanged '
+                           'together with the correction factors: for cool files as '
+                           '\'weight\' column, for h5 files as \'correction_factors\'. '
+                           'The factors are multiplicative weights, HiCExplorer applies '
+                           'them while loading the matrix, only to the loaded region.',
+                           action='store_true')
+
+    parserOpt.add_argument('--singlePrecision',
+                           help='Store the counts as 32 bit floats during the '
+                           'correction and in the corrected matrix. This halves '
+                           'the memory of the counts, the bias factors are still '
+                           'computed with 64 bit. Only for ICE!',
+                           action='store_true')
+
+    parserOpt.add_argument('--inPlace',
+                           help='Only for cool files: balance the matrix without '
+                           'loading it, the pixels are read in chunks in every '
+                           'iteration and only the bias vector is kept in memory. '
+                           'The result is written as \'weight\' column to the bins '
+                           'table of --matrix, the pixels are not changed. '
+                           'The weight is multiplicative and nan for filtered bins, '
+                           'as cooler expects it. --transCutoff is not supported and '
+                           'for KR --perchr neither.',
+                           action='store_true')
+
+    parserOpt.add_argument('--initialWeights',
+                           help='Start ICE or KR from the weights of a previous '
+                           'balancing instead of ones, e.g. after changing '
+                           '--filterThreshold or adding a sample to the matrix. '
+                           'This needs less iterations. Either a cool file with a '
+                           '\'weight\' column (e.g. from --inPlace or '
+                           '--correctionFactorsOnly), an h5 file stored with '
+                           '--correctionFactorsOnly or a .npy file with one weight '
+                           'per bin of --matrix. The weights are multiplicative as '
+                           'in cool files and matched by the bin coordinates. '
+                           'Bins without weight start from the mean weight.',
+                           required=False)
+
+    parserOpt.add_argument('--threads',
+                           help='Number of threads used to compute the marginal '
+                           'sums of the iterative correction. With --perchr the '
+                           'number of chromosomes that are corrected in parallel '
+                           'with ICE. (Default: %(default)s).',
+                           required=False,
+                           default=4,
+                           type=int)
+
     parserOpt.add_argument('--verbose',
                            help='Print processing status.',
                            action='store_true')
@@ -246,14 +301,143 @@ def correct_subparser():
     return parser
 
 
-def iterative_correction(matrix, args):
+def iterative_correction(matrix, args, initial_weights=None):
+    initial_bias = None
+    if initial_weights is not None:
+        initial_bias = 1.0 / initial_weights
     corrected_matrix, correction_factors = iterativeCorrection(matrix,
+                                                               v=initial_bias,
                                                                M=args.iterNum,
-                                                               verbose=args.verbose)
+                                                               verbose=args.verbose,
+                                                               threads=args.threads,
+                                                               dtype=np.float32 if args.singlePrecision else np.float64)
 
     return corrected_matrix, correction_factors
 
 
+def correct_chromosome(pMatrix, pChrRange, pArgs, pQueue, pInitialWeights=None):
+    """
+    Balances the submatrix of one chromosome. Puts the corrected submatrix,
+    or None if it is not needed, and the correction factors into pQueue.
+    """
+    try:
+        chr_submatrix = pMatrix[pChrRange[0]:pChrRange[1], pChrRange[0]:pChrRange[1]]
+        if pArgs.correctionMethod == 'ICE':
+            pArgs.threads = 1
+            corrected_submatrix, correction_factors = iterative_correction(chr_submatrix, pArgs, pInitialWeights)
+            if pArgs.correctionFactorsOnly:
+                corrected_submatrix = None
+            pQueue.put((corrected_submatrix, correction_factors))
+            return
+        # Set the kr matrix along with its correction factors vector
+        assert (pArgs.correctionMethod == 'KR')
+        if pInitialWeights is not None:
+            correction_factors, balancing_vector = knight_ruiz_from_weights(chr_submatrix, pInitialWeights)
+            if pArgs.correctionFactorsOnly:
+                pQueue.put((None, correction_factors))
+                return
+            corrected_submatrix = None
+            if pArgs.outFileName.endswith('.h5'):
+                corrected_submatrix = apply_weights(chr_submatrix, correction_factors)
+            pQueue.put((corrected_submatrix, balancing_vector))
+            return
+        log.debug("Loading a float sparse matrix for KR balancing")
+        kr = kr_balancing(chr_submatrix.shape[0],
+                          chr_submatrix.shape[1],
+                          chr_submatrix.count_nonzero(),
+                          chr_submatrix.indptr.astype(
+                              np.int64, copy=False),
+                          chr_submatrix.indices.astype(
+                              np.int64, copy=False),
+                          chr_submatrix.data.astype(np.float64, copy=False))
+        kr.computeKR()
+        if pArgs.correctionFactorsOnly:
+            # the factors of the matrix that would be stored otherwise
+            pQueue.put((None, kr.get_normalisation_vector(True).todense()))
+            return
+        corrected_submatrix = None
+        if pArgs.outFileName.endswith('.h5'):
+            corrected_submatrix = kr.get_normalised_matrix(True)
+        # correction_factors.append(np.true_divide(1,
+        #                                          kr.get_normalisation_vector(False).todense()))
+        pQueue.put((corrected_submatrix, kr.get_normalisation_vector(False).todense()))
+    except Exception as exp:
+        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
+
+
+def knight_ruiz_from_weights(pMatrix, pInitialWeights):
+    """
+    KR balancing of pMatrix that starts from the weights of a previous balancing.
+    Returns the vector that balances the matrix to its original sum, as
+    kr_balancing.get_normalisation_vector(True), and the one that balances it to
+    a doubly stochastic matrix, as get_normalisation_vector(False).
+    """
+    row_sum = np.asarray(pMatrix.sum(axis=1)).flatten()
+    balancing_vector, converged = coolerBalancing.knight_ruiz(pMatrix.dot, row_sum == 0,
+                                                              pInitialVector=pInitialWeights)
+    if not converged:
+        log.warning('The balancing did not converge.')
+    balancing_vector = np.nan_to_num(balancing_vector)
+    scaling = np.sqrt(row_sum.sum() / balancing_vector.dot(pMatrix.dot(balancing_vector)))
+    return balancing_vector * scaling, balancing_vector
+
+
+def apply_weights(pMatrix, pWeights):
+    # pMatrix[i, j] * pWeights[i] * pWeights[j]
+    return (diags(pWeights) @ pMatrix @ diags(pWeights)).tocsr()
+
+
+def read_initial_weights(pWeightsFile, pMatrixFile, pBins):
+    """
+    Reads the multiplicative weights of a previous balancing for the bins pBins,
+    given as (chromosome, start, end, ...). The weights of a .npy file are
+    the ones of the bins of pMatrixFile. Bins without a weight, e.g. because
+    they were filtered before, get the mean weight.
+    """
+    if pWeightsFile.endswith('.npy'):
+        weights = np.load(pWeightsFile).astype(np.float64).flatten()
+        weight_bins = read_bins(pMatrixFile)
+        if len(weights) != len(weight_bins):
+            log.error('{} contains {} weights, but the matrix has {} bins.'.format(pWeightsFile, len(weights), len(weight_bins)))
+            sys.exit(1)
+    elif check_cooler(pWeightsFile):
+        with cooler.Cooler(pWeightsFile).open('r') as cooler_group:
+            if 'weight' not in cooler_group['bins']:
+                log.error('{} has no \'weight\' column.'.format(pWeightsFile))
+                sys.exit(1)
+            weights = cooler_group['bins']['weight'][:].astype(np.float64)
+            if cooler_group['bins']['weight'].attrs.get('divisive_weights', False):
+                weights = 1.0 / weights
+        weight_bins = read_bins(pWeightsFile)
+    else:
+        weights = read_correction_factors_only(pWeightsFile)
+        if weights is None:
+            log.error('{} was not stored with --correctionFactorsOnly.'.format(pWeightsFile))
+            sys.exit(1)
+        weight_bins = read_bins(pWeightsFile)
+
+    weight_per_bin = dict(zip(weight_bins, weights))
+    initial_weights = np.array([weight_per_bin.get((toString(bin_[0]), int(bin_[1]), int(bin_[2])), np.nan)
+                                for bin_ in pBins], dtype=np.float64)
+    valid = np.isfinite(initial_weights) & (initial_weights > 0)
+    if not valid.any():
+        log.error('{} has no weights for the bins of the matrix.'.format(pWeightsFile))
+        sys.exit(1)
+    log.info('{} of {} bins start from a previous weight'.format(np.sum(valid), len(valid)))
+    initial_weights[~valid] = initial_weights[valid].mean()
+    return initial_weights
+
+
+def run_tasks_sequentially(pTarget, pTaskArguments, pQueueArgumentName='pQueue'):
+    """
+    Same interface as utilities.run_tasks, but all tasks are run in the main process.
+    """
+    for task_index, kwargs in enumerate(pTaskArguments):
+        queue = SimpleQueue()
+        pTarget(**dict(kwargs, **{pQueueArgumentName: queue}))
+        yield task_index, queue.get()
+
+
 def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
     """ try to fill-in the failed_bins the matrix by adding the
     average values of the neighboring rows and cols. The idea
@@ -267,11 +451,12 @@ def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
 
     """
     log.debug("starting fill gaps")
-    mat_size = hic_ma.matrix.shape[0]
-    fill_ma = hic_ma.matrix.copy().tolil()
+    matrix = hic_ma.matrix.tocsr()
+    mat_size = matrix.shape[0]
+    failed_bins = np.asarray(failed_bins, dtype=np.int64)
     if fill_contiguous is True:
         discontinuous_failed = failed_bins
-        consecutive_failed_idx = np.array([])
+        consecutive_failed_idx = np.array([], dtype=np.int64)
     else:
         # find stretches of consecutive failed regions
         consecutive_failed_idx = np.flatnonzero(np.diff(failed_bins) == 1)
@@ -280,70 +465,160 @@ def fill_gaps(hic_ma, failed_bins, fill_contiguous=False):
         # for [1,2,5,10] the np.diff is [1,3,5]. The consecutive id list
         # is [0], for '1', in the original list, but we are missing the '2'
         # thats where the consecutive_failed_idx+1 comes.
-        consecutive_failed_idx = np.unique(np.sort(
-            np.concatenate([consecutive_failed_idx,
-                            consecutive_failed_idx + 1])))
+        consecutive_failed_idx = np.unique(np.concatenate([consecutive_failed_idx,
+                                                           consecutive_failed_idx + 1]))
         # find the failed regions that are not consecutive
-        discontinuous_failed = [x for idx, x in enumerate(failed_bins)
-                                if idx not in consecutive_failed_idx]
+        discontinuous_failed = np.delete(failed_bins, consecutive_failed_idx)
 
     log.debug("Filling {} failed bins\n".format(
         len(discontinuous_failed)))
 
-    """
-    for missing_bin in discontinuous_failed:
-        if 0 < missing_bin < mat_size - 1:
-            for idx in range(1, mat_size - 2):
-                if idx % 100 == 0:
-                    log.info(".")
-                # the new row value is the mean between the upper
-                # and lower bins corresponding to the same diagonal
-                fill_ma[missing_bin, idx :] = \
-                    (hic_ma.matrix[missing_bin-1, idx-1] +
-                     hic_ma.matrix[missing_bin+1, idx+1]) / 2
-
-                # same for cols
-                fill_ma[idx, missing_bin] = \
-                    (hic_ma.matrix[idx-1, missing_bin-1] +
-                     hic_ma.matrix[idx+1, missing_bin+1]) / 2
+    filled = np.unique(discontinuous_failed[(discontinuous_failed > 0) & (discontinuous_failed < mat_size - 1)])
+    is_filled = np.zeros(mat_size, dtype=bool)
+    is_filled[filled] = True
+    inner = np.zeros(mat_size, dtype=bool)
+    inner[1:mat_size - 1] = True
+
+    # the new row value is the mean between the upper and lower rows
+    # of the same diagonal: fill[b, j] = (matrix[b - 1, j - 1] + matrix[b + 1, j + 1]) / 2
+    upper = matrix[filled - 1].tocoo()
+    lower = matrix[filled + 1].tocoo()
+    # same for cols, the cells of the filled rows have their value already
+    matrix_csc = matrix.tocsc()
+    left = matrix_csc[:, filled - 1].tocoo()
+    right = matrix_csc[:, filled + 1].tocoo()
+    fill_rows = np.concatenate([filled[upper.row], filled[lower.row], left.row + 1, right.row - 1])
+    fill_cols = np.concatenate([upper.col + 1, lower.col - 1, filled[left.col], filled[right.col]])
+    fill_values = np.concatenate([upper.data, lower.data, left.data, right.data]) / 2
+    in_col_part = np.arange(len(fill_rows)) >= upper.nnz + lower.nnz
+    # only the inner part of the matrix is filled
+    keep = (fill_rows >= 1) & (fill_rows < mat_size - 1) & (fill_cols >= 1) & (fill_cols < mat_size - 1)
+    keep[keep & in_col_part] = ~is_filled[fill_rows[keep & in_col_part]]
+    fill_part = coo_matrix((fill_values[keep], (fill_rows[keep], fill_cols[keep])), shape=matrix.shape).tocsr()
+    fill_part.eliminate_zeros()
+    fill_part = fill_part.tocoo()
+
+    # the original values of the filled rows and cols are replaced
+    original = matrix.tocoo()
+    replaced = (is_filled[original.row] & inner[original.col]) | (is_filled[original.col] & inner[original.row])
+    rows = np.concatenate([original.row[~replaced], fill_part.row])
+    cols = np.concatenate([original.col[~replaced], fill_part.col])
+    values = np.concatenate([original.data[~replaced], fill_part.data])
+
+    # identify the intersection points of the failed regions because they
+    # neighbors get wrong values. The fill value is the average over the
+    # neighbors that do have a value.
+    bin_a, bin_b = np.meshgrid(filled, filled, indexing='ij')
+    bin_a = bin_a.flatten()
+    bin_b = bin_b.flatten()
+    if len(bin_a) > 0:
+        fill_value = np.mean([np.asarray(matrix[bin_a - 1, bin_b - 1]).flatten(),
+                              np.asarray(matrix[bin_a - 1, bin_b + 1]).flatten(),
+                              np.asarray(matrix[bin_a + 1, bin_b - 1]).flatten(),
+                              np.asarray(matrix[bin_a + 1, bin_b + 1]).flatten()], axis=0)
+        target_rows = np.stack([bin_a - 1, bin_a + 1, bin_a, bin_a], axis=1).flatten()
+        target_cols = np.stack([bin_b, bin_b, bin_b - 1, bin_b + 1], axis=1).flatten()
+        target_values = np.repeat(fill_value, 4)
+        # a cell set for several intersections keeps the last value
+        target_keys = target_rows * mat_size + target_cols
+        _, last = np.unique(target_keys[::-1], return_index=True)
+        last = len(target_keys) - 1 - last
+        overwritten = np.isin(rows * mat_size + cols, target_keys[last])
+        last = last[target_values[last] != 0]
+        rows = np.concatenate([rows[~overwritten], target_rows[last]])
+        cols = np.concatenate([cols[~overwritten], target_cols[last]])
+        values = np.concatenate([values[~overwritten], target_values[last]])
+
+    fill_ma = coo_matrix((values, (rows, cols)), shape=matrix.shape).tocsr()
+    # return the matrix and the bins that continue to be failed regions
+    return fill_ma, np.sort(failed_bins[consecutive_failed_idx])
 
+
+def get_chromosome_ids(hic_ma):
+    """
+    Returns per bin the index of its chromosome in hic_ma.getChrNames().
     """
-    for missing_bin in discontinuous_failed:
-        if 0 < missing_bin < mat_size - 1:
-            # the new row value is the mean between the upper
-            # and lower rows
-            fill_ma[missing_bin, 1:mat_size - 1] = \
-                (hic_ma.matrix[missing_bin - 1, :mat_size - 2] +
-                 hic_ma.matrix[missing_bin + 1, 2:]) / 2
-
-            # same for cols
-            fill_ma[1:mat_size - 1, missing_bin] = \
-                (hic_ma.matrix[:mat_size - 2, missing_bin - 1] +
-                 hic_ma.matrix[2:, missing_bin + 1]) / 2
+    chromosome_ids = np.zeros(hic_ma.matrix.shape[0], dtype=np.int64)
+    for chromosome_id, chrname in enumerate(hic_ma.getChrNames()):
+        chr_range = hic_ma.getChrBinRange(chrname)
+        chromosome_ids[chr_range[0]:chr_range[1]] = chromosome_id
+    return chromosome_ids
 
-    # identify the intersection points of the failed regions because they
-    # neighbors get wrong values
-    for bin_a in discontinuous_failed:
-        for bin_b in discontinuous_failed:
-            if 0 < bin_a < mat_size and \
-                    0 < bin_b < mat_size:
-                # the fill value is the average over the
-                # neighbors that do have a value
-
-                fill_value = np.mean([
-                    hic_ma.matrix[bin_a - 1, bin_b - 1],
-                    hic_ma.matrix[bin_a - 1, bin_b + 1],
-                    hic_ma.matrix[bin_a + 1, bin_b - 1],
-                    hic_ma.matrix[bin_a + 1, bin_b + 1],
-                ])
-
-                fill_ma[bin_a - 1, bin_b] = fill_value
-                fill_ma[bin_a + 1, bin_b] = fill_value
-                fill_ma[bin_a, bin_b - 1] = fill_value
-                fill_ma[bin_a, bin_b + 1] = fill_value
 
-    # return the matrix and the bins that continue to be failed regions
-    return fill_ma.tocsr(), np.sort(failed_bins[consecutive_failed_idx])
+def marginal_statistics(matrix, chromosome_ids=None, chunk_size=10000000):
+    """
+    Computes the row sums and the diagonal of a csr matrix in one pass over
+    its indptr, without slicing the matrix. nan values count as zero. If
+    chromosome_ids are given, only the counts within the chromosome of a bin
+    are summed. The rows are processed in chunks of about chunk_size elements.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[1, 2, 3], [2, 4, 5], [3, 5, np.nan]]))
+    >>> marginal_statistics(matrix)
+    (array([ 6., 11.,  8.]), array([1., 4., 0.]))
+    >>> marginal_statistics(matrix, np.array([0, 0, 1]))
+    (array([3., 6., 0.]), array([1., 4., 0.]))
+    """
+    size = matrix.shape[0]
+    if chromosome_ids is None and not np.isnan(matrix.data).any():
+        return np.asarray(matrix.sum(axis=1), dtype=np.float64).flatten(), matrix.diagonal().astype(np.float64)
+    if chromosome_ids is not None and size > 0:
+        # smaller integers make the per element lookups faster
+        chromosome_ids = chromosome_ids.astype(np.min_scalar_type(chromosome_ids.max()))
+    row_sum = np.zeros(size, dtype=np.float64)
+    diagonal = np.zeros(size, dtype=np.float64)
+    boundaries = np.unique(np.concatenate([np.searchsorted(matrix.indptr, np.arange(0, matrix.nnz, chunk_size)) - 1,
+                                           [size]]).clip(0, size))
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        first, last = matrix.indptr[start], matrix.indptr[end]
+        data = matrix.data[first:last]
+        if np.isnan(data).any():
+            data = np.where(np.isnan(data), 0, data)
+        if chromosome_ids is not None:
+            row_chromosome = np.repeat(chromosome_ids[start:end], np.diff(matrix.indptr[start:end + 1]))
+            data = data * (row_chromosome == chromosome_ids[matrix.indices[first:last]])
+        chunk = csr_matrix((data, matrix.indices[first:last], matrix.indptr[start:end + 1] - first),
+                           shape=(end - start, size))
+        row_sum[start:end] = np.asarray(chunk.sum(axis=1)).flatten()
+        diagonal[start:end] = chunk.diagonal(k=start)
+    return row_sum, diagonal
+
+
+def modified_zscores(values, groups=None):
+    """
+    The modified z-scores of MAD, computed for each group separately but for
+    all groups at once. groups are small non negative integers, e.g. the
+    chromosome ids.
+
+    >>> values = np.array([1., 2., 3., 4., 100., 0., 10., 20., 30.])
+    >>> groups = np.array([0, 0, 0, 0, 0, 1, 1, 1, 1])
+    >>> np.allclose(modified_zscores(values, groups)[:5], MAD(values[:5]).get_motified_zscores())
+    True
+    """
+    if groups is None:
+        groups = np.zeros(len(values), dtype=np.int64)
+    number_of_groups = groups.max() + 1 if len(groups) > 0 else 0
+    positive = values > 0
+    median = _group_median(values[positive], groups[positive], number_of_groups)[groups]
+    diff = values - median
+    med_abs_deviation = _group_median(np.abs(diff), groups, number_of_groups)[groups]
+    return np.multiply(0.6745, np.divide(diff, med_abs_deviation))
+
+
+def _group_median(values, groups, number_of_groups):
+    # median per group by one sort of all values, nan for empty groups
+    if number_of_groups == 1:
+        return np.array([np.median(values)])
+    order = np.argsort(values)
+    order = order[np.argsort(groups[order], kind='stable')]
+    sorted_values = values[order]
+    counts = np.bincount(groups, minlength=number_of_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    median = np.full(number_of_groups, np.nan)
+    non_empty = counts > 0
+    median[non_empty] = (sorted_values[starts[non_empty] + (counts[non_empty] - 1) // 2] +
+                         sorted_values[starts[non_empty] + counts[non_empty] // 2]) / 2
+    return median
 
 
 class MAD(object):
@@ -504,14 +779,14 @@ def plot_total_contact_dist(hic_ma, args):
         grids = gridspec.GridSpec(num_rows, num_cols)
         fig = plt.figure(figsize=(6 * num_cols, 5 * num_rows))
         ax = {}
+        # the sums within the chromosome of all bins at once
+        row_sums, diagonal = marginal_statistics(hic_ma.matrix, get_chromosome_ids(hic_ma))
+        row_sums -= diagonal
         for plot_num, chrname in enumerate(chroms):
             log.info("Plotting chromosome {}".format(chrname))
 
             chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            row_sum = row_sum - chr_submatrix.diagonal()
+            row_sum = row_sums[chr_range[0]:chr_range[1]]
             mad = MAD(row_sum)
             modified_z_score = mad.get_motified_zscores()
 
@@ -527,8 +802,8 @@ def plot_total_contact_dist(hic_ma, args):
             ax[chrname].set_title(chrname)
     else:
         fig = plt.figure()
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        row_sum = row_sum - hic_ma.matrix.diagonal()
+        row_sum, diagonal = marginal_statistics(hic_ma.matrix)
+        row_sum = row_sum - diagonal
         mad = MAD(row_sum)
         modified_z_score = mad.get_motified_zscores()
 
@@ -552,44 +827,127 @@ def filter_by_zscore(hic_ma, lower_threshold, upper_threshold, perchr=False):
 
     """
     log.info("filtering by z-score")
-    to_remove = []
+    chromosome_ids = get_chromosome_ids(hic_ma) if perchr else None
+    row_sum, diagonal = marginal_statistics(hic_ma.matrix, chromosome_ids)
+    # subtract from row sum, the diagonal
+    # to account for interactions with other bins
+    # and not only self interactions that are the dominant count
+    row_sum = row_sum - diagonal
+    modified_z_score = modified_zscores(row_sum, chromosome_ids)
+    is_outlier = (modified_z_score < lower_threshold) | (modified_z_score > upper_threshold)
     if perchr:
-        for chrname in list(hic_ma.interval_trees):
-            chr_range = hic_ma.getChrBinRange(chrname)
-            chr_submatrix = hic_ma.matrix[chr_range[0]:chr_range[1],
-                                          chr_range[0]:chr_range[1]]
-
-            # replace nan values by zero
-            chr_submatrix.data[np.isnan(chr_submatrix.data)] = 0
-            row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten()
-            # subtract from row sum, the diagonal
-            # to account for interactions with other bins
-            # and not only self interactions that are the dominant count
-            row_sum = row_sum - chr_submatrix.diagonal()
-            mad = MAD(row_sum)
-            problematic = np.flatnonzero(
-                mad.is_outlier(lower_threshold, upper_threshold))
-
-            # because the problematic indices are specific for the given chromosome
-            # they need to be updated to match the large matrix indices
-            problematic += chr_range[0]
+        removed_per_chromosome = np.bincount(chromosome_ids[is_outlier], minlength=len(hic_ma.getChrNames()))
+        for chrname in np.array(hic_ma.getChrNames())[removed_per_chromosome == 0]:
+            log.warn("Warning. No bins removed for chromosome {} using thresholds {} {}"
+                     "\n".format(chrname, lower_threshold, upper_threshold))
+    return sorted(np.flatnonzero(is_outlier))
 
-            if len(problematic) == 0:
-                log.warn("Warning. No bins removed for chromosome {} using thresholds {} {}"
-                         "\n".format(chrname, lower_threshold, upper_threshold))
 
-            to_remove.extend(problematic)
+def filter_by_zscore_cooler(row_sum, mask, lower_threshold, upper_threshold, chromosome_ids=None):
+    """
+    Same as filter_by_zscore for the row sums (without the diagonal) of a
+    matrix that is not loaded. Masked bins are not considered.
+    """
+    log.info("filtering by z-score")
+    indices = np.flatnonzero(~mask)
+    groups = None if chromosome_ids is None else chromosome_ids[indices]
+    modified_z_score = modified_zscores(row_sum[indices], groups)
+    is_outlier = (modified_z_score < lower_threshold) | (modified_z_score > upper_threshold)
+    if chromosome_ids is not None:
+        for chromosome_id in np.setdiff1d(groups, groups[is_outlier]):
+            log.warn("Warning. No bins removed for chromosome id {} using thresholds {} {}"
+                     "\n".format(chromosome_id, lower_threshold, upper_threshold))
+    return sorted(indices[is_outlier])
+
+
+def correct_cooler_in_place(args):
+    """
+    Balances a cool file without loading the matrix and stores the result
+    as 'weight' column of its bins table.
+    """
+    if not check_cooler(args.matrix):
+        log.error('--inPlace is only supported for cool files.')
+        sys.exit(1)
+    if args.transCutoff:
+        log.error('--transCutoff is not supported with --inPlace.')
+        sys.exit(1)
+    if args.perchr and args.correctionMethod == 'KR':
+        log.error('--perchr is not supported for KR with --inPlace.')
+        sys.exit(1)
+    if args.correctionMethod == 'ICE' and not args.filterThreshold:
+        log.error('min and max filtering thresholds should be set')
+        sys.exit(1)
+
+    cooler_object = cooler.Cooler(args.matrix)
+    with cooler_object.open('r') as cooler_group:
+        chromosome_ids = cooler_group['bins']['chrom'][:]
+        selected = np.ones(len(chromosome_ids), dtype=bool)
+        if args.chromosomes:
+            chromosome_names = list(cooler_object.chromnames)
+            for chromosome in toString(args.chromosomes):
+                if chromosome not in chromosome_names:
+                    log.error('Chromosome {} is not part of the matrix.'.format(chromosome))
+                    sys.exit(1)
+            selected = np.isin(chromosome_ids, [chromosome_names.index(chromosome)
+                                                for chromosome in toString(args.chromosomes)])
+
+        # reading all pixels once gives the largest count for the divergence check of the correction
+        all_pixels = coolerBalancing.PixelTable(cooler_group)
+        row_sum, diagonal = all_pixels.dot_and_diagonal(selected.astype(np.float64))
+        mask = ~selected | (row_sum == 0)
+        log.info("Removing {} zero value bins".format(np.sum(selected & (row_sum == 0))))
+
+        initial_weights = None
+        if args.initialWeights:
+            initial_weights = read_initial_weights(args.initialWeights, args.matrix, read_bins(args.matrix))
+
+        pixels = coolerBalancing.PixelTable(cooler_group, pSkipDiagonal=args.skipDiagonal,
+                                            pChromosomeIds=chromosome_ids if args.perchr else None)
+        if args.correctionMethod == 'ICE':
+            if args.perchr:
+                row_sum, diagonal = coolerBalancing.PixelTable(cooler_group, pChromosomeIds=chromosome_ids).dot_and_diagonal((~mask).astype(np.float64))
+            outlier_regions = filter_by_zscore_cooler(row_sum - diagonal, mask, args.filterThreshold[0], args.filterThreshold[1],
+                                                      chromosome_ids=chromosome_ids if args.perchr else None)
+            log.info("Bins that are MAD outliers ({:.2f}%) out of {}".format(
+                100 * float(len(outlier_regions)) / np.sum(~mask), np.sum(~mask)))
+            if args.filteredBed:
+                chromosome_names = cooler_object.chromnames
+                starts = cooler_group['bins']['start']
+                ends = cooler_group['bins']['end']
+                with open(args.filteredBed, 'w') as f:
+                    for outlier_region in outlier_regions:
+                        f.write(f"{chromosome_names[chromosome_ids[outlier_region]]}\t{starts[outlier_region]}\t{ends[outlier_region]}\t.\t1.0\t.\n")
+            mask[outlier_regions] = True
+
+            bias, converged = coolerBalancing.iterative_correction(pixels.dot, mask, pMaxIterations=args.iterNum,
+                                                                   pGroups=chromosome_ids if args.perchr else None,
+                                                                   pMaxValue=all_pixels.maxValue,
+                                                                   pInitialBias=None if initial_weights is None else 1.0 / initial_weights)
+            weight = np.full(len(bias), np.nan)
+            np.divide(1.0, bias, out=weight, where=bias != 0)
+
+            if args.inflationCutoff and args.inflationCutoff > 0:
+                balanced_weight = np.nan_to_num(weight)
+                pre_row_sum = pixels.dot((~mask).astype(np.float64))
+                after_row_sum = balanced_weight * pixels.dot(balanced_weight)
+                # identify rows that were expanded more than args.inflationCutoff times
+                to_remove = np.flatnonzero(after_row_sum / pre_row_sum >= args.inflationCutoff)
+                log.info("inflated >={} regions: {}".format(args.inflationCutoff, len(to_remove)))
+                weight[to_remove] = np.nan
+        else:
+            weight, converged = coolerBalancing.knight_ruiz(pixels.dot, mask, pInitialVector=initial_weights)
+            # scale the weights such that the balanced matrix has the same sum as the raw matrix
+            balanced_weight = np.nan_to_num(weight)
+            weight *= np.sqrt(row_sum[~mask].sum() / balanced_weight.dot(pixels.dot(balanced_weight)))
 
-    else:
-        row_sum = np.asarray(hic_ma.matrix.sum(axis=1)).flatten()
-        # subtract from row sum, the diagonal
-        # to account for interactions with other bins
-        # and not only self interactions that are the dominant count
-        row_sum = row_sum - hic_ma.matrix.diagonal()
-        mad = MAD(row_sum)
-        to_remove = np.flatnonzero(mad.is_outlier(
-            lower_threshold, upper_threshold))
-    return sorted(to_remove)
+    if not converged:
+        log.warning('The balancing did not converge.')
+    log.info("Total regions to be removed: {}".format(np.sum(np.isnan(weight))))
+    coolerBalancing.write_weight(args.matrix, weight, {'method': args.correctionMethod,
+                                                       'converged': converged,
+                                                       'ignore_diags': 1 if args.skipDiagonal else 0,
+                                                       'divisive_weights': False,
+                                                       'generated-by': 'hicCorrectMatrix-' + __version__})
 
 
 def main(args=None):
@@ -599,15 +957,28 @@ def main(args=None):
     if args.verbose:
         log.setLevel(logging.INFO)
 
+    if 'inPlace' in args:
+        if args.inPlace:
+            correct_cooler_in_place(args)
+            return
+        if args.outFileName is None:
+            log.error('--outFileName is required.')
+            sys.exit(1)
+
     # args.chromosomes
+    # the counts of a matrix stored with correction factors only are corrected again
     if check_cooler(args.matrix) and args.chromosomes is not None and len(args.chromosomes) == 1:
-        ma = hm.hiCMatrix(args.matrix, pChrnameList=toString(args.chromosomes))
+        ma = load_matrix(args.matrix, pApplyCorrection=False, pChrnameList=toString(args.chromosomes))
     else:
-        ma = hm.hiCMatrix(args.matrix)
+        ma = load_matrix(args.matrix, pApplyCorrection=False)
 
         if args.chromosomes:
             ma.reorderChromosomes(toString(args.chromosomes))
 
+    # the counts stored with --correctionFactorsOnly, the masking and filtering below
+    # change copies of them only
+    input_matrix = ma.matrix if getattr(args, 'correctionFactorsOnly', False) else None
+
     # mask all zero value bins
     if 'correctionMethod' in args:
         if args.correctionMethod == 'ICE':
@@ -621,9 +992,13 @@ def main(args=None):
         ma.maskBins(np.flatnonzero(row_sum == 0))
         matrix_shape = ma.matrix.shape
 
+    # with --singlePrecision ICE works on 32 bit counts, no 64 bit copy is kept
+    if getattr(args, 'correctionMethod', None) == 'ICE' and args.singlePrecision:
+        ma.matrix = ma.matrix.astype(np.float32, copy=True)
+    else:
+        ma.matrix = ma.matrix.astype(np.float64, copy=True)
     ma.matrix = convertNansToZeros(ma.matrix)
     ma.matrix = convertInfsToZeros(ma.matrix)
-    ma.matrix = ma.matrix.astype(np.float64, copy=True)
 
     log.debug('ma.matrix.indices {}'.format(ma.matrix.indices.dtype))
     log.debug('ma.matrix.data {}'.format(ma.matrix.data.dtype))
@@ -698,46 +1073,59 @@ def main(args=None):
             ma.truncTrans(high=cutoff)
             pre_row_sum = np.asarray(ma.matrix.sum(axis=1)).flatten()
 
-    correction_factors = []
-    corrected_matrix = lil_matrix(ma.matrix.shape)
+    initial_weights = None
+    if args.initialWeights:
+        initial_weights = read_initial_weights(args.initialWeights, args.matrix, ma.cut_intervals)
+
+    corrected_matrix = None
     if args.perchr:
-        # normalize each chromosome independently
-        for chrname in list(ma.interval_trees):
-            chr_range = ma.getChrBinRange(chrname)
-            chr_submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
-            if args.correctionMethod == 'ICE':
-                _matrix, _corr_factors = iterative_correction(
-                    chr_submatrix, args)
-                corrected_matrix[chr_range[0]:chr_range[1],
-                                 chr_range[0]:chr_range[1]] = _matrix
-                correction_factors.append(_corr_factors)
-            else:
-                # Set the kr matrix along with its correction factors vector
-                assert (args.correctionMethod == 'KR')
-                log.debug("Loading a float sparse matrix for KR balancing")
-                kr = kr_balancing(chr_submatrix.shape[0],
-                                  chr_submatrix.shape[1],
-                                  chr_submatrix.count_nonzero(),
-                                  chr_submatrix.indptr.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.indices.astype(
-                                      np.int64, copy=False),
-                                  chr_submatrix.data.astype(np.float64, copy=False))
-                kr.computeKR()
-                if args.outFileName.endswith('.h5'):
-                    corrected_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = kr.get_normalised_matrix(True)
-                # correction_factors.append(np.true_divide(1,
-                #                                          kr.get_normalisation_vector(False).todense()))
-                correction_factors.append(
-                    kr.get_normalisation_vector(False).todense())
-
-        correction_factors = np.concatenate(correction_factors)
+        # normalize each chromosome independently, the processes share the read-only matrix
+        chromosome_ranges = [ma.getChrBinRange(chrname) for chrname in list(ma.interval_trees)]
+        # the largest chromosomes first, to keep all processes busy until the end
+        chromosome_ranges = sorted([chr_range for chr_range in chromosome_ranges if chr_range[1] > chr_range[0]],
+                                   key=lambda chr_range: ma.matrix.indptr[chr_range[1]] - ma.matrix.indptr[chr_range[0]],
+                                   reverse=True)
+        task_arguments = [dict(pMatrix=ma.matrix, pChrRange=chr_range, pArgs=args,
+                               pInitialWeights=None if initial_weights is None else initial_weights[chr_range[0]:chr_range[1]])
+                          for chr_range in chromosome_ranges]
+
+        correction_factors = np.zeros(ma.matrix.shape[0])
+        rows = []
+        columns = []
+        values = []
+        if args.correctionMethod == 'KR':
+            # krbalancing runs OpenMP threads, a forked process deadlocks once they were
+            # started in the main process. KR is multithreaded already, the chromosomes
+            # are balanced one after the other.
+            results = run_tasks_sequentially(correct_chromosome, task_arguments)
+        else:
+            results = run_tasks(correct_chromosome, task_arguments, pThreads=args.threads)
+        for task_index, result in results:
+            if isinstance(result, str) and result.startswith('Fail: '):
+                log.error(result[6:])
+                sys.exit(1)
+            chr_start, chr_end = chromosome_ranges[task_index]
+            _matrix, _corr_factors = result
+            correction_factors[chr_start:chr_end] = np.asarray(_corr_factors).flatten()
+            if _matrix is not None:
+                _matrix = _matrix.tocoo()
+                rows.append(_matrix.row + chr_start)
+                columns.append(_matrix.col + chr_start)
+                values.append(_matrix.data)
+        if len(values) > 0:
+            corrected_matrix = coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                          shape=ma.matrix.shape).tocsr()
 
     else:
         if args.correctionMethod == 'ICE':
             corrected_matrix, correction_factors = iterative_correction(
-                ma.matrix, args)
-            ma.setMatrixValues(corrected_matrix)
+                ma.matrix, args, initial_weights)
+            if not args.correctionFactorsOnly:
+                ma.setMatrixValues(corrected_matrix)
+        elif initial_weights is not None:
+            correction_factors, _ = knight_ruiz_from_weights(ma.matrix, initial_weights)
+            if args.outFileName.endswith('.h5') and not args.correctionFactorsOnly:
+                corrected_matrix = apply_weights(ma.matrix, correction_factors)
         else:
             assert (args.correctionMethod == 'KR')
             log.debug("Loading a float sparse matrix for KR balancing")
@@ -753,10 +1141,17 @@ def main(args=None):
             # correction_factors = np.true_divide(1, kr.get_normalisation_vector(False).todense())
             correction_factors = kr.get_normalisation_vector(True).todense()
 
-            if args.outFileName.endswith('.h5'):
+            if args.outFileName.endswith('.h5') and not args.correctionFactorsOnly:
                 corrected_matrix = kr.get_normalised_matrix(True)
 
-    if args.outFileName.endswith('.h5'):
+    if args.correctionFactorsOnly:
+        # the counts are kept, the factors are stored as multiplicative weights
+        if args.correctionMethod == 'ICE':
+            weights = np.zeros(len(correction_factors))
+            np.divide(1.0, correction_factors, out=weights, where=correction_factors != 0)
+            correction_factors = weights
+        correction_factors = np.asarray(correction_factors).flatten()
+    elif args.outFileName.endswith('.h5'):
         ma.setMatrixValues(corrected_matrix)
     # if
     ma.setCorrectionFactors(correction_factors)
@@ -764,7 +1159,11 @@ def main(args=None):
     log.debug("Correction factors {}".format(correction_factors[:10]))
     if args.inflationCutoff and args.inflationCutoff > 0 and args.correctionMethod == 'ICE':
 
-        after_row_sum = np.asarray(corrected_matrix.sum(axis=1)).flatten()
+        if corrected_matrix is None:
+            # --perchr --correctionFactorsOnly, the counts times the multiplicative weights
+            after_row_sum = correction_factors * ma.matrix.dot(correction_factors)
+        else:
+            after_row_sum = np.asarray(corrected_matrix.sum(axis=1)).flatten()
         # identify rows that were expanded more than args.inflationCutoff times
         to_remove = np.flatnonzero(
             after_row_sum / pre_row_sum >= args.inflationCutoff)
@@ -776,4 +1175,8 @@ def main(args=None):
     ma.printchrtoremove(sorted(list(total_filtered_out)),
                         label="Total regions to be removed", restore_masked_bins=False)
 
-    ma.save(args.outFileName, pApplyCorrection=False)
+    if args.correctionFactorsOnly:
+        # the filtered and masked bins get a correction factor of nan, the input counts are stored
+        ma.restoreMaskedBins()
+        ma.matrix = input_matrix
+    save_matrix(ma, args.outFileName, pCorrectionFactorsOnly=args.correctionFactorsOnly)
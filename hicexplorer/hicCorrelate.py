@@ -11,6 +11,7 @@ from scipy.sparse import triu
 from scipy.stats import pearsonr, spearmanr
 
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 from hicexplorer.utilities import check_cooler
 # for plotting
@@ -273,9 +274,9 @@ def main(args=None):
         log.debug("loading hic matrix {}\n".format(matrix))
 
         if (check_cooler(args.matrices[i])) and args.chromosomes is not None and len(args.chromosomes) == 1:
-            _mat = hm.hiCMatrix(matrix, pChrnameList=args.chromosomes)
+            _mat = load_matrix(matrix, pChrnameList=args.chromosomes)
         else:
-            _mat = hm.hiCMatrix(matrix)
+            _mat = load_matrix(matrix)
             if args.chromosomes:
                 _mat.keepOnlyTheseChr(args.chromosomes)
             _mat.filterOutInterChrCounts()
@@ -1,20 +1,20 @@
 import argparse
-from multiprocessing import Process, Queue
+import os
+import tempfile
 from multiprocessing.sharedctypes import Array, RawArray
-from copy import deepcopy
 import logging
 log = logging.getLogger(__name__)
-import time
 import gc
 import cooler
 import numpy as np
 from scipy.sparse import csr_matrix, triu
 from scipy.stats import anderson_ksamp, ranksums
 from scipy.stats import nbinom
+from scipy.ndimage import maximum_filter
 # import scipy.sparse
-import fit_nbinom
 
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicmatrix.lib import MatrixFileHandler
 from hicexplorer._version import __version__
 from hicexplorer.utilities import check_cooler
@@ -24,7 +24,11 @@ from inspect import currentframe
 import traceback
 
 
-from hicexplorer.utilities import obs_exp_matrix, obs_exp_matrix_non_zero
+from hicexplorer.utilities import convertInfsToZeros_ArrayFloat, toString
+from hicexplorer.utilities import run_tasks
+from hicexplorer.utilities import get_cache_prefix
+from hicexplorer.expectedInteractions import distance_sums, expected_per_distance
+from hicexplorer.utilities import ranksums_rows
 
 
 def get_linenumber():
@@ -93,15 +97,25 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
                            help='Chromosomes to include in the analysis. If not set, all chromosomes are included.',
                            nargs='+')
 
+    parserOpt.add_argument('--tileSize',
+                           type=int,
+                           default=50000000,
+                           help='The chromosomes are split into tiles of this size for the loop detection. A tile is '
+                           'loaded together with its neighborhood up to --maxLoopDistance, the memory needed for the '
+                           'loop detection depends on the tile size and not on the size of the chromosomes. The '
+                           'fitting of the distributions per distance keeps the obs/exp values up to --maxLoopDistance '
+                           'of a whole chromosome, 4 bytes per value. The detected loops do not depend on the tile size'
+                           ' (Default: %(default)s).')
     parserOpt.add_argument('--threads', '-t',
-                           help='Number of threads to use, the parallelization is implemented per chromosome'
+                           help='Number of threads to use, the parallelization is implemented per chromosome for the '
+                           'fitting of the distributions and per tile for the loop detection'
                            ' (Default: %(default)s).',
                            required=False,
                            default=4,
                            type=int
                            )
     parserOpt.add_argument('--threadsPerChromosome', '-tpc',
-                           help='Number of threads to use per parallel thread processing a chromosome. E.g. --threads = 4 and --threadsPerChromosome = 4 makes 4 * 4 = 16 threads in total'
+                           help='Number of threads to use per parallel thread fitting the distributions of a chromosome. E.g. --threads = 4 and --threadsPerChromosome = 4 makes 4 * 4 = 16 threads in total'
                            ' (Default: %(default)s).',
                            required=False,
                            default=4,
@@ -117,6 +131,12 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
                            default="mean",
                            choices=['mean', 'mean_nonzero', 'mean_nonzero_ligation']
                            )
+    parserOpt.add_argument('--cacheDirectory',
+                           help='Folder in which the fitted negative binomial distributions per genomic distance are '
+                           'stored. A later run on the same matrix with the same --expected and --maxLoopDistance '
+                           'uses them instead of fitting again, e.g. to try other thresholds. If not set, nothing '
+                           'is stored.',
+                           required=False)
     parserOpt.add_argument('--help', '-h', action='help',
                            help='show this help message and exit')
 
@@ -126,307 +146,362 @@ Computes enriched regions (peaks) or long range contacts on the given contact ma
     return parser
 
 
-def create_distance_distribution(pDataObsExp, pDistances, pWindowSize, pMinDistance, pMaxDistance, pQueue):
-    pGenomicDistanceDistributionObsExp = {}
-    pGenomicDistanceDistributionPosition = {}
-    try:
-        for distance in range(pMinDistance, pMaxDistance, 1):
-            mask = pDistances == distance
+def group_by_distance(pDistances):
+    """
+    Sorts the elements once by their distance to the main diagonal, such that
+    the elements of each distance are a contiguous slice.
 
-            pGenomicDistanceDistributionObsExp[distance] = pDataObsExp[mask]
-            pGenomicDistanceDistributionPosition[distance] = np.argwhere(mask == True).flatten()
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    pQueue.put([pGenomicDistanceDistributionPosition, pGenomicDistanceDistributionObsExp])
-    return
+    Returns:
+        - order: indices that sort pDistances, stable, i.e. elements with the same distance keep their order
+        - offsets: the elements with distance distances[i] are order[offsets[i]:offsets[i + 1]]
+        - distances: the distances that occur, sorted
 
+    >>> order, offsets, distances = group_by_distance(np.array([2, 0, 2, 1, 0]))
+    >>> order, offsets, distances
+    (array([1, 4, 3, 0, 2]), array([0, 2, 3, 5]), array([0, 1, 2]))
+    """
+    order = np.argsort(pDistances, kind='stable')
+    sorted_distances = pDistances[order]
+    starts = np.flatnonzero(np.diff(sorted_distances)) + 1
+    offsets = np.concatenate([[0], starts, [len(sorted_distances)]]).astype(np.int64)
+    if len(sorted_distances) == 0:
+        offsets = np.array([0], dtype=np.int64)
+    return order, offsets, sorted_distances[offsets[:-1]]
 
-def compute_p_values_mask(pGenomicDistanceDistributionsObsExp, pGenomicDistanceDistributionsKeyList,
-                          pPValuePreselection, pGenomicDistanceDistributionPosition, pResolution,
-                          pMinimumInteractionsThreshold, pObsExpThreshold, pQueue):
 
-    try:
-        true_values = []
-        if len(pGenomicDistanceDistributionsKeyList) == 0:
-            pQueue.put(true_values)
-            return
+def get_expected(pSums, pCounts, pExpected):
+    """
+    The expected value per distance of a chromosome, computed like obs_exp_matrix ('mean') and
+    obs_exp_matrix_non_zero ('mean_nonzero', 'mean_nonzero_ligation') do for the whole matrix.
+
+    Input:
+        - pSums, pCounts: the sums and numbers of non-zero values per distance of the upper
+          triangle of the chromosome, see distance_sums
+
+    >>> sums, counts = distance_sums(np.array([1, 1, 2]), np.array([4, 2, 1]), 4)
+    >>> get_expected(sums, counts, 'mean')
+    array([0.        , 1.5       , 0.33333333, 0.        ])
+    >>> get_expected(sums, counts, 'mean_nonzero')
+    array([0., 3., 1., 0.])
+    """
+    return expected_per_distance(pSums, pCounts, pMethod='mean' if pExpected == 'mean' else 'nonzero')
 
-        float_dict = isinstance(pPValuePreselection, float)
-        for i, key in enumerate(pGenomicDistanceDistributionsKeyList):
 
-            data_obs_exp = np.array(pGenomicDistanceDistributionsObsExp[key])
-            # do not fit and not compute any p-value if all values on this distance are small than the pMinimumInteractionsThreshold
-            mask = data_obs_exp >= pObsExpThreshold
-            nbinom_parameters = fit_nbinom.fit(data_obs_exp)
+def get_obs_exp(pValues, pRows, pColumns, pExpected, pExpectedMethod, pRowSums=None, pTotal=None):
+    """
+    The obs/exp values of the values at the positions pRows, pColumns of a chromosome, computed
+    like obs_exp_matrix and obs_exp_matrix_non_zero with pToEpsilon=True.
 
-            p_value = 1 - cnb.cdf(data_obs_exp[mask], nbinom_parameters['size'], nbinom_parameters['prob'])
+    Input:
+        - pExpected: the expected values per distance, see get_expected
+        - pRowSums, pTotal: the row sums and the sum of the chromosome, only for 'mean_nonzero_ligation'
+    """
+    distances = pColumns - pRows
+    if pExpectedMethod == 'mean':
+        # obs_exp_matrix takes the expected value of half the distance
+        expected = pExpected[np.ceil(distances / 2).astype(np.int32)]
+        obs_exp = np.divide(pValues.astype(np.float32), expected)
+        return convertInfsToZeros_ArrayFloat(obs_exp, pToEpsilon=True).astype(pValues.dtype)
+    expected = pExpected[distances]
+    if pExpectedMethod == 'mean_nonzero_ligation':
+        expected = expected * (pRowSums[pRows] * pRowSums[pColumns] / pTotal)
+    obs_exp = np.divide(pValues.astype(np.float32), expected).astype(np.float32)
+    obs_exp[~np.isfinite(obs_exp)] = 0.000000001
+    return obs_exp
+
+
+def fit_distances_thread(pSortedObsExp, pOffsets, pQueue):
+    """
+    Fits a negative binomial distribution per distance, pSortedObsExp[pOffsets[i]:pOffsets[i + 1]]
+    are the obs/exp values of one distance (see group_by_distance).
 
-            if float_dict:
-                mask_distance = p_value <= pPValuePreselection
-            else:
-                key_genomic = int(key * pResolution)
-                mask_distance = p_value <= pPValuePreselection[key_genomic]
-            j = 0
-            for k, value in enumerate(mask):
-                if value:
-                    if mask_distance[j]:
-                        true_values.append(pGenomicDistanceDistributionPosition[key][k])
-                    j += 1
+    Returns (via pQueue) the parameters size and prob per distance.
+    """
+    try:
+        values = pSortedObsExp[pOffsets[0]:pOffsets[-1]]
+        size, prob = cnb.fit_per_group(values, pOffsets - pOffsets[0])
     except Exception as exp:
         pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
         return
-    pQueue.put(true_values)
+    pQueue.put([size, prob])
     return
 
 
-def compute_long_range_contacts(pHiCMatrix, pObsExpMatrix, pWindowSize,
-                                pPValue, pPeakWindowSize,
-                                pPValuePreselection,
-                                pMinimumInteractionsThreshold,
-                                pObsExpThreshold, pThreads):
+def get_preselection_mask(pObsExp, pDistances, pStatistics, pObsExpThreshold):
     """
-        This function computes the loops by:
-            - decreasing the search space by removing values with p-values > pPValuePreselection
-            - decreasing the search space with the pMaximumInteractionPercentageThreshold: removes all values with less interactions as maximum value of their distance  * pMaximumInteractionPercentageThreshold
-            - calls neighborhood_merge to merging candidates which share a neighborhood to one candidate
-            - calling candidate_region_test to test the neighborhood of a candidate against its peak to detect significant peaks
-
-        Input:
-            - pHiCMatrix: original interaction matrix for neighborhood and peak region subset selection
-            - pWindowSize: integer, the size of (2*pWindowSize)^2 around a candidate defines its neighborhood. It is used for
-                    a) merging candidates and their neighborhoods to one candidate per neighborhood which appear in this region.
-                    b) same neighborhood is used to test the peak region against the neighborhood for significant difference (candidate_region_test)
-            - pMinimumInteractionsThreshold: float, remove candidates with less interactions
-            - pPValue: float, test rejection level for H0 and FDR correction
-            - pPValuePreselection: float, p-value for negative binomial
-            - pPeakWindowSize: integer, size of the peak region: (2*pPeakWindowSize)^2. Needs to be smaller than pWindowSize
+    Selects the values with an obs/exp value of at least pObsExpThreshold and a p-value of the
+    negative binomial distribution of their distance of at most the preselection threshold.
 
-        Returns:
-            - A list of detected loops [(x,y)] and x, y are matrix index values
-            - An associated list of p-values
+    Input:
+        - pObsExp: obs/exp values
+        - pDistances: their distances to the main diagonal
+        - pStatistics: the fitted distributions of the chromosome, see fit_chromosome
     """
-    # pObsExpMatrix.eliminate_zeros()
-    # pHiCMatrix.matrix.eliminate_zeros()
-    instances, features = pObsExpMatrix.nonzero()
-    distance = np.absolute(instances - features)
-    mask_interactions_hard_threshold = pHiCMatrix.matrix.data >= pMinimumInteractionsThreshold
-
-    del instances
-    del features
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    genomic_distance_distributions_thread = None
-    genomic_distance_distributions_obs_exp_thread = None
-
-    pGenomicDistanceDistributionPosition_thread = None
-    all_data_collected = False
-    thread_done = [False] * pThreads
-    min_distance = distance.min()
-    max_distance = distance.max()
-    len_distance = len(distance)
-
-    distances_per_threads = (max_distance - min_distance) // pThreads
-    for i in range(pThreads):
-
-        if i < pThreads - 1:
-            min_distance_thread = min_distance + (i * distances_per_threads)
-            max_distance_thread = min_distance + ((i + 1) * distances_per_threads)
-        else:
-            min_distance_thread = min_distance + (i * distances_per_threads)
-            max_distance_thread = max_distance + 1
-        queue[i] = Queue()
-        process[i] = Process(target=create_distance_distribution, kwargs=dict(
-            pDataObsExp=pObsExpMatrix.data,
-            pDistances=distance,
-            pWindowSize=pWindowSize,
-            pMinDistance=min_distance_thread,
-            pMaxDistance=max_distance_thread,
-            pQueue=queue[i]
-        )
-        )
-
-        process[i].start()
-
-    del pHiCMatrix.matrix
-    del distance
-    # genomic_distance_distributions = {}
-    genomic_distance_distributions_obs_exp = {}
-    pGenomicDistanceDistributionPosition = {}
-    fail_flag = False
-    fail_message = ''
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                queue_data = queue[i].get()
-                if 'Fail:' in queue_data:
-                    fail_flag = True
-                    fail_message = queue_data
-                else:
-                    pGenomicDistanceDistributionPosition_thread, \
-                        genomic_distance_distributions_obs_exp_thread = queue_data
-
-                    pGenomicDistanceDistributionPosition = {**pGenomicDistanceDistributionPosition, **pGenomicDistanceDistributionPosition_thread}
-                    del pGenomicDistanceDistributionPosition_thread
-
-                    genomic_distance_distributions_obs_exp = {**genomic_distance_distributions_obs_exp, **genomic_distance_distributions_obs_exp_thread}
-                    del genomic_distance_distributions_obs_exp_thread
-
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
+    mask = pObsExp >= pObsExpThreshold
+    # do not compute any p-value for values smaller than pObsExpThreshold
+    candidates = np.flatnonzero(mask)
+    distance_idx = np.searchsorted(pStatistics['distances'], pDistances[candidates])
+    p_value = 1 - cnb.cdf(pObsExp[candidates], pStatistics['size'][distance_idx], pStatistics['prob'][distance_idx])
+    mask[candidates] = p_value <= pStatistics['thresholds'][distance_idx]
+    return mask
 
-    if fail_flag:
-        return fail_message, None
-    mask = [False] * len_distance
-    genomic_distance_distributions_thread = (len(genomic_distance_distributions_obs_exp) // pThreads) + 1
 
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    all_data_collected = False
-    thread_done = [False] * pThreads
-    genomic_keys_list = sorted(list(genomic_distance_distributions_obs_exp.keys()))
+def load_nbinom_parameters(pFileName, pDistances, pCounts):
+    """
+    Reads the distributions per distance stored by save_nbinom_parameters. Returns
+    None if they were not fitted on values with the given distances and number of values.
+    """
+    with np.load(pFileName) as data:
+        if not np.array_equal(data['distances'], pDistances) or not np.array_equal(data['counts'], pCounts):
+            return None
+        return data['size'], data['prob']
+
+
+def save_nbinom_parameters(pFileName, pDistances, pCounts, pSize, pProb):
+    directory = os.path.dirname(pFileName)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    # written to a unique temporary file first, parallel processes never read or write a partial file
+    file_descriptor, temp_file_name = tempfile.mkstemp(dir=directory or '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as fh:
+            np.savez(fh, distances=pDistances, counts=pCounts, size=pSize, prob=pProb)
+        os.replace(temp_file_name, pFileName)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+        raise
 
-    for i in range(pThreads):
 
-        if i < pThreads - 1:
-            genomic_distance_keys_thread = genomic_keys_list[i * genomic_distance_distributions_thread:(i + 1) * genomic_distance_distributions_thread]
-        else:
-            genomic_distance_keys_thread = genomic_keys_list[i * genomic_distance_distributions_thread:]
-        if len(genomic_distance_keys_thread) == 0:
+def get_bin_size(pCutIntervals):
+    """
+    The bin size of a chromosome, the median distance of the bin starts like hiCMatrix.getBinSize.
+    """
+    return int(np.median(np.diff([start for _, start, _, _ in pCutIntervals])))
 
-            process[i] = None
-            queue[i] = None
-            thread_done[i] = True
-            continue
-        else:
-            queue[i] = Queue()
-            process[i] = Process(target=compute_p_values_mask, kwargs=dict(
-                pGenomicDistanceDistributionsObsExp=genomic_distance_distributions_obs_exp,
-                pGenomicDistanceDistributionsKeyList=genomic_distance_keys_thread,
-                pPValuePreselection=pPValuePreselection,
-                pGenomicDistanceDistributionPosition=pGenomicDistanceDistributionPosition,
-                pResolution=pHiCMatrix.getBinSize(),
-                pMinimumInteractionsThreshold=pMinimumInteractionsThreshold,
-                pObsExpThreshold=pObsExpThreshold,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-            del genomic_distance_keys_thread
-
-    del genomic_distance_distributions_obs_exp
-    del pGenomicDistanceDistributionPosition
-    del genomic_keys_list
-
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                mask_threads = queue[i].get()
-                if isinstance(mask_threads, str) and 'Fail: ' in mask_threads:
-                    fail_flag = True
-                    fail_message = mask_threads
-                else:
-                    for index in mask_threads:
-                        mask[index] = True
-                    del mask_threads
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
 
-    if fail_flag:
-        return fail_message, None
-    mask = np.logical_and(mask, mask_interactions_hard_threshold)
-    instances, features = pObsExpMatrix.nonzero()
+def get_tiles(pNumberOfBins, pTileSize):
+    """
+    Splits the bins of a chromosome into consecutive ranges of pTileSize bins.
 
-    instances = instances[mask]
-    features = features[mask]
+    >>> get_tiles(10, 4)
+    [(0, 4), (4, 8), (8, 10)]
+    """
+    return [(first, min(first + pTileSize, pNumberOfBins)) for first in range(0, pNumberOfBins, pTileSize)]
 
-    if len(features) == 0:
-        return None, None
-    candidates = np.array([*zip(instances, features)])
 
-    del instances
-    del features
-    del mask
+def load_band(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset, pFirstBin, pLastBin):
+    """
+        Loads the square region of the bins pFirstBin to pLastBin of a chromosome and removes
+        the values of the lower triangle, of the main diagonal and with a distance larger than
+        --maxLoopDistance, like it is done for a whole chromosome.
 
-    candidates, _ = neighborhood_merge(
-        candidates, pWindowSize, pObsExpMatrix, pThreads)
+        Input:
+            - pHiCMatrix: the Hi-C matrix for h5 files, None for cool files, they are read per region
+            - pCutIntervals: the bins of the chromosome
+            - pOffset: index of the first bin of the chromosome in pHiCMatrix
 
-    if isinstance(candidates, str) and 'Fail: ' in candidates:
-        return candidates, None
-    if len(candidates) == 0:
-        return None, None
-    candidates, p_value_list = candidate_region_test(
-        pObsExpMatrix, candidates, pWindowSize, pPValue,
-        pPeakWindowSize, pThreads)
+        Returns:
+            - csr_matrix of the region, the upper triangle only
+    """
+    if pIsCooler:
+        # cooler files load only what is necessary.
+        region = '{}:{}-{}'.format(pCutIntervals[pFirstBin][0], pCutIntervals[pFirstBin][1], pCutIntervals[pLastBin - 1][2])
+        matrix = load_matrix(pMatrixFile=pArgs.matrix, pChrnameList=[region], pDistance=pArgs.maxLoopDistance,
+                             pNoIntervalTree=True, pUpperTriangleOnly=True).matrix
+    else:
+        matrix = pHiCMatrix.matrix[pOffset + pFirstBin:pOffset + pLastBin, pOffset + pFirstBin:pOffset + pLastBin]
+        matrix.eliminate_zeros()
+        max_loop_distance = pArgs.maxLoopDistance / get_bin_size(pCutIntervals)
+        instances, features = matrix.nonzero()
+        matrix.data[np.absolute(instances - features) > max_loop_distance] = 0
+    # upper triangle without the main diagonal
+    matrix = triu(matrix, k=1, format='csr')
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def load_tile_band(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset, pFirstBin, pLastBin, pMaxDistance):
+    """
+        The rows pFirstBin to pLastBin of the band of a chromosome, see load_band. Returns the band
+        and the row, relative to the chromosome, and the distance to the main diagonal of its values.
+    """
+    band = load_band(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset,
+                     pFirstBin, min(pLastBin + pMaxDistance + 1, len(pCutIntervals)))[:pLastBin - pFirstBin]
+    band_rows, band_columns = band.nonzero()
+    return band, (band_rows + pFirstBin).astype(np.int32), (band_columns - band_rows).astype(np.int32)
 
-    return candidates, p_value_list
 
+def fit_chromosome(pArgs, pIsCooler, pHiCMatrix, pChromosome, pCutIntervals, pOffset, pQueue):
+    """
+        Computes the statistics of a chromosome the loop detection in its tiles needs: the expected
+        value per distance and the negative binomial distribution of the obs/exp values per distance.
 
-def neighborhood_merge_thread(pCandidateList, pWindowSize, pInteractionCountMatrix, pQueue):
+        The chromosome is read tile by tile, twice: the first pass sums the values per distance
+        for the expected values, the second pass writes the obs/exp values of each tile directly
+        to the slice of their distance. The fit needs all obs/exp values of a distance, they are
+        the only values kept for the whole chromosome. A chromosome that is a single tile is read
+        once only: its loops are detected right away and stored as 'loops' in the statistics,
+        otherwise 'loops' is None.
 
+        Returns (via pQueue) a dict with the statistics, or None if no loops can be detected on the chromosome.
+    """
     try:
-        new_candidate_list = []
-
-        if len(pCandidateList) == 0:
-            pQueue.put(new_candidate_list)
+        number_of_bins = len(pCutIntervals)
+        if number_of_bins < 5:
+            log.debug('Computed loops for {}: 0'.format(pChromosome))
+            pQueue.put(None)
+            return
+        bin_size = get_bin_size(pCutIntervals)
+        max_distance = pArgs.maxLoopDistance // bin_size
+        tiles = get_tiles(number_of_bins, max(pArgs.tileSize // bin_size, 1))
+        sums = np.zeros(number_of_bins)
+        nonzero_counts = np.zeros(number_of_bins, dtype=np.int64)
+        value_counts = np.zeros(number_of_bins, dtype=np.int64)
+        row_sums = None
+        single_tile_band = None
+        for first, last in tiles:
+            band, _, distances = load_tile_band(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset, first, last, max_distance)
+            tile_sums, tile_counts = distance_sums(distances, band.data, number_of_bins)
+            sums += tile_sums
+            nonzero_counts += tile_counts
+            value_counts += np.bincount(distances, minlength=number_of_bins)
+            if pArgs.expected == 'mean_nonzero_ligation':
+                # the sums like hiCMatrix.matrix.sum(axis=1) computes them for the whole chromosome
+                tile_row_sums = np.array(band.sum(axis=1).T).flatten()
+                if row_sums is None:
+                    row_sums = np.zeros(number_of_bins, dtype=tile_row_sums.dtype)
+                row_sums[first:last] = tile_row_sums
+            if len(tiles) == 1:
+                single_tile_band = band
+            del band
+            del distances
+        if value_counts.sum() == 0:
+            pQueue.put(None)
             return
-        x_max = pInteractionCountMatrix.shape[0]
-        y_max = pInteractionCountMatrix.shape[1]
-
-        for candidate in pCandidateList:
-
-            if (candidate[0] - pWindowSize) > 0:
-                start_x = candidate[0] - pWindowSize
-            else:
-                start_x = 0
 
-            if (candidate[1] - pWindowSize) > 0:
-                start_y = candidate[1] - pWindowSize
+        expected = get_expected(sums, nonzero_counts, pArgs.expected)
+        total = row_sums.sum() if row_sums is not None else None
+
+        # the obs/exp values sorted by distance, the values of a distance are the contiguous
+        # slice sorted_obs_exp[offsets[i]:offsets[i + 1]] in the order of their rows
+        unique_distances = np.flatnonzero(value_counts)
+        counts = value_counts[unique_distances]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        distance_index = np.zeros(number_of_bins, dtype=np.int64)
+        distance_index[unique_distances] = np.arange(len(unique_distances))
+        next_position = offsets[:-1].copy()
+        sorted_obs_exp = np.empty(offsets[-1], dtype=np.float32)
+        for first, last in tiles:
+            if single_tile_band is not None:
+                band = single_tile_band
+                band_rows, band_columns = band.nonzero()
+                rows, distances = band_rows.astype(np.int32), (band_columns - band_rows).astype(np.int32)
             else:
-                start_y = 0
-
-            end_x = candidate[0] + pWindowSize + 1 if candidate[0] + \
-                pWindowSize + 1 < x_max else x_max
-
-            end_y = candidate[1] + pWindowSize + 1 if candidate[1] + \
-                pWindowSize + 1 < y_max else y_max
-
-            neighborhood = pInteractionCountMatrix[start_x:end_x,
-                                                   start_y:end_y].toarray().flatten()
-
-            if len(neighborhood) > 0 and np.max(neighborhood) == pInteractionCountMatrix[candidate[0], candidate[1]]:
-                new_candidate_list.append(candidate)
+                band, rows, distances = load_tile_band(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset, first, last, max_distance)
+            obs_exp = get_obs_exp(band.data, rows, rows + distances, expected, pArgs.expected, row_sums, total)
+            del band
+            del rows
+            if np.any(obs_exp == 0):
+                # values which are zero after the obs/exp transformation would be removed
+                # and the matrix no longer has the same sparsity as the interaction matrix
+                log.debug('Computed loops for {}: 0'.format(pChromosome))
+                pQueue.put(None)
+                return
+            order, tile_offsets, tile_distances = group_by_distance(distances)
+            tile_counts = np.diff(tile_offsets)
+            groups = distance_index[tile_distances]
+            destination = np.repeat(next_position[groups] - tile_offsets[:-1], tile_counts) + np.arange(len(order))
+            sorted_obs_exp[destination] = obs_exp[order]
+            next_position[groups] += tile_counts
+            del obs_exp
+            del order
+            del destination
+            del distances
+
+        parameter_file = None
+        nbinom_parameters = None
+        if pArgs.cachePrefix is not None:
+            parameter_file = '{}_{}_nbinom.npz'.format(pArgs.cachePrefix, pChromosome)
+            if os.path.isfile(parameter_file):
+                nbinom_parameters = load_nbinom_parameters(parameter_file, unique_distances, counts)
+
+        if nbinom_parameters is None:
+            # each task fits a range of distances with about the same number of values
+            task_boundaries = np.searchsorted(offsets[:-1], np.linspace(0, offsets[-1], pArgs.threadsPerChromosome + 1)[1:-1])
+            task_boundaries = np.unique(np.concatenate([[0], task_boundaries, [len(unique_distances)]]))
+            task_arguments = [dict(pSortedObsExp=sorted_obs_exp, pOffsets=offsets[first:last + 1])
+                              for first, last in zip(task_boundaries[:-1], task_boundaries[1:])]
+            size = np.zeros(len(unique_distances))
+            prob = np.zeros(len(unique_distances))
+            for i, result in run_tasks(fit_distances_thread, task_arguments, pThreads=pArgs.threadsPerChromosome):
+                if isinstance(result, str) and 'Fail: ' in result:
+                    pQueue.put(result)
+                    return
+                size[task_boundaries[i]:task_boundaries[i + 1]], prob[task_boundaries[i]:task_boundaries[i + 1]] = result
+            if parameter_file is not None:
+                save_nbinom_parameters(parameter_file, unique_distances, counts, size, prob)
+        else:
+            size, prob = nbinom_parameters
+        del sorted_obs_exp
 
-            del neighborhood
-        del pCandidateList
+        if isinstance(pArgs.pValuePreselection, float):
+            thresholds = np.full(len(unique_distances), pArgs.pValuePreselection)
+        else:
+            thresholds = np.array([pArgs.pValuePreselection[int(distance * bin_size)] for distance in unique_distances])
+        statistics = dict(expected=expected, row_sums=row_sums, total=total,
+                          distances=unique_distances, size=size, prob=prob, thresholds=thresholds, loops=None)
+        if single_tile_band is not None:
+            statistics['loops'] = get_tile_loops(pArgs, single_tile_band, 0, 0, number_of_bins, pCutIntervals, statistics)
     except Exception as exp:
         pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
         return
-    pQueue.put(new_candidate_list)
+    pQueue.put(statistics)
     return
 
 
-def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix, pThreads):
+def get_dense_tiles(pMatrix, pCandidates, pHalo, pTileSize=500):
+    """
+    Groups the candidates into square tiles of pTileSize x pTileSize bins and converts the
+    region of each tile, extended by pHalo bins on all sides, once into a dense array. The
+    neighborhoods of all candidates of a tile are then slices of the same dense array.
+
+    Input:
+        - pMatrix: csr_matrix
+        - pCandidates: array of shape (number of candidates, 2) with the matrix positions
+        - pHalo: integer, number of bins added on each side of a tile, clipped at the matrix borders
+
+    Yields per tile with candidates:
+        - the indices of its candidates in pCandidates
+        - the dense array of pMatrix[first_row:..., first_column:...]
+        - first_row, first_column
+
+    >>> matrix = csr_matrix(np.arange(36, dtype=float).reshape(6, 6))
+    >>> for indices, block, first_row, first_column in get_dense_tiles(matrix, np.array([[0, 4], [1, 1], [5, 5]]), 1, 3):
+    ...     indices, block.shape, first_row, first_column
+    (array([1]), (4, 4), 0, 0)
+    (array([0]), (4, 4), 0, 2)
+    (array([2]), (4, 4), 2, 2)
+    """
+    tiles = pCandidates // pTileSize
+    tile_ids = tiles[:, 0] * (pMatrix.shape[1] // pTileSize + 1) + tiles[:, 1]
+    order, offsets, _ = group_by_distance(tile_ids)
+    for first, last in zip(offsets[:-1], offsets[1:]):
+        indices = order[first:last]
+        tile_row, tile_column = tiles[indices[0]]
+        first_row = max(tile_row * pTileSize - pHalo, 0)
+        first_column = max(tile_column * pTileSize - pHalo, 0)
+        last_row = min((tile_row + 1) * pTileSize + pHalo, pMatrix.shape[0])
+        last_column = min((tile_column + 1) * pTileSize + pHalo, pMatrix.shape[1])
+        block = pMatrix[first_row:last_row, first_column:last_column].toarray()
+        yield indices, block, first_row, first_column
+
+
+def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix):
     """
         Clusters candidates together to one candidate if they share / overlap their neighborhood.
-        Implemented in an iterative way, the candidate with the highest interaction count is accepted as candidate for the neighborhood.
+        A candidate is kept if it has the highest interaction count of its neighborhood, the
+        neighborhood maxima of all candidates are computed with a sliding maximum filter.
 
         Input:
             - pCandidates: List of candidates
@@ -436,212 +511,118 @@ def neighborhood_merge(pCandidates, pWindowSize, pInteractionCountMatrix, pThrea
         Returns:
             - Reduced list of candidates with no more overlapping neighborhoods
     """
-    log.debug('pCandidates {}'.format(pCandidates[:10]))
-    new_candidate_list = []
-
-    new_candidate_list_threads = [None] * pThreads
-    interactionFilesPerThread = len(pCandidates) // pThreads
-    all_data_collected = False
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    thread_done = [False] * pThreads
-    for i in range(pThreads):
-
-        if i < pThreads - 1:
-            candidateThread = pCandidates[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-        else:
-            candidateThread = pCandidates[i * interactionFilesPerThread:]
-        queue[i] = Queue()
-        process[i] = Process(target=neighborhood_merge_thread, kwargs=dict(
-            pCandidateList=candidateThread,
-            pWindowSize=pWindowSize,
-            pInteractionCountMatrix=pInteractionCountMatrix,
-            pQueue=queue[i]
-        )
-        )
-        if len(candidateThread) == 0:
-            process[i] = None
-            queue[i] = None
-            thread_done[i] = True
-
-            new_candidate_list_threads[i] = []
-            continue
-        else:
-            process[i].start()
-        del candidateThread
-    del pInteractionCountMatrix
-    fail_flag = False
-    fail_message = ''
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                new_candidate_list_threads[i] = queue[i].get()
-                if isinstance(new_candidate_list_threads[i], str) and 'Fail: ' in new_candidate_list_threads[i]:
-                    fail_flag = True
-                    fail_message = new_candidate_list_threads[i]
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-    if fail_flag:
-        return fail_message
-    new_candidate_list = [item for sublist in new_candidate_list_threads for item in sublist]
-    del new_candidate_list_threads
-    return new_candidate_list, True
-
-
-def candidate_region_test_thread(pHiCMatrix, pCandidates, pWindowSize, pPValue,
-                                 pPeakWindowSize, pQueue):
-    try:
-        mask = []
-        pvalues = []
-        if len(pCandidates) == 0:
-            pQueue.put([mask, pvalues])
-            return
-        x_max = pHiCMatrix.shape[0]
-        y_max = pHiCMatrix.shape[1]
-        for i, candidate in enumerate(pCandidates):
-
-            if (candidate[0] - pWindowSize) > 0:
-                start_x = candidate[0] - pWindowSize
-            else:
-                start_x = 0
-
-            if (candidate[1] - pWindowSize) > 0:
-                start_y = candidate[1] - pWindowSize
-            else:
-                start_y = 0
-
-            end_x = candidate[0] + pWindowSize + 1 if candidate[0] + \
-                pWindowSize + 1 < x_max else x_max
-
-            end_y = candidate[1] + pWindowSize + 1 if candidate[1] + \
-                pWindowSize + 1 < y_max else y_max
-
-            neighborhood = pHiCMatrix[start_x:end_x,
-                                      start_y:end_y].toarray()
-            if len(neighborhood) == 0:
-                mask.append(False)
-                del neighborhood
-                continue
-            # get index of original candidate
-            peak_region = np.array(np.where(neighborhood == pHiCMatrix[candidate[0], candidate[1]])).flatten()
-
-            if pPeakWindowSize > pWindowSize:
-                log.warning('Neighborhood window size ({}) needs to be larger than peak width({}).'.format(
-                    pWindowSize, pPeakWindowSize))
-                return None, None
-
-            peak = neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1,
-                                peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten()
-
-            background = []
-            # top to peak
-            background.extend(
-                list(neighborhood[:peak_region[0] - pPeakWindowSize, :].flatten()))
-            # from peak to bottom
-            background.extend(
-                list(neighborhood[peak_region[0] + pPeakWindowSize + 1:, :].flatten()))
-
-            # right middle
-            background.extend(
-                list(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten()))
-            # left middle
-            background.extend(
-                list(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten()))
-            background = np.array(background)
-
-            if len(background) < pWindowSize:
-                mask.append(False)
-                del peak
-                del background
-                continue
-            if len(peak) < pWindowSize:
-                mask.append(False)
-                del peak
-                del background
-                continue
-            if np.mean(peak) < np.mean(background):
-                mask.append(False)
-                del peak
-                del background
-                continue
-            if np.max(peak) < np.max(background):
-                mask.append(False)
-                del peak
-                del background
-                continue
+    candidates = np.asarray(pCandidates).reshape(-1, 2)
+    local_maximum = np.zeros(len(candidates), dtype=bool)
+    for indices, block, first_row, first_column in get_dense_tiles(pInteractionCountMatrix, candidates, pWindowSize):
+        # maximum of the (2 * pWindowSize + 1)^2 neighborhood of each pixel, the
+        # neighborhoods are clipped at the matrix borders
+        neighborhood_maximum = maximum_filter(block, size=2 * pWindowSize + 1, mode='nearest')
+        x = candidates[indices, 0] - first_row
+        y = candidates[indices, 1] - first_column
+        local_maximum[indices] = neighborhood_maximum[x, y] == block[x, y]
+        del block
+        del neighborhood_maximum
+    return candidates[local_maximum]
+
+
+def get_donut_masks(pWindowSize, pPeakWindowSize):
+    """
+    The regions of a (2 * pWindowSize + 1)^2 neighborhood with the candidate in its center
+    as boolean masks, see candidate_neighborhood_test.
+
+    Returns the masks of the peak, the background (all but the peak), the horizontal and the
+    vertical stripe through the peak and the bottom left corner.
+
+    >>> peak, background, horizontal, vertical, bottom_left = get_donut_masks(2, 1)
+    >>> print(bottom_left.astype(int))
+    [[0 0 0 0 0]
+     [0 0 0 0 0]
+     [1 0 0 0 0]
+     [1 0 0 0 0]
+     [1 1 1 0 0]]
+    """
+    size = 2 * pWindowSize + 1
+    rows, columns = np.indices((size, size))
+    peak_rows = np.abs(rows - pWindowSize) <= pPeakWindowSize
+    peak_columns = np.abs(columns - pWindowSize) <= pPeakWindowSize
+    peak = peak_rows & peak_columns
+    horizontal = ~peak_rows & peak_columns
+    vertical = peak_rows & ~peak_columns
+    bottom_left = (rows >= pWindowSize) & (columns < pWindowSize - pPeakWindowSize)
+    bottom_left |= (rows > pWindowSize + pPeakWindowSize) & peak_columns & (columns <= pWindowSize)
+    return peak, ~peak, horizontal, vertical, bottom_left
+
+
+def candidate_neighborhood_test(pNeighborhood, pCandidateValue, pWindowSize, pPValue, pPeakWindowSize):
+    """
+        Tests the peak of a single neighborhood against its background, see candidate_region_test.
+        The peak position is taken from the positions of the neighborhood with the value of the candidate.
 
-            donut_test_data = []
-            horizontal = []
-            # top middle
-            horizontal.extend(neighborhood[:peak_region[0] - pPeakWindowSize, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
-            # bottom middle
-            horizontal.extend(neighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
-            horizontal = np.array(horizontal).flatten()
-
-            vertical = []
-            # left
-            vertical.extend(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten())
-            # right
-            vertical.extend(neighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten())
-            vertical = np.array(vertical).flatten()
-
-            # bottom left
-            bottom_left_corner = []
-            bottom_left_corner.extend(neighborhood[peak_region[0]:, :peak_region[1] - pPeakWindowSize].flatten())
-            bottom_left_corner.extend(neighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + 1].flatten())
-            # bottom_left_corner = np.array(bottom_left_corner).flatten()
-            donut_test_data.append(bottom_left_corner)
-            donut_test_data.append(horizontal)
-            donut_test_data.append(vertical)
-
-            del neighborhood
-
-            # test vertical, horizontal, bottom left corner and neighborhood vs peak with wilcoxon-rank-sum test
-            accept_count = 0
-            for data in donut_test_data:
-                statistic, significance_level_test1 = ranksums(sorted(peak), sorted(data))
-                if significance_level_test1 <= pPValue:
-                    accept_count += 1
-            if accept_count >= 3:
-                statistic, significance_level = ranksums(sorted(peak), sorted(background))
-                if significance_level <= pPValue:
-                    mask.append(True)
-                    pvalues.append(significance_level)
-                    del peak
-                    del background
-                    del donut_test_data
-                    continue
-                else:
-                    mask.append(False)
-                    del peak
-                    del background
-                    del donut_test_data
-                    continue
-            else:
-                mask.append(False)
-                del peak
-                del background
-                del donut_test_data
-                continue
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    del pHiCMatrix
-    del pCandidates
-    pQueue.put([mask, pvalues])
-    return
+        Returns the p-value of the peak against the background if the candidate is accepted, None otherwise.
+    """
+    if len(pNeighborhood) == 0:
+        return None
+    # get index of original candidate
+    peak_region = np.array(np.where(pNeighborhood == pCandidateValue)).flatten()
+
+    peak = pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1,
+                         peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten()
+
+    background = []
+    # top to peak
+    background.extend(
+        list(pNeighborhood[:peak_region[0] - pPeakWindowSize, :].flatten()))
+    # from peak to bottom
+    background.extend(
+        list(pNeighborhood[peak_region[0] + pPeakWindowSize + 1:, :].flatten()))
+
+    # right middle
+    background.extend(
+        list(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten()))
+    # left middle
+    background.extend(
+        list(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten()))
+    background = np.array(background)
+
+    if len(background) < pWindowSize or len(peak) < pWindowSize:
+        return None
+    if np.mean(peak) < np.mean(background) or np.max(peak) < np.max(background):
+        return None
+
+    donut_test_data = []
+    horizontal = []
+    # top middle
+    horizontal.extend(pNeighborhood[:peak_region[0] - pPeakWindowSize, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
+    # bottom middle
+    horizontal.extend(pNeighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + pPeakWindowSize + 1].flatten())
+
+    vertical = []
+    # left
+    vertical.extend(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, :peak_region[1] - pPeakWindowSize].flatten())
+    # right
+    vertical.extend(pNeighborhood[peak_region[0] - pPeakWindowSize:peak_region[0] + pPeakWindowSize + 1, peak_region[1] + pPeakWindowSize + 1:].flatten())
+
+    # bottom left
+    bottom_left_corner = []
+    bottom_left_corner.extend(pNeighborhood[peak_region[0]:, :peak_region[1] - pPeakWindowSize].flatten())
+    bottom_left_corner.extend(pNeighborhood[peak_region[0] + pPeakWindowSize + 1:, peak_region[1] - pPeakWindowSize:peak_region[1] + 1].flatten())
+    donut_test_data.append(bottom_left_corner)
+    donut_test_data.append(horizontal)
+    donut_test_data.append(vertical)
+
+    # test vertical, horizontal, bottom left corner and neighborhood vs peak with wilcoxon-rank-sum test
+    for data in donut_test_data:
+        statistic, significance_level_test1 = ranksums(sorted(peak), sorted(data))
+        if not significance_level_test1 <= pPValue:
+            return None
+    statistic, significance_level = ranksums(sorted(peak), sorted(background))
+    if significance_level <= pPValue:
+        return significance_level
+    return None
 
 
 def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
-                          pPeakWindowSize, pThreads):
+                          pPeakWindowSize):
     """
         Tests if a candidate is having a significant peak compared to its neighborhood.
             - smoothes neighborhood in x an y orientation
@@ -653,6 +634,10 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
                 - Size of background is: (2*pWindowSize)^2 - (2*pPeakWindowSize)^2
             - Apply multi-test Bonferonni based on pPValue
 
+        The neighborhoods of all candidates of a tile are taken from one dense array and the peak,
+        background and donut regions are selected with the masks of get_donut_masks, such that the
+        candidates are tested together.
+
         Input:
             - pHiCMatrix: csr_matrix, interaction matrix to extract candidate neighborhood
             - pCandidates: list of candidates to test for enrichment
@@ -665,99 +650,80 @@ def candidate_region_test(pHiCMatrix, pCandidates, pWindowSize, pPValue,
             - List of accepted candidates
             - List of associated p-values
     """
-
-    mask = []
-    pvalues = []
     log.debug('candidate_region_test initial: {}'.format(len(pCandidates)))
 
     if len(pCandidates) == 0:
         return None, None
-
-    pCandidates = np.array(pCandidates)
-
-    mask = []
-
-    mask_thread = [None] * pThreads
-    pvalues_thread = [None] * pThreads
-
-    interactionFilesPerThread = len(pCandidates) // pThreads
-    all_data_collected = False
-    queue = [None] * pThreads
-    process = [None] * pThreads
-    thread_done = [False] * pThreads
-    for i in range(pThreads):
-
-        if i < pThreads - 1:
-            candidateThread = pCandidates[i * interactionFilesPerThread:(i + 1) * interactionFilesPerThread]
-        else:
-            candidateThread = pCandidates[i * interactionFilesPerThread:]
-        queue[i] = Queue()
-        process[i] = Process(target=candidate_region_test_thread, kwargs=dict(
-            pHiCMatrix=pHiCMatrix,
-            pCandidates=candidateThread,
-            pWindowSize=pWindowSize,
-            pPValue=pPValue,
-            pPeakWindowSize=pPeakWindowSize,
-            pQueue=queue[i]
-
-        )
-        )
-        if len(candidateThread) == 0:
-            process[i] = None
-            queue[i] = None
-            thread_done[i] = True
-            pvalues_thread[i] = []
-            mask_thread[i] = []
-            continue
-        else:
-            process[i].start()
-
-    fail_flag = False
-    fail_message = ''
-    while not all_data_collected:
-        for i in range(pThreads):
-            if queue[i] is not None and not queue[i].empty():
-                result_thread = queue[i].get()
-                if isinstance(result_thread, str) and 'Fail: ' in result_thread:
-                    fail_flag = True
-                    fail_message = result_thread
-                else:
-                    mask_thread[i], pvalues_thread[i] = result_thread
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-        all_data_collected = True
-        for thread in thread_done:
-            if not thread:
-                all_data_collected = False
-        time.sleep(1)
-
-    if fail_flag:
-        return fail_message, None
-    mask = [item for sublist in mask_thread for item in sublist]
-    pvalues = [item for sublist in pvalues_thread for item in sublist]
-    del mask_thread
-    del pvalues_thread
-    if mask is not None and len(mask) == 0:
+    if pPeakWindowSize > pWindowSize:
+        log.warning('Neighborhood window size ({}) needs to be larger than peak width({}).'.format(
+            pWindowSize, pPeakWindowSize))
         return None, None
-    mask = np.array(mask)
-    pCandidates = pCandidates[mask]
-    pvalues = np.array(pvalues)
 
-    if len(pCandidates) == 0:
+    candidates = np.asarray(pCandidates).reshape(-1, 2)
+    mask = np.zeros(len(candidates), dtype=bool)
+    pvalues = np.zeros(len(candidates))
+    masks = get_donut_masks(pWindowSize, pPeakWindowSize)
+    peak_mask, background_mask = masks[:2]
+    window = np.arange(-pWindowSize, pWindowSize + 1)
+    center = pWindowSize * (2 * pWindowSize + 1) + pWindowSize
+    for indices, block, first_row, first_column in get_dense_tiles(pHiCMatrix, candidates, pWindowSize):
+        x = candidates[indices, 0] - first_row
+        y = candidates[indices, 1] - first_column
+        # the neighborhoods of the candidates which are not clipped by the matrix borders
+        regular = (candidates[indices, 0] >= pWindowSize) & (candidates[indices, 1] >= pWindowSize) & \
+            (candidates[indices, 0] + pWindowSize < pHiCMatrix.shape[0]) & \
+            (candidates[indices, 1] + pWindowSize < pHiCMatrix.shape[1])
+        neighborhoods = block[x[regular, None, None] + window[None, :, None],
+                              y[regular, None, None] + window[None, None, :]]
+        neighborhoods = neighborhoods.reshape(len(neighborhoods), len(window) ** 2)
+        # the peak position is derived from all positions with the value of the
+        # candidate, it is the candidate itself if there is only one
+        matches = neighborhoods == neighborhoods[:, center, None]
+        centered = matches.sum(axis=1) == 1
+        regular[regular] = centered
+        neighborhoods = neighborhoods[centered]
+
+        peak = neighborhoods[:, peak_mask.flatten()]
+        background = neighborhoods[:, background_mask.flatten()]
+        if background.shape[1] < pWindowSize or peak.shape[1] < pWindowSize:
+            accepted = np.zeros(len(neighborhoods), dtype=bool)
+        else:
+            accepted = (peak.mean(axis=1) >= background.mean(axis=1)) & (peak.max(axis=1) >= background.max(axis=1))
+        # vertical, horizontal and bottom left corner vs peak with wilcoxon-rank-sum test
+        for donut_mask in masks[2:]:
+            accepted[accepted] = ranksums_rows(peak[accepted], neighborhoods[accepted][:, donut_mask.flatten()]) <= pPValue
+        significance_level = ranksums_rows(peak[accepted], background[accepted])
+
+        regular_indices = indices[regular]
+        accepted_indices = regular_indices[accepted]
+        mask[accepted_indices] = significance_level <= pPValue
+        pvalues[accepted_indices] = significance_level
+
+        # candidates at the matrix borders or with the same value elsewhere in their neighborhood
+        for i in indices[~regular]:
+            start_x = max(candidates[i, 0] - pWindowSize, 0) - first_row
+            start_y = max(candidates[i, 1] - pWindowSize, 0) - first_column
+            neighborhood = block[start_x:candidates[i, 0] + pWindowSize + 1 - first_row,
+                                 start_y:candidates[i, 1] + pWindowSize + 1 - first_column]
+            significance_level = candidate_neighborhood_test(neighborhood, block[candidates[i, 0] - first_row, candidates[i, 1] - first_column],
+                                                             pWindowSize, pPValue, pPeakWindowSize)
+            if significance_level is not None:
+                mask[i] = True
+                pvalues[i] = significance_level
+        del block
+        del neighborhoods
+    if not mask.any():
         return None, None
 
-    return pCandidates, pvalues
+    return candidates[mask], pvalues[mask]
 
 
-def cluster_to_genome_position_mapping(pHicMatrix, pCandidates, pPValueList, pMaxLoopDistance):
+def cluster_to_genome_position_mapping(pCutIntervals, pCandidates, pPValueList, pMaxLoopDistance):
     """
         Maps the computed enriched loops from matrix index values to genomic locations.
 
         Input:
-            - pHicMatrix: hicmatrix object
+            - pCutIntervals: the bins of the chromosome
             - pCandidates: List of detect loops
             - pPValueList: Associated p-values of loops
             - pMaxLoopDistance: integer, exclude detected loops if (x - y) has a larger distance
@@ -766,8 +732,8 @@ def cluster_to_genome_position_mapping(pHicMatrix, pCandidates, pPValueList, pMa
     """
     mapped_cluster = []
     for i, candidate in enumerate(pCandidates):
-        chr_x, start_x, end_x, _ = pHicMatrix.getBinPos(candidate[0])
-        chr_y, start_y, end_y, _ = pHicMatrix.getBinPos(candidate[1])
+        chr_x, start_x, end_x, _ = pCutIntervals[candidate[0]]
+        chr_y, start_y, end_y, _ = pCutIntervals[candidate[1]]
         distance = abs(int(start_x) - int(start_y))
         if pMaxLoopDistance is not None and distance > pMaxLoopDistance:
             continue
@@ -792,148 +758,72 @@ def write_bedgraph(pLoops, pOutFileName, pStartRegion=None, pEndRegion=None):
                 fh.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % loop_item)
 
 
-def compute_loops(pHiCMatrix, pRegion, pArgs, pIsCooler, pQueue=None):
+def get_tile_loops(pArgs, pBand, pFirst, pFirstBin, pLastBin, pCutIntervals, pStatistics):
     """
-        Master function to compute the loops for one chromosome.
-            - Removes all regions greater maxLoopSize
-            - Calls
-            - Writes computed loops to a bedgraph file
+        Detects the loops whose first bin is one of the bins pFirstBin to pLastBin in pBand.
+            - Selects the candidates with the p-values of the distributions fitted for the whole chromosome
+            - Calls neighborhood_merge and candidate_region_test
 
         Input:
-            - pHiCMatrix: Hi-C interaction matrix object
-            - pRegion: Chromosome name
-            - pArgs: Argparser object
-            - pIsCooler: True / False if matrix is stored in a .cool file
-            - pQueue: Queue object for multiprocessing communication with parent process
+            - pBand: the upper triangle of the bins pFirst to pFirst + pBand.shape[0] of a chromosome,
+              as returned by load_band
+            - pCutIntervals: the bins of the chromosome
+            - pStatistics: the statistics of the chromosome computed by fit_chromosome
+
+        Returns the list of detected loops in genomic coordinates.
     """
-    try:
+    rows, columns = pBand.nonzero()
+    obs_exp = get_obs_exp(pBand.data, rows + pFirst, columns + pFirst, pStatistics['expected'], pArgs.expected,
+                          pStatistics['row_sums'], pStatistics['total'])
+    obs_exp_matrix = csr_matrix((obs_exp, pBand.indices, pBand.indptr), shape=pBand.shape)
+
+    # only the candidates of the rows of this tile, the other rows are in the neighborhood only
+    mask = (rows + pFirst >= pFirstBin) & (rows + pFirst < pLastBin)
+    mask &= pBand.data >= pArgs.peakInteractionsThreshold
+    mask[mask] = get_preselection_mask(obs_exp[mask], (columns - rows)[mask], pStatistics, pArgs.obsExpThreshold)
+    candidates = np.transpose([rows[mask], columns[mask]])
+    del rows
+    del columns
+    del mask
 
-        if pQueue is not None:
-            if pIsCooler:
-                pHiCMatrix = hm.hiCMatrix(pMatrixFile=pArgs.matrix, pChrnameList=[pRegion], pDistance=pArgs.maxLoopDistance, pNoIntervalTree=True, pUpperTriangleOnly=False)
-            else:
-                pHiCMatrix = hm.hiCMatrix(pMatrixFile=pArgs.matrix, pChrnameList=[pRegion], pDistance=pArgs.maxLoopDistance, pNoIntervalTree=False, pUpperTriangleOnly=False)
-
-        if not pIsCooler:
-            # cooler files load only what is necessary.
-            pHiCMatrix.keepOnlyTheseChr([pRegion])
-            max_loop_distance = pArgs.maxLoopDistance / pHiCMatrix.getBinSize()
-            instances, features = pHiCMatrix.matrix.nonzero()
-            distances = np.absolute(instances - features)
-            mask = distances > max_loop_distance
-            pHiCMatrix.matrix.data[mask] = 0
-            pHiCMatrix.matrix.eliminate_zeros()
-
-        if len(pHiCMatrix.matrix.data) == 0:
-            pQueue.put([None])
-            return
+    mapped_loops = []
+    if len(candidates) > 0:
+        candidates = neighborhood_merge(candidates, pArgs.windowSize, obs_exp_matrix)
+    if len(candidates) > 0:
+        candidates, p_value_list = candidate_region_test(obs_exp_matrix, candidates, pArgs.windowSize,
+                                                         pArgs.pValue, pArgs.peakWidth)
+        if candidates is not None:
+            mapped_loops = cluster_to_genome_position_mapping(pCutIntervals, candidates + pFirst, p_value_list,
+                                                              pArgs.maxLoopDistance)
+    return mapped_loops
+
+
+def compute_tile_loops(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset, pFirstBin, pLastBin, pStatistics, pQueue):
+    """
+        Detects the loops of a chromosome whose first bin is one of the bins pFirstBin to pLastBin.
+        Loads the tile with --windowSize bins more on each side and --maxLoopDistance bins more
+        on the right, the neighborhoods of its candidates are therefore complete, and calls get_tile_loops.
 
-        if pHiCMatrix.matrix.shape[0] < 5 or pHiCMatrix.matrix.shape[1] < 5:
-            log.debug('Computed loops for {}: 0'.format(pRegion))
+        Each loop is found by exactly one tile, no matter how the tiles overlap.
 
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        if pArgs.windowSize is None:
-            bin_size = pHiCMatrix.getBinSize()
-            if 0 < bin_size <= 5000:
-                pArgs.windowSize = 10
-            elif 5000 < bin_size <= 10000:
-                pArgs.windowSize = 5
-            elif 10000 < bin_size <= 25000:
-                pArgs.windowSize = 5
-            elif 25000 < bin_size <= 50000:
-                pArgs.windowSize = 5
-            else:
-                pArgs.windowSize = 5
-            log.debug('Setting window size to: {}'.format(pArgs.windowSize))
-        if pArgs.peakWidth is None:
-            pArgs.peakWidth = pArgs.windowSize - 3
-        log.debug('Setting peak width to: {}'.format(pArgs.peakWidth))
-        pHiCMatrix.matrix = triu(pHiCMatrix.matrix, format='csr')
-        pHiCMatrix.matrix.eliminate_zeros()
-        # log.debug('candidates region {} {}'.format(
-        #     pRegion, len(pHiCMatrix.matrix.data)))
-
-        # delete main diagonal
-        instances, features = pHiCMatrix.matrix.nonzero()
-        distances = np.absolute(instances - features)
-        mask = distances == 0
-        pHiCMatrix.matrix.data[mask] = 0
-        pHiCMatrix.matrix.eliminate_zeros()
-
-        del instances
-        del features
-        del mask
-        del distances
-
-        if pArgs.expected == 'mean':
-            obs_exp_csr_matrix = obs_exp_matrix(pHiCMatrix.matrix, pInplace=False, pToEpsilon=True, pThreads=pArgs.threadsPerChromosome)
-        elif pArgs.expected == 'mean_nonzero':
-            obs_exp_csr_matrix = obs_exp_matrix_non_zero(pHiCMatrix.matrix, ligation_factor=False, pInplace=False, pToEpsilon=True, pThreads=pArgs.threadsPerChromosome)
-
-        elif pArgs.expected == 'mean_nonzero_ligation':
-            obs_exp_csr_matrix = obs_exp_matrix_non_zero(pHiCMatrix.matrix, ligation_factor=True, pInplace=False, pToEpsilon=True, pThreads=pArgs.threadsPerChromosome)
-
-        if not isinstance(obs_exp_csr_matrix, csr_matrix):
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        pHiCMatrix.matrix.eliminate_zeros()
-        obs_exp_csr_matrix.eliminate_zeros()
-        if len(pHiCMatrix.matrix.data) != len(obs_exp_csr_matrix.data):
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        # handle pValuePreselection
-        try:
-            pArgs.pValuePreselection = float(pArgs.pValuePreselection)
-        except Exception:
-            pArgs.pValuePreselection = read_threshold_file(pArgs.pValuePreselection)
-
-        candidates, pValueList = compute_long_range_contacts(pHiCMatrix,
-                                                             obs_exp_csr_matrix,
-                                                             pArgs.windowSize,
-                                                             pArgs.pValue,
-                                                             pArgs.peakWidth,
-                                                             pArgs.pValuePreselection,
-                                                             pArgs.peakInteractionsThreshold,
-                                                             pArgs.obsExpThreshold,
-                                                             pArgs.threadsPerChromosome)
-
-        if candidates is None:
-            log.info('Computed loops for {}: 0'.format(pRegion))
-            if pQueue is None:
-                return None
-            else:
-                pQueue.put([None])
-                return
-        elif isinstance(candidates, str) and 'Fail: ' in candidates and pQueue is not None:
-            pQueue.put(candidates)
-            return
-        elif isinstance(candidates, str) and 'Fail: ' in candidates and pQueue is None:
-            return candidates
-        mapped_loops = cluster_to_genome_position_mapping(
-            pHiCMatrix, candidates, pValueList, pArgs.maxLoopDistance)
-        del pHiCMatrix
-        del candidates
-        log.debug('Computed loops for {}: {}'.format(pRegion, len(mapped_loops)))
+        Input:
+            - pHiCMatrix: the Hi-C matrix for h5 files, None for cool files
+            - pCutIntervals: the bins of the chromosome
+            - pOffset: index of the first bin of the chromosome in pHiCMatrix
+            - pStatistics: the statistics of the chromosome computed by fit_chromosome
+
+        Returns (via pQueue) the list of detected loops in genomic coordinates.
+    """
+    try:
+        bin_size = get_bin_size(pCutIntervals)
+        first = max(pFirstBin - pArgs.windowSize, 0)
+        last = min(pLastBin + pArgs.windowSize + pArgs.maxLoopDistance // bin_size + 1, len(pCutIntervals))
+        band = load_band(pArgs, pIsCooler, pHiCMatrix, pCutIntervals, pOffset, first, last)
+        mapped_loops = get_tile_loops(pArgs, band, first, pFirstBin, pLastBin, pCutIntervals, pStatistics)
     except Exception as exp:
-        if pQueue is not None:
-            pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-            return
-        else:
-            return 'Fail: ' + str(exp) + traceback.format_exc()
-    if pQueue is None:
-        return mapped_loops
-    else:
-        pQueue.put([mapped_loops])
+        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
+        return
+    pQueue.put(mapped_loops)
     return
 
 
@@ -961,125 +851,90 @@ def main(args=None):
     is_cooler = check_cooler(args.matrix)
     if args.threadsPerChromosome < 1:
         args.threadsPerChromosome = 1
-
-    mapped_loops = []
-
-    if not is_cooler:
-        hic_matrix = hm.hiCMatrix(args.matrix)
-        matrix = deepcopy(hic_matrix.matrix)
-        cut_intervals = deepcopy(hic_matrix.cut_intervals)
+    args.cachePrefix = None
+    if args.cacheDirectory is not None:
+        parameters = {'expected': args.expected, 'maxLoopDistance': args.maxLoopDistance}
+        args.cachePrefix = get_cache_prefix(args.matrix, args.cacheDirectory, parameters)
+    # handle pValuePreselection
+    try:
+        args.pValuePreselection = float(args.pValuePreselection)
+    except Exception:
+        args.pValuePreselection = read_threshold_file(args.pValuePreselection)
+
+    # the bins and the index of the first bin in hic_matrix per chromosome
+    cut_intervals = {}
+    offsets = {}
+    if is_cooler:
+        # cooler files are read per tile, only what is necessary.
+        hic_matrix = None
+        cooler_file = cooler.Cooler(args.matrix)
+        for chromosome in cooler_file.chromnames:
+            bins = cooler_file.bins()[['chrom', 'start', 'end']].fetch(chromosome)
+            cut_intervals[chromosome] = [(toString(chrom), start, end, 1.0) for chrom, start, end in bins.values]
+            offsets[chromosome] = 0
+    else:
+        hic_matrix = load_matrix(args.matrix)
+        for chromosome, (start, end) in hic_matrix.chrBinBoundaries.items():
+            cut_intervals[chromosome] = hic_matrix.cut_intervals[start:end]
+            offsets[chromosome] = start
 
     if args.chromosomes is None:
-        # get all chromosomes from cooler file
-        if not is_cooler:
-            chromosomes_list = list(hic_matrix.chrBinBoundaries)
-        else:
-            chromosome_sizes = cooler.Cooler(args.matrix).chromsizes
-
-            # shuffle the processing order of chromosomes.
-            # with this one large chromosome and 4 smalls are in a row
-            # peak memory is reduced and more chromosomes can be processed in parallel on low memory systems.
-            sorted_sizes_desc = chromosome_sizes.sort_values(ascending=False)
-
-            size = sorted_sizes_desc.size
-            chromosome_names_list = sorted_sizes_desc.index.tolist()
-            chromosomes_list = []
-            i = 0
-            j = args.threads  # biggest + thread smallest; 2nd biggest chr + 4 - 8 smallest
-            k = size - 1
-            while i < size:
-                chromosomes_list.append(chromosome_names_list[i])
-                while j > 0 and k > 0:
-                    if k == i:
-                        break
-                    chromosomes_list.append(chromosome_names_list[k])
-                    k -= 1
-                    j -= 1
-                j = args.threads - 1
-                if i == k:
-                    break
-                i += 1
+        chromosomes_list = list(cut_intervals)
     else:
         chromosomes_list = args.chromosomes
-
-    if len(chromosomes_list) < args.threads:
-        args.threads = len(chromosomes_list)
-    if len(chromosomes_list) == 1:
-        single_core = True
-    else:
-        single_core = False
+        for chromosome in chromosomes_list:
+            if chromosome not in cut_intervals:
+                log.error('Chromosome {} is not in the matrix.'.format(chromosome))
+                exit(1)
 
     fail_flag = False
     fail_message = ''
-    if single_core:
-        for chromosome in chromosomes_list:
-            if is_cooler:
-                hic_matrix = hm.hiCMatrix(
-                    pMatrixFile=args.matrix, pChrnameList=[chromosome], pDistance=args.maxLoopDistance, pNoIntervalTree=True, pUpperTriangleOnly=True)
-            else:
-                hic_matrix.setMatrix(
-                    deepcopy(matrix), deepcopy(cut_intervals))
-                hic_matrix.keepOnlyTheseChr([chromosome])
-            loops = compute_loops(hic_matrix, chromosome, args, is_cooler)
-            if loops is None:
-                log.error('No loops could be detected. Please change your input parameters, use a matrix with a better read coverage or contact the develops on https://github.com/deeptools/HiCExplorer/issues')
-                exit(1)
-            if isinstance(loops, str) and 'Fail: ' in loops:
-                log.error(loops[6:])
-                exit(1)
-            if loops is not None:
-                mapped_loops.extend(loops)
-    else:
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        all_data_processed = False
-        all_threads_done = False
-        thread_done = [False] * args.threads
-        count_call_of_read_input = 0
-        while not all_data_processed or not all_threads_done:
-            for i in range(args.threads):
-                if queue[i] is None and not all_data_processed:
-                    if count_call_of_read_input >= len(chromosomes_list):
-                        all_data_processed = True
-                        continue
-                    queue[i] = Queue()
-                    thread_done[i] = False
-                    process[i] = Process(target=compute_loops, kwargs=dict(
-                        pHiCMatrix=args.matrix,
-                        pRegion=chromosomes_list[count_call_of_read_input],
-                        pArgs=args,
-                        pIsCooler=is_cooler,
-                        pQueue=queue[i]
-                    ))
-                    process[i].start()
-
-                    if count_call_of_read_input < len(chromosomes_list):
-                        count_call_of_read_input += 1
-                    else:
-                        all_data_processed = True
-                elif queue[i] is not None and not queue[i].empty():
-                    result = queue[i].get()
-                    if result is not None and isinstance(result, str) and 'Fail: ' in result:
-                        fail_flag = True
-                        fail_message = result
-                    if result[0] is not None:
-                        mapped_loops.extend(result[0])
-
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-                elif all_data_processed and queue[i] is None:
-                    thread_done[i] = True
-                else:
-                    time.sleep(1)
-
-            if all_data_processed:
-                all_threads_done = True
-                for thread in thread_done:
-                    if not thread:
-                        all_threads_done = False
+    # the distributions per distance are fitted for each chromosome as a whole
+    task_arguments = [dict(pArgs=args,
+                           pIsCooler=is_cooler,
+                           pHiCMatrix=hic_matrix,
+                           pChromosome=chromosome,
+                           pCutIntervals=cut_intervals[chromosome],
+                           pOffset=offsets[chromosome]) for chromosome in chromosomes_list]
+    statistics = [None] * len(chromosomes_list)
+    for i, result in run_tasks(fit_chromosome, task_arguments, pThreads=args.threads):
+        if isinstance(result, str) and 'Fail: ' in result:
+            fail_flag = True
+            fail_message = result
+            break
+        statistics[i] = result
+
+    # the loops are detected in tiles of all chromosomes at once, the peak memory
+    # depends on the tile size and not on the size of the chromosomes. The loops of
+    # single tile chromosomes are already known.
+    loops_per_tile = []
+    task_arguments = []
+    task_tiles = []
+    if not fail_flag:
+        for chromosome, chromosome_statistics in zip(chromosomes_list, statistics):
+            if chromosome_statistics is None:
+                continue
+            if chromosome_statistics['loops'] is not None:
+                loops_per_tile.append(chromosome_statistics['loops'])
+                continue
+            tile_size = max(args.tileSize // get_bin_size(cut_intervals[chromosome]), 1)
+            for first, last in get_tiles(len(cut_intervals[chromosome]), tile_size):
+                task_tiles.append(len(loops_per_tile))
+                loops_per_tile.append([])
+                task_arguments.append(dict(pArgs=args,
+                                           pIsCooler=is_cooler,
+                                           pHiCMatrix=hic_matrix,
+                                           pCutIntervals=cut_intervals[chromosome],
+                                           pOffset=offsets[chromosome],
+                                           pFirstBin=first,
+                                           pLastBin=last,
+                                           pStatistics=chromosome_statistics))
+    for i, result in run_tasks(compute_tile_loops, task_arguments, pThreads=args.threads):
+        if isinstance(result, str) and 'Fail: ' in result:
+            fail_flag = True
+            fail_message = result
+            break
+        loops_per_tile[task_tiles[i]] = result
 
     if fail_flag:
         if fail_message is not None:
@@ -1087,6 +942,10 @@ def main(args=None):
         else:
             log.error('An error occurred.')
         exit(1)
+    mapped_loops = [loop for loops in loops_per_tile for loop in loops]
+    if len(mapped_loops) == 0 and len(chromosomes_list) == 1:
+        log.error('No loops could be detected. Please change your input parameters, use a matrix with a better read coverage or contact the develops on https://github.com/deeptools/HiCExplorer/issues')
+        exit(1)
     if len(mapped_loops) > 0:
         write_bedgraph(mapped_loops, args.outFileName)
     log.info("Number of detected loops for all regions: {}".format(
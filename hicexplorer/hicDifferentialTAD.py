@@ -2,15 +2,15 @@ import pandas as pd
 import numpy as np
 from scipy.stats import ranksums
 import argparse
-from multiprocessing import Process, Queue
-import time
 import traceback
 from copy import deepcopy
 import logging
 log = logging.getLogger(__name__)
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import run_tasks
 from hicexplorer._version import __version__
 
 
@@ -121,16 +121,16 @@ def computeDifferentialTADs(pMatrixTarget, pMatrixControl, pDomainList, pCoolOrH
             if pCoolOrH5:
 
                 # # get intra-TAD data
-                hic_matrix_target = hm.hiCMatrix(
+                hic_matrix_target = load_matrix(
                     pMatrixFile=pMatrixTarget, pChrnameList=[str(row[0]) + ':' + str(row[1]) + '-' + str(row[2])])
-                hic_matrix_control = hm.hiCMatrix(
+                hic_matrix_control = load_matrix(
                     pMatrixFile=pMatrixControl, pChrnameList=[str(row[0]) + ':' + str(row[1]) + '-' + str(row[2])])
                 matrix_target = hic_matrix_target.matrix.toarray()
                 matrix_control = hic_matrix_control.matrix.toarray()
 
-                hic_matrix_target_inter_tad = hm.hiCMatrix(
+                hic_matrix_target_inter_tad = load_matrix(
                     pMatrixFile=pMatrixTarget, pChrnameList=[str(chromosom) + ':' + str(start) + '-' + str(end)])
-                hic_matrix_control_inter_tad = hm.hiCMatrix(
+                hic_matrix_control_inter_tad = load_matrix(
                     pMatrixFile=pMatrixControl, pChrnameList=[str(chromosom) + ':' + str(start) + '-' + str(end)])
 
                 matrix_target_inter_tad = hic_matrix_target_inter_tad.matrix
@@ -316,8 +316,8 @@ def main(args=None):
         log.error('Matrices are not given in the same format!')
         exit(1)
     if not is_cooler_control:
-        hic_matrix_target = hm.hiCMatrix(args.targetMatrix)
-        hic_matrix_control = hm.hiCMatrix(args.controlMatrix)
+        hic_matrix_target = load_matrix(args.targetMatrix)
+        hic_matrix_control = load_matrix(args.controlMatrix)
     else:
         hic_matrix_target = args.targetMatrix
         hic_matrix_control = args.controlMatrix
@@ -349,10 +349,7 @@ def main(args=None):
         elif domainsPerThread > 0:
             args.threads = threads_save
 
-        all_data_collected = False
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        thread_done = [False] * args.threads
+        task_arguments = []
         # None --> first thread, process first element in list, ignore last one
         # True --> middle thread: ignore first and last element in tad processing
         # False --> last thread: ignore first element, process last one
@@ -379,46 +376,24 @@ def main(args=None):
             log.debug('len(domainListThread) {}'.format(len(domainListThread)))
             log.debug('len(thread_id) {}'.format(thread_id))
 
-            queue[i] = Queue()
-            process[i] = Process(target=computeDifferentialTADs, kwargs=dict(
+            task_arguments.append(dict(
                 pMatrixTarget=hic_matrix_target,
                 pMatrixControl=hic_matrix_control,
                 pDomainList=domainListThread,
                 pCoolOrH5=is_cooler_control,
                 pPValue=args.pValue,
-                pThreadId=thread_id,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
+                pThreadId=thread_id
+            ))
         fail_flag = False
         fail_message = ''
-        while not all_data_collected:
-            for i in range(args.threads):
-
-                if queue[i] is not None and not queue[i].empty():
-                    queue_data = queue[i].get()
-                    if 'Fail:' in queue_data:
-                        fail_flag = True
-                        fail_message = queue_data
-                    else:
-                        stats_threads[i], p_values_threads[i], accepted_left_inter_threads[i], \
-                            accepted_right_inter_threads[i], \
-                            accepted_intra_threads[i], rows_threads[i] = queue_data
-
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-                # elif queue[i] is None and
-
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+        for i, queue_data in run_tasks(computeDifferentialTADs, task_arguments, pThreads=args.threads):
+            if 'Fail:' in queue_data:
+                fail_flag = True
+                fail_message = queue_data
+            else:
+                stats_threads[i], p_values_threads[i], accepted_left_inter_threads[i], \
+                    accepted_right_inter_threads[i], \
+                    accepted_intra_threads[i], rows_threads[i] = queue_data
 
         # outfile_names = [item for sublist in outfile_names for item in sublist]
         # target_list_name = [
@@ -3,15 +3,21 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import os.path
+import shutil
+import tempfile
 import logging
 import argparse
 import json
 from collections import OrderedDict
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer.utilities import enlarge_bins
+from hicexplorer.utilities import get_cache_prefix
+from hicexplorer.utilities import ranksums_rows
 from scipy import sparse
 import numpy as np
 import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString, toBytes, check_chrom_str_bytes
 
@@ -20,8 +26,8 @@ from past.builtins import map
 
 log = logging.getLogger(__name__)
 
-# this is a holder vor the
-hic_ma = None
+# the SharedBandMatrix used by compute_matrix, set in every worker process by init_worker
+shared_matrix = None
 
 
 def parse_arguments(args=None):
@@ -122,6 +128,15 @@ of information at certain bins, and depending on the parameters used with this t
                            'not be used.',
                            required=False)
 
+    parserOpt.add_argument('--cacheDirectory',
+                           help='Folder in which the z-score matrix and the TAD-separation score are cached. '
+                           'A later run on the same matrix with the same --minDepth, --maxDepth, --step and '
+                           '--chromosomes reuses them, only the boundaries are computed again. This makes it fast '
+                           'to try different values of --thresholdComparisons, --delta or '
+                           '--correctForMultipleTesting. The cached files are identified by the checksum of the '
+                           'matrix file and the parameters. If not set, nothing is stored.',
+                           required=False)
+
     parserOpt.add_argument('--thresholdComparisons',
                            help='P-value threshold for the Bonferroni correction / q-value for FDR. '
                            'The probability of a local minima to be a boundary '
@@ -173,6 +188,74 @@ def compute_matrix_wrapper(args):
     return compute_matrix(*args)
 
 
+def init_worker(pSharedMatrix):
+    global shared_matrix
+    shared_matrix = pSharedMatrix
+
+
+class SharedBandMatrix(object):
+    """
+    The upper band of a Hi-C matrix as CSR matrix together with the start and end
+    position of each bin, stored in RawArrays. The object is handed to the worker
+    processes when they are started, all of them read the same memory independent
+    of the start method (fork or spawn) and of the number of processes.
+
+    :param hic_matrix: HiCMatrix object whose matrix holds only the band that is used
+    """
+
+    def __init__(self, hic_matrix):
+        matrix = sparse.csr_matrix(hic_matrix.matrix)
+        self.shape = matrix.shape
+        self.raw_arrays = {'data': self._to_raw_array(matrix.data, 'd'),
+                           'indices': self._to_raw_array(matrix.indices, 'q'),
+                           'indptr': self._to_raw_array(matrix.indptr, 'q'),
+                           'starts': self._to_raw_array([interval[1] for interval in hic_matrix.cut_intervals], 'q'),
+                           'ends': self._to_raw_array([interval[2] for interval in hic_matrix.cut_intervals], 'q')}
+        # (name, first bin, last bin + 1) per chromosome, in the order of the bins
+        self.chromosome_ranges = sorted([(chrom, first_bin, last_bin) for chrom, (first_bin, last_bin)
+                                         in hic_matrix.chrBinBoundaries.items()], key=lambda chr_range: chr_range[1])
+        self._set_views()
+
+    @staticmethod
+    def _to_raw_array(values, typecode):
+        values = np.asarray(values)
+        raw_array = RawArray(typecode, len(values))
+        if len(values) > 0:
+            np.frombuffer(raw_array, dtype=typecode)[:] = values
+        return raw_array
+
+    def _set_views(self):
+        # numpy arrays on the shared memory, nothing is copied
+        arrays = {name: np.frombuffer(raw_array, dtype=raw_array._type_)
+                  for name, raw_array in self.raw_arrays.items()}
+        self.matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=self.shape)
+        self.starts = arrays['starts']
+        self.ends = arrays['ends']
+
+    def __getstate__(self):
+        # only the RawArrays are transferred, the views are rebuilt in the worker
+        state = self.__dict__.copy()
+        for view in ['matrix', 'starts', 'ends']:
+            del state[view]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_views()
+
+    def get_tasks(self, pBinsPerTask=5000):
+        """
+        Splits the bins into ranges of at most pBinsPerTask bins, a range never
+        contains bins of two chromosomes. The ranges do not depend on the number
+        of processes, such that the scores are always computed the same way.
+        """
+        tasks = []
+        for _, first_bin, last_bin in self.chromosome_ranges:
+            for start in range(first_bin, last_bin, pBinsPerTask):
+                tasks.append(np.arange(start, min(start + pBinsPerTask, last_bin)))
+        return tasks
+
+
 def get_cut_weight_by_bin_id(matrix, cut, depth, return_mean=False):
     """
     like get_cut_weight which is the 'diamond' representing the counts
@@ -301,9 +384,102 @@ def get_incremental_step_size(min_win_size, max_win_size, start_step_len):
     return incremental_step
 
 
+class BandIntegral(object):
+    """
+    Summed-area table of a matrix that has values only in the band
+    0 <= j - i < band_width of the upper triangle, like the matrix used for the
+    TAD-separation score. The table needs O(n * band_width) memory and gives
+    the sum of any rectangle above the diagonal with four lookups.
+
+    :param matrix: scipy sparse matrix, values outside of the band are ignored
+    :param band_width: width of the band, by default the largest distance
+                       of a value to the diagonal plus one
+
+    >>> matrix = sparse.csr_matrix(np.triu(np.arange(36, dtype=float).reshape(6, 6)) -
+    ...                            np.triu(np.arange(36, dtype=float).reshape(6, 6), k=3))
+    >>> integral = BandIntegral(matrix)
+    >>> integral.diamond_sum(np.array([0, 1]), np.array([2, 3]), np.array([4, 6]))
+    array([19., 40.])
+    >>> float(matrix[0:2, 2:4].sum()), float(matrix[1:3, 3:6].sum())
+    (19.0, 40.0)
+    """
+
+    def __init__(self, matrix, band_width=None):
+        matrix = sparse.coo_matrix(matrix)
+        matrix.sum_duplicates()
+        size = matrix.shape[0]
+        offset = matrix.col - matrix.row
+        if band_width is None:
+            band_width = offset.max() + 1 if matrix.nnz > 0 else 1
+        width = max(1, int(band_width))
+        in_band = (offset >= 0) & (offset < width)
+
+        # band[i, d] = matrix[i, i + d], row_prefix[i, k] = sum(band[i, :k])
+        row_prefix = np.zeros((size, width + 1))
+        row_prefix[matrix.row[in_band], offset[in_band] + 1] = matrix.data[in_band]
+        np.cumsum(row_prefix, axis=1, out=row_prefix)
+        # sum of all rows above row i
+        self.rows_above = np.concatenate([[0], np.cumsum(row_prefix[:, width])])
+        # upper[j, k] = sum of row_prefix[j - e, e] for k <= e < width, the part of the
+        # rows j - width < i' < j left of column j that is not covered by rows_above
+        self.upper = np.zeros((size + 1, width + 1))
+        for e in range(1, width):
+            self.upper[e:, e] = row_prefix[:size + 1 - e, e]
+        self.upper[:, 1:] = np.cumsum(self.upper[:, :0:-1], axis=1)[:, ::-1]
+        self.width = width
+
+    def prefix_sum(self, rows, cols):
+        """
+        Sum of matrix[:rows, :cols] for cols >= rows.
+        """
+        # nothing of the rows above is right of column rows + width - 1
+        cols = rows + np.minimum(cols - rows, self.width - 1)
+        return self.rows_above[np.clip(cols - self.width + 1, 0, rows)] + self.upper[cols, cols - rows + 1]
+
+    def diamond_sum(self, left, cut, right):
+        """
+        Sum of matrix[left:cut, cut:right], the 'diamond' when the matrix is
+        rotated 45 degrees, for left <= cut <= right.
+        """
+        return self.prefix_sum(cut, right) - self.prefix_sum(left, right) - \
+            self.prefix_sum(cut, cut) + self.prefix_sum(left, cut)
+
+
+def get_bin_at_position(starts, ends, positions):
+    """
+    Index of the bin given by sorted starts and ends that contains each position
+    and if such a bin exists.
+    """
+    idx = np.searchsorted(starts, positions, side='right') - 1
+    found = (idx >= 0) & (ends[np.clip(idx, 0, None)] > positions)
+    return np.clip(idx, 0, None), found
+
+
+def get_idx_of_bins_at_distances(starts, ends, cuts, distances):
+    """
+    Vectorized get_idx_of_bins_at_given_distance for the bins of one chromosome.
+
+    :param starts: start positions of the bins of the chromosome
+    :param ends: end positions of the bins of the chromosome
+    :param cuts: bin indices relative to the first bin of the chromosome
+    :param distances: distances in bp
+    :return: left and right bin indices of shape (len(cuts), len(distances)) and
+             per cut if all bins were found
+    """
+    chr_end_pos = ends[-1]
+    left_idx, left_found = get_bin_at_position(starts, ends, np.maximum(0, starts[cuts, None] - distances))
+    right_positions = np.minimum(chr_end_pos, ends[cuts, None] + distances) - 1
+    right_idx, right_found = get_bin_at_position(starts, ends, right_positions)
+    return left_idx, right_idx, left_found.all(axis=1) & right_found.all(axis=1)
+
+
 def compute_matrix(bins_list, min_win_size=8, max_win_size=50, step_len=2):
     """
     Receives a number of bins for which the tad-score should be computed.
+    The score is the mean of the 'diamond' of each bin (see get_cut_weight)
+    for all window sizes. Instead of slicing the matrix for every bin and
+    window, the diamond sums of all bins and windows of a chromosome are
+    looked up in a BandIntegral of the region they cover.
     Parameters
     ----------
     hic_ma Hi-C matrix object
@@ -316,38 +492,138 @@ def compute_matrix(bins_list, min_win_size=8, max_win_size=50, step_len=2):
     """
 
     """
-    :param hic_ma: Hi-C matrix object from HiCMatrix
-    :param outfile: String, path of a file to save the conductance
-                matrix in *bedgraph matrix* format
+    :param bins_list: bin ids of the matrix of the module wide SharedBandMatrix shared_matrix
     :return: (chrom, start, end, matrix)
     """
-    global hic_ma
-    positions_array = []
+    incremental_step = np.array(get_incremental_step_size(min_win_size, max_win_size, step_len))
+    bins_list = np.asarray(bins_list, dtype=np.int64)
+    chrom = []
+    chr_start = []
+    chr_end = []
     cond_matrix = []
-    incremental_step = get_incremental_step_size(min_win_size, max_win_size, step_len)
-    # if type(next(iter(self.interval_trees))) is np.bytes_:
-    #     chrname = toBytes(chrname)
-    # else:
-    #     chrname = toString(chrname)
-    # print("cut_intervals", hic_ma.cut_intervals)
-    for cut in bins_list:
-        chrom, chr_start, chr_end, _ = hic_ma.cut_intervals[cut]
-        # get conductance
-        # for multiple window lengths at a time
-        mult_matrix = [get_cut_weight(hic_ma, cut, depth, return_mean=True) for depth in incremental_step]
-        if any(x is None or np.isnan(x) for x in mult_matrix):
-            # skip problematic cases
+    for chrom_name, chr_first_bin, chr_last_bin in shared_matrix.chromosome_ranges:
+        cuts = bins_list[(bins_list >= chr_first_bin) & (bins_list < chr_last_bin)]
+        if len(cuts) == 0:
+            continue
+        starts = shared_matrix.starts[chr_first_bin:chr_last_bin]
+        ends = shared_matrix.ends[chr_first_bin:chr_last_bin]
+        local_cuts = cuts - chr_first_bin
+
+        # the bins at window_len distance of each cut
+        left_idx, right_idx, valid = get_idx_of_bins_at_distances(starts, ends, local_cuts, incremental_step)
+        # skip problematic cases
+        local_cuts, left_idx, right_idx = local_cuts[valid], left_idx[valid], right_idx[valid]
+        if len(local_cuts) == 0:
             continue
 
-        cond_matrix.append(mult_matrix)
-
-        positions_array.append((chrom, chr_start, chr_end))
-    chrom, chr_start, chr_end = zip(*positions_array)
-    cond_matrix = np.vstack(cond_matrix)
+        region_start = left_idx.min()
+        region_end = max(right_idx.max(), local_cuts.max())
+        region = shared_matrix.matrix[chr_first_bin + region_start:chr_first_bin + region_end,
+                                      chr_first_bin + region_start:chr_first_bin + region_end]
+        # no diamond reaches further from the diagonal
+        band_width = (right_idx - left_idx).max()
+        nan_values = np.isnan(region.data)
+        if nan_values.any():
+            nan_region = region.copy()
+            nan_region.data = nan_values.astype(float)
+            region.data[nan_values] = 0
+            # a window with a nan value has a nan mean and the bin is skipped
+            nan_integral = BandIntegral(nan_region, band_width)
+            nan_counts = nan_integral.diamond_sum(left_idx - region_start, local_cuts[:, None] - region_start,
+                                                  right_idx - region_start)
+            keep = ~(nan_counts > 0).any(axis=1)
+            local_cuts, left_idx, right_idx = local_cuts[keep], left_idx[keep], right_idx[keep]
+
+        cut_column = local_cuts[:, None]
+        integral = BandIntegral(region, band_width)
+        diamond = integral.diamond_sum(left_idx - region_start, cut_column - region_start, right_idx - region_start)
+        # the mean of the diamond, 0 for empty diamonds
+        size = (cut_column - left_idx) * (right_idx - cut_column)
+        mean = np.zeros(diamond.shape)
+        np.divide(diamond, size, out=mean, where=size > 0)
+
+        cond_matrix.append(mean)
+        chrom.extend([chrom_name] * len(local_cuts))
+        chr_start.extend(starts[local_cuts].tolist())
+        chr_end.extend(ends[local_cuts].tolist())
+
+    if len(cond_matrix) > 0:
+        cond_matrix = np.vstack(cond_matrix)
+    else:
+        cond_matrix = np.zeros((0, len(incremental_step)))
 
     return chrom, chr_start, chr_end, cond_matrix
 
 
+def get_diamond_values(matrix, left, cut, right):
+    """
+    The values of matrix[left:cut, cut:right] (see get_cut_weight) for many
+    cuts at once. All diamonds must have the same shape.
+
+    :return: array of shape (len(cut), (cut - left) * (right - cut))
+    """
+    rows = left[:, None, None] + np.arange(cut[0] - left[0])[None, :, None]
+    cols = cut[:, None, None] + np.arange(right[0] - cut[0])[None, None, :]
+    rows, cols = np.broadcast_arrays(rows, cols)
+    values = np.asarray(matrix[rows.ravel(), cols.ravel()], dtype=float).reshape(len(cut), -1)
+    return values
+
+
+def compute_pvalues_wrapper(args):
+    return compute_pvalues(*args)
+
+
+def compute_pvalues(bins_list, window_len, max_values=10000000):
+    """
+    Compares the diamond of each bin with the diamonds of the bins at
+    window_len distance to the left and to the right with the Wilcoxon
+    rank-sum test. The diamonds of the same shape are tested together.
+
+    :param bins_list: bin ids of the matrix of the module wide SharedBandMatrix shared_matrix
+    :param window_len: window length in bp
+    :param max_values: largest number of matrix values that is tested at once
+    :return: the smaller of both p-values per bin, nan if a diamond is missing or empty
+    """
+    bins_list = np.asarray(bins_list, dtype=np.int64)
+    pvalues = np.full(len(bins_list), np.nan)
+    distance = np.array([window_len])
+    for _, chr_first_bin, chr_last_bin in shared_matrix.chromosome_ranges:
+        in_chromosome = np.flatnonzero((bins_list >= chr_first_bin) & (bins_list < chr_last_bin))
+        if len(in_chromosome) == 0:
+            continue
+        starts = shared_matrix.starts[chr_first_bin:chr_last_bin]
+        ends = shared_matrix.ends[chr_first_bin:chr_last_bin]
+        cuts = bins_list[in_chromosome] - chr_first_bin
+
+        # (left, cut, right) of the diamond of the boundary and of its neighbors
+        left_idx, right_idx, found = get_idx_of_bins_at_distances(starts, ends, cuts, distance)
+        diamonds = [(left_idx[:, 0], cuts, right_idx[:, 0])]
+        for neighbor in [left_idx[:, 0], right_idx[:, 0]]:
+            neighbor_left, neighbor_right, neighbor_found = get_idx_of_bins_at_distances(starts, ends, neighbor,
+                                                                                         distance)
+            found &= neighbor_found
+            diamonds.append((neighbor_left[:, 0], neighbor, neighbor_right[:, 0]))
+
+        shapes = np.column_stack([np.column_stack([cut - left, right - cut]) for left, cut, right in diamonds])
+        # missing or empty diamonds keep a p-value of nan
+        testable = found & (shapes > 0).all(axis=1)
+        shapes, group_ids = np.unique(shapes[testable], axis=0, return_inverse=True)
+        testable_idx = np.flatnonzero(testable)
+        for group_id, shape in enumerate(shapes):
+            group = testable_idx[group_ids.ravel() == group_id]
+            chunk_size = max(1, max_values // int(shape[0::2].dot(shape[1::2])))
+            for chunk_start in range(0, len(group), chunk_size):
+                chunk = group[chunk_start:chunk_start + chunk_size]
+                boundary, left, right = [get_diamond_values(shared_matrix.matrix, chr_first_bin + left[chunk],
+                                                            chr_first_bin + cut[chunk], chr_first_bin + right[chunk])
+                                         for left, cut, right in diamonds]
+                pvalue_left = ranksums_rows(boundary, left)
+                pvalue_right = ranksums_rows(boundary, right)
+                # min(pvalue_left, pvalue_right) with a nan in pvalue_right ignored
+                pvalues[in_chromosome[chunk]] = np.where(pvalue_right < pvalue_left, pvalue_right, pvalue_left)
+    return pvalues
+
+
 class HicFindTads(object):
 
     def __init__(self, matrix, num_processors=1, max_depth=None, min_depth=None, step=None, delta=0.01,
@@ -393,9 +669,11 @@ class HicFindTads(object):
 
     def set_matrix(self, pMatrix, pChromosomes):
         if isinstance(pMatrix, str):
-            self.hic_ma = hm.hiCMatrix(pMatrix)
+            self.hic_ma = load_matrix(pMatrix)
         else:
             self.hic_ma = pMatrix
+        # the matrix in shared memory for the worker processes, created when needed
+        self.shared_matrix = None
 
         if pChromosomes is not None:
             valid_chromosomes = []
@@ -1092,23 +1370,23 @@ class HicFindTads(object):
         self.hic_ma.matrix.eliminate_zeros()
 
         func = compute_matrix_wrapper
-        TASKS = []
-        bins_to_consider = []
-        # to speed up parallel computation the self.hic_ma (HiCMatrix object) is converted into a global object.
-        global hic_ma
-        hic_ma = self.hic_ma
-        for chrom in list(self.hic_ma.chrBinBoundaries):
-            bins_to_consider.extend(list(range(*self.hic_ma.chrBinBoundaries[chrom])))
-
-        for idx_array in np.array_split(bins_to_consider, self.num_processors):
-            TASKS.append((idx_array, self.min_depth, self.max_depth, self.step))
+        # the band and the bin positions are placed once in shared memory, the
+        # workers receive them at their start and the tasks contain only bin ids
+        band_matrix = SharedBandMatrix(self.hic_ma)
+        self.hic_ma.matrix = band_matrix.matrix
+        self.shared_matrix = band_matrix
+        # usually more tasks than processors, a process that finishes early takes the next one
+        TASKS = [(idx_array, self.min_depth, self.max_depth, self.step)
+                 for idx_array in band_matrix.get_tasks()]
 
         if self.num_processors > 1:
-            pool = multiprocessing.Pool(self.num_processors)
+            pool = multiprocessing.Pool(self.num_processors, initializer=init_worker, initargs=(band_matrix,))
             log.info("Using {} processors\n".format(self.num_processors))
-            res = pool.map_async(func, TASKS).get(9999999)
+            res = list(pool.imap(func, TASKS))
             pool.close()
+            pool.join()
         else:
+            init_worker(band_matrix)
             res = map(func, TASKS)
 
         chrom = []
@@ -1165,6 +1443,33 @@ class HicFindTads(object):
                                 'chr_end': np.array(end_list).astype(int),
                                 'matrix': matrix}
 
+    def save_bedgraph_matrix_binary(self, outfile):
+        """
+        Saves the bedgraph matrix and its parameters as .npz file, which is much
+        faster to load than the .bm text file.
+        """
+        params = OrderedDict()
+        params['step'] = self.step
+        params['minDepth'] = self.min_depth
+        params['maxDepth'] = self.max_depth
+        params['binsize'] = self.binsize
+        with open(outfile, 'wb') as fh:
+            np.savez(fh, chrom=np.array(toString(list(self.bedgraph_matrix['chrom'])), dtype=str),
+                     chr_start=self.bedgraph_matrix['chr_start'], chr_end=self.bedgraph_matrix['chr_end'],
+                     matrix=self.bedgraph_matrix['matrix'], parameters=json.dumps(params))
+
+    def load_bedgraph_matrix_binary(self, filename):
+        with np.load(filename) as data:
+            parameters = json.loads(str(data['parameters']))
+            self.bedgraph_matrix = {'chrom': data['chrom'],
+                                    'chr_start': data['chr_start'].astype(int),
+                                    'chr_end': data['chr_end'].astype(int),
+                                    'matrix': data['matrix']}
+        self.min_depth = parameters['minDepth']
+        self.max_depth = parameters['maxDepth']
+        self.step = parameters['step']
+        self.binsize = parameters['binsize']
+
     def min_pvalue(self, min_idx):
         """
         For each putative local minima, find the -window_len diammond and the +window_len diamond
@@ -1178,73 +1483,60 @@ class HicFindTads(object):
         """
 
         log.info("Computing p-values for window length: {}\n".format(self.min_depth))
-        pvalues = []
         chrom = self.bedgraph_matrix['chrom']
         chr_start = self.bedgraph_matrix['chr_start']
         chr_end = self.bedgraph_matrix['chr_end']
         window_len = self.min_depth
 
-        from scipy.stats import ranksums
-
-        new_min_idx = []
-        for idx in min_idx:
-
-            matrix_idx = self.hic_ma.getRegionBinRange(chrom[idx], chr_start[idx], chr_end[idx])
-            if matrix_idx is None:
+        if self.shared_matrix is None:
+            self.shared_matrix = SharedBandMatrix(self.hic_ma)
+            self.hic_ma.matrix = self.shared_matrix.matrix
+
+        # matrix bin of each local minimum, minima whose start or end is not
+        # within a bin of the matrix are skipped
+        min_idx = np.asarray(min_idx, dtype=np.int64)
+        matrix_idx = np.full(len(min_idx), -1, dtype=np.int64)
+        for chrom_name, chr_first_bin, chr_last_bin in self.shared_matrix.chromosome_ranges:
+            in_chromosome = np.flatnonzero(chrom[min_idx] == toString(chrom_name))
+            if len(in_chromosome) == 0:
                 continue
-            else:
-                matrix_idx = matrix_idx[0]
-
-            new_min_idx += [idx]
-            min_chr, min_start, min_end, _ = self.hic_ma.getBinPos(matrix_idx)
-            assert toString(chrom[idx]) == toString(min_chr) and chr_start[idx] == min_start and chr_end[idx] == min_end
-            left_idx, right_idx = get_idx_of_bins_at_given_distance(self.hic_ma, matrix_idx, window_len)
-
-            left = get_cut_weight(self.hic_ma, left_idx, window_len)
-            right = get_cut_weight(self.hic_ma, right_idx, window_len)
-            boundary = get_cut_weight(self.hic_ma, matrix_idx, window_len)
-
-            if left is None:
-                left = []
-            if right is None:
-                right = []
-
-            if len(left) == 0 and len(right) == 0:
-                pval = np.nan
-
-            elif boundary is None or len(boundary) == 0 or len(left) == 0 or len(right) == 0:
-                pval = np.nan
-
-            else:
-
-                try:
-                    pval1 = ranksums(boundary, left)[1]
-                    pval2 = ranksums(boundary, right)[1]
-                    pval = min(pval1, pval2)
-                except ValueError:
-                    # this condition happens when boundary, left and right are only composed of 'zeros'
-                    pval = np.nan
-            pvalues += [pval]
+            starts = self.shared_matrix.starts[chr_first_bin:chr_last_bin]
+            ends = self.shared_matrix.ends[chr_first_bin:chr_last_bin]
+            start_bin, start_found = get_bin_at_position(starts, ends, chr_start[min_idx[in_chromosome]])
+            _, end_found = get_bin_at_position(starts, ends, chr_end[min_idx[in_chromosome]] - 1)
+            found = start_found & end_found
+            matrix_idx[in_chromosome[found]] = start_bin[found] + chr_first_bin
+        new_min_idx = min_idx[matrix_idx >= 0]
+        matrix_idx = matrix_idx[matrix_idx >= 0]
+        assert np.array_equal(self.shared_matrix.starts[matrix_idx], chr_start[new_min_idx]) and \
+            np.array_equal(self.shared_matrix.ends[matrix_idx], chr_end[new_min_idx])
+
+        # the minima are tested in chunks that are distributed to the processes
+        TASKS = [(bins, window_len) for bins in np.array_split(matrix_idx, max(1, len(matrix_idx) // 1000))]
+        if self.num_processors > 1 and len(TASKS) > 1:
+            pool = multiprocessing.Pool(self.num_processors, initializer=init_worker, initargs=(self.shared_matrix,))
+            res = list(pool.imap(compute_pvalues_wrapper, TASKS))
+            pool.close()
+            pool.join()
+        else:
+            init_worker(self.shared_matrix)
+            res = list(map(compute_pvalues_wrapper, TASKS))
+        pvalues = np.concatenate(res) if len(res) > 0 else np.array([])
+        new_min_idx = new_min_idx.tolist()
 
         assert len(pvalues) == len(new_min_idx)
 
         # fdr
         if self.correct_for_multiple_testing == 'fdr':
-
-            pvalues = np.array([e if ~np.isnan(e) else 1 for e in pvalues])
-            pvalues_ = sorted(pvalues)
-            largest_p_i = 0
-            for i, p in enumerate(pvalues_):
-                if p <= (self.threshold_comparisons * (i + 1) / len(pvalues_)):
-                    if p >= largest_p_i:
-                        largest_p_i = p
-            self.pvalueFDR = largest_p_i
+            pvalues[np.isnan(pvalues)] = 1
+            # Benjamini-Hochberg: the largest p-value that is below its threshold
+            sorted_pvalues = np.sort(pvalues)
+            thresholds = self.threshold_comparisons * np.arange(1, len(sorted_pvalues) + 1) / len(sorted_pvalues)
+            below_threshold = sorted_pvalues[sorted_pvalues <= thresholds]
+            self.pvalueFDR = below_threshold.max() if len(below_threshold) > 0 else 0
         elif self.correct_for_multiple_testing == 'bonferroni':
             # bonferroni correction
-            pvalues = np.array(pvalues) * len(pvalues)
-            to_one_index_values = np.array([e > 1 if ~np.isnan(e) else False for e in pvalues])
-            if len(to_one_index_values) > 0:
-                pvalues[to_one_index_values] = 1
+            pvalues = np.minimum(pvalues * len(pvalues), 1)
 
         return OrderedDict(zip(new_min_idx, pvalues))
 
@@ -1294,6 +1586,22 @@ class HicFindTads(object):
                            'pvalues': pvalues}
 
 
+def write_cache_file(pFileName, pWrite):
+    """
+    Writes a file of the cache with pWrite(file_name) to a unique temporary file in the
+    folder of pFileName and moves it to pFileName, parallel runs never read or write a partial file.
+    """
+    file_descriptor, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(pFileName) or '.', suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        pWrite(temp_file_name)
+        os.replace(temp_file_name, pFileName)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+        raise
+
+
 def print_args(args):
     """
     Print to stderr the parameters used
@@ -1343,10 +1651,33 @@ def main(args=None):
         ft.load_bedgraph_matrix(tad_score_file, args.chromosomes)
 
     elif not os.path.isfile(tad_score_file):
-        ft.compute_spectra_matrix()
-        # save z-score matrix that is needed for find TADs algorithm
-        ft.hic_ma.save(args.outPrefix + "_zscore_matrix." + matrix_ending)
-        ft.save_bedgraph_matrix(tad_score_file)
+        cache_prefix = None
+        if args.cacheDirectory is not None:
+            parameters = {'minDepth': args.minDepth, 'maxDepth': args.maxDepth, 'step': args.step,
+                          'chromosomes': args.chromosomes, 'use_zscore': True}
+            cache_prefix = get_cache_prefix(args.matrix, args.cacheDirectory, parameters)
+            cached_tad_score_file = cache_prefix + "_tad_score.bm"
+            cached_zscore_matrix_file = cache_prefix + "_zscore_matrix." + matrix_ending
+            # the .npz file is written last, it exists only if the cache is complete
+            cached_bedgraph_matrix_file = cache_prefix + "_tad_score.npz"
+
+        if cache_prefix is not None and os.path.isfile(cached_bedgraph_matrix_file):
+            log.info("\nUsing the cached TAD-separation score: {}\n".format(cached_tad_score_file))
+            shutil.copyfile(cached_zscore_matrix_file, zscore_matrix_file)
+            shutil.copyfile(cached_tad_score_file, tad_score_file)
+            ft.set_matrix(zscore_matrix_file, args.chromosomes)
+            ft.load_bedgraph_matrix_binary(cached_bedgraph_matrix_file)
+        else:
+            ft.compute_spectra_matrix()
+            # save z-score matrix that is needed for find TADs algorithm
+            ft.hic_ma.save(args.outPrefix + "_zscore_matrix." + matrix_ending)
+            ft.save_bedgraph_matrix(tad_score_file)
+            if cache_prefix is not None:
+                if not os.path.isdir(args.cacheDirectory):
+                    os.makedirs(args.cacheDirectory)
+                write_cache_file(cached_zscore_matrix_file, lambda file_name: shutil.copyfile(zscore_matrix_file, file_name))
+                write_cache_file(cached_tad_score_file, lambda file_name: shutil.copyfile(tad_score_file, file_name))
+                write_cache_file(cached_bedgraph_matrix_file, ft.save_bedgraph_matrix_binary)
     else:
         log.info("\nFound existing TAD-separation score file: {}\n".format(tad_score_file))
         log.info("This file will be used\n")
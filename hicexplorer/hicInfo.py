@@ -6,10 +6,10 @@ from io import StringIO
 
 import cooler
 
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import load_matrix
 import logging
 log = logging.getLogger(__name__)
 
@@ -120,7 +120,7 @@ def main(args=None):
                 chromosome_sizes = cooler_file.chromsizes
 
         else:
-            hic_ma = hm.hiCMatrix(matrix)
+            hic_ma = load_matrix(matrix)
             size = hic_ma.matrix.shape[0]
             num_non_zero = hic_ma.matrix.nnz
             sum_elements = ((hic_ma.matrix.sum() - hic_ma.matrix.diagonal().sum()) / 2) + hic_ma.matrix.diagonal().sum()
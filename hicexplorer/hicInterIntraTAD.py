@@ -1,7 +1,5 @@
 import pandas as pd
 import argparse
-from multiprocessing import Process, Queue
-import time
 import traceback
 from copy import deepcopy
 import matplotlib.pyplot as plt
@@ -9,8 +7,10 @@ import matplotlib as mpl
 import logging
 log = logging.getLogger(__name__)
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 
 from hicexplorer.utilities import check_cooler
+from hicexplorer.utilities import run_tasks
 from hicexplorer._version import __version__
 
 
@@ -128,11 +128,11 @@ def computeInterIntraTADs(pMatrix, pDomainList, pCoolOrH5, pThreadId, pQueue):
             if pCoolOrH5:
 
                 # # get intra-TAD data
-                hic_matrix = hm.hiCMatrix(
+                hic_matrix = load_matrix(
                     pMatrixFile=pMatrix, pChrnameList=[str(row[0]) + ':' + str(row[1]) + '-' + str(row[2])])
                 matrix = hic_matrix.matrix
 
-                hic_matrix_inter_tad = hm.hiCMatrix(
+                hic_matrix_inter_tad = load_matrix(
                     pMatrixFile=pMatrix, pChrnameList=[str(chromosom) + ':' + str(start) + '-' + str(end)])
 
                 matrix_inter_tad = hic_matrix_inter_tad.matrix
@@ -300,7 +300,7 @@ def main(args=None):
     is_cooler = check_cooler(args.matrix)
 
     if not is_cooler:
-        hic_matrix = hm.hiCMatrix(args.matrix)
+        hic_matrix = load_matrix(args.matrix)
     else:
         hic_matrix = args.matrix
 
@@ -352,10 +352,7 @@ def main(args=None):
         elif domainsPerThread > 0:
             args.threads = threads_save
 
-        all_data_collected = False
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        thread_done = [False] * args.threads
+        task_arguments = []
         # None --> first thread, process first element in list, ignore last one
         # True --> middle thread: ignore first and last element in tad processing
         # False --> last thread: ignore first element, process last one
@@ -382,59 +379,37 @@ def main(args=None):
             # log.debug('len(domainListThread) {}'.format(len(domainListThread)))
             # log.debug('len(thread_id) {}'.format(thread_id))
 
-            queue[i] = Queue()
-            process[i] = Process(target=computeInterIntraTADs, kwargs=dict(
+            task_arguments.append(dict(
                 pMatrix=hic_matrix,
                 # pMatrixControl=hic_matrix_control,
                 pDomainList=domainListThread,
                 pCoolOrH5=is_cooler,
                 # pPValue=args.pValue,
-                pThreadId=thread_id,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
+                pThreadId=thread_id
+            ))
         fail_flag = False
         fail_message = ''
-        while not all_data_collected:
-            for i in range(args.threads):
-
-                if queue[i] is not None and not queue[i].empty():
-                    queue_data = queue[i].get()
-                    if 'Fail:' in queue_data:
-                        fail_flag = True
-                        fail_message = queue_data
-                    else:
-                        inter_left_sum_list_threads[i], \
-                            inter_right_sum_list_threads[i], \
-                            inter_left_density_list_threads[i], \
-                            inter_right_density_list_threads[i], \
-                            inter_left_number_of_contacts_list_threads[i], \
-                            inter_right_number_of_contacts_list_threads[i], \
-                            inter_left_number_of_contacts_nnz_list_threads[i], \
-                            inter_right_number_of_contacts_nzz_list_threads[i], \
-                            intra_sum_list_threads[i], \
-                            intra_number_of_contacts_list_threads[i], \
-                            intra_number_of_contacts_nnz_list_threads[i], \
-                            intra_density_list_threads[i], \
-                            inter_left_intra_ratio_list_threads[i], \
-                            inter_right_intra_ratio_list_threads[i], \
-                            inter_left_inter_right_intra_ratio_list_threads[i], \
-                            rows_threads[i] = queue_data
-
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-                # elif queue[i] is None and
-
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+        for i, queue_data in run_tasks(computeInterIntraTADs, task_arguments, pThreads=args.threads):
+            if 'Fail:' in queue_data:
+                fail_flag = True
+                fail_message = queue_data
+            else:
+                inter_left_sum_list_threads[i], \
+                    inter_right_sum_list_threads[i], \
+                    inter_left_density_list_threads[i], \
+                    inter_right_density_list_threads[i], \
+                    inter_left_number_of_contacts_list_threads[i], \
+                    inter_right_number_of_contacts_list_threads[i], \
+                    inter_left_number_of_contacts_nnz_list_threads[i], \
+                    inter_right_number_of_contacts_nzz_list_threads[i], \
+                    intra_sum_list_threads[i], \
+                    intra_number_of_contacts_list_threads[i], \
+                    intra_number_of_contacts_nnz_list_threads[i], \
+                    intra_density_list_threads[i], \
+                    inter_left_intra_ratio_list_threads[i], \
+                    inter_right_intra_ratio_list_threads[i], \
+                    inter_left_inter_right_intra_ratio_list_threads[i], \
+                    rows_threads[i] = queue_data
 
         if fail_flag:
             log.error(fail_message[6:])
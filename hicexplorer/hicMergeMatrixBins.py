@@ -11,6 +11,7 @@ log = logging.getLogger(__name__)
 from hicmatrix import HiCMatrix as hm
 from hicexplorer.reduceMatrix import reduce_matrix
 from hicexplorer._version import __version__
+from hicexplorer.utilities import load_matrix, read_correction_factors_only
 
 
 def parse_arguments(args=None):
@@ -272,7 +273,12 @@ def merge_bins(hic, num_bins):
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
-    hic = hm.hiCMatrix(args.matrix)
+    if read_correction_factors_only(args.matrix) is not None:
+        log.error('{} stores uncorrected counts with correction factors (hicCorrectMatrix --correctionFactorsOnly), '
+                  'the factors are not valid for merged bins. Please merge the bins of the uncorrected matrix '
+                  'and correct the merged matrix.'.format(args.matrix))
+        exit(1)
+    hic = load_matrix(args.matrix)
 
     if args.runningWindow:
         merged_matrix = running_window_merge(hic, args.numBins)
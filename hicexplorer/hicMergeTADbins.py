@@ -5,10 +5,10 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import sys
 import argparse
-from hicmatrix import HiCMatrix as hm
 from past.builtins import zip
 import numpy as np
 from hicexplorer.utilities import toString
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 
 import logging
@@ -136,7 +136,7 @@ def get_boundary_bin_id(hic, bed_fh):
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
-    hic_ma = hm.hiCMatrix(args.matrix)
+    hic_ma = load_matrix(args.matrix)
     hic_ma.restoreMaskedBins()
 
     # the bin id of boundary positions
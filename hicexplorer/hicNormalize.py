@@ -2,8 +2,8 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
+from hicexplorer.utilities import load_matrix, save_matrix, read_correction_factors_only
 import logging
 log = logging.getLogger(__name__)
 
@@ -65,8 +65,11 @@ def main(args=None):
     args = parse_arguments().parse_args(args)
     hic_matrix_list = []
     sum_list = []
+    correction_factors_only_list = []
     for matrix in args.matrices:
-        hic_ma = hm.hiCMatrix(matrix)
+        # the counts of a matrix stored with correction factors only are normalized, the factors are kept
+        hic_ma = load_matrix(matrix, pApplyCorrection=False)
+        correction_factors_only_list.append(read_correction_factors_only(matrix) is not None)
         if args.normalize == 'smallest':
             sum_list.append(hic_ma.matrix.sum())
         hic_matrix_list.append(hic_ma)
@@ -97,7 +100,7 @@ def main(args=None):
             hic_matrix.matrix.data[mask] = 0
             hic_matrix.matrix.eliminate_zeros()
 
-            hic_matrix.save(args.outFileName[i], pApplyCorrection=False)
+            save_matrix(hic_matrix, args.outFileName[i], pCorrectionFactorsOnly=correction_factors_only_list[i])
     elif args.normalize == 'smallest':
         argmin = np.argmin(sum_list)
 
@@ -124,7 +127,7 @@ def main(args=None):
             hic_matrix.matrix.data[mask] = 0
             hic_matrix.matrix.eliminate_zeros()
 
-            hic_matrix.save(args.outFileName[i], pApplyCorrection=False)
+            save_matrix(hic_matrix, args.outFileName[i], pCorrectionFactorsOnly=correction_factors_only_list[i])
     elif args.normalize == 'multiplicative':
 
         for i, hic_matrix in enumerate(hic_matrix_list):
@@ -150,4 +153,4 @@ def main(args=None):
             hic_matrix.matrix.data[mask] = 0
             hic_matrix.matrix.eliminate_zeros()
 
-            hic_matrix.save(args.outFileName[i], pApplyCorrection=False)
+            save_matrix(hic_matrix, args.outFileName[i], pCorrectionFactorsOnly=correction_factors_only_list[i])
@@ -8,10 +8,13 @@ import numpy as np
 import pyBigWig
 
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 from hicexplorer.utilities import obs_exp_matrix_lieberman, obs_exp_matrix_non_zero
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
 from hicexplorer.utilities import enlarge_bins
+from hicexplorer.utilities import get_cache_prefix
+from hicexplorer.expectedInteractions import ExpectedCache
 from hicexplorer.parserCommon import CustomFormatter
 from hicexplorer.utilities import toString
 from hicexplorer.utilities import opener
@@ -126,6 +129,12 @@ Computes PCA eigenvectors for a Hi-C matrix.
                            'Attention: this will lead to empty PCA regions.',
                            action='store_true')
 
+    parserOpt.add_argument('--cacheDirectory',
+                           help='Folder in which the expected interactions per genomic distance of the chromosomes '
+                           'are stored. Later runs of hicPCA, hicTransform and hicTADClassifier on the same matrix use them '
+                           'instead of computing them again. If not set, nothing is stored.',
+                           required=False)
+
     parserOpt.add_argument('--help', '-h', action='help', help='show the help '
                            'message and exit')
 
@@ -247,7 +256,7 @@ def main(args=None):
                                             len(args.whichEigenvectors)))
         exit(1)
 
-    ma = hm.hiCMatrix(args.matrix)
+    ma = load_matrix(args.matrix)
     # ma.maskBins(ma.nan_bins)
 
     if args.ignoreMaskedBins:
@@ -258,6 +267,14 @@ def main(args=None):
     if args.chromosomes:
         ma.keepOnlyTheseChr(args.chromosomes)
 
+    # the expected interactions per distance of the chromosomes, stored for other runs if requested
+    if args.cacheDirectory is not None:
+        # without the masked bins the chromosomes are other submatrices
+        parameters = {'ignoreMaskedBins': True} if args.ignoreMaskedBins else {}
+        expected_cache = ExpectedCache(get_cache_prefix(args.matrix, args.cacheDirectory, parameters))
+    else:
+        expected_cache = ExpectedCache()
+
     vecs_list = []
     chrom_list = []
     start_list = []
@@ -284,9 +301,11 @@ def main(args=None):
         if args.method == 'lieberman':
             obs_exp_matrix_ = obs_exp_matrix_lieberman(submatrix,
                                                        length_chromosome,
-                                                       chromosome_count)
+                                                       chromosome_count,
+                                                       expected_cache.distance_sums(chrname, submatrix))
         else:
-            obs_exp_matrix_ = obs_exp_matrix_non_zero(submatrix, args.ligation_factor)
+            obs_exp_matrix_ = obs_exp_matrix_non_zero(submatrix, args.ligation_factor,
+                                                      pDistanceSums=expected_cache.distance_sums(chrname, submatrix))
 
         obs_exp_matrix_ = csr_matrix(obs_exp_matrix_).todense()
         if args.obsexpMatrix:
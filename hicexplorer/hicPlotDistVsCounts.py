@@ -8,6 +8,7 @@ import argparse
 import sys
 
 from hicmatrix import HiCMatrix
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 
 import matplotlib
@@ -382,7 +383,7 @@ def main(args=None):
 
     chroms = set()
     for matrix_file in args.matrices:
-        hic_ma = HiCMatrix.hiCMatrix(matrix_file)
+        hic_ma = load_matrix(matrix_file)
         matrix_sum[matrix_file] = hic_ma.matrix.sum()
         if args.chromosomeExclude is None:
             args.chromosomeExclude = []
@@ -20,6 +20,7 @@ from hicexplorer.utilities import enlarge_bins
 from hicexplorer.utilities import toString, toBytes
 from hicexplorer.utilities import writableFile
 from hicmatrix import HiCMatrix
+from hicexplorer.utilities import load_matrix
 import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
@@ -688,7 +689,7 @@ def main(args=None):
             args.region2 = None
             regionsToRetrieve = args.chromosomeOrder
 
-        ma = HiCMatrix.hiCMatrix(args.matrix, pChrnameList=regionsToRetrieve)
+        ma = load_matrix(args.matrix, pChrnameList=regionsToRetrieve)
         log.debug('Shape {}'.format(ma.matrix.shape))
         if args.clearMaskedBins:
             ma.maskBins(ma.nan_bins)
@@ -705,7 +706,7 @@ def main(args=None):
         matrix_length = len(matrix[0])
         log.debug("Number of data points matrix_cool: {}".format(matrix_length))
     else:
-        ma = HiCMatrix.hiCMatrix(args.matrix)
+        ma = load_matrix(args.matrix)
         if args.clearMaskedBins:
             ma.maskBins(ma.nan_bins)
             new_intervals = enlarge_bins(ma.cut_intervals)
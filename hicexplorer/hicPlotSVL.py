@@ -3,8 +3,6 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 from io import StringIO
-from multiprocessing import Process, Queue
-import time
 import numpy as np
 import cooler
 import matplotlib
@@ -14,9 +12,10 @@ import matplotlib.patches as mpatches
 import matplotlib as mpl
 from scipy.stats import ranksums
 
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
 from hicexplorer.utilities import toString
+from hicexplorer.utilities import run_tasks
+from hicexplorer.utilities import load_matrix
 from hicmatrix.HiCMatrix import check_cooler
 import logging
 log = logging.getLogger(__name__)
@@ -100,7 +99,7 @@ def compute_relation_short_long_range(pHiCMatrix, pChromosomes, pDistance, pIsCo
     sum_greater = []
     for chromosome in pChromosomes:
         if pIsCooler:
-            hic_matrix_obj = hm.hiCMatrix(
+            hic_matrix_obj = load_matrix(
                 pMatrixFile=pHiCMatrix, pChrnameList=[chromosome])
             max_distance = pDistance / hic_matrix_obj.getBinSize()
             hic_matrix = hic_matrix_obj.matrix
@@ -140,7 +139,7 @@ def main(args=None):
 
         is_cooler = check_cooler(matrix)
         if not is_cooler:
-            hic_matrix = hm.hiCMatrix(matrix)
+            hic_matrix = load_matrix(matrix)
         else:
             hic_matrix = matrix
         if args.chromosomes is None:
@@ -157,10 +156,7 @@ def main(args=None):
         sum_greater_threads = [None] * args.threads
 
         chromosomesListPerThread = len(chromosomes_list) // args.threads
-        all_data_collected = False
-        queue = [None] * args.threads
-        process = [None] * args.threads
-        thread_done = [False] * args.threads
+        task_arguments = []
         for i in range(args.threads):
 
             if i < args.threads - 1:
@@ -168,32 +164,15 @@ def main(args=None):
             else:
                 chromosomeListThread = chromosomes_list[i * chromosomesListPerThread:]
 
-            queue[i] = Queue()
-            process[i] = Process(target=compute_relation_short_long_range, kwargs=dict(
+            task_arguments.append(dict(
                 pHiCMatrix=hic_matrix,
                 pChromosomes=chromosomeListThread,
                 pDistance=args.distance,
-                pIsCooler=is_cooler,
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-
-        while not all_data_collected:
-            for i in range(args.threads):
-                if queue[i] is not None and not queue[i].empty():
-                    short_v_long_range_matrix_threads[i], sum_smaller_threads[i], sum_greater_threads[i] = queue[i].get()
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
+                pIsCooler=is_cooler
+            ))
+
+        for i, thread_result in run_tasks(compute_relation_short_long_range, task_arguments, pThreads=args.threads):
+            short_v_long_range_matrix_threads[i], sum_smaller_threads[i], sum_greater_threads[i] = thread_result
 
         short_v_long_range_matrix = [item for sublist in short_v_long_range_matrix_threads for item in sublist]
         sum_smaller_matrix = [item for sublist in sum_smaller_threads for item in sublist]
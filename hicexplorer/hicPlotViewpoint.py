@@ -4,6 +4,7 @@ warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
 import numpy as np
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer.utilities import toString
 
 import matplotlib
@@ -72,7 +73,7 @@ def relabelTicks(pTick):
 
 def getViewpointValues(pMatrix, pReferencePoint, pChromViewpoint, pRegion_start, pRegion_end, pInteractionList=None, pChromosome=None):
 
-    hic = hm.hiCMatrix(pMatrix)
+    hic = load_matrix(pMatrix)
     if pChromosome is not None:
         hic.keepOnlyTheseChr(pChromosome)
 
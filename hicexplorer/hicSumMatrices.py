@@ -2,8 +2,8 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import argparse
-from hicmatrix import HiCMatrix as hm
 from hicexplorer._version import __version__
+from hicexplorer.utilities import load_matrix, read_correction_factors_only
 
 import logging
 log = logging.getLogger(__name__)
@@ -45,11 +45,18 @@ def parse_arguments(args=None):
 def main(args=None):
     args = parse_arguments().parse_args(args)
 
-    hic = hm.hiCMatrix(args.matrices[0])
+    for matrix in args.matrices:
+        if read_correction_factors_only(matrix) is not None:
+            log.error('{} stores uncorrected counts with correction factors (hicCorrectMatrix --correctionFactorsOnly), '
+                      'the factors are not valid for the sum. Please sum the uncorrected matrices and correct '
+                      'the summed matrix.'.format(matrix))
+            exit(1)
+
+    hic = load_matrix(args.matrices[0])
     summed_matrix = hic.matrix
     nan_bins = set(hic.nan_bins)
     for matrix in args.matrices[1:]:
-        hic_to_append = hm.hiCMatrix(matrix)
+        hic_to_append = load_matrix(matrix)
         if hic.chrBinBoundaries != hic_to_append.chrBinBoundaries:
             log.error("The two matrices have different chromosome order. Use the tool `hicConvertFormat` to change the order.\n"
                       "{}: {}\n"
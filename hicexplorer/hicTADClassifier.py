@@ -62,6 +62,12 @@ $ hicTADClassifier -m my_matrix.cool -o predictions -n range
     parserOpt.add_argument('--chromosomes',
                            help='Chromosomes to include in the analysis. If not set, all chromosomes are included.',
                            nargs='+')
+
+    parserOpt.add_argument('--cacheDirectory',
+                           help='Folder in which the expected interactions per genomic distance of the chromosomes '
+                           'are stored for the obs_exp normalization. Later runs of hicTADClassifier, hicTransform and '
+                           'hicPCA on the same matrix use them instead of computing them again. If not set, nothing is stored.',
+                           required=False)
     parserOpt.add_argument("--help", "-h", action="help",
                            help="show this help message and exit")
 
@@ -80,7 +86,8 @@ def main(args=None):
                             normalization_method=args.normalization_method,
                             unselect_border_cases=args.unselect_border_cases,
                             threads=args.threads,
-                            pAddRemoveChrPrexix=None
+                            pAddRemoveChrPrexix=None,
+                            cache_directory=args.cacheDirectory
                             )
 
     program.run_hicTADClassifier(args.matrices, args.chromosomes)
@@ -7,9 +7,12 @@ from scipy.sparse import csr_matrix, lil_matrix
 import numpy as np
 
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
 from hicexplorer._version import __version__
 from hicexplorer.utilities import obs_exp_matrix_lieberman, obs_exp_matrix_non_zero, obs_exp_matrix
 from hicexplorer.utilities import convertNansToZeros, convertInfsToZeros
+from hicexplorer.utilities import get_cache_prefix
+from hicexplorer.expectedInteractions import ExpectedCache
 
 
 import logging
@@ -82,6 +85,13 @@ def parse_arguments(args=None):
                            'not valid for obs_exp_lieberman.',
                            action='store_true')
 
+    parserOpt.add_argument('--cacheDirectory',
+                           help='Folder in which the expected interactions per genomic distance of the chromosomes '
+                           'are stored. Later runs of hicTransform, hicPCA and hicTADClassifier on the same matrix use them '
+                           'instead of computing them again. Only used for the per chromosome obs/exp methods. '
+                           'If not set, nothing is stored.',
+                           required=False)
+
     parserOpt.add_argument("--help", "-h", action="help", help="Show this help message and exit.")
 
     parserOpt.add_argument('--version', action='version',
@@ -90,11 +100,11 @@ def parse_arguments(args=None):
     return parser
 
 
-def _obs_exp_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount):
+def _obs_exp_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount, pDistanceSums=None):
 
     if len(pSubmatrix.data) == 0:
         return pSubmatrix
-    obs_exp_matrix_ = obs_exp_matrix_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount)
+    obs_exp_matrix_ = obs_exp_matrix_lieberman(pSubmatrix, pLengthChromosome, pChromosomeCount, pDistanceSums)
     obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
     obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_))
     # if len(obs_exp_matrix_.data) == 0:
@@ -113,11 +123,11 @@ def _pearson(pSubmatrix):
     return pearson_correlation_matrix  # .todense()
 
 
-def _obs_exp(pSubmatrix):
+def _obs_exp(pSubmatrix, pDistanceSums=None):
 
     if len(pSubmatrix.data) == 0:
         return pSubmatrix
-    obs_exp_matrix_ = obs_exp_matrix(pSubmatrix)
+    obs_exp_matrix_ = obs_exp_matrix(pSubmatrix, pDistanceSums=pDistanceSums)
     obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
     obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_))
     # log.error('obs_exp_matrix_.data {}'.format(obs_exp_matrix_.data))
@@ -127,10 +137,10 @@ def _obs_exp(pSubmatrix):
     return obs_exp_matrix_  # .todense()
 
 
-def _obs_exp_non_zero(pSubmatrix, ligation_factor):
+def _obs_exp_non_zero(pSubmatrix, ligation_factor, pDistanceSums=None):
     if len(pSubmatrix.data) == 0:
         return pSubmatrix
-    obs_exp_matrix_ = obs_exp_matrix_non_zero(pSubmatrix, ligation_factor)
+    obs_exp_matrix_ = obs_exp_matrix_non_zero(pSubmatrix, ligation_factor, pDistanceSums=pDistanceSums)
     obs_exp_matrix_ = convertNansToZeros(csr_matrix(obs_exp_matrix_))
     obs_exp_matrix_ = convertInfsToZeros(csr_matrix(obs_exp_matrix_))
     # if len(obs_exp_matrix_.data) == 0:
@@ -149,14 +159,20 @@ def main(args=None):
         exit(1)
 
     if args.matrix.endswith('cool') and args.chromosomes is not None and len(args.chromosomes) == 1:
-        hic_ma = hm.hiCMatrix(pMatrixFile=args.matrix, pChrnameList=args.chromosomes)
+        hic_ma = load_matrix(pMatrixFile=args.matrix, pChrnameList=args.chromosomes)
     else:
-        hic_ma = hm.hiCMatrix(pMatrixFile=args.matrix)
+        hic_ma = load_matrix(pMatrixFile=args.matrix)
         if args.chromosomes:
             hic_ma.keepOnlyTheseChr(args.chromosomes)
 
     trasf_matrix = lil_matrix(hic_ma.matrix.shape)
 
+    # the expected interactions per distance of the chromosomes, stored for other runs if requested
+    if args.cacheDirectory is not None:
+        expected_cache = ExpectedCache(get_cache_prefix(args.matrix, args.cacheDirectory, {}))
+    else:
+        expected_cache = ExpectedCache()
+
     if args.method == 'obs_exp':
         if args.perChromosome:
 
@@ -164,7 +180,7 @@ def main(args=None):
                 chr_range = hic_ma.getChrBinRange(chrname)
                 submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
                 submatrix.astype(float)
-                submatrix_chr = _obs_exp(submatrix)
+                submatrix_chr = _obs_exp(submatrix, expected_cache.distance_sums(chrname, submatrix))
                 if len(submatrix_chr.data) == 0:
                     submatrix_chr = lil_matrix(submatrix_chr.shape)
                 else:
@@ -182,7 +198,8 @@ def main(args=None):
                 submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
                 submatrix.astype(float)
 
-                submatrix_chr = _obs_exp_non_zero(submatrix, args.ligation_factor)
+                submatrix_chr = _obs_exp_non_zero(submatrix, args.ligation_factor,
+                                                  expected_cache.distance_sums(chrname, submatrix))
                 if len(submatrix_chr.data) == 0:
                     submatrix_chr = lil_matrix(submatrix_chr.shape)
                 else:
@@ -202,7 +219,8 @@ def main(args=None):
             submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
             submatrix.astype(float)
 
-            submatrix_chr = _obs_exp_lieberman(submatrix, length_chromosome, chromosome_count)
+            submatrix_chr = _obs_exp_lieberman(submatrix, length_chromosome, chromosome_count,
+                                               expected_cache.distance_sums(chrname, submatrix))
             if len(submatrix_chr.data) == 0:
                 submatrix_chr = lil_matrix(submatrix_chr.shape)
             else:
@@ -2,12 +2,14 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import numpy as np
+from scipy.sparse import csr_matrix
+from concurrent.futures import ThreadPoolExecutor
 import time
 import logging
 log = logging.getLogger(__name__)
 
 
-def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
+def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False, threads=1, dtype=np.float64):
     """
     adapted from cytonised version in mirnylab
     original code from: ultracorrectSymmetricWithVector
@@ -16,46 +18,84 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
     Main method for correcting DS and SS read data.
     Possibly excludes diagonal.
     By default does iterative correction, but can perform an M-time correction
-    :param matrix: a scipy sparse matrix
+
+    Only the upper triangle of the matrix is kept as CSR matrix. The counts are
+    not changed during the iterations, instead the bias vector is applied
+    to the marginal sums. The sums are computed on row blocks of the matrix
+    by 'threads' threads, scipy releases the GIL for them.
+
+    :param matrix: a symmetric scipy sparse matrix
+    :param v: bias vector to start from instead of ones, e.g. the bias of a
+              previous correction of the same matrix. Bins with a bias of
+              0 are excluded.
     :param tolerance: Tolerance is the maximum allowed relative
                       deviation of the marginals.
+    :param threads: number of threads
+    :param dtype: float type of the counts during the correction and of the
+                  corrected matrix, np.float32 halves the memory.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> matrix = csr_matrix(np.array([[10, 4, 2], [4, 6, 3], [2, 3, 8]]))
+    >>> corrected, bias = iterativeCorrection(matrix, M=500, tolerance=1e-10)
+    >>> np.allclose(np.asarray(corrected.sum(axis=1)).flatten(), corrected.sum() / 3)
+    True
+    >>> corrected_threads, bias_threads = iterativeCorrection(matrix, M=500, tolerance=1e-10, threads=2)
+    >>> np.allclose(bias, bias_threads) and np.allclose(corrected.toarray(), corrected_threads.toarray())
+    True
+    >>> corrected_warm, bias_warm = iterativeCorrection(matrix, v=bias, M=500, tolerance=1e-10)
+    >>> np.allclose(bias, bias_warm)
+    True
     """
     if verbose:
         log.setLevel(logging.INFO)
 
-    total_bias = np.ones(matrix.shape[0], 'float64')
-
-    if np.isnan(matrix.sum()):
+    matrix = csr_matrix(matrix)
+    if np.isnan(matrix.data).any():
         log.warn("[iterative correction] the matrix contains nans, they will be replaced by zeros.")
         matrix.data[np.isnan(matrix.data)] = 0
 
-    matrix = matrix.astype(float)
-    W = matrix.tocoo()
-
-    if np.abs(matrix - matrix.T).mean() / (1. * np.abs(matrix.mean())) > 1e-10:
+    # instead of the mean of |matrix - matrix.T| both products with a
+    # random vector are compared, this needs no copy of the matrix
+    probe = np.random.RandomState(0).random_sample(matrix.shape[0]).astype(np.promote_types(matrix.dtype, np.float32))
+    product = matrix.dot(probe)
+    product_transposed = matrix.T.dot(probe)
+    if np.abs(product - product_transposed).mean() / (1. * np.abs(product).mean()) > 1e-10:
         raise ValueError("Please provide symmetric matrix!")
+    product = product_transposed = probe = None
+
+    blocks = _upper_triangle_blocks(matrix, max(1, threads), dtype)
+    diagonal = np.zeros(matrix.shape[0], dtype=np.float64)
+    for block in blocks:
+        diagonal[block.start:block.end] = block.matrix.diagonal(k=block.start)
+    max_count = max((block.matrix.data.max() for block in blocks if block.matrix.nnz > 0), default=0)
+
+    executor = ThreadPoolExecutor(max_workers=len(blocks)) if len(blocks) > 1 else None
+
+    if v is not None:
+        total_bias = np.array(v, dtype='float64').flatten()
+    else:
+        total_bias = np.ones(matrix.shape[0], 'float64')
+    inverse_bias = np.zeros(matrix.shape[0], 'float64')
+    np.divide(1.0, total_bias, out=inverse_bias, where=total_bias != 0)
 
     start_time = time.time()
     log.info("starting iterative correction")
     for iternum in range(M):
         iternum += 1
-        s = np.array(W.sum(axis=1)).flatten()
+        # row sums of the corrected matrix W[i, j] = matrix[i, j] / (total_bias[i] * total_bias[j])
+        s = inverse_bias * _symmetric_dot(blocks, diagonal, inverse_bias, executor)
         mask = (s == 0)
         s = s / np.mean(s[~mask])
 
         total_bias *= s
-        deviation = np.abs(s - 1).max()
+        # empty bins stay empty and do not count for the convergence
+        deviation = np.abs(s[~mask] - 1).max() if not mask.all() else 0
+        inverse_bias = np.zeros(matrix.shape[0], 'float64')
+        np.divide(1.0, total_bias, out=inverse_bias, where=total_bias != 0)
 
-        s = 1.0 / s
-
-        # The following code  is an optimization of this
-        # for i in range(N):
-        #     for j in range(N):
-        #         W[i,j] = W[i,j] / (s[i] * s[j])
-
-        W.data *= np.take(s, W.row)
-        W.data *= np.take(s, W.col)
-        if np.any(W.data > 1e100):
+        max_inverse_bias = inverse_bias.max()
+        if max_count * max_inverse_bias * max_inverse_bias > 1e100 and \
+                _max_corrected_value(blocks, inverse_bias, executor) > 1e100:
             log.error("*Error* matrix correction is producing extremely large values. "
                       "This is often caused by bins of low counts. Use a more stringent "
                       "filtering of bins.")
@@ -76,11 +116,113 @@ def iterativeCorrection(matrix, v=None, M=50, tolerance=1e-5, verbose=False):
     # scale the total bias such that the sum is 1.0
     corr = total_bias[total_bias != 0].mean()
     total_bias = np.divide(total_bias, corr)
-    W.data = W.data * corr * corr
-    if np.any(W.data > 1e10):
+    inverse_bias = np.zeros(matrix.shape[0], 'float64')
+    np.divide(1.0, total_bias, out=inverse_bias, where=total_bias != 0)
+    blocks = None
+
+    corrected_matrix = _apply_bias(matrix, inverse_bias, dtype, executor)
+    if executor is not None:
+        executor.shutdown()
+    if corrected_matrix.nnz > 0 and corrected_matrix.data.max() > 1e10:
         log.error("*Error* matrix correction produced extremely large values. "
                   "This is often caused by bins of low counts. Use a more stringent "
                   "filtering of bins.")
         exit(1)
 
-    return W.tocsr(), total_bias
+    return corrected_matrix, total_bias
+
+
+class _RowBlock(object):
+    """Rows start to end of the upper triangle of a matrix."""
+
+    def __init__(self, start, end, matrix):
+        self.start = start
+        self.end = end
+        self.matrix = matrix
+
+
+def _upper_triangle_blocks(matrix, number_of_blocks, dtype):
+    # the blocks have about the same number of elements, only the upper triangle
+    # is copied in dtype. It is selected in chunks of rows, first to count and
+    # then to copy the elements, such that no temporary array of the size of
+    # the matrix is needed.
+    indptr = matrix.indptr
+    boundaries = np.searchsorted(indptr, np.linspace(0, indptr[-1], number_of_blocks + 1)[1:-1])
+    boundaries = np.unique(np.concatenate([[0], boundaries, [matrix.shape[0]]]))
+    blocks = []
+    for start, end in zip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+        chunks = _row_chunks(indptr, start, end)
+        counts = np.zeros(end - start, dtype=np.int64)
+        for chunk_start, chunk_end in chunks:
+            rows, upper = _upper_triangle_mask(matrix, chunk_start, chunk_end)
+            counts[chunk_start - start:chunk_end - start] = np.bincount(rows[upper], minlength=chunk_end - chunk_start)
+        block_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(indptr.dtype)
+        data = np.empty(block_indptr[-1], dtype=dtype)
+        indices = np.empty(block_indptr[-1], dtype=matrix.indices.dtype)
+        for chunk_start, chunk_end in chunks:
+            _, upper = _upper_triangle_mask(matrix, chunk_start, chunk_end)
+            first, last = block_indptr[chunk_start - start], block_indptr[chunk_end - start]
+            data[first:last] = matrix.data[indptr[chunk_start]:indptr[chunk_end]][upper]
+            indices[first:last] = matrix.indices[indptr[chunk_start]:indptr[chunk_end]][upper]
+        blocks.append(_RowBlock(start, end, csr_matrix((data, indices, block_indptr), shape=(end - start, matrix.shape[1]))))
+    return blocks
+
+
+def _row_chunks(indptr, start, end, max_elements=2 ** 20):
+    # consecutive ranges of the rows start to end with about max_elements elements each
+    boundaries = np.searchsorted(indptr[start:end + 1], np.arange(indptr[start], indptr[end], max_elements), side='right') - 1
+    boundaries = np.unique(np.concatenate([boundaries + start, [start, end]]))
+    return list(zip(boundaries[:-1].tolist(), boundaries[1:].tolist()))
+
+
+def _row_indices(indptr, start, end, dtype):
+    # the row of each element of the rows start to end, relative to start
+    return np.repeat(np.arange(end - start, dtype=dtype), np.diff(indptr[start:end + 1]))
+
+
+def _upper_triangle_mask(matrix, start, end):
+    # the relative row of each element of the rows start to end and if it is in the upper triangle
+    rows = _row_indices(matrix.indptr, start, end, matrix.indices.dtype)
+    return rows, matrix.indices[matrix.indptr[start]:matrix.indptr[end]] >= rows + start
+
+
+def _symmetric_dot(blocks, diagonal, vector, executor):
+    # (U + U.T - D) * vector for the upper triangle U given in row blocks
+    # in the dtype of the blocks, scipy would otherwise upcast a copy of each block
+    vector_typed = vector.astype(blocks[0].matrix.dtype, copy=False)
+
+    def block_dot(block):
+        return block.matrix.dot(vector_typed), block.matrix.T.dot(vector_typed[block.start:block.end])
+    results = executor.map(block_dot, blocks) if executor is not None else map(block_dot, blocks)
+    product = -diagonal * vector
+    for block, (rows, columns) in zip(blocks, results):
+        product[block.start:block.end] += rows
+        product += columns
+    return product
+
+
+def _max_corrected_value(blocks, inverse_bias, executor):
+    inverse_bias = inverse_bias.astype(blocks[0].matrix.dtype, copy=False)
+
+    def block_max(block):
+        if block.matrix.nnz == 0:
+            return 0
+        rows = _row_indices(block.matrix.indptr, 0, block.end - block.start, block.matrix.indices.dtype)
+        return (block.matrix.data * inverse_bias[rows + block.start] * inverse_bias[block.matrix.indices]).max()
+    results = executor.map(block_max, blocks) if executor is not None else map(block_max, blocks)
+    return max(results)
+
+
+def _apply_bias(matrix, inverse_bias, dtype, executor):
+    # matrix[i, j] / (bias[i] * bias[j]) for all elements, computed in chunks of rows
+    data = np.empty(matrix.nnz, dtype=dtype)
+    inverse_bias = inverse_bias.astype(dtype, copy=False)
+
+    def apply_block(start_end):
+        start, end = start_end
+        first, last = matrix.indptr[start], matrix.indptr[end]
+        rows = _row_indices(matrix.indptr, start, end, matrix.indices.dtype)
+        data[first:last] = matrix.data[first:last] * inverse_bias[rows + start] * inverse_bias[matrix.indices[first:last]]
+    ranges = _row_chunks(matrix.indptr, 0, matrix.shape[0])
+    list(executor.map(apply_block, ranges) if executor is not None else map(apply_block, ranges))
+    return csr_matrix((data, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
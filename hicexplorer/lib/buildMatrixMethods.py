@@ -3,11 +3,16 @@ log = logging.getLogger(__name__)
 
 import argparse
 import numpy as np
-from scipy.sparse import coo_matrix, dia_matrix
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix, dia_matrix
 import time
 from os import unlink
 import os
 from pathlib import Path
+import gzip
+import json
+import shutil
+from tempfile import mkdtemp
 from io import StringIO
 import traceback
 import warnings
@@ -17,10 +22,10 @@ warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import pysam
 from collections import OrderedDict
 
-from copy import deepcopy
-from ctypes import Structure, c_uint, c_ushort
+from ctypes import Structure, c_uint
 from multiprocessing import Process, Queue
-from multiprocessing.sharedctypes import Array, RawArray
+from queue import Empty, Full
+from multiprocessing.sharedctypes import RawArray
 
 from intervaltree import IntervalTree, Interval
 
@@ -32,9 +37,10 @@ from hicexplorer.utilities import getUserRegion, genomicRegion
 from hicexplorer._version import __version__
 import hicexplorer.hicPrepareQCreport as QC
 
-from hicmatrix.lib import MatrixFileHandler
+import cooler
+import h5py
+from importlib.metadata import version
 
-from hicexplorer import hicMergeMatrixBins
 import logging
 log = logging.getLogger(__name__)
 
@@ -53,39 +59,421 @@ class C_Coverage(Structure):
                 ("end", c_uint)]
 
 
-class ReadPositionMatrix(object):
-    """A class to check for PCR duplicates.
-       A set storing all possible
-       start sites. Checks if read is already in the set.
+class DuplicationIndex(object):
+    """Index of the read pair positions to check for PCR duplicates.
+       Each pair is stored as 64-bit hash of the reference ids and
+       the start positions of both mates in a numpy based hash table.
+
+       If 'pMaxMemory' (in bytes) is given, the hash table does not grow beyond
+       this size. A full table is written as sorted run to a temporary folder
+       and a bloom filter keeps track of the pairs on disk, such that
+       only a small fraction of the new pairs needs to be looked up in the runs.
     """
 
-    def __init__(self):
+    def __init__(self, pMaxMemory=None, pTempDir=None):
         """
-        >>> rp = ReadPositionMatrix()
-        >>> rp.is_duplicated('1', 0, '2', 0)
-        False
-        >>> rp.is_duplicated('1', 0, '2', 0)
+        >>> index = DuplicationIndex()
+        >>> keys = DuplicationIndex.hash_pairs(np.array([0, 1, 0]), np.array([10, 20, 10]),
+        ...                                    np.array([1, 0, 1]), np.array([20, 10, 20]))
+        >>> bool(keys[0] == keys[1])
+        True
+        >>> index.duplicated(keys).tolist()
+        [False, True, True]
+        >>> index.add(keys[:1])
+        >>> index.duplicated(keys).tolist()
+        [True, True, True]
+
+        With a memory limit the index is written in sorted runs to disk
+
+        >>> index = DuplicationIndex(pMaxMemory=64 * 1024)
+        >>> keys = DuplicationIndex.hash_pairs(np.zeros(20000), np.arange(20000), np.zeros(20000), np.arange(20000))
+        >>> for i in range(0, 20000, 1000):
+        ...     index.add(keys[i:i + 1000])
+        >>> len(index.runs) > 0
+        True
+        >>> bool(index.duplicated(keys).all())
         True
+        >>> new_keys = DuplicationIndex.hash_pairs(np.ones(100), np.arange(100), np.ones(100), np.arange(100))
+        >>> bool(index.duplicated(new_keys).any())
+        False
+        >>> index.close()
+        """
+        self.max_memory = pMaxMemory
+        self.temp_dir = pTempDir
+        self.temp_folder = None
+        self.runs = []
+        self.bloom_filter = None
+        if pMaxMemory is None:
+            self.max_capacity = None
+            capacity = 2**20
+        else:
+            # a quarter of the memory is used for the bloom filter,
+            # the hash table gets the largest power of two fitting into the rest
+            self.max_capacity = 2**max(10, int(np.log2(max(1, pMaxMemory * 3 // 4) // 8)))
+            self.bloom_filter = np.zeros(max(1024, pMaxMemory // 4), dtype=np.uint8)
+            capacity = min(2**20, self.max_capacity)
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+
+    @staticmethod
+    def mix(pKeys):
+        """Finalizer of splitmix64, mixes the bits of a uint64 array."""
+        with np.errstate(over='ignore'):
+            keys = (pKeys ^ (pKeys >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+            keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return keys ^ (keys >> np.uint64(31))
+
+    @staticmethod
+    def hash_pairs(pReferenceId1, pPosition1, pReferenceId2, pPosition2):
+        """
+        Returns the 64-bit hash per read pair. As before, a pair is a duplicate of another one
+        if both have the same two references and the same two start positions, independent
+        of the order of the mates.
         """
+        reference_id1 = np.asarray(pReferenceId1).astype(np.uint64)
+        reference_id2 = np.asarray(pReferenceId2).astype(np.uint64)
+        position1 = np.asarray(pPosition1).astype(np.uint64)
+        position2 = np.asarray(pPosition2).astype(np.uint64)
+        keys = DuplicationIndex.mix((np.minimum(reference_id1, reference_id2) << np.uint64(32)) | np.maximum(reference_id1, reference_id2))
+        keys = DuplicationIndex.mix(keys ^ np.minimum(position1, position2))
+        keys = DuplicationIndex.mix(keys ^ np.maximum(position1, position2))
+        # 0 marks an empty slot in the hash table
+        keys[keys == 0] = 1
+        return keys
+
+    def duplicated(self, pKeys):
+        """
+        Returns a boolean array which is True for each key which is
+        already in the index or which occurs earlier in 'pKeys'.
+        The keys are not added to the index, see `add`.
+        """
+        duplicated = np.ones(len(pKeys), dtype=bool)
+        if len(pKeys) == 0:
+            return duplicated
+        _, first_occurrence = np.unique(pKeys, return_index=True)
+        duplicated[first_occurrence] = self.contains(pKeys[first_occurrence])
+        return duplicated
+
+    def contains(self, pKeys):
+        found = self._lookup_table(pKeys)
+        if self.runs:
+            candidates = np.flatnonzero(~found)
+            candidates = candidates[self._lookup_bloom_filter(pKeys[candidates])]
+            if len(candidates) > 0:
+                keys = pKeys[candidates]
+                for run_file in self.runs:
+                    run = np.load(run_file, mmap_mode='r')
+                    index = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+                    found[candidates] |= run[index] == keys
+        return found
+
+    def add(self, pKeys):
+        """
+        Adds the keys to the index. The keys need to be unique and must not be in the index, see `duplicated`.
+        """
+        pKeys = np.asarray(pKeys, dtype=np.uint64)
+        while len(pKeys) > 0:
+            # keep the load factor of the hash table below 0.5
+            if 2 * (self.size + len(pKeys)) > len(self.table):
+                if self.max_capacity is None or len(self.table) < self.max_capacity:
+                    self._rehash(len(self.table) * 2)
+                    continue
+                free = len(self.table) // 2 - self.size
+                if free <= 0:
+                    self._spill()
+                    continue
+                self._insert(pKeys[:free])
+                pKeys = pKeys[free:]
+            else:
+                self._insert(pKeys)
+                pKeys = pKeys[:0]
 
-        self.pos_matrix = set()
+    def close(self):
+        """Removes the runs written to disk."""
+        if self.temp_folder is not None:
+            shutil.rmtree(self.temp_folder, ignore_errors=True)
+            self.temp_folder = None
+        self.runs = []
 
-    def is_duplicated(self, chrom1, start1, chrom2, start2):
-        if chrom1 < chrom2:
-            id_string = "{}-{}".format(chrom1, chrom2)
-        else:
-            id_string = "{}-{}".format(chrom2, chrom1)
+    def get_state(self):
+        """
+        Returns the state of the index as a json serializable dictionary and a dictionary
+        of arrays, see `set_state`. The runs on disk are referenced by their file names.
+
+        >>> index = DuplicationIndex()
+        >>> keys = DuplicationIndex.hash_pairs(np.array([0, 1]), np.array([10, 20]), np.array([1, 0]), np.array([30, 40]))
+        >>> index.add(keys[:1])
+        >>> state, arrays = index.get_state()
+        >>> restored = DuplicationIndex()
+        >>> restored.set_state(state, arrays)
+        >>> restored.duplicated(keys).tolist()
+        [True, False]
+        """
+        state = {'runs': list(self.runs), 'temp_folder': self.temp_folder, 'size': self.size}
+        arrays = {'table': self.table}
+        if self.bloom_filter is not None:
+            arrays['bloom_filter'] = self.bloom_filter
+        return state, arrays
+
+    def set_state(self, pState, pArrays):
+        """Restores the state returned by `get_state`."""
+        self.runs = list(pState['runs'])
+        self.temp_folder = pState['temp_folder']
+        self.size = pState['size']
+        self.table = np.array(pArrays['table'], dtype=np.uint64)
+        if 'bloom_filter' in pArrays:
+            self.bloom_filter = np.array(pArrays['bloom_filter'], dtype=np.uint8)
+
+    def _lookup_table(self, pKeys):
+        # linear probing, all keys are moved one slot further per round until
+        # either the key or an empty slot is found
+        mask = np.uint64(len(self.table) - 1)
+        slots = pKeys & mask
+        found = np.zeros(len(pKeys), dtype=bool)
+        pending = np.arange(len(pKeys))
+        while len(pending) > 0:
+            values = self.table[slots[pending]]
+            hit = values == pKeys[pending]
+            found[pending[hit]] = True
+            pending = pending[~hit & (values != 0)]
+            slots[pending] = (slots[pending] + np.uint64(1)) & mask
+        return found
+
+    def _insert(self, pKeys):
+        mask = np.uint64(len(self.table) - 1)
+        slots = pKeys & mask
+        pending = np.arange(len(pKeys))
+        while len(pending) > 0:
+            free = pending[self.table[slots[pending]] == 0]
+            # several keys can probe the same free slot, the first one wins
+            _, first = np.unique(slots[free], return_index=True)
+            winners = free[first]
+            self.table[slots[winners]] = pKeys[winners]
+            placed = np.zeros(len(pKeys), dtype=bool)
+            placed[winners] = True
+            pending = pending[~placed[pending]]
+            slots[pending] = (slots[pending] + np.uint64(1)) & mask
+        self.size += len(pKeys)
+
+    def _rehash(self, pCapacity):
+        keys = self.table[self.table != 0]
+        self.table = np.zeros(pCapacity, dtype=np.uint64)
+        self.size = 0
+        self._insert(keys)
+
+    def _bloom_filter_bits(self, pKeys):
+        number_of_bits = np.uint64(len(self.bloom_filter) * 8)
+        return [DuplicationIndex.mix(pKeys + np.uint64(i)) % number_of_bits for i in range(3)]
+
+    def _lookup_bloom_filter(self, pKeys):
+        contained = np.ones(len(pKeys), dtype=bool)
+        for bits in self._bloom_filter_bits(pKeys):
+            contained &= ((self.bloom_filter[bits >> np.uint64(3)] >> (bits & np.uint64(7)).astype(np.uint8)) & 1).astype(bool)
+        return contained
+
+    def _spill(self):
+        if self.temp_folder is None:
+            self.temp_folder = mkdtemp(prefix='duplication_index_', dir=self.temp_dir)
+        keys = np.sort(self.table[self.table != 0])
+        run_file = os.path.join(self.temp_folder, 'run_{}.npy'.format(len(self.runs)))
+        np.save(run_file, keys)
+        self.runs.append(run_file)
+        for bits in self._bloom_filter_bits(keys):
+            np.bitwise_or.at(self.bloom_filter, bits >> np.uint64(3), (np.uint8(1) << (bits & np.uint64(7)).astype(np.uint8)))
+        log.debug('duplication index: {} pairs written to {}'.format(len(keys), run_file))
+        self.table[:] = 0
+        self.size = 0
+
+
+class PixelAccumulator(object):
+    r"""
+       Sums up the counts of the (row, col) pixels of the symmetric contact matrix,
+       a pixel of the lower triangle is added to its mirrored pixel of the upper triangle.
+
+       Each added chunk is kept as a sorted run of linear pixel indices and counts.
+       Without 'pMaxMemory' (in bytes) the runs are merged in memory whenever the
+       new runs are as large as the merged one. With 'pMaxMemory' the runs are
+       merged and written to a temporary folder once they exceed the limit and
+       `pixel_chunks` combines all runs with a blockwise k-way merge, such that
+       the pixels can be written without having all of them in memory.
+    """
 
-        if start1 < start2:
-            id_string += "-{}-{}".format(start1, start2)
+    def __init__(self, pMatrixSize, pMaxMemory=None, pTempDir=None):
+        """
+        >>> accumulator = PixelAccumulator(4)
+        >>> accumulator.add(np.array([1, 0, 1]), np.array([2, 0, 2]), np.array([1, 1, 1]))
+        >>> accumulator.add(np.array([3, 2]), np.array([3, 1]), np.array([2, 5]))
+        >>> row, col, data = accumulator.pixels()
+        >>> row.tolist(), col.tolist(), data.tolist()
+        ([0, 1, 3], [0, 2, 3], [1, 7, 2])
+
+        With a memory limit the runs are written to disk
+
+        >>> accumulator = PixelAccumulator(1000, pMaxMemory=64 * 1024)
+        >>> for i in range(20):
+        ...     accumulator.add(np.arange(1000), (np.arange(1000) * (i + 1)) % 1000, np.ones(1000))
+        >>> len(accumulator.runs) > 1
+        True
+        >>> row, col, data = accumulator.pixels()
+        >>> int(data.sum()), len(data), bool(np.all(np.diff(row * 1000 + col) > 0))
+        (20000, 19372, True)
+        >>> accumulator.close()
+        """
+        self.matrix_size = np.uint64(pMatrixSize)
+        self.max_memory = pMaxMemory
+        self.temp_dir = pTempDir
+        self.temp_folder = None
+        # merged runs, in memory as (index, data) or on disk as (index file, data file)
+        self.runs = []
+        self.pending = []
+        self.pending_size = 0
+        if pMaxMemory is None:
+            self.max_pending = None
         else:
-            id_string += "-{}-{}".format(start2, start1)
+            # a pixel needs 12 bytes and merging the pending runs needs about twice their size
+            self.max_pending = max(1024, pMaxMemory // 24)
+
+    def add(self, pRow, pCol, pData):
+        row = np.asarray(pRow, dtype=np.uint64)
+        col = np.asarray(pCol, dtype=np.uint64)
+        index = np.minimum(row, col) * self.matrix_size + np.maximum(row, col)
+        self.pending.append((index, np.asarray(pData, dtype=np.uint32)))
+        self.pending_size += len(index)
+        if self.max_pending is None:
+            merged_size = len(self.runs[0][0]) if self.runs else 0
+            if self.pending_size >= max(2**20, merged_size):
+                self.runs = [self._merge(self.runs + self.pending)]
+                self.pending = []
+                self.pending_size = 0
+        elif self.pending_size >= self.max_pending:
+            self._spill()
+
+    def pixels(self):
+        """
+        Returns the row, col and data arrays of all pixels, sorted by row and col.
+        The row and col arrays are int32 if possible, like the indices of a scipy matrix.
+        """
+        chunks = list(self.pixel_chunks())
+        if len(chunks) == 0:
+            return self._to_pixels(*self._merge([]))
+        return tuple(np.concatenate([chunk[i] for chunk in chunks]) for i in range(3))
 
-        if id_string in self.pos_matrix:
-            return True
+    def pixel_chunks(self, pChunkSize=2**22):
+        """
+        Yields the row, col and data arrays of the pixels in chunks, sorted by row and col
+        over all chunks. With 'pMaxMemory' a chunk has about the size of the memory limit.
+
+        >>> accumulator = PixelAccumulator(4)
+        >>> accumulator.add(np.array([1, 0, 3]), np.array([2, 0, 3]), np.array([1, 1, 2]))
+        >>> [[values.tolist() for values in chunk] for chunk in accumulator.pixel_chunks(pChunkSize=2)]
+        [[[0, 1], [0, 2], [1, 1]], [[3], [3], [2]]]
+        """
+        if self.max_pending is None:
+            index, data = self._merge(self.runs + self.pending)
+            for start in range(0, len(index), pChunkSize):
+                yield self._to_pixels(index[start:start + pChunkSize], data[start:start + pChunkSize])
+        else:
+            runs = [(np.load(index_file, mmap_mode='r'), np.load(data_file, mmap_mode='r')) for index_file, data_file in self.runs]
+            if self.pending:
+                runs.append(self._merge(self.pending))
+            for index, data in self._merged_blocks(runs):
+                yield self._to_pixels(index, data)
+
+    def close(self):
+        """Removes the runs written to disk."""
+        if self.temp_folder is not None:
+            shutil.rmtree(self.temp_folder, ignore_errors=True)
+            self.temp_folder = None
+        self.runs = []
+        self.pending = []
+        self.pending_size = 0
+
+    def get_state(self):
+        """
+        Returns the state of the accumulator as a json serializable dictionary and a dictionary
+        of arrays, see `set_state`. The runs on disk are referenced by their file names.
+
+        >>> accumulator = PixelAccumulator(4)
+        >>> accumulator.add(np.array([1, 0]), np.array([2, 0]), np.array([1, 3]))
+        >>> state, arrays = accumulator.get_state()
+        >>> restored = PixelAccumulator(4)
+        >>> restored.set_state(state, arrays)
+        >>> restored.add(np.array([1]), np.array([2]), np.array([1]))
+        >>> [values.tolist() for values in restored.pixels()]
+        [[0, 1], [0, 2], [3, 2]]
+        """
+        if self.max_pending is None:
+            self.runs = [self._merge(self.runs + self.pending)]
+            self.pending = []
+            self.pending_size = 0
+            index, data = self.runs[0]
+            runs = []
         else:
-            self.pos_matrix.add(id_string)
-            return False
+            index, data = self._merge(self.pending)
+            runs = [list(run) for run in self.runs]
+        return {'runs': runs, 'temp_folder': self.temp_folder}, {'index': index, 'data': data}
+
+    def set_state(self, pState, pArrays):
+        """Restores the state returned by `get_state`."""
+        self.temp_folder = pState['temp_folder']
+        runs = [tuple(run) for run in pState['runs']]
+        if self.max_pending is None:
+            # the runs are kept in memory
+            runs = [(np.load(index_file), np.load(data_file)) for index_file, data_file in runs]
+        self.runs = runs
+        self.pending = [(np.array(pArrays['index'], dtype=np.uint64), np.array(pArrays['data'], dtype=np.uint32))]
+        self.pending_size = len(self.pending[0][0])
+
+    @staticmethod
+    def _merge(pRuns):
+        if len(pRuns) == 0:
+            return np.array([], dtype=np.uint64), np.array([], dtype=np.uint32)
+        index = np.concatenate([run[0] for run in pRuns])
+        data = np.concatenate([run[1] for run in pRuns])
+        # the stable sort merges the already sorted runs
+        order = np.argsort(index, kind='stable')
+        index = index[order]
+        data = data[order]
+        if len(index) == 0:
+            return index, data
+        first = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        return index[first], np.add.reduceat(data, first).astype(np.uint32)
+
+    def _to_pixels(self, pIndex, pData):
+        index_dtype = np.int32 if self.matrix_size <= np.iinfo(np.int32).max else np.int64
+        return (pIndex // self.matrix_size).astype(index_dtype), (pIndex % self.matrix_size).astype(index_dtype), pData
+
+    def _merged_blocks(self, pRuns):
+        # yields the merged pixels of all runs in blocks, the blocks are disjoint and increasing
+        block_size = max(1024, self.max_pending // max(1, len(pRuns)))
+        positions = [0] * len(pRuns)
+        while True:
+            active = [i for i, run in enumerate(pRuns) if positions[i] < len(run[0])]
+            if not active:
+                break
+            # all pixels up to the smallest last index of the current blocks are
+            # complete, they can not occur in a later block of any run
+            bound = min(pRuns[i][0][min(positions[i] + block_size, len(pRuns[i][0])) - 1] for i in active)
+            parts = []
+            for i in active:
+                index = pRuns[i][0][positions[i]:positions[i] + block_size]
+                end = positions[i] + int(np.searchsorted(index, bound, side='right'))
+                parts.append((np.asarray(pRuns[i][0][positions[i]:end]), np.asarray(pRuns[i][1][positions[i]:end])))
+                positions[i] = end
+            yield self._merge(parts)
+
+    def _spill(self):
+        if self.temp_folder is None:
+            self.temp_folder = mkdtemp(prefix='pixel_accumulator_', dir=self.temp_dir)
+        index, data = self._merge(self.pending)
+        index_file = os.path.join(self.temp_folder, 'run_{}_index.npy'.format(len(self.runs)))
+        data_file = os.path.join(self.temp_folder, 'run_{}_data.npy'.format(len(self.runs)))
+        np.save(index_file, index)
+        np.save(data_file, data)
+        self.runs.append((index_file, data_file))
+        log.debug('pixel accumulator: {} pixels written to {}'.format(len(index), index_file))
+        self.pending = []
+        self.pending_size = 0
 
 
 def intervalListToIntervalTree(interval_list):
@@ -284,28 +672,77 @@ def get_chrom_sizes(bam_handle):
     return list(list_chrom_sizes.items())
 
 
-def check_dangling_end(read, dangling_sequences):
+def check_dangling_end(pMateRecords, dangling_sequences):
     """
-    given a pysam read object, this function
-    checks if a forward read starts with
+    given an array of mate records (see `mates_to_records`), this function
+    checks for each read if a forward read starts with
     the dangling sequence or if a reverse
     read ends with the dangling sequence.
+
+    >>> records = np.array([(0, 10, 4, 4, False, 'GATC', 'GATC'), (0, 10, 4, 4, True, 'AGCT', 'GATC'),
+    ...                     (0, 10, 4, 4, False, 'AGCT', 'GATC')], dtype=get_mate_record_dtype(4))
+    >>> check_dangling_end(records, {'pat_forw': 'GATC', 'pat_rev': 'GATC'}).tolist()
+    [True, True, False]
     """
     ds = dangling_sequences
     # check if keys are existing, return false otherwise
     if 'pat_forw' not in ds or 'pat_rev' not in ds:
-        return False
-    # skip forward read that stars with the restriction sequence
-    if not read.is_reverse and \
-            read.seq.upper().startswith(ds['pat_forw']):
-        return True
+        return np.zeros(len(pMateRecords), dtype=bool)
+    # forward reads that start with the restriction sequence
+    forward = ~pMateRecords['is_reverse'] & np.char.startswith(pMateRecords['seq_start'], ds['pat_forw'])
+    # reverse reads that end with the restriction sequence
+    reverse = pMateRecords['is_reverse'] & np.char.endswith(pMateRecords['seq_end'], ds['pat_rev'])
+    return forward | reverse
 
-    # skip reverse read that ends with the restriction sequence
-    if read.is_reverse and \
-            read.seq.upper().endswith(ds['pat_rev']):
-        return True
 
-    return False
+def get_mate_record_dtype(pSequenceLength):
+    """
+    Returns the numpy dtype of the compact mate records which are sent to the
+    worker processes instead of the pysam objects.
+
+    :param pSequenceLength: number of bases stored of the start and of the end of each read,
+        this is the length of the longest dangling sequence.
+    """
+    return np.dtype([('reference_id', np.int32),
+                     ('pos', np.int64),
+                     ('qlen', np.int32),
+                     ('seq_len', np.int32),
+                     ('is_reverse', np.bool_),
+                     ('seq_start', 'U{}'.format(max(1, pSequenceLength))),
+                     ('seq_end', 'U{}'.format(max(1, pSequenceLength)))])
+
+
+def mates_to_records(pMateBuffer, pSequenceLength):
+    """
+    Converts a list of pysam reads into a numpy array of compact mate records.
+    Only the information needed to classify and bin a read pair is kept, such that
+    the buffer is cheap to send to a worker process.
+
+    :param pMateBuffer: list of pysam AlignedSegment
+    :param pSequenceLength: number of bases to keep of the start and end of each read sequence,
+        only needed for the dangling end check. If 0, the sequence is not decoded.
+
+    :return: numpy array of type `get_mate_record_dtype(pSequenceLength)`
+
+    >>> test = Tester()
+    >>> reads = [read for read in pysam.Samfile(test.bam_file_1, 'rb')][:2]
+    >>> records = mates_to_records(reads, 4)
+    >>> records['pos'].tolist() == [read.pos for read in reads]
+    True
+    >>> records['seq_start'].tolist() == [read.seq[:4].upper() for read in reads]
+    True
+    """
+    dtype = get_mate_record_dtype(pSequenceLength)
+    if pSequenceLength > 0:
+        records = []
+        for read in pMateBuffer:
+            sequence = (read.query_sequence or '').upper()
+            records.append((read.reference_id, read.pos, read.qlen, read.query_length,
+                            read.is_reverse, sequence[:pSequenceLength], sequence[-pSequenceLength:]))
+    else:
+        records = [(read.reference_id, read.pos, read.qlen, read.query_length,
+                    read.is_reverse, '', '') for read in pMateBuffer]
+    return np.array(records, dtype=dtype)
 
 
 def get_supplementary_alignment(read, pysam_obj):
@@ -455,11 +892,478 @@ def enlarge_bins(bin_intervals, chrom_sizes):
     return bin_intervals
 
 
-def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pReadPosMatrix, pRefId2name, pMinMappingQuality):
-    """Read the two bam input files into n buffers each with pNumberOfItemsPerBuffer
-        with n = number of processes. The duplication check is handled here too."""
+def coarsen_bins(pBinIntervals, pFactor):
+    r"""
+    Returns the coarse bin of each fine bin and the intervals of the bins which are pFactor
+    times larger. The coarse bins start, like the fine ones, at the beginning of each chromosome;
+    the last bin of a chromosome can be shorter. The coverage of a coarse bin is the maximum
+    coverage of its bins.
+
+    >>> bin_intervals = [('a', 0, 10, 1), ('a', 10, 20, 3), ('a', 20, 25, np.nan), ('b', 0, 10, 2)]
+    >>> coarse_index, bin_intervals = coarsen_bins(bin_intervals, 2)
+    >>> coarse_index.tolist(), bin_intervals
+    ([0, 0, 1, 2], [('a', 0, 20, 3.0), ('a', 20, 25, nan), ('b', 0, 10, 2.0)])
+    """
+    chrom_list, start_list, end_list, coverage_list = zip(*pBinIntervals)
+    chrom_list = np.array(chrom_list)
+    chrom_start = np.flatnonzero(np.r_[True, chrom_list[1:] != chrom_list[:-1]])
+    chrom_length = np.diff(np.r_[chrom_start, len(chrom_list)])
+
+    # index of the fine bin within its chromosome divided by the factor
+    # gives the coarse bin within the chromosome
+    coarse_within = (np.arange(len(chrom_list)) - np.repeat(chrom_start, chrom_length)) // pFactor
+    coarse_per_chrom = (chrom_length + pFactor - 1) // pFactor
+    coarse_offset = np.r_[0, np.cumsum(coarse_per_chrom)[:-1]]
+    coarse_index = coarse_within + np.repeat(coarse_offset, chrom_length)
+    size = int(coarse_per_chrom.sum())
+
+    coverage = np.full(size, np.nan)
+    coverage_list = np.array(coverage_list, dtype=float)
+    mask = ~np.isnan(coverage_list)
+    np.fmax.at(coverage, coarse_index[mask], coverage_list[mask])
+    first = np.flatnonzero(np.r_[True, coarse_index[1:] != coarse_index[:-1]])
+    last = np.r_[first[1:], len(coarse_index)] - 1
+    bin_intervals = [(str(chrom_list[i]), start_list[i], end_list[j], coverage[k])
+                     for k, (i, j) in enumerate(zip(first, last))]
+    return coarse_index, bin_intervals
+
+
+def coarsen_pixel_chunks(pPixelChunks, pCoarseIndex):
+    r"""
+    Sums chunks of upper triangle pixels, sorted by row and col over all chunks, into
+    the coarse bins pCoarseIndex of `coarsen_bins`. The coarse pixels are yielded in
+    chunks of the same order, only the last coarse row of a chunk is kept until the next one.
+
+    >>> chunks = [(np.array([0, 0, 1]), np.array([0, 1, 2]), np.array([1, 2, 4])),
+    ...           (np.array([1, 3]), np.array([3, 3]), np.array([1, 6]))]
+    >>> [[values.tolist() for values in chunk] for chunk in coarsen_pixel_chunks(chunks, np.array([0, 0, 1, 2]))]
+    [[[0, 0, 0], [0, 1, 2], [3, 4, 1]], [[2], [2], [6]]]
+    """
+    size = np.int64(pCoarseIndex[-1] + 1) if len(pCoarseIndex) > 0 else np.int64(1)
+
+    def summed(pRow, pCol, pData):
+        index, inverse = np.unique(pRow.astype(np.int64) * size + pCol, return_inverse=True)
+        data = np.bincount(inverse, weights=pData, minlength=len(index)).astype(np.int64)
+        return (index // size).astype(pRow.dtype), (index % size).astype(pRow.dtype), data
+
+    carry_row, carry_col, carry_data = (np.array([], dtype=pCoarseIndex.dtype), np.array([], dtype=pCoarseIndex.dtype),
+                                        np.array([], dtype=np.int64))
+    for row, col, data in pPixelChunks:
+        if len(row) == 0:
+            continue
+        row = np.concatenate([carry_row, pCoarseIndex[row]])
+        col = np.concatenate([carry_col, pCoarseIndex[col]])
+        data = np.concatenate([carry_data, data])
+        # the last coarse row can get pixels of the next chunk
+        complete = row < row[-1]
+        if complete.any():
+            yield summed(row[complete], col[complete], data[complete])
+        carry_row, carry_col, carry_data = row[~complete], col[~complete], data[~complete]
+    if len(carry_row) > 0:
+        yield summed(carry_row, carry_col, carry_data)
+
+
+def save_cool(pFileName, pBinIntervals, pPixelChunks, pHiCInfo, pAppend=False):
+    """
+    Writes a cool file like hiCMatrix.save, but from chunks of upper triangle pixels
+    (row, col and data arrays sorted by row and col over all chunks) such that
+    only one chunk is in memory. pHiCInfo is the metadata given to hiCMatrix.save,
+    with pAppend a further resolution of a .mcool file is added.
+    """
+    bins = pd.DataFrame([bin_interval[:3] for bin_interval in pBinIntervals], columns=['chrom', 'start', 'end'])
+    # the same attributes as written by hiCMatrix
+    info = {'format': 'HDF5::Cooler',
+            'format-url': 'https://github.com/mirnylab/cooler',
+            'generated-by': 'HiCMatrix-' + version('HiCMatrix'),
+            'generated-by-cooler-lib': 'cooler-' + version('cooler'),
+            'tool-url': 'https://github.com/deeptools/HiCMatrix'}
+    for key in ['matrix-generated-by', 'matrix-generated-by-url', 'genome-assembly']:
+        if key in pHiCInfo:
+            info[key] = str(pHiCInfo[key])
+    # the counts are int64 like the data of the matrix given to hiCMatrix, else cooler sums them up as float
+    pixels = (pd.DataFrame({'bin1_id': row, 'bin2_id': col, 'count': data.astype(np.int64)})
+              for row, col, data in pPixelChunks)
+    cooler.create_cooler(cool_uri=pFileName,
+                         bins=bins,
+                         pixels=pixels,
+                         mode='a' if pAppend else 'w',
+                         dtypes={'bin1_id': np.int32, 'bin2_id': np.int32, 'count': np.int32},
+                         ordered=True,
+                         metadata=info,
+                         temp_dir=os.path.dirname(os.path.realpath(pFileName.split('::')[0])))
+    if not pAppend:
+        with h5py.File(pFileName.split('::')[0], 'r+') as h5file:
+            h5file.attrs.update(info)
+
+
+def read_mate_file(pFileName, pQueue, pChunkSize, pSequenceLength, pOutputBam, pDecompressionThreads,
+                   pStartOffset=None, pSkipReads=0):
+    """
+    Reads one of the two mate files in its own process. Secondary alignments are skipped and
+    for reads with supplementary alignments the correct mapping is selected (see `get_correct_map`).
+    The reads are sent in chunks to the main process, such that decoding the two
+    input files happens in parallel and not in the main process.
+
+    Parameters
+    ----------
+    pFileName : string, the sam / bam file of one mate
+    pQueue : multiprocessing.Queue, receives tuples of (file offset of the chunk, chunk) (see `reads_to_chunk`),
+             None after the last chunk or a 'Fail: ' message. The offset is None if the file does not support it.
+    pChunkSize : integer, number of reads per chunk
+    pSequenceLength : integer, number of bases stored of the start and of the end of each read, see `mates_to_records`
+    pOutputBam : boolean, if the reads are needed to write the output bam file
+    pDecompressionThreads : integer, number of htslib threads used to decompress the input file
+    pStartOffset : integer, file offset to start reading from, as sent with a previous chunk
+    pSkipReads : integer, number of reads to skip before the first chunk
+    """
+    parent_id = os.getppid()
+    try:
+        bam_file = pysam.Samfile(pFileName, 'rb', threads=pDecompressionThreads)
+        if pStartOffset is not None:
+            bam_file.seek(pStartOffset)
+        buffer_reads = []
+        chunk_offset = None
+        end_of_file = False
+        while not end_of_file:
+            if len(buffer_reads) == 0 and pSkipReads == 0:
+                try:
+                    chunk_offset = bam_file.tell()
+                except Exception:
+                    chunk_offset = None
+            try:
+                read = next(bam_file)
+            except StopIteration:
+                break
+
+            # skip 'not primary' alignments
+            while read.flag & 256 == 256:
+                try:
+                    read = next(bam_file)
+                except StopIteration:
+                    end_of_file = True
+                    break
+            if not end_of_file:
+                try:
+                    supplementary_list = get_supplementary_alignment(read, bam_file)
+                except StopIteration:
+                    supplementary_list = None
+                    end_of_file = True
+                if supplementary_list:
+                    read = get_correct_map(read, supplementary_list)
+
+            if pSkipReads > 0:
+                pSkipReads -= 1
+                continue
+            buffer_reads.append(read)
+            if len(buffer_reads) == pChunkSize:
+                if not put_to_queue(pQueue, (chunk_offset, reads_to_chunk(buffer_reads, pSequenceLength, pOutputBam)), parent_id):
+                    return
+                buffer_reads = []
+        if len(buffer_reads) > 0:
+            if not put_to_queue(pQueue, (chunk_offset, reads_to_chunk(buffer_reads, pSequenceLength, pOutputBam)), parent_id):
+                return
+        bam_file.close()
+    except Exception as exp:
+        put_to_queue(pQueue, 'Fail: ' + str(exp) + traceback.format_exc(), parent_id)
+        return
+    put_to_queue(pQueue, None, parent_id)
+
+
+def reads_to_chunk(pReads, pSequenceLength, pOutputBam):
+    """
+    Converts a list of pysam reads into the chunk format which is sent from the reader processes to the main process:
+    a tuple of (mate records, flags, mapping qualities, read names, sam lines). The sam lines are only
+    stored if an output bam file is written, otherwise they are None.
+
+    >>> test = Tester()
+    >>> reads = [read for read in pysam.Samfile(test.bam_file_1, 'rb')][:3]
+    >>> records, flags, mapq, names, sam_lines = reads_to_chunk(reads, 0, False)
+    >>> len(records), flags.tolist() == [read.flag for read in reads], sam_lines
+    (3, True, None)
+    """
+    flags = np.fromiter((read.flag for read in pReads), dtype=np.int32, count=len(pReads))
+    mapq = np.fromiter((read.mapq for read in pReads), dtype=np.int32, count=len(pReads))
+    names = np.array([read.qname for read in pReads])
+    sam_lines = [read.to_string() for read in pReads] if pOutputBam else None
+    return mates_to_records(pReads, pSequenceLength), flags, mapq, names, sam_lines
+
+
+class MatePairReader(object):
+    """
+    Reads the two mate files in parallel, each by a `read_mate_file` process, and
+    assembles the received chunks into chunks of read pairs.
+
+    The reading can be continued at a position returned by `position`.
+    """
+
+    def __init__(self, pFileNames, pChunkSize, pSequenceLength, pOutputBam, pDecompressionThreads=1, pStartPosition=None):
+        if pStartPosition is None:
+            pStartPosition = {'offsets': [None, None], 'skip': 0, 'pairs': 0}
+        # the queues are bounded such that the readers are only a few chunks ahead
+        self.queues = [Queue(maxsize=4), Queue(maxsize=4)]
+        self.processes = [None, None]
+        for i in range(2):
+            offset = pStartPosition['offsets'][i]
+            self.processes[i] = Process(target=read_mate_file, kwargs=dict(
+                pFileName=pFileNames[i],
+                pQueue=self.queues[i],
+                pChunkSize=pChunkSize,
+                pSequenceLength=pSequenceLength,
+                pOutputBam=pOutputBam,
+                pDecompressionThreads=pDecompressionThreads,
+                pStartOffset=offset,
+                # without a file offset all pairs read so far are skipped
+                pSkipReads=pStartPosition['skip'] if offset is not None else pStartPosition['pairs']
+            ))
+            self.processes[i].daemon = True
+            self.processes[i].start()
+        self.all_data_read = False
+        # part of a pair chunk which was not consumed yet by `readBamFiles`
+        self.pending = None
+        self.chunk_offsets = [None, None]
+        self.chunk_length = 0
+        self.pairs_before_chunk = pStartPosition['pairs']
+
+    def position(self):
+        """
+        Returns the position after the pairs consumed so far as dictionary of the file offsets of the
+        current chunks, the number of pairs to skip after these offsets and the number of pairs in total.
+        """
+        skip = self.chunk_length - (len(self.pending[0][0]) if self.pending is not None else 0)
+        offsets = self.chunk_offsets
+        if offsets[0] is None or offsets[1] is None:
+            offsets = [None, None]
+        return {'offsets': list(offsets), 'skip': skip, 'pairs': self.pairs_before_chunk + skip}
+
+    def _received(self, pOffsets, pLength):
+        # keeps track of the position of the chunk returned last
+        self.pairs_before_chunk += self.chunk_length
+        self.chunk_offsets = pOffsets
+        self.chunk_length = pLength
+
+    def next_pair_chunk(self):
+        """
+        Returns the next chunk of read pairs as a tuple of (chunk file one, chunk file two),
+        both in the format of `reads_to_chunk` and of the same length. Returns None if one of the files has no more reads.
+        """
+        if self.pending is not None:
+            pair_chunk = self.pending
+            self.pending = None
+            return pair_chunk
+        if self.all_data_read:
+            return None
+        chunk1 = self._get(0)
+        chunk2 = self._get(1)
+        for chunk in (chunk1, chunk2):
+            if isinstance(chunk, str):
+                self.close()
+                raise Exception(chunk[6:])
+        if chunk1 is None or chunk2 is None:
+            self.all_data_read = True
+            return None
+        (offset1, chunk1), (offset2, chunk2) = chunk1, chunk2
+        length = min(len(chunk1[0]), len(chunk2[0]))
+        if length < len(chunk1[0]) or length < len(chunk2[0]):
+            # one of the files ends here, the remaining reads of the other one have no mate
+            self.all_data_read = True
+            chunk1 = slice_chunk(chunk1, 0, length)
+            chunk2 = slice_chunk(chunk2, 0, length)
+        self._received([offset1, offset2], length)
+        return chunk1, chunk2
+
+    def _get(self, pIndex):
+        # a reader process which is killed does not send the end of its file
+        try:
+            return get_from_queue(self.queues[pIndex], [self.processes[pIndex]])
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for i in range(len(self.processes)):
+            if self.processes[i] is not None:
+                self.queues[i].cancel_join_thread()
+                self.processes[i].terminate()
+                self.processes[i].join()
+                self.processes[i] = None
+
+
+def read_pairs_header(pFileName):
+    """
+    Reads the header of a 4DN pairs file (plain text, gzip or bgzip compressed, e.g. indexed by pairix).
+
+    :return: tuple of (list of the column names, list of (chromosome, size) tuples, number of header lines)
+
+    >>> import tempfile, gzip
+    >>> pairs_file = tempfile.NamedTemporaryFile(suffix='.pairs.gz', delete=False)
+    >>> with gzip.open(pairs_file.name, 'wt') as file:
+    ...     _ = file.write('## pairs format v1.0\\n#chromsize: chr1 1000\\n#chromsize: chr2 500\\n'
+    ...                    '#columns: readID chrom1 pos1 chrom2 pos2 strand1 strand2 pair_type\\n'
+    ...                    'r1\\tchr1\\t10\\tchr2\\t20\\t+\\t-\\tUU\\n')
+    >>> read_pairs_header(pairs_file.name)
+    (['readID', 'chrom1', 'pos1', 'chrom2', 'pos2', 'strand1', 'strand2', 'pair_type'], [('chr1', 1000), ('chr2', 500)], 4)
+    >>> os.unlink(pairs_file.name)
+    """
+    # the mandatory columns of the pairs format
+    columns = ['readID', 'chrom1', 'pos1', 'chrom2', 'pos2', 'strand1', 'strand2']
+    chrom_sizes = []
+    number_of_header_lines = 0
+    with open_pairs_file(pFileName) as file:
+        for line in file:
+            if not line.startswith('#'):
+                break
+            number_of_header_lines += 1
+            if line.startswith('#chromsize:'):
+                chrom, size = line[len('#chromsize:'):].split()
+                chrom_sizes.append((chrom, int(size)))
+            elif line.startswith('#columns:'):
+                columns = line[len('#columns:'):].split()
+    return columns, chrom_sizes, number_of_header_lines
+
+
+def open_pairs_file(pFileName):
+    """Opens a pairs file as text, gzip and bgzip compressed files are detected by their magic bytes."""
+    with open(pFileName, 'rb') as file:
+        magic_bytes = file.read(2)
+    if magic_bytes == b'\x1f\x8b':
+        return gzip.open(pFileName, 'rt')
+    return open(pFileName, 'r')
+
+
+def pairs_to_chunks(pPairs, pChromosomeIndex, pCoverageLength):
+    """
+    Converts a data frame of pairs into two chunks in the format of `reads_to_chunk`.
+    The reads are represented by their 5' position (the pairs format is 1-based),
+    the length of the alignment is not known. Pairs with a mate on an unknown chromosome
+    (e.g. '!' for unmapped mates) are flagged as unmapped.
+    Without mapq1 / mapq2 columns all pairs have the mapping quality 255.
+
+    >>> import pandas as pd
+    >>> pairs = pd.DataFrame({'chrom1': ['chr1', '!'], 'pos1': [10, 0], 'chrom2': ['chr2', 'chr1'], 'pos2': [20, 5],
+    ...                       'strand1': ['+', '-'], 'strand2': ['-', '+']})
+    >>> chunk1, chunk2 = pairs_to_chunks(pairs, {'chr1': 0, 'chr2': 1}, 10)
+    >>> chunk2[0]['reference_id'].tolist(), chunk2[0]['pos'].tolist(), chunk2[0]['is_reverse'].tolist()
+    ([1, 0], [19, 4], [True, False])
+    >>> chunk1[1].tolist(), chunk1[2].tolist()
+    ([0, 4], [255, 255])
+    """
+    length = len(pPairs)
+    names = np.zeros(length, dtype='U1')
+    chunks = []
+    for mate in ['1', '2']:
+        reference_id = pPairs['chrom' + mate].map(pChromosomeIndex).fillna(-1).to_numpy().astype(np.int32)
+        position = pPairs['pos' + mate].to_numpy().astype(np.int64)
+        unmapped = (reference_id < 0) | (position <= 0)
+        records = np.zeros(length, dtype=get_mate_record_dtype(0))
+        records['reference_id'] = np.maximum(reference_id, 0)
+        records['pos'] = np.maximum(position - 1, 0)
+        records['seq_len'] = pCoverageLength
+        records['is_reverse'] = pPairs['strand' + mate].to_numpy() == '-'
+        flags = np.where(unmapped, 4, 0).astype(np.int32)
+        if 'mapq' + mate in pPairs:
+            mapq = pPairs['mapq' + mate].to_numpy().astype(np.int32)
+        else:
+            mapq = np.full(length, 255, dtype=np.int32)
+        chunks.append((records, flags, mapq, names, None))
+    return chunks[0], chunks[1]
+
+
+def read_pairs_file(pFileName, pQueue, pChunkSize, pChromosomeIndex, pCoverageLength, pSkipPairs=0):
+    """
+    Reads a pairs file in its own process and sends the pairs in chunks (see `pairs_to_chunks`) to the main process.
+    The first pSkipPairs pairs are skipped.
+    """
+    parent_id = os.getppid()
+    try:
+        columns, _, number_of_header_lines = read_pairs_header(pFileName)
+        use_columns = [column for column in ['chrom1', 'pos1', 'chrom2', 'pos2', 'strand1', 'strand2', 'mapq1', 'mapq2'] if column in columns]
+        with open_pairs_file(pFileName) as file:
+            pairs_reader = pd.read_csv(file, sep='\t', header=None, skiprows=number_of_header_lines,
+                                       usecols=[columns.index(column) for column in use_columns],
+                                       dtype={columns.index(column): str for column in ['chrom1', 'chrom2', 'strand1', 'strand2']},
+                                       chunksize=pChunkSize)
+            for pairs in pairs_reader:
+                if pSkipPairs > 0:
+                    skip = min(pSkipPairs, len(pairs))
+                    pSkipPairs -= skip
+                    pairs = pairs.iloc[skip:]
+                    if len(pairs) == 0:
+                        continue
+                pairs.columns = [columns[index] for index in pairs.columns]
+                if not put_to_queue(pQueue, pairs_to_chunks(pairs, pChromosomeIndex, pCoverageLength), parent_id):
+                    return
+    except Exception as exp:
+        put_to_queue(pQueue, 'Fail: ' + str(exp) + traceback.format_exc(), parent_id)
+        return
+    put_to_queue(pQueue, None, parent_id)
+
+
+class PairsFileReader(MatePairReader):
+    """
+    Reads the read pairs of a pairs file in a separate process (see `read_pairs_file`).
+    It provides the same chunks of read pairs as `MatePairReader`, such that
+    the pairs are filtered and binned the same way as the reads of bam files.
+    """
+
+    def __init__(self, pFileName, pChunkSize, pChromosomeIndex, pCoverageLength, pStartPosition=None):
+        if pStartPosition is None:
+            pStartPosition = {'offsets': [None, None], 'skip': 0, 'pairs': 0}
+        self.queues = [Queue(maxsize=4)]
+        self.processes = [Process(target=read_pairs_file, kwargs=dict(
+            pFileName=pFileName,
+            pQueue=self.queues[0],
+            pChunkSize=pChunkSize,
+            pChromosomeIndex=pChromosomeIndex,
+            pCoverageLength=pCoverageLength,
+            pSkipPairs=pStartPosition['pairs']
+        ))]
+        self.processes[0].daemon = True
+        self.processes[0].start()
+        self.all_data_read = False
+        self.pending = None
+        self.chunk_offsets = [None, None]
+        self.chunk_length = 0
+        self.pairs_before_chunk = pStartPosition['pairs']
+
+    def next_pair_chunk(self):
+        if self.pending is not None:
+            pair_chunk = self.pending
+            self.pending = None
+            return pair_chunk
+        if self.all_data_read:
+            return None
+        pair_chunk = self._get(0)
+        if isinstance(pair_chunk, str):
+            self.close()
+            raise Exception(pair_chunk[6:])
+        if pair_chunk is None:
+            self.all_data_read = True
+        else:
+            self._received([None, None], len(pair_chunk[0][0]))
+        return pair_chunk
+
+
+def slice_chunk(pChunk, pStart, pEnd):
+    """
+    Returns the reads from pStart to pEnd of a chunk in the format of `reads_to_chunk`.
+    """
+    records, flags, mapq, names, sam_lines = pChunk
+    if sam_lines is not None:
+        sam_lines = sam_lines[pStart:pEnd]
+    return records[pStart:pEnd], flags[pStart:pEnd], mapq[pStart:pEnd], names[pStart:pEnd], sam_lines
+
+
+def readBamFiles(pMatePairReader, pNumberOfItemsPerBuffer, pSkipDuplicationCheck, pDuplicationIndex, pMinMappingQuality):
+    """Assemble the read pairs of the two input files into a buffer of pNumberOfItemsPerBuffer valid pairs.
+        The reads are decoded by the processes of pMatePairReader, here only the unmapped and low quality pairs are
+        removed and the duplication check is done with pDuplicationIndex (see `DuplicationIndex`).
+
+        The buffers are returned as mate records (see `mates_to_records`) together with
+        the sam lines of the reads if an output bam file is written."""
     buffer_mate1 = []
     buffer_mate2 = []
+    buffer_sam_lines1 = []
+    buffer_sam_lines2 = []
     duplicated_pairs = 0
     one_mate_unmapped = 0
     one_mate_not_unique = 0
@@ -469,404 +1373,525 @@ def readBamFiles(pFileOneIterator, pFileTwoIterator, pNumberOfItemsPerBuffer, pS
     j = 0
     iter_num = 0
     while j < pNumberOfItemsPerBuffer:
-        try:
-            mate1 = next(pFileOneIterator)
-            mate2 = next(pFileTwoIterator)
-        except StopIteration:
+        pair_chunk = pMatePairReader.next_pair_chunk()
+        if pair_chunk is None:
             all_data_read = True
             break
-        iter_num += 1
+        chunk1, chunk2 = pair_chunk
+        records1, flags1, mapq1, names1, sam_lines1 = chunk1
+        records2, flags2, mapq2, names2, sam_lines2 = chunk2
 
-        # skip 'not primary' alignments
-        while mate1.flag & 256 == 256:
-            try:
-                mate1 = next(pFileOneIterator)
-            except StopIteration:
-                all_data_read = True
-                break
-        while mate2.flag & 256 == 256:
-            try:
-                mate2 = next(pFileTwoIterator)
-            except StopIteration:
-                all_data_read = True
-                break
-
-        assert mate1.qname == mate2.qname, "FATAL ERROR {} {} " \
+        different_names = np.flatnonzero(names1 != names2)
+        assert len(different_names) == 0, "FATAL ERROR {} {} " \
             "Be sure that the sam files have the same read order " \
             "If using Bowtie2 or Hisat2 add " \
-            "the --reorder option".format(mate1.qname, mate2.qname)
+            "the --reorder option".format(names1[different_names[0]], names2[different_names[0]])
 
-        # check for supplementary alignments
-        # (needs to be done before skipping any unmapped reads
-        # to keep the order of the two bam files in sync)
-        mate1_supplementary_list = get_supplementary_alignment(
-            mate1, pFileOneIterator)
-        mate2_supplementary_list = get_supplementary_alignment(
-            mate2, pFileTwoIterator)
+        # skip if any of the reads is not mapped
+        unmapped = ((flags1 & 0x4) == 4) | ((flags2 & 0x4) == 4)
+        # skip if the read quality is low
+        low_quality = ~unmapped & ((mapq1 < pMinMappingQuality) | (mapq2 < pMinMappingQuality))
+        # for bwa other way to test
+        # for multi-mapping reads is with a mapq = 0
+        # the XS flag is not reliable.
+        not_unique = low_quality & (mapq1 == 0)
+        candidates = np.flatnonzero(~unmapped & ~low_quality)
+
+        end = len(records1)
+        if pSkipDuplicationCheck is False:
+            keys = DuplicationIndex.hash_pairs(records1['reference_id'][candidates], records1['pos'][candidates],
+                                               records2['reference_id'][candidates], records2['pos'][candidates])
+            duplicated = pDuplicationIndex.duplicated(keys)
+        else:
+            duplicated = np.zeros(len(candidates), dtype=bool)
+        accepted = candidates[~duplicated]
+        missing = pNumberOfItemsPerBuffer - j
+        if len(accepted) >= missing:
+            accepted = accepted[:missing]
+            end = accepted[-1] + 1
+        consumed = candidates < end
+        duplicated_pairs += int(np.sum(duplicated[consumed]))
+        if pSkipDuplicationCheck is False:
+            pDuplicationIndex.add(keys[consumed & ~duplicated])
+        j += len(accepted)
 
-        if mate1_supplementary_list:
-            mate1 = get_correct_map(mate1, mate1_supplementary_list)
+        if end < len(records1):
+            # the buffer is full, the remaining pairs are used for the next buffer
+            pMatePairReader.pending = (slice_chunk(chunk1, end, len(records1)), slice_chunk(chunk2, end, len(records2)))
 
-        if mate2_supplementary_list:
-            mate2 = get_correct_map(mate2, mate2_supplementary_list)
+        iter_num += end
+        one_mate_unmapped += int(np.sum(unmapped[:end]))
+        one_mate_not_unique += int(np.sum(not_unique[:end]))
+        one_mate_low_quality += int(np.sum(low_quality[:end] & ~not_unique[:end]))
 
-        # skip if any of the reads is not mapped
-        if mate1.flag & 0x4 == 4 or mate2.flag & 0x4 == 4:
-            one_mate_unmapped += 1
-            continue
+        buffer_mate1.append(records1[accepted])
+        buffer_mate2.append(records2[accepted])
+        if sam_lines1 is not None:
+            buffer_sam_lines1.extend(sam_lines1[index] for index in accepted.tolist())
+            buffer_sam_lines2.extend(sam_lines2[index] for index in accepted.tolist())
 
-        # skip if the read quality is low
-        if mate1.mapq < pMinMappingQuality or mate2.mapq < pMinMappingQuality:
-            # for bwa other way to test
-            # for multi-mapping reads is with a mapq = 0
-            # the XS flag is not reliable.
-            if mate1.mapq == 0 & mate2.mapq == 0:
-                one_mate_not_unique += 1
-                continue
+    if j > 0:
+        buffer_mate1 = np.concatenate(buffer_mate1)
+        buffer_mate2 = np.concatenate(buffer_mate2)
+    if all_data_read and j == 0:
+        return None, None, None, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num
+    return buffer_mate1, buffer_mate2, (buffer_sam_lines1, buffer_sam_lines2), all_data_read, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - j
 
-            """
-            # check if low quality is because of
-            # read being repetitive
-            # by reading the XS flag.
-            # The XS:i field is set by bowtie when a read is
-            # multi read and it contains the mapping score of the next
-            # best match
-            if 'XS' in dict(mate1.tags) or 'XS' in dict(mate2.tags):
-                one_mate_not_unique += 1
-                continue
-            """
 
-            one_mate_low_quality += 1
-            continue
+def get_rf_positions(pRfInterval):
+    """
+    Returns per chromosome the sorted start and the sorted end positions of the restriction sites.
 
-        if pSkipDuplicationCheck is False:
-            if pReadPosMatrix.is_duplicated(pRefId2name[mate1.rname],
-                                            mate1.pos,
-                                            pRefId2name[mate2.rname],
-                                            mate2.pos):
-                duplicated_pairs += 1
-                continue
-        buffer_mate1.append(mate1)
-        buffer_mate2.append(mate2)
-        j += 1
+    >>> rf_positions = get_rf_positions([('chr1', 30, 34), ('chr1', 10, 14), ('chr2', 5, 9)])
+    >>> rf_positions['chr1'][0].tolist(), rf_positions['chr1'][1].tolist()
+    ([10, 30], [14, 34])
+    """
+    rf_positions = {}
+    for chrom, start, end in pRfInterval:
+        if chrom not in rf_positions:
+            rf_positions[chrom] = ([], [])
+        rf_positions[chrom][0].append(start)
+        rf_positions[chrom][1].append(end)
+    for chrom in rf_positions:
+        rf_positions[chrom] = (np.sort(np.array(rf_positions[chrom][0], dtype=np.int64)),
+                               np.sort(np.array(rf_positions[chrom][1], dtype=np.int64)))
+    return rf_positions
+
+
+def has_restriction_site(pRfPositions, pReferenceNames, pStart, pEnd):
+    """
+    Checks for each region [pStart, pEnd) if a restriction site of pRfPositions (see `get_rf_positions`) overlaps it.
 
-    if all_data_read and len(buffer_mate1) != 0 and len(buffer_mate2) != 0:
-        return buffer_mate1, buffer_mate2, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
-    if all_data_read and len(buffer_mate1) == 0 or len(buffer_mate2) == 0:
-        return None, None, True, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
-    return buffer_mate1, buffer_mate2, False, duplicated_pairs, one_mate_unmapped, one_mate_not_unique, one_mate_low_quality, iter_num - len(buffer_mate1)
+    >>> rf_positions = get_rf_positions([('chr1', 10, 14), ('chr1', 20, 24)])
+    >>> has_restriction_site(rf_positions, np.array(['chr1'] * 4 + ['chr2']), np.array([14, 13, 23, 15, 0]),
+    ...                      np.array([20, 20, 30, 12, 100])).tolist()
+    [False, True, True, False, False]
+    """
+    has_rf = np.zeros(len(pStart), dtype=bool)
+    for chrom in np.unique(pReferenceNames):
+        if chrom not in pRfPositions:
+            continue
+        mask = pReferenceNames == chrom
+        rf_start, rf_end = pRfPositions[chrom]
+        start = pStart[mask]
+        end = pEnd[mask]
+        # number of sites starting before the region end minus
+        # the number of sites ending before the region start
+        overlapping = np.searchsorted(rf_start, end, side='left') - np.searchsorted(rf_end, start, side='right')
+        has_rf[mask] = (overlapping > 0) & (start < end)
+    return has_rf
+
+
+def assign_bins(pBins, pReferenceNames, pPositions, pDictBinIntervalTreeIndex):
+    """
+    Finds for each position the index of the bin in pBins which contains it. The bins of each chromosome
+    are stored sorted in pBins and pDictBinIntervalTreeIndex gives the first and last index per chromosome.
+    A position at the border of two bins belongs to both; in this case the bin is chosen which
+    a binary search over the bins of the chromosome finds first. Returns -1 for positions without a bin.
+
+    >>> bins = np.array([(0, 10, 0), (10, 20, 1), (30, 40, 2)], dtype=[('begin', np.int64), ('end', np.int64), ('data', np.int64)])
+    >>> assign_bins(bins, np.array(['chr1'] * 5 + ['chr2']), np.array([5, 10, 25, 40, 20, 5]), {'chr1': (0, 2)}).tolist()
+    [0, 1, -1, 2, 1, -1]
+    """
+    bin_index = np.full(len(pPositions), -1, dtype=np.int64)
+    for chrom in np.unique(pReferenceNames):
+        if chrom not in pDictBinIntervalTreeIndex:
+            # for small contigs it can happen that they are not
+            # in the bin_intval_tree keys if no restriction site is found
+            # on the contig.
+            continue
+        first, last = pDictBinIntervalTreeIndex[chrom]
+        begin = pBins['begin'][first:last + 1].astype(np.int64)
+        end = pBins['end'][first:last + 1].astype(np.int64)
+        mask = np.flatnonzero(pReferenceNames == chrom)
+        positions = pPositions[mask]
+        # last bin starting at or before the position
+        candidate = np.searchsorted(begin, positions, side='right') - 1
+        found = (candidate >= 0) & (end[np.maximum(candidate, 0)] >= positions)
+        bin_index[mask[found]] = first + candidate[found]
+
+        # positions which are contained in a bin further left too, e.g. they are at the border of two bins.
+        # These are resolved by the same binary search as used before to keep the assignment identical.
+        max_end_left = np.maximum.accumulate(end)
+        ambiguous = np.flatnonzero((candidate > 0) & (max_end_left[np.maximum(candidate - 1, 0)] >= positions))
+        for i in ambiguous.tolist():
+            position = positions[i]
+            start = 0
+            stop = len(begin) - 1
+            middle = (start + stop) // 2
+            bin_index[mask[i]] = -1
+            while not start > stop:
+                if begin[middle] <= position and position <= end[middle]:
+                    bin_index[mask[i]] = first + middle
+                    break
+                elif begin[middle] > position:
+                    stop = middle - 1
+                else:
+                    start = middle + 1
+                middle = (start + stop) // 2
+    return bin_index
 
 
 def process_data(pMateBuffer1, pMateBuffer2, pMinMappingQuality,
                  pKeepSelfCircles, pRestrictionSequence, pKeepSelfLigation, pMatrixSize,
                  pRfPositions, pRefId2name,
-                 pDanglingSequences, pBinsize, pResultIndex,
-                 pQueueOut, pTemplate, pOutputBamSet, pCounter,
-                 pSharedBinIntvalTree, pDictBinIntervalTreeIndex, pCoverage, pCoverageIndex,
-                 pOutputFileBufferDir, pRow, pCol, pData,
+                 pDanglingSequences, pBinsize, pOutputBamSet,
+                 pSharedBinIntvalTree, pDictBinIntervalTreeIndex, pCoverageIndex,
                  pMaxInsertSize, pQuickQCMode):
     """
     This function computes for a given number of elements in pMateBuffer1 and pMaterBuffer2 a partial interaction matrix.
     This function is used by multiple processes to speed up the computation.
     All partial matrices are merged in the end into one interaction matrix.
+    All read pairs of the buffers are classified at once on numpy arrays.
 
     Parameters
     ----------
-    pMateBuffer1 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 1
-    pMateBuffer2 : List of n reads of type 'pysam.libcalignedsegment.AlignedSegment' of sam input file 2
+    pMateBuffer1 : numpy array of n mate records (see `mates_to_records`) of sam input file 1
+    pMateBuffer2 : numpy array of n mate records (see `mates_to_records`) of sam input file 2
     pMinMappingQuality : integer, minimum mapping quality of a read
     pKeepSelfCircles : boolean, if self circles should be kept
     pRestrictionSequence : List of String, the restriction sequence
     pKeepSelfLigation : If self ligations should be removed
     pMatrixSize : integer, the size of the interaction matrix
-    pRfPositions : intervalTree, only used if a restriction cut file and not a bin size was defined.
+    pRfPositions : dict, the restriction sites per chromosome (see `get_rf_positions`), only used if a restriction cut file and not a bin size was defined.
     pRefId2name : Tuple, Maps a reference id to a name
     pDanglingSequences : dict, dict of dangling sequences
     pBinsize : integer, the size of the bins
-    pResultIndex : integer, number of processs, range(0, threads). Is returned via the queue to have access to the right row, col and data array after the computation.
-    pQueueOut : multiprocessing.Queue, queue to return the computed counting variables:
-            one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-            mate_not_close_to_rf, count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, long_range,
-            pair_added, len(pMateBuffer1), pResultIndex, pCounter
-    pTemplate : The template for the output bam file
     pOutputBamSet : If a output bam file should be written. Depending on the input parameter '--outBam'
-    pOutputName : String, Name of the partial bam file
-    pCounter : integer, value which is returned to the main process. The main process can than write a pCounter.bam_done file
-                to signal the background process, which is merging the partial bam files into one, that this dataset can be merged.
     pSharedBinIntvalTree : multiprocessing.sharedctype.RawArray of C_Interval, stores the interval tree in a 1D-RawArray.
     pDictBinIntervalTreeIndex : dict, stores the information at which index position a given interval starts and ends in the 1D-array 'pSharedBinIntvalTree'
-    pCoverage : multiprocessing.sharedctype.Array of c_uint, Stores the coverage in a 1D-Array
-    pCoverageIndex :  multiprocessing.sharedctype.RawArray of C_Coverage, stores the information in the 1D-array 'pCoverage'
-    pOutputFileBufferDir : String, the directory where the partial output bam files are buffered. Default is '/dev/shm/'
-    pRow : multiprocessing.sharedctype.RawArray of c_uint, Stores the row index information. It is available for all processes and does not need to be copied.
-    pCol : multiprocessing.sharedctype.RawArray of c_uint, stores the column index information. It is available for all processes and does not need to be copied.
-    pData : multiprocessing.sharedctype.RawArray of c_ushort, stores a 1 for each row - column pair. It is available for all processes and does not need to be copied.
+    pCoverageIndex :  multiprocessing.sharedctype.RawArray of C_Coverage, stores per bin the start and end of its elements in the coverage array
     pMaxInsertSize : maximum illumina insert size
+    pQuickQCMode : boolean, if set no matrix elements are returned
+
+    Returns
+    -------
+    A list with the counting variables:
+        one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
+        mate_not_close_to_rf, count_inward, count_outward, count_left, count_right, inter_chromosomal, short_range, long_range,
+        pair_added, len(pMateBuffer1), the row, column and data arrays of the partial matrix, the indices of the pairs
+        to write to the output bam file and the changes of the coverage. The coverage changes are a tuple of the
+        positions where covered ranges start, their counts, the positions where they end and their counts.
     """
-    try:
-
-        one_mate_unmapped = 0
-        one_mate_low_quality = 0
-        one_mate_not_unique = 0
-        dangling_end = {}
-        if pRestrictionSequence is not None:
-            for restrictionSequence in pRestrictionSequence:
-                dangling_end[restrictionSequence] = 0
-        self_circle = 0
-        self_ligation = 0
-        same_fragment = 0
-        mate_not_close_to_rf = 0
-
-        count_inward = 0
-        count_outward = 0
-        count_left = 0
-        count_right = 0
-        inter_chromosomal = 0
-        short_range = 0
-        long_range = 0
-
-        pair_added = 0
-
-        iter_num = 0
-        hic_matrix = None
-
-        out_bam_index_buffer = []
-
-        if pMateBuffer1 is None or pMateBuffer2 is None:
+    one_mate_unmapped = 0
+    one_mate_low_quality = 0
+    one_mate_not_unique = 0
+    dangling_end = {}
+    if pRestrictionSequence is not None:
+        for restrictionSequence in pRestrictionSequence:
+            dangling_end[restrictionSequence] = 0
+    self_circle = 0
 
-            pQueueOut.put([hic_matrix, [one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-                                        mate_not_close_to_rf, count_inward, count_outward,
-                                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, iter_num, pResultIndex, out_bam_index_buffer]])
-            return
+    length = min(len(pMateBuffer1), len(pMateBuffer2))
+    mate1 = pMateBuffer1[:length]
+    mate2 = pMateBuffer2[:length]
+
+    # the shared arrays are used without copying them
+    bins = np.ctypeslib.as_array(pSharedBinIntvalTree)
+    coverage_index = np.ctypeslib.as_array(pCoverageIndex)
+    reference_names = np.array(pRefId2name)
+    reference_name1 = reference_names[mate1['reference_id']]
+    reference_name2 = reference_names[mate2['reference_id']]
+    position1 = mate1['pos'].astype(np.int64)
+    position2 = mate2['pos'].astype(np.int64)
+    query_length1 = mate1['qlen'].astype(np.int64)
+    query_length2 = mate2['qlen'].astype(np.int64)
+
+    # check if reads belong to a bin. The middle genomic position of
+    # the read is used to find the bin it belongs to.
+    bin_index1 = assign_bins(bins, reference_name1, position1 + query_length1 // 2, pDictBinIntervalTreeIndex)
+    bin_index2 = assign_bins(bins, reference_name2, position2 + query_length2 // 2, pDictBinIntervalTreeIndex)
+
+    # if a mate is unassigned, it means it is not close
+    # to a restriction site
+    assigned = (bin_index1 >= 0) & (bin_index2 >= 0)
+    mate_not_close_to_rf = int(np.sum(~assigned))
+
+    # to identify 'inward' and 'outward' orientations
+    # the order or the mates in the genome has to be
+    # known.
+    """
+    outward
+    <---------------              ---------------->
 
-        while iter_num < len(pMateBuffer1) and iter_num < len(pMateBuffer2):
-            mate1 = pMateBuffer1[iter_num]
-            mate2 = pMateBuffer2[iter_num]
-            iter_num += 1
-
-            # check if reads belong to a bin
-            #
-            # pDictBinInterval stores the start and end position for each chromsome in the array 'pSharedBinIntvalTree'
-            # To get to the right interval a binary search is used.
-            mate_bins = []
-            mate_is_unasigned = False
-            for mate in [mate1, mate2]:
-                mate_ref = pRefId2name[mate.rname]
-                # find the middle genomic position of the read. This is used to
-                # find the bin it belongs to.
-                read_middle = mate.pos + int(mate.qlen / 2)
-                try:
-                    start, end = pDictBinIntervalTreeIndex[mate_ref]
-                    middle_pos = int((start + end) / 2)
-                    mate_bin = None
-                    while not start > end:
-                        if pSharedBinIntvalTree[middle_pos].begin <= read_middle and read_middle <= pSharedBinIntvalTree[middle_pos].end:
-                            mate_bin = pSharedBinIntvalTree[middle_pos]
-                            mate_is_unasigned = False
-                            break
-                        elif pSharedBinIntvalTree[middle_pos].begin > read_middle:
-                            end = middle_pos - 1
-                            middle_pos = int((start + end) / 2)
-                            mate_is_unasigned = True
-                        else:
-                            start = middle_pos + 1
-                            middle_pos = int((start + end) / 2)
-                            mate_is_unasigned = True
-
-                except KeyError:
-                    # for small contigs it can happen that they are not
-                    # in the bin_intval_tree keys if no restriction site is found
-                    # on the contig.
-                    mate_is_unasigned = True
-                    break
+    inward
+    --------------->              <----------------
 
-                # report no match case
-                if mate_bin is None:
-                    mate_is_unasigned = True
-                    break
-                mate_bin_id = mate_bin.data
-                mate_bins.append(mate_bin_id)
+    same-strand-right
+    --------------->              ---------------->
 
-            # if a mate is unassigned, it means it is not close
-            # to a restriction site
-            if mate_is_unasigned is True:
-                mate_not_close_to_rf += 1
+    same-strand-left
+    <---------------              <----------------
+    """
+    same_chromosome = assigned & (mate1['reference_id'] == mate2['reference_id'])
+    mate1_is_first = position1 < position2
+    first_is_reverse = np.where(mate1_is_first, mate1['is_reverse'], mate2['is_reverse'])
+    second_is_reverse = np.where(mate1_is_first, mate2['is_reverse'], mate1['is_reverse'])
+    inward = same_chromosome & ~first_is_reverse & second_is_reverse
+    outward = same_chromosome & first_is_reverse & ~second_is_reverse
+    same_strand_left = same_chromosome & first_is_reverse & second_is_reverse
+    same_strand_right = same_chromosome & ~first_is_reverse & ~second_is_reverse
+    distance = np.abs(position2 - position1)
+
+    # check if in between the two mate ends a restriction site is found. The interval used is:
+    # start of fragment + length of restriction sequence
+    # end of fragment - length of restriction sequence
+    # the restriction sequence length is subtracted
+    # such that only fragments internally containing
+    # the restriction site are identified.
+    # has_rf[i] is True if any of the first i + 1 restriction sequences has a site in between.
+    check_rf = bool(pRfPositions) and bool(pRestrictionSequence)
+    has_rf = []
+    if check_rf:
+        fragment_start = np.minimum(position1, position2)
+        fragment_end = np.maximum(position1 + query_length1, position2 + query_length2)
+        has_rf_any = np.zeros(length, dtype=bool)
+        for restrictionSequence in pRestrictionSequence:
+            has_rf_any = has_rf_any | has_restriction_site(pRfPositions, reference_name1,
+                                                           fragment_start + len(restrictionSequence),
+                                                           fragment_end - len(restrictionSequence))
+            has_rf.append(has_rf_any)
+
+    # check self-circles
+    # self circles are defined as outward pairs that do not
+    # have a restriction sequence in between. The distance of < 25kb is
+    # used to only check close outward pairs as far apart pairs can not be self-circles
+    if check_rf:
+        self_circle_candidates = outward & (distance < 25000)
+        for has_rf_any in has_rf:
+            self_circle += int(np.sum(self_circle_candidates & ~has_rf_any))
+
+    # check for dangling ends if the restriction sequence is known and if they look
+    # like 'same fragment'. Stop check with first match.
+    same_fragment_candidates = inward & (distance < pMaxInsertSize)
+    removed = ~assigned
+    if pRestrictionSequence and pDanglingSequences:
+        for restrictionSequence in pRestrictionSequence:
+            dangling = same_fragment_candidates & ~removed & \
+                (check_dangling_end(mate1, pDanglingSequences[restrictionSequence]) |
+                 check_dangling_end(mate2, pDanglingSequences[restrictionSequence]))
+            dangling_end[restrictionSequence] += int(np.sum(dangling))
+            removed |= dangling
+
+    same_fragment_candidates &= ~removed
+    if check_rf:
+        # case when there is no restriction fragment site between the
+        # mates
+        same_fragment_mask = same_fragment_candidates & ~has_rf[-1]
+    else:
+        same_fragment_mask = same_fragment_candidates
+    self_ligation_mask = same_fragment_candidates & ~same_fragment_mask
+    same_fragment = int(np.sum(same_fragment_mask))
+    self_ligation = int(np.sum(self_ligation_mask))
+    removed |= same_fragment_mask
+    if not pKeepSelfLigation:
+        # skip self ligations
+        removed |= self_ligation_mask
+
+    added = ~removed
+    pair_added = int(np.sum(added))
+
+    # count type of pair (distance, orientation)
+    inter_chromosomal = int(np.sum(added & ~same_chromosome))
+    short_range = int(np.sum(added & same_chromosome & (distance < 20000)))
+    long_range = int(np.sum(added & same_chromosome & (distance >= 20000)))
+    count_inward = int(np.sum(added & inward))
+    count_outward = int(np.sum(added & outward))
+    count_left = int(np.sum(added & same_strand_left))
+    count_right = int(np.sum(added & same_strand_right))
+
+    # fill in coverage vector. Both mates are counted in the bin of the second mate.
+    added_index = np.flatnonzero(added)
+    mate_bin = bins[bin_index2[added_index]]
+    coverage_begin = coverage_index['begin'][mate_bin['data']].astype(np.int64)
+    length_coverage = coverage_index['end'][mate_bin['data']].astype(np.int64) - coverage_begin
+    coverage_ranges = []
+    for mate in [mate1, mate2]:
+        vec_start = np.maximum(0, mate['pos'][added_index] - mate_bin['begin'].astype(np.int64)) // pBinsize
+        vec_end = np.minimum(length_coverage, vec_start + mate['seq_len'][added_index] // pBinsize)
+        coverage_ranges.append((coverage_begin + vec_start, coverage_begin + vec_end))
+    coverage_start = np.concatenate([coverage_range[0] for coverage_range in coverage_ranges])
+    coverage_end = np.concatenate([coverage_range[1] for coverage_range in coverage_ranges])
+    # the ranges are summed up by the main process as difference array, only the
+    # starts and ends of the ranges are sent back
+    covered = coverage_end > coverage_start
+    coverage_start_positions, coverage_start_counts = np.unique(coverage_start[covered], return_counts=True)
+    coverage_end_positions, coverage_end_counts = np.unique(coverage_end[covered], return_counts=True)
+    coverage_changes = (coverage_start_positions, coverage_start_counts.astype(np.int32),
+                        coverage_end_positions, coverage_end_counts.astype(np.int32))
+
+    out_bam_index_buffer = added_index.tolist() if pOutputBamSet else []
+
+    # sum up the pairs which fall into the same matrix element
+    # to keep the data which is sent back to the main process small
+    if pQuickQCMode:
+        added_index = added_index[:0]
+    row, col, data = sum_matrix_elements(bins['data'][bin_index1[added_index]], bins['data'][bin_index2[added_index]], pMatrixSize)
+
+    return [one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
+            mate_not_close_to_rf, count_inward, count_outward,
+            count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1), row, col, data, out_bam_index_buffer,
+            coverage_changes]
+
+
+def get_from_queue(pQueue, pProcesses, pTimeout=5):
+    """
+    Returns the next item of pQueue like pQueue.get(), but raises an exception if one of
+    pProcesses, which put the items into the queue, has exited and no item is left. A process
+    killed e.g. by the out of memory killer would block the main process forever otherwise.
+
+    >>> queue = Queue()
+    >>> process = Process(target=queue.put, args=(1,))
+    >>> process.start()
+    >>> process.join()
+    >>> get_from_queue(queue, [process], pTimeout=0.1)
+    1
+    >>> get_from_queue(queue, [process], pTimeout=0.1)
+    Traceback (most recent call last):
+    ...
+    Exception: A process exited with code 0 without sending its data.
+    """
+    while True:
+        try:
+            return pQueue.get(timeout=pTimeout)
+        except Empty:
+            exit_codes = [process.exitcode for process in pProcesses if process.exitcode is not None]
+            if len(exit_codes) == 0:
                 continue
+            # the last item of a process which has just exited may still arrive
+            try:
+                return pQueue.get(timeout=pTimeout)
+            except Empty:
+                raise Exception('A process exited with code {} without sending its data.'.format(exit_codes[0]))
 
-            # check if mates are in the same chromosome
-            if mate1.reference_id != mate2.reference_id:
-                orientation = 'diff_chromosome'
-            else:
-                # to identify 'inward' and 'outward' orientations
-                # the order or the mates in the genome has to be
-                # known.
-                if mate1.pos < mate2.pos:
-                    first_mate = mate1
-                    second_mate = mate2
-                else:
-                    first_mate = mate2
-                    second_mate = mate1
 
-                """
-                outward
-                <---------------              ---------------->
+def put_to_queue(pQueue, pItem, pParentId, pTimeout=5):
+    """
+    Puts pItem into the bounded pQueue like pQueue.put() and returns True. Returns False if the
+    parent process pParentId, which reads the queue, has exited. A killed main process would
+    block the reader processes forever otherwise.
+
+    >>> queue = Queue(maxsize=1)
+    >>> put_to_queue(queue, 1, os.getppid(), pTimeout=0.1)
+    True
+    >>> put_to_queue(queue, 2, -1, pTimeout=0.1)
+    False
+    """
+    while True:
+        try:
+            pQueue.put(pItem, timeout=pTimeout)
+            return True
+        except Full:
+            if os.getppid() != pParentId:
+                # the buffered items can not be sent anymore, the process must not wait for them at exit
+                pQueue.cancel_join_thread()
+                return False
 
-                inward
-                --------------->              <----------------
 
-                same-strand-right
-                --------------->              ---------------->
+def process_data_worker(pTaskQueue, pResultQueue, **pKwargs):
+    """
+    Long-lived worker process of hicBuildMatrix. The worker takes buffers of mate records from 'pTaskQueue',
+    computes the partial interaction matrix via `process_data` and puts the result into 'pResultQueue'.
+    All arguments which do not change during the run, e.g. the shared bins and the coverage index, are given
+    once via 'pKwargs'. The worker stops if it receives None or if the main process has exited.
 
-                same-strand-left
-                <---------------              <----------------
-                """
+    Parameters
+    ----------
+    pTaskQueue : multiprocessing.Queue, tuples of (task id, mate records file one, mate records file two)
+    pResultQueue : multiprocessing.Queue, tuples of (task id, result of `process_data`) or (task id, 'Fail: ...')
+    pKwargs : the remaining parameters of `process_data`
+    """
+    parent_id = os.getppid()
+    while True:
+        try:
+            task = pTaskQueue.get(timeout=5)
+        except Empty:
+            # a killed main process never sends None, the worker is then a child of another process
+            if os.getppid() != parent_id:
+                pResultQueue.cancel_join_thread()
+                return
+            continue
+        if task is None:
+            return
+        task_id, mate_records1, mate_records2 = task
+        try:
+            result = process_data(pMateBuffer1=mate_records1, pMateBuffer2=mate_records2, **pKwargs)
+        except Exception as exp:
+            result = 'Fail: ' + str(exp) + traceback.format_exc()
+        pResultQueue.put((task_id, result))
 
-                if not first_mate.is_reverse and second_mate.is_reverse:
-                    orientation = 'inward'
-                elif first_mate.is_reverse and not second_mate.is_reverse:
-                    orientation = 'outward'
-                elif first_mate.is_reverse and second_mate.is_reverse:
-                    orientation = 'same-strand-left'
-                else:
-                    orientation = 'same-strand-right'
-
-                # check self-circles
-                # self circles are defined as outward pairs that do not
-                # have a restriction sequence in between. The distance of < 25kb is
-                # used to only check close outward pairs as far apart pairs can not be self-circles
-                if abs(mate2.pos - mate1.pos) < 25000 and orientation == 'outward':
-                    has_rf = []
-
-                    if pRfPositions and pRestrictionSequence:
-                        # check if in between the two mate
-                        # ends the restriction fragment is found.
-                        # check for multiple restriction sequences
-                        for restrictionSequence in pRestrictionSequence:
-                            # the interval used is:
-                            # start of fragment + length of restriction sequence
-                            # end of fragment - length of restriction sequence
-                            # the restriction sequence length is subtracted
-                            # such that only fragments internally containing
-                            # the restriction site are identified
-                            frag_start = min(mate1.pos, mate2.pos) + \
-                                len(restrictionSequence)
-                            frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(restrictionSequence)
-                            mate_ref = pRefId2name[mate1.rname]
-                            if mate_ref in pRfPositions:
-                                has_rf.extend(sorted(
-                                    pRfPositions[mate_ref][frag_start: frag_end]))
-
-                            if len(has_rf) == 0:
-                                self_circle += 1
-                                if not pKeepSelfCircles:
-                                    continue
-                if abs(mate2.pos - mate1.pos) < pMaxInsertSize and orientation == 'inward':
-                    # check for dangling ends if the restriction sequence is known and if they look
-                    # like 'same fragment'
-                    if pRestrictionSequence:
-                        if pDanglingSequences:
-
-                            # check for dangling ends in sequence. Stop check with first match
-                            one_match = False
-                            for restrictionSequence in pRestrictionSequence:
-                                if check_dangling_end(mate1, pDanglingSequences[restrictionSequence]) or \
-                                        check_dangling_end(mate2, pDanglingSequences[restrictionSequence]):
-                                    dangling_end[restrictionSequence] += 1
-                                    one_match = True
-                                    break
-                            if one_match:
-                                continue
-                    has_rf = []
-
-                    if pRfPositions and pRestrictionSequence:
-                        # check if in between the two mate
-                        # ends the restriction fragment is found.
-
-                        # the interval used is:
-                        # start of fragment + length of restriction sequence
-                        # end of fragment - length of restriction sequence
-                        # the restriction sequence length is subtracted
-                        # such that only fragments internally containing
-                        # the restriction site are identified
-
-                        for restrictionSequence in pRestrictionSequence:
-                            frag_start = min(mate1.pos, mate2.pos) + \
-                                len(restrictionSequence)
-                            frag_end = max(mate1.pos + mate1.qlen, mate2.pos + mate2.qlen) - len(restrictionSequence)
-                            mate_ref = pRefId2name[mate1.rname]
-                            if mate_ref in pRfPositions:
-                                has_rf.extend(sorted(
-                                    pRfPositions[mate_ref][frag_start: frag_end]))
-
-                    # case when there is no restriction fragment site between the
-                    # mates
-                    if len(has_rf) == 0:
-                        same_fragment += 1
-                        continue
 
-                    self_ligation += 1
+def sum_matrix_elements(pRow, pCol, pMatrixSize):
+    """
+    Sums up the counts of identical (row, col) pairs.
 
-                    if not pKeepSelfLigation:
-                        # skip self ligations
-                        continue
+    >>> row, col, data = sum_matrix_elements(np.array([1, 0, 1]), np.array([2, 0, 2]), 3)
+    >>> row.tolist(), col.tolist(), data.tolist()
+    ([0, 1], [0, 2], [1, 2])
+    """
+    linear_index, data = np.unique(np.asarray(pRow, dtype=np.uint64) * np.uint64(pMatrixSize) + np.asarray(pCol, dtype=np.uint64),
+                                   return_counts=True)
+    return (linear_index // np.uint64(pMatrixSize)).astype(np.uint32), (linear_index % np.uint64(pMatrixSize)).astype(np.uint32), data.astype(np.uint32)
 
-                # set insert size to save bam
-                mate1.isize = mate2.pos - mate1.pos
-                mate2.isize = mate1.pos - mate2.pos
 
-            # if mate_bins, which is set in the previous section
-            # does not have size=2, it means that one
-            # of the exceptions happened
-            if len(mate_bins) != 2:
-                continue
+def get_bin_max_coverage(pCoverage, pCoverageIndex):
+    """
+    Returns the maximal coverage per bin as list, bins without coverage are np.nan.
+    As before, a bin covers the coverage elements from its begin to its end without the end itself.
 
-            # count type of pair (distance, orientation)
-            if mate1.reference_id != mate2.reference_id:
-                inter_chromosomal += 1
+    >>> coverage = np.array([1, 5, 2, 0, 0, 7, 3, 4])
+    >>> coverage_index = np.array([(0, 3), (3, 5), (5, 7), (8, 7)], dtype=[('begin', np.uint32), ('end', np.uint32)])
+    >>> get_bin_max_coverage(coverage, coverage_index)
+    [5, nan, 7, nan]
+    """
+    begin = pCoverageIndex['begin'].astype(np.int64)
+    end = pCoverageIndex['end'].astype(np.int64)
+    valid = np.flatnonzero((end > begin) & (end < len(pCoverage)))
+    bin_max = np.zeros(len(begin), dtype=pCoverage.dtype)
+    if len(valid) > 0:
+        # the maxima of [begin, end) are at the even positions, those of [end, next begin) at the odd ones
+        boundaries = np.column_stack([begin[valid], end[valid]]).ravel()
+        bin_max[valid] = np.maximum.reduceat(pCoverage, boundaries)[::2]
+    return [np.nan if value == 0 else value for value in bin_max.tolist()]
+
+
+def write_checkpoint(pFolder, pState, pArrays):
+    """
+    Writes a checkpoint of `createMatrix` to pFolder. The arrays are stored in a new npz file
+    and the json state file is replaced afterwards, such that the folder holds always one complete checkpoint.
+
+    >>> import tempfile
+    >>> folder = tempfile.mkdtemp()
+    >>> write_checkpoint(folder, {'generation': 1, 'pairs': 10}, {'coverage': np.arange(3)})
+    >>> write_checkpoint(folder, {'generation': 2, 'pairs': 20}, {'coverage': np.arange(4)})
+    >>> state, arrays = read_checkpoint(folder)
+    >>> state['pairs'], arrays['coverage'].tolist(), sorted(os.listdir(folder))
+    (20, [0, 1, 2, 3], ['arrays_2.npz', 'state.json'])
+    >>> shutil.rmtree(folder)
+    """
+    arrays_file = 'arrays_{}.npz'.format(pState['generation'])
+    np.savez(os.path.join(pFolder, arrays_file), **pArrays)
+    pState = dict(pState, arrays_file=arrays_file)
+    state_file = os.path.join(pFolder, 'state.json')
+    with open(state_file + '.tmp', 'w') as file:
+        json.dump(pState, file)
+    os.replace(state_file + '.tmp', state_file)
+    previous_file = os.path.join(pFolder, 'arrays_{}.npz'.format(pState['generation'] - 1))
+    if os.path.exists(previous_file):
+        unlink(previous_file)
+
+
+def read_checkpoint(pFolder):
+    """
+    Reads the checkpoint written by `write_checkpoint`.
 
-            elif abs(mate2.pos - mate1.pos) < 20000:
-                short_range += 1
-            else:
-                long_range += 1
-
-            if orientation == 'inward':
-                count_inward += 1
-            elif orientation == 'outward':
-                count_outward += 1
-            elif orientation == 'same-strand-left':
-                count_left += 1
-            elif orientation == 'same-strand-right':
-                count_right += 1
-
-            for mate in [mate1, mate2]:
-                # fill in coverage vector
-                vec_start = int(max(0, mate.pos - mate_bin.begin) / pBinsize)
-                length_coverage = pCoverageIndex[mate_bin_id].end - \
-                    pCoverageIndex[mate_bin_id].begin
-                vec_end = min(length_coverage, int(
-                    vec_start + len(mate.seq) / pBinsize))
-                coverage_index = pCoverageIndex[mate_bin_id].begin + vec_start
-                coverage_end = pCoverageIndex[mate_bin_id].begin + vec_end
-                for i in range(coverage_index, coverage_end, 1):
-                    pCoverage[i] += 1
-
-            if not pQuickQCMode:
-                pRow[pair_added] = mate_bins[0]
-                pCol[pair_added] = mate_bins[1]
-                pData[pair_added] = np.uint8(1)
-
-            pair_added += 1
-            if pOutputBamSet:
-
-                out_bam_index_buffer.append(iter_num - 1)
-
-        pQueueOut.put([[one_mate_unmapped, one_mate_low_quality, one_mate_not_unique, dangling_end, self_circle, self_ligation, same_fragment,
-                        mate_not_close_to_rf, count_inward, count_outward,
-                        count_left, count_right, inter_chromosomal, short_range, long_range, pair_added, len(pMateBuffer1), pResultIndex, pCounter, out_bam_index_buffer]])
-    except Exception as exp:
-        pQueueOut.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
-    return
+    :return: tuple of the state dictionary and the dictionary of arrays
+    """
+    with open(os.path.join(pFolder, 'state.json')) as file:
+        state = json.load(file)
+    with np.load(os.path.join(pFolder, state['arrays_file'])) as arrays_file:
+        arrays = dict(arrays_file)
+    return state, arrays
 
 
 def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
@@ -874,13 +1899,24 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
                  pDoTestRun, pOutBam, pChromosomeSizes, pRestrictionCutFile,
                  pRegion, pBinSize, pInputBufferSize,
                  pDoTestRunLines, pSkipDuplicationCheck, pMinMappingQuality,
-                 pKeepSelfCircles, pKeepSelfLigation, pMinDistance, pGenomeAssembly):
+                 pKeepSelfCircles, pKeepSelfLigation, pMinDistance, pGenomeAssembly, pDuplicationCheckMemory=None,
+                 pPairsFile=None, pMatrixMemory=None, pCheckpointInterval=None, pResume=False):
     # pOutFileName.name = pOutFileName.name.strip()
     # log.debug('pOutFileName.name: {}'.format(pOutFileName.name.endswith('.h5')))
     if not pOutFileName.name.endswith('.h5') and not pOutFileName.name.endswith('.cool'):
         if '.mcool' not in pOutFileName.name:
             log.error('Please define the file extension. h5 and cool are supported, or the specializations of cool, mcool. Given input {}'.format(pOutFileName.name))
             exit(1)
+    if pBinSize is not None and len(pBinSize) > 1:
+        # all resolutions are derived from the finest one
+        pBinSize = sorted(set(pBinSize))
+        if not pOutFileName.name.endswith('.mcool'):
+            log.error('Multiple bin sizes are only supported for the mcool file format. Given output {}'.format(pOutFileName.name))
+            exit(1)
+        for resolution in pBinSize[1:]:
+            if resolution % pBinSize[0] != 0:
+                log.error('All bin sizes need to be a multiple of the smallest bin size {}. Given {}'.format(pBinSize[0], resolution))
+                exit(1)
     # for backwards compatibility
     if pMaxDistance is not None:
         pMaxLibraryInsertSize = pMaxDistance
@@ -889,6 +1925,44 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
     except OSError:
         exit("Can't open/create QC folder path: {}. Please check".format(pQCfolder))
 
+    # the checkpoints are written next to the output file, a resumed run
+    # must use the same parameters which influence the result
+    checkpoint_folder = None
+    checkpoint_state = None
+    checkpoint_arrays = None
+    checkpoint_parameters = None
+    if (pCheckpointInterval is not None or pResume) and not pDoTestRun:
+        checkpoint_folder = pOutFileName.name + '.checkpoint'
+        checkpoint_parameters = {
+            'samFiles': [samFile.name for samFile in pSamFiles] if pSamFiles else None,
+            'pairsFile': pPairsFile,
+            'binSize': list(pBinSize) if pBinSize else None,
+            'restrictionCutFile': [restrictionCutFile.name for restrictionCutFile in pRestrictionCutFile] if pRestrictionCutFile else None,
+            'restrictionSequence': pRestrictionSequence,
+            'danglingSequence': pDanglingSequence,
+            'chromosomeSizes': pChromosomeSizes.name if pChromosomeSizes else None,
+            'region': pRegion,
+            'minDistance': pMinDistance,
+            'maxLibraryInsertSize': pMaxLibraryInsertSize,
+            'minMappingQuality': pMinMappingQuality,
+            'keepSelfLigation': pKeepSelfLigation,
+            'keepSelfCircles': pKeepSelfCircles,
+            'skipDuplicationCheck': pSkipDuplicationCheck,
+            'outBam': bool(pOutBam)
+        }
+        if pResume and os.path.exists(os.path.join(checkpoint_folder, 'state.json')):
+            checkpoint_state, checkpoint_arrays = read_checkpoint(checkpoint_folder)
+            if checkpoint_state['parameters'] != checkpoint_parameters:
+                log.error('The checkpoint {} was created with different parameters. '
+                          'Please run without --resume to start from the beginning.'.format(checkpoint_folder))
+                exit(1)
+            log.info('Resuming from checkpoint {} after {} read pairs'.format(checkpoint_folder, checkpoint_state['position']['pairs']))
+        else:
+            if pResume:
+                log.warning('No checkpoint found in {}, starting from the beginning.'.format(checkpoint_folder))
+            shutil.rmtree(checkpoint_folder, ignore_errors=True)
+            Path(checkpoint_folder).mkdir(parents=True)
+
     if pThreads < 2:
         pThreads = 2
         warnings.warn(
@@ -897,20 +1971,43 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
     if pDanglingSequence and not pRestrictionSequence:
         exit("\nIf --danglingSequence is set, --restrictionSequence needs to be set too.\n")
 
-    log.info("reading {} and {} to build hic_matrix\n".format(pSamFiles[0].name,
-                                                              pSamFiles[1].name))
-    str1 = pysam.Samfile(pSamFiles[0].name, 'rb')
-    str2 = pysam.Samfile(pSamFiles[1].name, 'rb')
+    if pPairsFile is not None:
+        log.info("reading {} to build hic_matrix\n".format(pPairsFile))
+        _, pairs_chrom_sizes, _ = read_pairs_header(pPairsFile)
+        if pOutBam:
+            log.warning('An output bam file can not be created from a pairs file. --outBam is ignored.')
+            pOutBam.close()
+            unlink(pOutBam.name)
+            pOutBam = None
+        if pDanglingSequence:
+            log.warning('The pairs file does not contain the read sequences, dangling ends can not be detected.')
+    else:
+        log.info("reading {} and {} to build hic_matrix\n".format(pSamFiles[0].name,
+                                                                  pSamFiles[1].name))
+        str1 = pysam.Samfile(pSamFiles[0].name, 'rb')
 
-    pSamFiles[0].close()
-    pSamFiles[1].close()
+        pSamFiles[0].close()
+        pSamFiles[1].close()
     if not pDoTestRun:
         if pOutBam:
             pOutBam.close()
-            out_bam_file = pysam.Samfile(pOutBam.name, 'wb', template=str1)
+            if checkpoint_folder is not None:
+                # the bam file is written in one part per checkpoint, the parts are concatenated at the end
+                bam_parts = checkpoint_state['bam_parts'] if checkpoint_state is not None else []
+                bam_part = os.path.join(checkpoint_folder, 'part_{}.bam'.format(len(bam_parts)))
+                out_bam_file = pysam.Samfile(bam_part, 'wb', template=str1)
+            else:
+                out_bam_file = pysam.Samfile(pOutBam.name, 'wb', template=str1)
 
     if pChromosomeSizes is None:
-        chrom_sizes = get_chrom_sizes(str1)
+        if pPairsFile is not None:
+            if len(pairs_chrom_sizes) == 0:
+                log.error('The pairs file {} does not define the chromosome sizes in its header. '
+                          'Please use --chromosomeSizes.'.format(pPairsFile))
+                exit(1)
+            chrom_sizes = pairs_chrom_sizes
+        else:
+            chrom_sizes = get_chrom_sizes(str1)
     else:
         chrom_sizes = OrderedDict()
         with open(pChromosomeSizes.name, 'r') as file:
@@ -923,14 +2020,15 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
         chrom_sizes = list(chrom_sizes.items())
 
     # log.debug('chrom_sizes {}'.format(chrom_sizes))
-    read_pos_matrix = ReadPositionMatrix()
+    duplication_index = DuplicationIndex(pMaxMemory=pDuplicationCheckMemory * 1024 * 1024 if pDuplicationCheckMemory else None,
+                                         pTempDir=checkpoint_folder)
 
     rf_interval = []
     if pRestrictionCutFile:
         for restrictionCutFile in pRestrictionCutFile:
             rf_interval.extend(bed2interval_list(restrictionCutFile, chrom_sizes, pRegion))
 
-        rf_positions = intervalListToIntervalTree(rf_interval)
+        rf_positions = get_rf_positions(rf_interval)
         log.debug('rf_positions {}'.format(rf_positions.keys()))
     else:
         rf_positions = None
@@ -944,7 +2042,11 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
 
     matrix_size = len(bin_intervals)
     bin_intval_tree = intervalListToIntervalTree(bin_intervals)
-    ref_id2name = str1.references
+    if pPairsFile is not None:
+        # the reference ids of the pairs are the positions of the chromosomes in the header
+        ref_id2name = tuple(chrom for chrom, _ in (pairs_chrom_sizes if len(pairs_chrom_sizes) > 0 else chrom_sizes))
+    else:
+        ref_id2name = str1.references
 
     # build c_type shared memory for the interval tree
     shared_array_list = []
@@ -995,23 +2097,21 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
         start_pos_coverage, end_pos_coverage)))
     start_pos_coverage = None
     end_pos_coverage = None
-    coverage = Array(c_uint, [0] * number_of_elements_coverage)
-
-    # define global shared ctypes arrays for row, col and data
-    pThreads = pThreads - 1
-    row = [None] * pThreads
-    col = [None] * pThreads
-    data = [None] * pThreads
-    for i in range(pThreads):
-        row[i] = RawArray(c_uint, pInputBufferSize)
-        col[i] = RawArray(c_uint, pInputBufferSize)
-        data[i] = RawArray(c_ushort, pInputBufferSize)
+    # the coverage is accumulated by the main process as difference array of the covered ranges
+    # returned by the workers, its cumulative sum is the coverage
+    coverage_difference = np.zeros(number_of_elements_coverage + 1, dtype=np.int32)
+    if checkpoint_state is not None:
+        coverage_difference[:] = checkpoint_arrays['coverage_difference']
+    # two threads are used by the processes which read the two input files (one for a pairs file),
+    # the main process only assembles the read pairs. All others are long-lived worker processes.
+    # Each reader of a bam file decompresses it with half of the threads, the decompression
+    # and the workers alternate as the readers are only a few chunks ahead.
+    decompression_threads = max(1, pThreads // 2)
+    pThreads = max(1, pThreads - (1 if pPairsFile is not None else 2))
 
     start_time = time.time()
 
     iter_num = 0
-    # pair_added = 0
-    # hic_matrix = None
 
     one_mate_unmapped = 0
     one_mate_low_quality = 0
@@ -1037,209 +2137,306 @@ def createMatrix(pOutFileName, pMaxDistance, pMaxLibraryInsertSize, pQCfolder,
 
     pair_added = 0
 
-    # input buffer for bam files
-    buffer_workers1 = [None] * pThreads
-    buffer_workers2 = [None] * pThreads
-
-    # output buffer to write bam with mate1 and mate2 pairs
+    if checkpoint_state is not None:
+        qc_counters = checkpoint_state['qc_counters']
+        iter_num = qc_counters['iter_num']
+        one_mate_unmapped = qc_counters['one_mate_unmapped']
+        one_mate_low_quality = qc_counters['one_mate_low_quality']
+        one_mate_not_unique = qc_counters['one_mate_not_unique']
+        dangling_end = qc_counters['dangling_end']
+        self_circle = qc_counters['self_circle']
+        self_ligation = qc_counters['self_ligation']
+        same_fragment = qc_counters['same_fragment']
+        mate_not_close_to_rf = qc_counters['mate_not_close_to_rf']
+        duplicated_pairs = qc_counters['duplicated_pairs']
+        count_inward = qc_counters['count_inward']
+        count_outward = qc_counters['count_outward']
+        count_left = qc_counters['count_left']
+        count_right = qc_counters['count_right']
+        inter_chromosomal = qc_counters['inter_chromosomal']
+        short_range = qc_counters['short_range']
+        long_range = qc_counters['long_range']
+        pair_added = qc_counters['pair_added']
+
+        def restored_arrays(pPrefix):
+            return {key[len(pPrefix):]: value for key, value in checkpoint_arrays.items() if key.startswith(pPrefix)}
+        duplication_index.set_state(checkpoint_state['duplication_index'], restored_arrays('duplication_index.'))
+
+    # the reads are sent to the workers as compact records. Only the start and the end of the
+    # read sequence is needed to check for dangling ends.
+    sequence_length = 0
+    if dangling_sequences:
+        sequence_length = max(len(dangling_sequences[sequence]['pat_forw']) for sequence in dangling_sequences)
+
+    # the task queue is bounded to limit the number of buffers in memory,
+    # the main process blocks on the result queue until any worker has finished.
+    max_tasks_in_flight = 2 * pThreads
+    task_queue = Queue(maxsize=pThreads)
+    result_queue = Queue()
     process = [None] * pThreads
+    for i in range(pThreads):
+        process[i] = Process(target=process_data_worker, args=(task_queue, result_queue), kwargs=dict(
+            pMinMappingQuality=pMinMappingQuality,
+            pKeepSelfCircles=pKeepSelfCircles,
+            pRestrictionSequence=pRestrictionSequence,
+            pKeepSelfLigation=pKeepSelfLigation,
+            pMatrixSize=matrix_size,
+            pRfPositions=rf_positions,
+            pRefId2name=ref_id2name,
+            pDanglingSequences=dangling_sequences,
+            pBinsize=binsize,
+            pOutputBamSet=pOutBam,
+            pSharedBinIntvalTree=shared_build_intval_tree,
+            pDictBinIntervalTreeIndex=index_dict,
+            pCoverageIndex=pos_coverage,
+            pMaxInsertSize=pMaxLibraryInsertSize,
+            pQuickQCMode=pDoTestRun
+        ))
+        process[i].daemon = True
+        process[i].start()
+
+    chunk_size = min(pInputBufferSize if not pDoTestRun else pDoTestRunLines, 100000)
+    start_position = checkpoint_state['position'] if checkpoint_state is not None else None
+    if pPairsFile is not None:
+        # the pairs are parsed in a reader process, each mate covers one coverage unit at its 5' position
+        mate_pair_reader = PairsFileReader(pFileName=pPairsFile,
+                                           pChunkSize=chunk_size,
+                                           pChromosomeIndex={chrom: i for i, chrom in enumerate(ref_id2name)},
+                                           pCoverageLength=binsize,
+                                           pStartPosition=start_position)
+    else:
+        # the input files are decoded in parallel by two reader processes
+        mate_pair_reader = MatePairReader(pFileNames=[pSamFiles[0].name, pSamFiles[1].name],
+                                          pChunkSize=chunk_size,
+                                          pSequenceLength=sequence_length,
+                                          pOutputBam=bool(pOutBam) and not pDoTestRun,
+                                          pDecompressionThreads=decompression_threads,
+                                          pStartPosition=start_position)
+
+    # the sam lines of the buffers in computation, only kept to write the output bam file
+    tasks_in_flight = {}
+    task_id = 0
     all_data_processed = False
-    hic_matrix = coo_matrix((matrix_size, matrix_size), dtype='uint32')
-    queue = [None] * pThreads
-
-    all_threads_done = False
-    thread_done = [False] * pThreads
-    count_output = 0
-    count_call_of_read_input = 0
-    computed_pairs = 0
+    pixel_accumulator = PixelAccumulator(matrix_size, pMaxMemory=pMatrixMemory * 1024 * 1024 if pMatrixMemory else None,
+                                         pTempDir=checkpoint_folder)
+    if checkpoint_state is not None:
+        pixel_accumulator.set_state(checkpoint_state['pixel_accumulator'], restored_arrays('pixel_accumulator.'))
+    checkpoint_arrays = None
+    checkpoint_generation = checkpoint_state['generation'] if checkpoint_state is not None else 0
+    checkpoint_interval = 30 if pCheckpointInterval is None else pCheckpointInterval
+    last_checkpoint_time = time.time()
+    # at a checkpoint no new buffers are started until all buffers in computation are finished
+    checkpoint_due = False
 
     if pDoTestRun:
         pInputBufferSize = pDoTestRunLines
     fail_flag = False
     fail_message = ''
-    while not all_data_processed or not all_threads_done:
-
-        for i in range(pThreads):
-            if queue[i] is None and not all_data_processed:
-                count_call_of_read_input += 1
-
-                buffer_workers1[i], buffer_workers2[i], all_data_processed, \
+    while not all_data_processed or len(tasks_in_flight) > 0:
+
+        if checkpoint_folder is not None and not all_data_processed:
+            if time.time() - last_checkpoint_time >= checkpoint_interval * 60:
+                checkpoint_due = True
+            if checkpoint_due and len(tasks_in_flight) == 0:
+                if pOutBam:
+                    out_bam_file.close()
+                    bam_parts.append(bam_part)
+                    bam_part = os.path.join(checkpoint_folder, 'part_{}.bam'.format(len(bam_parts)))
+                    out_bam_file = pysam.Samfile(bam_part, 'wb', template=str1)
+                duplication_index_state, duplication_index_arrays = duplication_index.get_state()
+                pixel_accumulator_state, pixel_accumulator_arrays = pixel_accumulator.get_state()
+                arrays = {'coverage_difference': coverage_difference}
+                arrays.update({'duplication_index.' + key: value for key, value in duplication_index_arrays.items()})
+                arrays.update({'pixel_accumulator.' + key: value for key, value in pixel_accumulator_arrays.items()})
+                checkpoint_generation += 1
+                write_checkpoint(checkpoint_folder, {
+                    'generation': checkpoint_generation,
+                    'parameters': checkpoint_parameters,
+                    'position': mate_pair_reader.position(),
+                    'qc_counters': {'iter_num': int(iter_num),
+                                    'one_mate_unmapped': int(one_mate_unmapped),
+                                    'one_mate_low_quality': int(one_mate_low_quality),
+                                    'one_mate_not_unique': int(one_mate_not_unique),
+                                    'dangling_end': {key: int(value) for key, value in dangling_end.items()},
+                                    'self_circle': int(self_circle),
+                                    'self_ligation': int(self_ligation),
+                                    'same_fragment': int(same_fragment),
+                                    'mate_not_close_to_rf': int(mate_not_close_to_rf),
+                                    'duplicated_pairs': int(duplicated_pairs),
+                                    'count_inward': int(count_inward),
+                                    'count_outward': int(count_outward),
+                                    'count_left': int(count_left),
+                                    'count_right': int(count_right),
+                                    'inter_chromosomal': int(inter_chromosomal),
+                                    'short_range': int(short_range),
+                                    'long_range': int(long_range),
+                                    'pair_added': int(pair_added)},
+                    'duplication_index': duplication_index_state,
+                    'pixel_accumulator': pixel_accumulator_state,
+                    'bam_parts': bam_parts if pOutBam else []
+                }, arrays)
+                arrays = None
+                log.info('Checkpoint written to {} after {} read pairs'.format(checkpoint_folder, mate_pair_reader.position()['pairs']))
+                last_checkpoint_time = time.time()
+                checkpoint_due = False
+
+        if not all_data_processed and not checkpoint_due and len(tasks_in_flight) < max_tasks_in_flight:
+            try:
+                buffer_mate1, buffer_mate2, buffer_sam_lines, all_data_processed, \
                     duplicated_pairs_, one_mate_unmapped_, one_mate_not_unique_, \
-                    one_mate_low_quality_, iter_num_ = readBamFiles(pFileOneIterator=str1,
-                                                                    pFileTwoIterator=str2,
+                    one_mate_low_quality_, iter_num_ = readBamFiles(pMatePairReader=mate_pair_reader,
                                                                     pNumberOfItemsPerBuffer=pInputBufferSize,
                                                                     pSkipDuplicationCheck=pSkipDuplicationCheck,
-                                                                    pReadPosMatrix=read_pos_matrix,
-                                                                    pRefId2name=ref_id2name,
+                                                                    pDuplicationIndex=duplication_index,
                                                                     pMinMappingQuality=pMinMappingQuality
                                                                     )
-                duplicated_pairs += duplicated_pairs_
-                one_mate_unmapped += one_mate_unmapped_
-                one_mate_not_unique += one_mate_not_unique_
-                one_mate_low_quality += one_mate_low_quality_
-                iter_num += iter_num_
-                queue[i] = Queue()
-                thread_done[i] = False
-                computed_pairs += len(buffer_workers1[i])
-                # create process to compute hic matrix for this buffer
-                process[i] = Process(target=process_data, kwargs=dict(
-                    pMateBuffer1=buffer_workers1[i],
-                    pMateBuffer2=buffer_workers2[i],
-                    pMinMappingQuality=pMinMappingQuality,
-                    pKeepSelfCircles=pKeepSelfCircles,
-                    pRestrictionSequence=pRestrictionSequence,
-                    pKeepSelfLigation=pKeepSelfLigation,
-                    pMatrixSize=matrix_size,
-                    pRfPositions=rf_positions,
-                    pRefId2name=ref_id2name,
-                    pDanglingSequences=dangling_sequences,
-                    pBinsize=binsize,
-                    pResultIndex=i,
-                    pQueueOut=queue[i],
-                    pTemplate=str1,
-                    pOutputBamSet=pOutBam,
-                    pCounter=count_output,
-                    pSharedBinIntvalTree=shared_build_intval_tree,
-                    pDictBinIntervalTreeIndex=index_dict,
-                    pCoverage=coverage,
-                    pCoverageIndex=pos_coverage,
-                    pOutputFileBufferDir="",
-                    pRow=row[i],
-                    pCol=col[i],
-                    pData=data[i],
-                    pMaxInsertSize=pMaxLibraryInsertSize,
-                    pQuickQCMode=pDoTestRun
-                ))
-                process[i].start()
-                count_output += 1
-
-            elif queue[i] is not None and not queue[i].empty():
-                result = queue[i].get()
-                if 'Fail:' in result:
-                    fail_flag = True
-                    fail_message = result[6:]
-                else:
-                    if result[0] is not None:
-                        elements = result[0][15]
-                        if hic_matrix is None:
-                            hic_matrix = coo_matrix(
-                                (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-                        else:
-                            hic_matrix += coo_matrix(
-                                (data[i][:elements], (row[i][:elements], col[i][:elements])), shape=(matrix_size, matrix_size))
-
-                        for sequence in result[0][3]:
-                            dangling_end[sequence] += result[0][3][sequence]
-                        self_circle += result[0][4]
-                        self_ligation += result[0][5]
-                        same_fragment += result[0][6]
-                        mate_not_close_to_rf += result[0][7]
-
-                        count_inward += result[0][8]
-                        count_outward += result[0][9]
-                        count_left += result[0][10]
-                        count_right += result[0][11]
-                        inter_chromosomal += result[0][12]
-                        short_range += result[0][13]
-                        long_range += result[0][14]
-
-                        pair_added += result[0][15]
-                        iter_num += result[0][16]
-
-                    for bam_index in result[0][19]:
-                        mate1 = buffer_workers1[i][bam_index]
-                        mate2 = buffer_workers2[i][bam_index]
-
-                        mate1.flag |= 0x1
-                        mate2.flag |= 0x1
-
-                        # set one read as the first in pair and the
-                        # other as second
-                        mate1.flag |= 0x40
-                        mate2.flag |= 0x80
-
-                        # set chrom of mate
-                        mate1.mrnm = mate2.rname
-                        mate2.mrnm = mate1.rname
-
-                        # set position of mate
-                        mate1.mpos = mate2.pos
-                        mate2.mpos = mate1.pos
-
-                        out_bam_file.write(mate1)
-                        out_bam_file.write(mate2)
-
-                buffer_workers1[i] = None
-                buffer_workers2[i] = None
-                queue[i] = None
-                process[i].join()
-                process[i].terminate()
-                process[i] = None
-                thread_done[i] = True
-
-                # caused by the architecture I try to display this output
-                # information after +-1e5 of 1e6 reads.
-                if iter_num % 1e6 < 100000:
-                    elapsed_time = time.time() - start_time
-                    log.info("processing {} lines took {:.2f} "
-                             "secs ({:.1f} lines per "
-                             "second)\n".format(iter_num,
-                                                elapsed_time,
-                                                iter_num / elapsed_time))
-                    log.info("{} ({:.2f}%) valid pairs added to matrix"
-                             "\n".format(pair_added, float(100 * pair_added) / iter_num))
-                if pDoTestRun and iter_num > pDoTestRunLines:
-                    log.debug(
-                        "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
-                    all_data_processed = True
-                    thread_done[i] = True
-                    break
-            elif all_data_processed and queue[i] is None:
-                thread_done[i] = True
-            else:
-                time.sleep(1)
+            except Exception as exp:
+                fail_flag = True
+                fail_message = str(exp)
+                break
+            duplicated_pairs += duplicated_pairs_
+            one_mate_unmapped += one_mate_unmapped_
+            one_mate_not_unique += one_mate_not_unique_
+            one_mate_low_quality += one_mate_low_quality_
+            iter_num += iter_num_
+            if buffer_mate1 is None:
+                continue
+            task_queue.put((task_id, buffer_mate1, buffer_mate2))
+            tasks_in_flight[task_id] = buffer_sam_lines if pOutBam else None
+            task_id += 1
+            continue
+
+        try:
+            result_task_id, result = get_from_queue(result_queue, process)
+        except Exception as exp:
+            fail_flag = True
+            fail_message = str(exp)
+            break
+        buffer_mates = tasks_in_flight.pop(result_task_id)
+        if isinstance(result, str):
+            fail_flag = True
+            fail_message = result[6:]
+            break
+
+        if len(result[19]) > 0:
+            pixel_accumulator.add(result[17], result[18], result[19])
+
+        for sequence in result[3]:
+            dangling_end[sequence] += result[3][sequence]
+        self_circle += result[4]
+        self_ligation += result[5]
+        same_fragment += result[6]
+        mate_not_close_to_rf += result[7]
+
+        count_inward += result[8]
+        count_outward += result[9]
+        count_left += result[10]
+        count_right += result[11]
+        inter_chromosomal += result[12]
+        short_range += result[13]
+        long_range += result[14]
+
+        pair_added += result[15]
+        iter_num += result[16]
+
+        coverage_start_positions, coverage_start_counts, coverage_end_positions, coverage_end_counts = result[21]
+        coverage_difference[coverage_start_positions] += coverage_start_counts
+        coverage_difference[coverage_end_positions] -= coverage_end_counts
+
+        for bam_index in result[20]:
+            mate1 = pysam.AlignedSegment.fromstring(buffer_mates[0][bam_index], str1.header)
+            mate2 = pysam.AlignedSegment.fromstring(buffer_mates[1][bam_index], str1.header)
+
+            mate1.flag |= 0x1
+            mate2.flag |= 0x1
+
+            # set one read as the first in pair and the
+            # other as second
+            mate1.flag |= 0x40
+            mate2.flag |= 0x80
+
+            # set chrom of mate
+            mate1.mrnm = mate2.rname
+            mate2.mrnm = mate1.rname
+
+            # set position of mate
+            mate1.mpos = mate2.pos
+            mate2.mpos = mate1.pos
+
+            out_bam_file.write(mate1)
+            out_bam_file.write(mate2)
+        buffer_mates = None
+
+        # caused by the architecture I try to display this output
+        # information after +-1e5 of 1e6 reads.
+        if iter_num % 1e6 < 100000:
+            elapsed_time = time.time() - start_time
+            log.info("processing {} lines took {:.2f} "
+                     "secs ({:.1f} lines per "
+                     "second)\n".format(iter_num,
+                                        elapsed_time,
+                                        iter_num / elapsed_time))
+            log.info("{} ({:.2f}%) valid pairs added to matrix"
+                     "\n".format(pair_added, float(100 * pair_added) / iter_num))
+        if pDoTestRun and iter_num > pDoTestRunLines:
+            log.debug(
+                "\n## *WARNING*. Early exit because of --doTestRun parameter  ##\n\n")
+            all_data_processed = True
+
+    mate_pair_reader.close()
+    # with checkpoints, the files on disk are kept until the matrix is written
+    if checkpoint_folder is None:
+        duplication_index.close()
+    duplication_index = None
+    # the h5 writer of hiCMatrix needs the whole matrix, cool files are written from the pixel chunks
+    save_h5 = pOutFileName.name.endswith('.h5')
+    if not fail_flag and not pDoTestRun and save_h5:
+        row, col, data = pixel_accumulator.pixels()
+        hic_matrix = coo_matrix((data.astype(np.int64), (row, col)), shape=(matrix_size, matrix_size))
+        row, col, data = None, None, None
+    if checkpoint_folder is None and (fail_flag or pDoTestRun or save_h5):
+        pixel_accumulator.close()
+    # stop the worker processes
+    if fail_flag:
+        task_queue.cancel_join_thread()
+    for i in range(pThreads):
+        if fail_flag:
+            process[i].terminate()
+        else:
+            task_queue.put(None)
+    for i in range(pThreads):
+        process[i].join()
 
-        if all_data_processed:
-            all_threads_done = True
-            for thread in thread_done:
-                if not thread:
-                    all_threads_done = False
     if fail_flag:
         log.error(fail_message)
         exit(1)
     else:
         log.debug('Parallel stuff done')
     if not pDoTestRun:
-        # the resulting matrix is only filled unevenly with some pairs
-        # int the upper triangle and others in the lower triangle. To construct
-        # the definite matrix I add the values from the upper and lower triangles
-        # and subtract the diagonal to avoid double counting it.
-        # The resulting matrix is symmetric.
         if pOutBam:
             out_bam_file.close()
-
-        dia = dia_matrix(([hic_matrix.diagonal()], [0]),
-                         shape=hic_matrix.shape)
-        hic_matrix = hic_matrix + hic_matrix.T - dia
+            if checkpoint_folder is not None:
+                pysam.cat('-o', pOutBam.name, *(bam_parts + [bam_part]))
+
+        if save_h5:
+            # the pixels are stored in the upper triangle. To construct the symmetric
+            # matrix the lower triangle is added and the diagonal subtracted to avoid double counting it.
+            dia = dia_matrix(([hic_matrix.diagonal()], [0]),
+                             shape=hic_matrix.shape)
+            hic_matrix = hic_matrix + hic_matrix.T - dia
         # extend bins such that they are next to each other
         bin_intervals = enlarge_bins(bin_intervals[:], chrom_sizes)
         # compute max bin coverage
-        bin_max = []
-
-        for cover in pos_coverage:
-            max_element = 0
-            for i in range(cover.begin, cover.end, 1):
-                if coverage[i] > max_element:
-                    max_element = coverage[i]
-            if max_element == 0:
-                bin_max.append(np.nan)
-            else:
-                bin_max.append(max_element)
+        coverage = np.cumsum(coverage_difference, out=coverage_difference)[:-1]
+        coverage_difference = None
+        bin_max = get_bin_max_coverage(coverage, np.ctypeslib.as_array(pos_coverage))
+        coverage = None
 
         chr_name_list, start_list, end_list = list(zip(*bin_intervals))
         bin_intervals = list(zip(chr_name_list, start_list, end_list, bin_max))
-        hic_ma = hm.hiCMatrix()
-        hic_ma.setMatrix(hic_matrix, cut_intervals=bin_intervals)
+        if save_h5:
+            hic_ma = hm.hiCMatrix()
+            hic_ma.setMatrix(hic_matrix, cut_intervals=bin_intervals)
 
     """
     if pRestrictionCutFile:
@@ -1376,36 +2573,27 @@ Max library insert size\t{}\t\t
         hic_metadata['genome-assembly'] = np.string_(pGenomeAssembly)
 
     intermediate_qc_log.close()
-    if pOutFileName.name.endswith('.mcool') and pBinSize is not None and len(pBinSize) > 2:
-
-        matrixFileHandlerOutput = MatrixFileHandler(
-            pFileType='cool', pHiCInfo=hic_metadata)
-        matrixFileHandlerOutput.set_matrix_variables(hic_ma.matrix,
-                                                     hic_ma.cut_intervals,
-                                                     hic_ma.nan_bins,
-                                                     hic_ma.correction_factors,
-                                                     hic_ma.distance_counts)
-        matrixFileHandlerOutput.save(pOutFileName.name + '::/resolutions/' + str(
-            pBinSize[0]), pSymmetric=True, pApplyCorrection=False)
-
-        for resolution in pBinSize[1:]:
-            hic_matrix_to_merge = deepcopy(hic_ma)
-            _mergeFactor = int(resolution) // pBinSize[0]
-            merged_matrix = hicMergeMatrixBins.merge_bins(
-                hic_matrix_to_merge, _mergeFactor)
-            matrixFileHandlerOutput = MatrixFileHandler(
-                pFileType='cool', pAppend=True, pHiCInfo=hic_metadata)
-            matrixFileHandlerOutput.set_matrix_variables(merged_matrix.matrix,
-                                                         merged_matrix.cut_intervals,
-                                                         merged_matrix.nan_bins,
-                                                         merged_matrix.correction_factors,
-                                                         merged_matrix.distance_counts)
-            matrixFileHandlerOutput.save(pOutFileName.name + '::/resolutions/' + str(
-                resolution), pSymmetric=True, pApplyCorrection=False)
-
-    else:
-        if not pDoTestRun:
+    if not pDoTestRun:
+        if save_h5:
             hic_ma.save(pOutFileName.name, pHiCInfo=hic_metadata)
+        elif pOutFileName.name.endswith('.mcool') and pBinSize is not None:
+            # the coarser resolutions are computed from the pixels of the finest one by summing its bins
+            for resolution in pBinSize:
+                if resolution == pBinSize[0]:
+                    cut_intervals, pixel_chunks = bin_intervals, pixel_accumulator.pixel_chunks()
+                else:
+                    coarse_index, cut_intervals = coarsen_bins(bin_intervals, resolution // pBinSize[0])
+                    pixel_chunks = coarsen_pixel_chunks(pixel_accumulator.pixel_chunks(), coarse_index)
+                save_cool(pOutFileName.name + '::/resolutions/' + str(resolution), cut_intervals, pixel_chunks,
+                          hic_metadata, pAppend=resolution != pBinSize[0])
+        else:
+            save_cool(pOutFileName.name, bin_intervals, pixel_accumulator.pixel_chunks(), hic_metadata)
+        if checkpoint_folder is None and not save_h5:
+            pixel_accumulator.close()
+    pixel_accumulator = None
+
+    if checkpoint_folder is not None:
+        shutil.rmtree(checkpoint_folder, ignore_errors=True)
 
 
 class Tester(object):
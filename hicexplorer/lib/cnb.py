@@ -27,3 +27,60 @@ def cdf(pX, pR, pP):
     # if pX == 0:
     # return 0
     return special.betainc(pR, pX + 1, pP)
+
+
+def fit_per_group(pValues, pOffsets, pMaxIterations=100, pTolerance=1e-10, pMaxSize=1e10):
+    """
+    Maximum likelihood fit of the continuous NB distribution to many groups of values at once,
+    e.g. the values of all distances of a Hi-C matrix.
+
+    For a given size r the likelihood is maximal for prob = r / (r + mean), the size
+    is found with Newton steps on log(r) for all groups together. The start
+    values are the method of moments estimates like in fit_nbinom.fit. A group whose
+    variance is not larger than its mean has no finite maximum, its size grows to pMaxSize.
+
+    :param pValues: the values of all groups, group i is pValues[pOffsets[i]:pOffsets[i + 1]]
+    :param pOffsets: start of each group and the end of the last group, no group may be empty
+    :return: size and prob per group
+
+    >>> values = np.random.RandomState(0).negative_binomial(5, 0.3, size=(2, 20000)).astype(float)
+    >>> size, prob = fit_per_group(values.ravel(), np.array([0, 20000, 40000]))
+    >>> np.allclose(size, 5, rtol=0.1), np.allclose(prob, 0.3, rtol=0.05)
+    (True, True)
+    """
+    pValues = np.asarray(pValues, dtype=np.float64)
+    counts = np.diff(pOffsets)
+    sums = np.add.reduceat(pValues, pOffsets[:-1])
+    mean = sums / counts
+    variance = np.add.reduceat((pValues - np.repeat(mean, counts)) ** 2, pOffsets[:-1]) / counts
+    overdispersed = variance > mean
+    size = np.full(len(counts), 10.0)
+    size[overdispersed] = mean[overdispersed] ** 2 / (variance[overdispersed] - mean[overdispersed])
+    log_size = np.log(np.clip(size, np.finfo(float).tiny, pMaxSize))
+
+    active = np.ones(len(counts), dtype=bool)
+    for _ in range(pMaxIterations):
+        if not active.any():
+            break
+        active_idx = np.flatnonzero(active)
+        active_values = pValues[np.repeat(active, counts)]
+        active_offsets = np.concatenate([[0], np.cumsum(counts[active_idx])[:-1]])
+        r = np.exp(log_size[active_idx])
+        r_values = np.repeat(r, counts[active_idx])
+        n = counts[active_idx]
+        m = mean[active_idx]
+        # first and second derivative of the profile log-likelihood with respect to r
+        first = np.add.reduceat(special.digamma(active_values + r_values), active_offsets) \
+            - n * special.digamma(r) + n * np.log(r / (r + m))
+        second = np.add.reduceat(special.polygamma(1, active_values + r_values), active_offsets) \
+            - n * special.polygamma(1, r) + n * m / (r * (r + m))
+        # Newton step on log(r), a step in the direction of the gradient where the function is not concave
+        curvature = first + r * second
+        step = np.where(curvature < 0, -first / np.where(curvature < 0, curvature, 1), np.sign(first))
+        step = np.clip(step, -1, 1)
+        log_size[active_idx] = np.minimum(log_size[active_idx] + step, np.log(pMaxSize))
+        converged = (np.abs(step) < pTolerance) | (log_size[active_idx] >= np.log(pMaxSize))
+        active[active_idx[converged]] = False
+
+    size = np.exp(log_size)
+    return size, size / (size + mean)
@@ -0,0 +1,269 @@
+import time
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+import cooler
+
+
+class PixelTable():
+    """
+    Read access to the pixel table of a cooler file in chunks. The pixels
+    store the upper triangle of the symmetric matrix, only one chunk is in
+    memory at any time.
+
+    :param pCoolerGroup: the opened h5py group of the cooler, e.g. from cooler.Cooler(uri).open('r')
+    :param pChunkSize: number of pixels read at once
+    :param pSkipDiagonal: ignore the pixels of the main diagonal
+    :param pChromosomeIds: chromosome id per bin, if given only cis pixels are used
+    """
+
+    def __init__(self, pCoolerGroup, pChunkSize=10000000, pSkipDiagonal=False, pChromosomeIds=None):
+        self.pixels = pCoolerGroup['pixels']
+        self.size = pCoolerGroup['bins']['chrom'].shape[0]
+        self.chunkSize = pChunkSize
+        self.skipDiagonal = pSkipDiagonal
+        self.chromosomeIds = pChromosomeIds
+        # largest count read so far
+        self.maxValue = 0
+
+    def chunks(self):
+        number_of_pixels = self.pixels['count'].shape[0]
+        for start in range(0, number_of_pixels, self.chunkSize):
+            end = min(start + self.chunkSize, number_of_pixels)
+            bin1 = self.pixels['bin1_id'][start:end]
+            bin2 = self.pixels['bin2_id'][start:end]
+            count = self.pixels['count'][start:end].astype(np.float64)
+            count[np.isnan(count)] = 0
+            if len(count) > 0:
+                self.maxValue = max(self.maxValue, count.max())
+            if self.chromosomeIds is not None:
+                cis = self.chromosomeIds[bin1] == self.chromosomeIds[bin2]
+                bin1, bin2, count = bin1[cis], bin2[cis], count[cis]
+            if self.skipDiagonal:
+                off_diagonal = bin1 != bin2
+                bin1, bin2, count = bin1[off_diagonal], bin2[off_diagonal], count[off_diagonal]
+            yield bin1, bin2, count
+
+    def dot(self, pVector):
+        """
+        Product of the full symmetric matrix with pVector, computed chunk by chunk.
+        """
+        product, _ = self.dot_and_diagonal(pVector)
+        return product
+
+    def dot_and_diagonal(self, pVector):
+        """
+        Product of the full symmetric matrix with pVector and the product of
+        its main diagonal with pVector.
+        """
+        product = np.zeros(self.size, dtype=np.float64)
+        diagonal = np.zeros(self.size, dtype=np.float64)
+        for bin1, bin2, count in self.chunks():
+            product += np.bincount(bin1, weights=count * pVector[bin2], minlength=self.size)
+            # the diagonal is stored once but is part of the lower triangle too
+            on_diagonal = bin1 == bin2
+            diagonal += np.bincount(bin1[on_diagonal], weights=count[on_diagonal] * pVector[bin1[on_diagonal]],
+                                    minlength=self.size)
+            count[on_diagonal] = 0
+            product += np.bincount(bin2, weights=count * pVector[bin1], minlength=self.size)
+        return product, diagonal
+
+
+def iterative_correction(pMatrixVectorProduct, pMask, pMaxIterations=500, pTolerance=1e-5, pGroups=None, pMaxValue=1,
+                         pInitialBias=None):
+    """
+    Iterative correction (Imakaev et al. 2012) of a symmetric matrix that is
+    only accessible by matrix vector products. The matrix itself is never
+    changed, each pass computes the marginals of the corrected matrix with
+    one product.
+
+    :param pMatrixVectorProduct: function computing matrix @ vector
+    :param pMask: boolean array, True for bins that are excluded
+    :param pGroups: optional group id per bin, e.g. the chromosome. The groups
+                    are corrected independently, the matrix should not contain
+                    values between different groups.
+    :param pMaxValue: largest value of the matrix, used to detect diverging corrections
+    :param pInitialBias: bias to start from instead of ones, e.g. of a previous correction
+
+    Returns the bias per bin, the corrected matrix is matrix[i, j] / (bias[i] * bias[j]).
+    Excluded bins have a bias of 0.
+
+    >>> matrix = np.array([[10, 4, 2, 0], [4, 6, 3, 0], [2, 3, 8, 0], [0, 0, 0, 0]])
+    >>> bias, converged = iterative_correction(matrix.dot, np.array([False, False, False, True]), pTolerance=1e-10)
+    >>> corrected = matrix / np.outer(bias, bias)
+    >>> converged, np.allclose(corrected[:3, :3].sum(axis=1), corrected[:3, :3].sum() / 3), float(bias[3])
+    (True, True, 0.0)
+    >>> warm_bias, converged = iterative_correction(matrix.dot, np.array([False, False, False, True]), pTolerance=1e-10,
+    ...                                             pInitialBias=bias)
+    >>> converged, np.allclose(warm_bias, bias)
+    (True, True)
+    """
+    size = len(pMask)
+    if pInitialBias is not None:
+        total_bias = np.array(pInitialBias, dtype=np.float64)
+    else:
+        total_bias = np.ones(size, dtype=np.float64)
+    total_bias[pMask] = 0
+    inverse_bias = np.zeros(size, dtype=np.float64)
+    np.divide(1.0, total_bias, out=inverse_bias, where=total_bias != 0)
+    converged = False
+    start_time = time.time()
+    for iteration in range(1, pMaxIterations + 1):
+        marginals = inverse_bias * pMatrixVectorProduct(inverse_bias)
+        valid = marginals != 0
+        marginals[valid] /= _group_mean(marginals, valid, pGroups)[valid]
+
+        total_bias *= marginals
+        deviation = np.abs(marginals[valid] - 1).max() if valid.any() else 0
+        inverse_bias = np.zeros(size, dtype=np.float64)
+        np.divide(1.0, total_bias, out=inverse_bias, where=total_bias != 0)
+        if pMaxValue * inverse_bias.max() ** 2 > 1e100:
+            log.error("*Error* matrix correction is producing extremely large values. "
+                      "This is often caused by bins of low counts. Use a more stringent "
+                      "filtering of bins.")
+            exit(1)
+        if iteration % 5 == 0:
+            log.info("pass {} max delta - 1 = {}, {:.0f}s".format(iteration, deviation, time.time() - start_time))
+        if deviation < pTolerance:
+            log.info("[iterative correction] {} iterations used".format(iteration))
+            converged = True
+            break
+
+    # scale the total bias such that the mean is 1.0
+    valid = total_bias != 0
+    total_bias[valid] /= _group_mean(total_bias, valid, pGroups)[valid]
+    return total_bias, converged
+
+
+def knight_ruiz(pMatrixVectorProduct, pMask, pMaxIterations=500, pTolerance=1e-6, pDelta=0.1, pDeltaMax=3,
+                pInitialVector=None):
+    """
+    Balancing of a symmetric matrix with the algorithm of Knight and Ruiz (2012),
+    'A fast algorithm for matrix balancing'. The matrix is only accessed by
+    matrix vector products.
+
+    :param pMatrixVectorProduct: function computing matrix @ vector
+    :param pMask: boolean array, True for bins that are excluded
+    :param pInitialVector: vector to start from instead of ones, e.g. the weights of a
+                           previous balancing. Only its shape matters, not its scale.
+
+    Returns the vector x, matrix[i, j] * x[i] * x[j] is doubly stochastic. Excluded bins have nan.
+
+    >>> matrix = np.array([[10, 4, 2, 0], [4, 6, 3, 0], [2, 3, 8, 0], [0, 0, 0, 0]])
+    >>> x, converged = knight_ruiz(matrix.dot, np.array([False, False, False, True]))
+    >>> balanced = matrix[:3, :3] * np.outer(x[:3], x[:3])
+    >>> converged, np.allclose(balanced.sum(axis=1), 1, atol=1e-5), bool(np.isnan(x[3]))
+    (True, True, True)
+    >>> warm_x, converged = knight_ruiz(matrix.dot, np.array([False, False, False, True]), pInitialVector=10 * x)
+    >>> converged, np.allclose(warm_x[:3], x[:3], rtol=1e-4)
+    (True, True)
+    """
+    valid = ~pMask
+    full_vector = np.zeros(len(pMask), dtype=np.float64)
+
+    def dot(pVector):
+        full_vector[valid] = pVector
+        return pMatrixVectorProduct(full_vector)[valid]
+
+    ones = np.ones(valid.sum())
+    x = ones.copy()
+    if pInitialVector is not None:
+        # scaled such that the balanced matrix has a mean row sum of 1
+        x = np.array(pInitialVector, dtype=np.float64)[valid]
+        x /= np.sqrt(x.dot(dot(x)) / len(x))
+    g = 0.9
+    eta_max = 0.1
+    eta = eta_max
+    stop_tolerance = pTolerance * 0.5
+    residual_tolerance = pTolerance ** 2
+    v = x * dot(x)
+    rk = 1 - v
+    rho_km1 = rk.dot(rk)
+    rho_km2 = rho_km1
+    residual_outer = rho_km1
+    residual_old = residual_outer
+    converged = False
+
+    for iteration in range(1, pMaxIterations + 1):
+        if residual_outer <= residual_tolerance:
+            converged = True
+            break
+        k = 0
+        y = ones.copy()
+        inner_tolerance = max(eta ** 2 * residual_outer, residual_tolerance)
+        # conjugate gradient steps on the Newton system
+        while rho_km1 > inner_tolerance:
+            k += 1
+            if k == 1:
+                z = rk / v
+                p = z
+                rho_km1 = rk.dot(z)
+            else:
+                beta = rho_km1 / rho_km2
+                p = z + beta * p
+            w = x * dot(x * p) + v * p
+            alpha = rho_km1 / p.dot(w)
+            ap = alpha * p
+            y_new = y + ap
+            # keep the step inside [delta, Delta]
+            if y_new.min() <= pDelta:
+                if pDelta == 0:
+                    break
+                negative = ap < 0
+                gamma = ((pDelta - y[negative]) / ap[negative]).min()
+                y = y + gamma * ap
+                break
+            if y_new.max() >= pDeltaMax:
+                large = y_new > pDeltaMax
+                gamma = ((pDeltaMax - y[large]) / ap[large]).min()
+                y = y + gamma * ap
+                break
+            y = y_new
+            rk = rk - alpha * w
+            rho_km2 = rho_km1
+            z = rk / v
+            rho_km1 = rk.dot(z)
+        x = x * y
+        v = x * dot(x)
+        rk = 1 - v
+        rho_km1 = rk.dot(rk)
+        residual_outer = rho_km1
+        ratio = residual_outer / residual_old
+        residual_old = residual_outer
+        eta_old = eta
+        eta = g * ratio
+        if g * eta_old ** 2 > 0.1:
+            eta = max(eta, g * eta_old ** 2)
+        eta = max(min(eta, eta_max), stop_tolerance / np.sqrt(residual_outer))
+        log.info("KR pass {} residual {}".format(iteration, np.sqrt(residual_outer)))
+    else:
+        converged = residual_outer <= residual_tolerance
+
+    balancing_vector = np.full(len(pMask), np.nan)
+    balancing_vector[valid] = x
+    return balancing_vector, converged
+
+
+def write_weight(pCoolerUri, pWeight, pAttributes=None):
+    """
+    Stores pWeight as 'weight' column of the bins table of the cooler, an existing
+    column is replaced. The pixel table is not touched.
+    """
+    with cooler.Cooler(pCoolerUri).open('r+') as cooler_group:
+        bins = cooler_group['bins']
+        if 'weight' in bins:
+            del bins['weight']
+        bins.create_dataset('weight', data=np.asarray(pWeight, dtype=np.float64),
+                            compression='gzip', compression_opts=6)
+        if pAttributes:
+            bins['weight'].attrs.update(pAttributes)
+
+
+def _group_mean(pValues, pValid, pGroups):
+    # mean of the valid values, per group if groups are given, broadcasted to all bins
+    if pGroups is None:
+        return np.full(len(pValues), pValues[pValid].mean())
+    sums = np.bincount(pGroups[pValid], weights=pValues[pValid], minlength=pGroups.max() + 1)
+    counts = np.bincount(pGroups[pValid], minlength=pGroups.max() + 1)
+    return (sums / np.maximum(counts, 1))[pGroups]
@@ -21,6 +21,9 @@ import site
 from hicexplorer import hicFindTADs
 from hicexplorer import hicTransform
 from hicmatrix import HiCMatrix as hm
+from hicexplorer.utilities import load_matrix
+from hicexplorer.utilities import get_cache_prefix
+from hicexplorer.expectedInteractions import ExpectedCache
 from pybedtools import BedTool
 import cooler
 from hicexplorer.utilities import obs_exp_matrix
@@ -219,13 +222,19 @@ class TADClassifier:
         '''acts as a wrapper class for a HiCMatrix Object and implements helper functions for matrix data preparation'''
         # currently supports matrices of one chromosome
 
-        def __init__(self, matrix_file, method=None, range_max=None, pChromosome=None, pThreads=None):
+        def __init__(self, matrix_file, method=None, range_max=None, pChromosome=None, pThreads=None, pCacheDirectory=None):
 
             # use input directly, if already normalized
             if method == 'obs_exp':
                 hic_ma, hic_ma_np = TADClassifier.MP_Matrix.read_matrix_file(
                     matrix_file, pChromosome)
-                hic_ma = TADClassifier.MP_Matrix.obs_exp_normalization(hic_ma, pThreads=pThreads)
+                # expected interactions stored by other runs on the same matrix file
+                if pCacheDirectory is not None and isinstance(matrix_file, str):
+                    expected_cache = ExpectedCache(get_cache_prefix(matrix_file, pCacheDirectory, {}))
+                else:
+                    expected_cache = ExpectedCache()
+                hic_ma = TADClassifier.MP_Matrix.obs_exp_normalization(hic_ma, pThreads=pThreads,
+                                                                       pExpectedCache=expected_cache)
                 # hic_ma_np = np.array(hic_ma.getMatrix())
                 # hic_ma_np = hic_ma.matrix
 
@@ -374,9 +383,9 @@ class TADClassifier:
             # check if instance of string or file and load appropriate
             if isinstance(matrix_file, str):
                 if pChromosome is not None:
-                    hic_ma = hm.hiCMatrix(matrix_file, pChrnameList=[pChromosome])
+                    hic_ma = load_matrix(matrix_file, pChrnameList=[pChromosome])
                 else:
-                    hic_ma = hm.hiCMatrix(matrix_file)
+                    hic_ma = load_matrix(matrix_file)
 
                 # log.debug('hic_ma: {}'.format(hic_ma.matrix))
 
@@ -393,15 +402,17 @@ class TADClassifier:
 
             return o_min + (n - n_min) * (o_max - o_min) / (n_max - n_min)
 
-        def obs_exp_normalization(hic_ma, pThreads=None):
+        def obs_exp_normalization(hic_ma, pThreads=None, pExpectedCache=None):
             '''apply obs_exp normalization'''
             log.debug('obs/exp matrix computation...')
 
             trasf_matrix = lil_matrix(hic_ma.matrix.shape)
+            if pExpectedCache is None:
+                pExpectedCache = ExpectedCache()
 
             # from hicTransformTADs
-            def _obs_exp(pSubmatrix, pThreads=None):
-                obs_exp_matrix_ = obs_exp_matrix(pSubmatrix, pThreads=pThreads, pDistance=100)
+            def _obs_exp(pSubmatrix, pThreads=None, pDistanceSums=None):
+                obs_exp_matrix_ = obs_exp_matrix(pSubmatrix, pThreads=pThreads, pDistance=100, pDistanceSums=pDistanceSums)
                 obs_exp_matrix_ = convertNansToZeros(
                     csr_matrix(obs_exp_matrix_))
                 obs_exp_matrix_ = convertInfsToZeros(
@@ -414,7 +425,7 @@ class TADClassifier:
                 chr_range = hic_ma.getChrBinRange(chrname)
                 submatrix = hic_ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
                 submatrix.astype(float)
-                obs_exp = _obs_exp(submatrix, pThreads)
+                obs_exp = _obs_exp(submatrix, pThreads, pExpectedCache.distance_sums(chrname, submatrix))
                 if obs_exp.nnz != 0:
                     trasf_matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]] = lil_matrix(obs_exp)
 
@@ -715,7 +726,8 @@ class TADClassifier:
                  use_cleanlab=False,
                  estimators_per_step=50,
                  concatenate_before_resample=False,
-                 pAddRemoveChrPrexix=None
+                 pAddRemoveChrPrexix=None,
+                 cache_directory=None
                  ):
 
         self.mode = mode
@@ -725,6 +737,7 @@ class TADClassifier:
         self.unselect_border_cases = unselect_border_cases
         self.concatenate_before_resample = concatenate_before_resample
         self.addRemoveChrPrexix = pAddRemoveChrPrexix
+        self.cache_directory = cache_directory
 
         if (mode == 'predict' or mode == 'train_existing' or mode == 'predict_test'):
             if (saved_classifier is not None):
@@ -811,7 +824,8 @@ class TADClassifier:
         log.debug('loading matrix')
         # ingest matrix
         matrix = TADClassifier.MP_Matrix(matrix_file,
-                                         method=self.classifier.normalization_method, pChromosome=pChromosome)
+                                         method=self.classifier.normalization_method, pChromosome=pChromosome,
+                                         pCacheDirectory=self.cache_directory)
 
         # build inputs for classifier
         log.debug('build features')
@@ -846,7 +860,8 @@ class TADClassifier:
         log.debug('loading matrix')
         # ingest matrix
         matrix = TADClassifier.MP_Matrix(matrix_file,
-                                         method=self.classifier.normalization_method, pChromosome=pChromosome)
+                                         method=self.classifier.normalization_method, pChromosome=pChromosome,
+                                         pCacheDirectory=self.cache_directory)
 
         # build inputs for classifier
         log.debug('build features')
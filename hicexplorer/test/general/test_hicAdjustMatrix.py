@@ -4,6 +4,8 @@ import os
 from tempfile import NamedTemporaryFile
 from hicmatrix import HiCMatrix as hm
 from hicexplorer import hicAdjustMatrix
+from hicexplorer import hicCorrectMatrix
+from hicexplorer.utilities import load_matrix, read_correction_factors_only
 import numpy.testing as np
 from hicexplorer.test.test_compute_function import compute
 
@@ -188,3 +190,28 @@ def test_remove_intra():
     np.assert_equal(test.cut_intervals, new.cut_intervals)
 
     os.unlink(outfile.name)
+
+
+def test_keep_correction_factors_only():
+    factors_only = NamedTemporaryFile(suffix='.h5', prefix='test_matrix', delete=False)
+    factors_only.close()
+    outfile = NamedTemporaryFile(suffix='.h5', prefix='test_matrix', delete=False)
+    outfile.close()
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes chrUextra chr3LHet --iterNum 500 "\
+           "--filterThreshold -1.5 5.0 --correctionFactorsOnly --outFileName {}".format(ROOT + "small_test_matrix.h5",
+                                                                                        factors_only.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    args = "--matrix {} --outFileName {} --chromosomes chr3LHet --action keep".format(
+        factors_only.name, outfile.name).split()
+    compute(hicAdjustMatrix.main, args, 5)
+
+    # the counts are kept together with the factors of the kept chromosome
+    assert read_correction_factors_only(outfile.name) is not None
+    test = load_matrix(factors_only.name)
+    start, end = test.getChrBinRange('chr3LHet')
+    new = load_matrix(outfile.name)
+    np.assert_almost_equal(test.matrix[start:end, start:end].toarray(), new.matrix.toarray(), decimal=5)
+
+    os.unlink(factors_only.name)
+    os.unlink(outfile.name)
@@ -2,6 +2,10 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 from hicexplorer import hicBuildMatrix, hicInfo
+from hicexplorer.lib import buildMatrixMethods
+from multiprocessing import Process, Queue
+import time
+import psutil
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile, mkdtemp
 import shutil
@@ -366,3 +370,61 @@ def test_build_matrix_fail(capsys):
                                                                                         qc_folder).split()
     # hicBuildMatrix.main(args)
     compute(hicBuildMatrix.main, args, 5)
+
+
+def start_orphan(pTarget, pKwargs, pPidQueue):
+    # starts pTarget in a process and exits without cleaning up, like a killed main process
+    process = Process(target=pTarget, kwargs=pKwargs)
+    process.start()
+    pPidQueue.put(process.pid)
+    time.sleep(1)
+    os._exit(0)
+
+
+def is_running(pPid):
+    try:
+        return psutil.Process(pPid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def write_pairs_file():
+    pairs_file = NamedTemporaryFile(suffix='.pairs', delete=False, mode='w')
+    pairs_file.write("## pairs format v1.0\n"
+                     "#chromsize: chr1 20000\n"
+                     "#columns: readID chrom1 pos1 chrom2 pos2 strand1 strand2\n")
+    for i in range(10):
+        pairs_file.write("r{}\tchr1\t100\tchr1\t12000\t+\t-\n".format(i))
+    pairs_file.close()
+    return pairs_file.name
+
+
+@pytest.mark.parametrize("target", ['worker', 'mate_reader', 'pairs_reader'])
+def test_process_exits_without_main_process(target):
+    # the readers are blocked on their full queue, the worker waits for a task
+    pairs_file = None
+    if target == 'worker':
+        target, kwargs = buildMatrixMethods.process_data_worker, {'pTaskQueue': Queue(), 'pResultQueue': Queue()}
+    elif target == 'mate_reader':
+        target, kwargs = buildMatrixMethods.read_mate_file, {'pFileName': ROOT + "R1_1000.bam", 'pQueue': Queue(maxsize=1),
+                                                             'pChunkSize': 10, 'pSequenceLength': 0, 'pOutputBam': False,
+                                                             'pDecompressionThreads': 1}
+    else:
+        pairs_file = write_pairs_file()
+        target, kwargs = buildMatrixMethods.read_pairs_file, {'pFileName': pairs_file, 'pQueue': Queue(maxsize=1), 'pChunkSize': 1,
+                                                              'pChromosomeIndex': {'chr1': 0}, 'pCoverageLength': 10}
+    pid_queue = Queue()
+    process = Process(target=start_orphan, args=(target, kwargs, pid_queue))
+    process.start()
+    worker_pid = pid_queue.get(timeout=30)
+    process.join()
+    for _ in range(60):
+        if not is_running(worker_pid):
+            break
+        time.sleep(0.5)
+    running = is_running(worker_pid)
+    if running:
+        psutil.Process(worker_pid).kill()
+    if pairs_file is not None:
+        os.unlink(pairs_file)
+    assert not running
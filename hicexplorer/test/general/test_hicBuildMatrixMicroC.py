@@ -2,17 +2,21 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 from hicexplorer import hicBuildMatrixMicroC, hicInfo
+from hicexplorer.lib import buildMatrixMethods
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile, mkdtemp
 import shutil
 import os
 import numpy.testing as nt
+from scipy.sparse import csr_matrix, triu
 import pytest
 from hicexplorer.test.test_compute_function import compute
 
 ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data/")
 sam_R1 = ROOT + "small_test_R1_unsorted.bam"
 sam_R2 = ROOT + "small_test_R2_unsorted.bam"
+sam_R1_1000 = ROOT + "R1_1000.bam"
+sam_R2_1000 = ROOT + "R2_1000.bam"
 delta = 80000
 
 
@@ -60,3 +64,177 @@ def test_build_matrix(capsys):
 
     os.unlink(outfile.name)
     shutil.rmtree(qc_folder)
+
+
+def write_pairs_file():
+    pairs_file = NamedTemporaryFile(suffix='.pairs', delete=False, mode='w')
+    pairs_file.write("## pairs format v1.0\n"
+                     "#chromsize: chr1 20000\n"
+                     "#chromsize: chr2 10000\n"
+                     "#columns: readID chrom1 pos1 chrom2 pos2 strand1 strand2 pair_type mapq1 mapq2\n"
+                     "r1\tchr1\t100\tchr1\t12000\t+\t-\tUU\t60\t60\n"
+                     "r2\tchr1\t100\tchr1\t12000\t+\t-\tUU\t60\t60\n"
+                     "r3\tchr1\t6000\tchr2\t3000\t+\t+\tUU\t60\t60\n"
+                     "r4\tchr1\t7000\t!\t0\t+\t-\tUN\t60\t0\n"
+                     "r5\tchr1\t8000\tchr2\t8000\t-\t+\tMM\t0\t60\n"
+                     "r6\tchr1\t1000\tchr1\t9000\t+\t-\tUU\t60\t60\n")
+    pairs_file.close()
+    return pairs_file.name
+
+
+def test_build_matrix_pairs_file():
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    pairs_file = write_pairs_file()
+    qc_folder = mkdtemp(prefix="testQC_")
+    args = "--pairsFile {} --outFileName {} -bs 5000 --QCfolder {} --threads 4".format(
+        pairs_file, outfile.name, qc_folder).split()
+    hicBuildMatrixMicroC.main(args)
+    new = hm.hiCMatrix(outfile.name)
+    assert new.matrix.shape == (6, 6)
+    dense = new.matrix.toarray()
+    assert dense[0, 2] == 1 and dense[2, 0] == 1
+    assert dense[1, 4] == 1 and dense[4, 1] == 1
+    assert dense[0, 1] == 1 and dense[1, 0] == 1
+    assert dense.sum() == 6
+
+    os.unlink(outfile.name)
+    os.unlink(pairs_file)
+    shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_pairs_file_multiple_resolutions():
+    outfile = NamedTemporaryFile(suffix='.mcool', delete=False)
+    outfile.close()
+    outfile_single = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile_single.close()
+    pairs_file = write_pairs_file()
+    qc_folder = mkdtemp(prefix="testQC_")
+    args = "--pairsFile {} --outFileName {} -bs 10000 5000 --QCfolder {} --threads 4".format(
+        pairs_file, outfile.name, qc_folder).split()
+    hicBuildMatrixMicroC.main(args)
+    args = "--pairsFile {} --outFileName {} -bs 10000 --QCfolder {} --threads 4".format(
+        pairs_file, outfile_single.name, qc_folder).split()
+    hicBuildMatrixMicroC.main(args)
+
+    new_5000 = hm.hiCMatrix(outfile.name + '::/resolutions/5000')
+    new_10000 = hm.hiCMatrix(outfile.name + '::/resolutions/10000')
+    single_10000 = hm.hiCMatrix(outfile_single.name)
+    assert new_5000.matrix.shape == (6, 6)
+    # the contact between bin 0 and 1 is on the diagonal of the merged bin and counted once
+    nt.assert_equal(new_10000.matrix.toarray(), [[1, 1, 1], [1, 0, 0], [1, 0, 0]])
+    nt.assert_equal(new_10000.matrix.toarray(), single_10000.matrix.toarray())
+    nt.assert_equal([x[:3] for x in new_10000.cut_intervals],
+                    [x[:3] for x in single_10000.cut_intervals])
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_single.name)
+    os.unlink(pairs_file)
+    shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_decompression_threads(monkeypatch):
+    # each of the two readers decompresses its bam file with half of the threads
+    decompression_threads = []
+    mate_pair_reader = buildMatrixMethods.MatePairReader
+
+    def record_decompression_threads(**pKwargs):
+        decompression_threads.append(pKwargs['pDecompressionThreads'])
+        return mate_pair_reader(**pKwargs)
+    monkeypatch.setattr(buildMatrixMethods, 'MatePairReader', record_decompression_threads)
+
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    args = "-s {} {} --outFileName {} -bs 5000 --QCfolder {} --threads 6".format(
+        sam_R1_1000, sam_R2_1000, outfile.name, qc_folder).split()
+    hicBuildMatrixMicroC.main(args)
+    assert decompression_threads == [3]
+    assert hm.hiCMatrix(outfile.name).matrix.sum() > 0
+
+    os.unlink(outfile.name)
+    shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_cool_matrix_memory():
+    # the cool and mcool files are written from the merged parts of the contacts on disk
+    outfile_h5 = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile_h5.close()
+    outfile_cool = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile_cool.close()
+    outfile_mcool = NamedTemporaryFile(suffix='.mcool', delete=False)
+    outfile_mcool.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    for outfile, bin_size in [(outfile_h5, '5000'), (outfile_cool, '5000'), (outfile_mcool, '5000 20000')]:
+        args = "-s {} {} --outFileName {} -bs {} --QCfolder {} --threads 4 --matrixMemory 1".format(
+            sam_R1_1000, sam_R2_1000, outfile.name, bin_size, qc_folder).split()
+        hicBuildMatrixMicroC.main(args)
+
+    test = hm.hiCMatrix(outfile_h5.name)
+    for uri in [outfile_cool.name, outfile_mcool.name + '::/resolutions/5000']:
+        new = hm.hiCMatrix(uri)
+        assert (new.matrix != test.matrix).nnz == 0
+        nt.assert_equal([x[:3] for x in new.cut_intervals], [x[:3] for x in test.cut_intervals])
+    # the coarse matrix sums the upper triangle of the fine one
+    coarse_index, coarse_intervals = buildMatrixMethods.coarsen_bins(test.cut_intervals, 4)
+    upper = triu(test.matrix).tocoo()
+    coarse = csr_matrix((upper.data, (coarse_index[upper.row], coarse_index[upper.col])), shape=(len(coarse_intervals),) * 2)
+    new = hm.hiCMatrix(outfile_mcool.name + '::/resolutions/20000')
+    assert (triu(new.matrix) != coarse).nnz == 0
+    nt.assert_equal([x[:3] for x in new.cut_intervals], [x[:3] for x in coarse_intervals])
+
+    for outfile in [outfile_h5, outfile_cool, outfile_mcool]:
+        os.unlink(outfile.name)
+    shutil.rmtree(qc_folder)
+
+
+def test_build_matrix_resume(monkeypatch):
+    # a run stopped after a checkpoint and resumed gives the same result as an uninterrupted run
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    outfile_resumed = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile_resumed.close()
+    qc_folder = mkdtemp(prefix="testQC_")
+    qc_folder_resumed = mkdtemp(prefix="testQC_")
+    args = "-s {} {} -bs 5000 --threads 4 --inputBufferSize 100 --matrixMemory 1 --checkpointInterval 0".format(
+        sam_R1_1000, sam_R2_1000).split()
+    hicBuildMatrixMicroC.main(args + ['--outFileName', outfile.name, '--QCfolder', qc_folder])
+
+    write_checkpoint = buildMatrixMethods.write_checkpoint
+    checkpoints = []
+
+    def stop_after_checkpoint(pFolder, pState, pArrays):
+        write_checkpoint(pFolder, pState, pArrays)
+        checkpoints.append(pState['position']['pairs'])
+        if len(checkpoints) == 4:
+            # not an Exception, such that nothing in createMatrix handles it
+            raise KeyboardInterrupt
+    monkeypatch.setattr(buildMatrixMethods, 'write_checkpoint', stop_after_checkpoint)
+    with pytest.raises(KeyboardInterrupt):
+        hicBuildMatrixMicroC.main(args + ['--outFileName', outfile_resumed.name, '--QCfolder', qc_folder_resumed])
+    assert checkpoints[-1] > 0
+    assert os.path.exists(outfile_resumed.name + '.checkpoint/state.json')
+
+    read_checkpoint = buildMatrixMethods.read_checkpoint
+    resumed = []
+
+    def record_resume(pFolder):
+        state, arrays = read_checkpoint(pFolder)
+        resumed.append(state['position']['pairs'])
+        return state, arrays
+    monkeypatch.setattr(buildMatrixMethods, 'write_checkpoint', write_checkpoint)
+    monkeypatch.setattr(buildMatrixMethods, 'read_checkpoint', record_resume)
+    hicBuildMatrixMicroC.main(args + ['--outFileName', outfile_resumed.name, '--QCfolder', qc_folder_resumed, '--resume'])
+    assert resumed == checkpoints[-1:]
+    assert not os.path.exists(outfile_resumed.name + '.checkpoint')
+
+    test = hm.hiCMatrix(outfile.name)
+    new = hm.hiCMatrix(outfile_resumed.name)
+    assert (new.matrix != test.matrix).nnz == 0
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+    assert are_files_equal(qc_folder + "/QC.log", qc_folder_resumed + "/QC.log", delta=0)
+
+    for outfile_ in [outfile, outfile_resumed]:
+        os.unlink(outfile_.name)
+    shutil.rmtree(qc_folder)
+    shutil.rmtree(qc_folder_resumed)
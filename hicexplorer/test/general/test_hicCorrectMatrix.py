@@ -5,11 +5,15 @@ from hicexplorer import hicCorrectMatrix
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile
 import os
+import shutil
+import numpy as np
 import numpy.testing as nt
+import cooler
 from matplotlib.testing.compare import compare_images
 from matplotlib.testing.exceptions import ImageComparisonFailure
 import pytest
 from hicexplorer.test.test_compute_function import compute
+from hicexplorer.utilities import load_matrix, read_correction_factors_only
 
 
 ROOT = os.path.join(os.path.dirname(
@@ -42,13 +46,57 @@ def test_correct_matrix_ICE():
     test = hm.hiCMatrix(
         ROOT + "hicCorrectMatrix/small_test_matrix_ICEcorrected_chrUextra_chr3LHet.h5")
     new = hm.hiCMatrix(outfile.name)
-    nt.assert_equal(test.matrix.data, new.matrix.data)
+    nt.assert_almost_equal(test.matrix.data, new.matrix.data, decimal=10)
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
     assert are_files_equal(outfile_filtered.name, ROOT + 'hicCorrectMatrix/filtered.bed')
 
     os.unlink(outfile.name)
 
 
+def test_correct_matrix_ICE_single_precision_threads():
+    outfile = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500 --outFileName {} "\
+           "--filterThreshold -1.5 5.0 --singlePrecision --threads 2".format(ROOT + "small_test_matrix.h5",
+                                                                             outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    test = hm.hiCMatrix(
+        ROOT + "hicCorrectMatrix/small_test_matrix_ICEcorrected_chrUextra_chr3LHet.h5")
+    new = hm.hiCMatrix(outfile.name)
+    nt.assert_almost_equal(test.matrix.data, new.matrix.data, decimal=5)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    os.unlink(outfile.name)
+
+
+def test_correct_matrix_ICE_correction_factors_only():
+    outfile = NamedTemporaryFile(suffix='.ICE.h5', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500 --outFileName {} "\
+           "--filterThreshold -1.5 5.0 --correctionFactorsOnly".format(ROOT + "small_test_matrix.h5",
+                                                                       outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    # the counts are stored unchanged, also of the filtered bins, they have a correction factor of 0
+    raw = hm.hiCMatrix(outfile.name)
+    assert raw.matrix.dtype == np.int64
+    original = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    original.reorderChromosomes(['chrUextra', 'chr3LHet'])
+    nt.assert_equal(raw.matrix.toarray(), original.matrix.toarray())
+    filtered = read_correction_factors_only(outfile.name) == 0
+    assert raw.matrix[filtered].nnz > 0
+    test = hm.hiCMatrix(
+        ROOT + "hicCorrectMatrix/small_test_matrix_ICEcorrected_chrUextra_chr3LHet.h5")
+    new = load_matrix(outfile.name)
+    nt.assert_almost_equal(test.matrix.data, new.matrix.data, decimal=10)
+    nt.assert_equal(test.cut_intervals, new.cut_intervals)
+
+    os.unlink(outfile.name)
+
+
 def test_correct_matrix_KR_H5():
     outfile = NamedTemporaryFile(suffix='.KR.h5', delete=False)
     outfile.close()
@@ -91,6 +139,29 @@ def test_correct_matrix_KR_cool():
     os.unlink(outfile.name)
 
 
+def test_correct_matrix_ICE_perchr_correction_factors_only():
+    outfile = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile.close()
+    outfile_factors = NamedTemporaryFile(suffix='_ICE.cool', delete=False)
+    outfile_factors.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 --perchr --threads 2 "\
+           "--outFileName {}".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -1.5 5.0 --perchr --threads 2 "\
+           "--correctionFactorsOnly --outFileName {}".format(
+               ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", outfile_factors.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    # the cool file of the corrected matrix stores the divisive correction factors
+    test = cooler.Cooler(outfile.name).bins()['weight'][:].values
+    new = cooler.Cooler(outfile_factors.name).bins()['weight'][:].values
+    nt.assert_almost_equal(1 / test, new, decimal=10)
+
+    os.unlink(outfile.name)
+    os.unlink(outfile_factors.name)
+
+
 def test_correct_matrix_KR_partial_cool():
     outfile = NamedTemporaryFile(suffix='_KR.cool', delete=False)
     outfile.close()
@@ -109,6 +180,161 @@ def test_correct_matrix_KR_partial_cool():
     os.unlink(outfile.name)
 
 
+def test_correct_matrix_KR_perchr():
+    outfile = NamedTemporaryFile(suffix='.KR.h5', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --correctionMethod KR --chromosomes "\
+           "chrUextra chr3LHet chrX --perchr --threads 2 "\
+           "--outFileName {} ".format(ROOT + "small_test_matrix.h5", outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    new = hm.hiCMatrix(outfile.name)
+    for chromosome in ['chrUextra', 'chr3LHet', 'chrX']:
+        start, end = new.getChrBinRange(chromosome)
+        row_sum = np.asarray(new.matrix[start:end, start:end].sum(axis=1)).flatten()
+        nt.assert_allclose(row_sum[row_sum > 0], row_sum.max(), rtol=1e-3)
+        # no values between chromosomes
+        assert new.matrix[start:end, :start].nnz == 0
+        assert new.matrix[start:end, end:].nnz == 0
+
+    os.unlink(outfile.name)
+
+
+def test_correct_matrix_ICE_in_place_cool():
+    matrix = NamedTemporaryFile(suffix='.cool', delete=False)
+    matrix.close()
+    shutil.copy(ROOT + "small_test_matrix.cool", matrix.name)
+    outfile = NamedTemporaryFile(suffix='.ICE.cool', delete=False)
+    outfile.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500 --filterThreshold -1.5 5.0 --inPlace".format(matrix.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500 --filterThreshold -1.5 5.0 "\
+           "--outFileName {}".format(ROOT + "small_test_matrix.cool", outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    in_place = cooler.Cooler(matrix.name)
+    # the pixels are unchanged
+    assert in_place.pixels()[:].equals(cooler.Cooler(ROOT + "small_test_matrix.cool").pixels()[:])
+    test = cooler.Cooler(outfile.name)
+    for chromosome in ['chrUextra', 'chr3LHet']:
+        nt.assert_almost_equal(np.nan_to_num(in_place.matrix(balance=True).fetch(chromosome)),
+                               test.matrix(balance=False).fetch(chromosome), decimal=10)
+    # bins of the other chromosomes are not balanced
+    assert np.isnan(in_place.bins().fetch('chrX')['weight'].values).all()
+
+    os.unlink(matrix.name)
+    os.unlink(outfile.name)
+
+
+def test_correct_matrix_ICE_in_place_max_value(monkeypatch):
+    matrix = NamedTemporaryFile(suffix='.cool', delete=False)
+    matrix.close()
+    shutil.copy(ROOT + "small_test_matrix.cool", matrix.name)
+    max_values = []
+    iterative_correction = hicCorrectMatrix.coolerBalancing.iterative_correction
+
+    def record_max_value(*args, **kwargs):
+        max_values.append(kwargs['pMaxValue'])
+        return iterative_correction(*args, **kwargs)
+    monkeypatch.setattr(hicCorrectMatrix.coolerBalancing, 'iterative_correction', record_max_value)
+
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes "\
+           "chrUextra chr3LHet --iterNum 500 --filterThreshold -1.5 5.0 --inPlace".format(matrix.name).split()
+    hicCorrectMatrix.main(args)
+    # the divergence check needs the largest count before the correction starts
+    assert max_values == [cooler.Cooler(ROOT + "small_test_matrix.cool").pixels()[:]['count'].max()]
+
+    os.unlink(matrix.name)
+
+
+def test_correct_matrix_KR_in_place_cool():
+    matrix = NamedTemporaryFile(suffix='.cool', delete=False)
+    matrix.close()
+    shutil.copy(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", matrix.name)
+
+    args = "correct --matrix {} --correctionMethod KR --inPlace".format(matrix.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    in_place = cooler.Cooler(matrix.name)
+    balanced = np.nan_to_num(in_place.matrix(balance=True)[:])
+    row_sum = balanced.sum(axis=1)
+    nt.assert_allclose(row_sum[row_sum > 0], row_sum.max(), rtol=1e-4)
+    nt.assert_allclose(balanced.sum(), in_place.matrix(balance=False)[:].sum(), rtol=1e-6)
+
+    os.unlink(matrix.name)
+
+
+def test_correct_matrix_ICE_initial_weights():
+    previous = NamedTemporaryFile(suffix='.cool', delete=False)
+    previous.close()
+    outfile = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile.close()
+    outfile_warm = NamedTemporaryFile(suffix='.cool', delete=False)
+    outfile_warm.close()
+
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -3 5 --correctionFactorsOnly "\
+           "--outFileName {}".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", previous.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -2.5 5 --correctionFactorsOnly "\
+           "--outFileName {}".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", outfile.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    args = "correct --matrix {} --correctionMethod ICE --filterThreshold -2.5 5 --correctionFactorsOnly "\
+           "--outFileName {} --initialWeights {}".format(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool",
+                                                         outfile_warm.name, previous.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    test = cooler.Cooler(outfile.name).bins()['weight'][:].values
+    new = cooler.Cooler(outfile_warm.name).bins()['weight'][:].values
+    nt.assert_allclose(new, test, rtol=1e-4)
+
+    os.unlink(previous.name)
+    os.unlink(outfile.name)
+    os.unlink(outfile_warm.name)
+
+
+def test_correct_matrix_KR_in_place_initial_weights_npy():
+    matrix = NamedTemporaryFile(suffix='.cool', delete=False)
+    matrix.close()
+    shutil.copy(ROOT + "hicCorrectMatrix/gm12878_raw_values.cool", matrix.name)
+    weights = NamedTemporaryFile(suffix='.npy', delete=False)
+    weights.close()
+
+    args = "correct --matrix {} --correctionMethod KR --inPlace".format(matrix.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    test = cooler.Cooler(matrix.name).bins()['weight'][:].values
+    # start from a perturbed version of the result
+    np.save(weights.name, np.nan_to_num(test) * np.random.RandomState(0).uniform(0.8, 1.2, len(test)))
+
+    args = "correct --matrix {} --correctionMethod KR --inPlace "\
+           "--initialWeights {}".format(matrix.name, weights.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+    in_place = cooler.Cooler(matrix.name)
+    balanced = np.nan_to_num(in_place.matrix(balance=True)[:])
+    row_sum = balanced.sum(axis=1)
+    nt.assert_allclose(row_sum[row_sum > 0], row_sum.max(), rtol=1e-4)
+    nt.assert_equal(np.isnan(in_place.bins()['weight'][:].values), np.isnan(test))
+
+    os.unlink(matrix.name)
+    os.unlink(weights.name)
+
+
+def test_filter_by_zscore_perchr():
+    ma = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    to_remove = hicCorrectMatrix.filter_by_zscore(ma, -1.5, 5.0, perchr=True)
+
+    expected = []
+    for chrname in ma.getChrNames():
+        chr_range = ma.getChrBinRange(chrname)
+        chr_submatrix = ma.matrix[chr_range[0]:chr_range[1], chr_range[0]:chr_range[1]]
+        row_sum = np.asarray(chr_submatrix.sum(axis=1)).flatten() - chr_submatrix.diagonal()
+        expected.extend(np.flatnonzero(hicCorrectMatrix.MAD(row_sum).is_outlier(-1.5, 5.0)) + chr_range[0])
+    nt.assert_equal(to_remove, sorted(expected))
+
+
 @pytest.mark.xfail(raises=ImageComparisonFailure, reason='Matplotlib plots for reasons a different image size.')
 def test_correct_matrix_diagnostic_plot():
     outfile = NamedTemporaryFile(
@@ -1,6 +1,9 @@
 import os.path
-from tempfile import NamedTemporaryFile
+import shutil
+from tempfile import NamedTemporaryFile, mkdtemp
 from psutil import virtual_memory
+import numpy as np
+from scipy import sparse
 import logging
 log = logging.getLogger(__name__)
 
@@ -90,3 +93,69 @@ def test_main_cool_chromosomes_threads_inner_threads():
     compute(hicDetectLoops.main, args, 5)
     assert are_files_equal(
         ROOT + "hicDetectLoops/loops.bedgraph", outfile_loop_cool.name, delta=0)
+
+
+def test_main_cool_chromosomes_tiles():
+    outfile_loop_cool = NamedTemporaryFile(suffix='.bedgraph', delete=True)
+
+    # tiles of 8 bins, the loops must not depend on the tiling
+    args = "--matrix {} -o {} --maxLoopDistance 3000000 -pit 1 -w 5 -pw 2 -p 0.5 -pp 0.55 --chromosomes 1 2 -t 2 -tpc 1 --tileSize 20000000".format(
+        ROOT + "hicDetectLoops/GSE63525_GM12878_insitu_primary_2_5mb.cool", outfile_loop_cool.name).split()
+    compute(hicDetectLoops.main, args, 5)
+    assert are_files_equal(
+        ROOT + "hicDetectLoops/loops.bedgraph", outfile_loop_cool.name, delta=0)
+
+
+def test_main_cool_cache():
+    # the second run uses the fitted distributions of the first one and finds the same loops
+    outfile_loop_cool = NamedTemporaryFile(suffix='.bedgraph', delete=True)
+    cached_loop_cool = NamedTemporaryFile(suffix='.bedgraph', delete=True)
+    cache_directory = mkdtemp(prefix="test_case_detect_loops_cache")
+
+    args = "--matrix {} -o {} --maxLoopDistance 50000000 -pit 1 -w 5 -pw 2 -p 0.5 -pp 0.55 --chromosomes 1 2 -t 2 -tpc 2 "\
+           "--cacheDirectory {}".format(ROOT + "hicDetectLoops/GSE63525_GM12878_insitu_primary_2_5mb.cool",
+                                        outfile_loop_cool.name, cache_directory).split()
+    compute(hicDetectLoops.main, args, 5)
+    cache_files = sorted(os.listdir(cache_directory))
+    assert len(cache_files) == 2
+
+    args[args.index(outfile_loop_cool.name)] = cached_loop_cool.name
+    compute(hicDetectLoops.main, args, 5)
+    assert sorted(os.listdir(cache_directory)) == cache_files
+    assert are_files_equal(outfile_loop_cool.name, cached_loop_cool.name, delta=0)
+
+    shutil.rmtree(cache_directory)
+
+
+def test_candidate_region_test_same_as_single_neighborhoods():
+    # small integer counts give many equal values in the neighborhoods and candidates at the borders
+    matrix = sparse.random(60, 60, density=0.6, random_state=np.random.RandomState(5),
+                           data_rvs=lambda size: np.random.RandomState(7).poisson(3, size=size) + 1)
+    matrix = sparse.triu(matrix, format='csr')
+    candidates = np.transpose(matrix.nonzero())
+    window_size, peak_width, p_value = 3, 1, 0.5
+
+    accepted, p_values = hicDetectLoops.candidate_region_test(matrix, candidates, window_size, p_value, peak_width)
+
+    expected_accepted = []
+    expected_p_values = []
+    for x, y in candidates:
+        neighborhood = matrix[max(x - window_size, 0):x + window_size + 1, max(y - window_size, 0):y + window_size + 1].toarray()
+        significance_level = hicDetectLoops.candidate_neighborhood_test(neighborhood, matrix[x, y], window_size, p_value, peak_width)
+        if significance_level is not None:
+            expected_accepted.append((x, y))
+            expected_p_values.append(significance_level)
+    assert len(expected_accepted) > 0
+    assert np.array_equal(accepted, np.array(expected_accepted))
+    assert np.array_equal(p_values, np.array(expected_p_values))
+
+    # a tile with candidates at the matrix border only
+    border = candidates[candidates[:, 0] == 0]
+    accepted, p_values = hicDetectLoops.candidate_region_test(matrix, border, window_size, p_value, peak_width)
+    assert accepted is None or np.all(accepted[:, 0] == 0)
+
+    merged = hicDetectLoops.neighborhood_merge(candidates, window_size, matrix)
+    expected_merged = [(x, y) for x, y in candidates
+                       if matrix[max(x - window_size, 0):x + window_size + 1,
+                                 max(y - window_size, 0):y + window_size + 1].max() == matrix[x, y]]
+    assert np.array_equal(np.array(merged), np.array(expected_merged))
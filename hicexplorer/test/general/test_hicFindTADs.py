@@ -6,7 +6,9 @@ from hicmatrix import HiCMatrix as hm
 from tempfile import mkdtemp
 import shutil
 import os
+import numpy as np
 import numpy.testing as nt
+import multiprocessing
 from hicexplorer.test.test_compute_function import compute
 
 
@@ -80,6 +82,33 @@ def test_find_TADs_fdr_chromosomes():
     shutil.rmtree(tad_folder)
 
 
+def test_find_TADs_cache():
+    # the second run with other boundary parameters uses the cached TAD-separation score of the first one
+    matrix = ROOT + "small_test_matrix.h5"
+    tad_folder = mkdtemp(prefix="test_case_find_tads_cache")
+    args = "--matrix {0} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 2 --step 20000 \
+    --outPrefix {1}/test_multiNone --minBoundaryDistance 20000 --cacheDirectory {1}/cache \
+    --correctForMultipleTesting None --thresholdComparisons 1.0".format(matrix, tad_folder).split()
+    compute(hicFindTADs.main, args, 5)
+    cache_files = os.listdir(tad_folder + "/cache")
+    assert len(cache_files) == 3
+
+    args = "--matrix {0} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 2 --step 20000 \
+    --outPrefix {1}/test_multiFDR --minBoundaryDistance 20000 --cacheDirectory {1}/cache \
+    --correctForMultipleTesting fdr --thresholdComparisons 0.1".format(matrix, tad_folder).split()
+    compute(hicFindTADs.main, args, 5)
+    assert sorted(os.listdir(tad_folder + "/cache")) == sorted(cache_files)
+
+    new = hm.hiCMatrix(tad_folder + "/test_multiFDR_zscore_matrix.h5")
+    test = hm.hiCMatrix(ROOT + 'find_TADs/FDR/multiFDR_zscore_matrix.h5')
+    nt.assert_equal(test.matrix.data, new.matrix.data)
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_boundaries.bed", tad_folder + "/test_multiFDR_boundaries.bed")
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_domains.bed", tad_folder + "/test_multiFDR_domains.bed")
+    assert are_files_equal(ROOT + "find_TADs/FDR/multiFDR_tad_score.bm", tad_folder + "/test_multiFDR_tad_score.bm")
+
+    shutil.rmtree(tad_folder)
+
+
 def test_find_TADs_bonferroni():
     # reduced test case, the z-score matrix is given to decrease run time
     matrix = ROOT + "small_test_matrix.h5"
@@ -115,9 +144,96 @@ def test_find_TADs_none():
     # hicFindTADs.main(args)
     compute(hicFindTADs.main, args, 5)
 
-    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.bed", tad_folder + "/test_multiNone_boundaries.bed")
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_domains.bed", tad_folder + "/test_multiNone_domains.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.bed", tad_folder + "/test_multiNone_boundaries.bed")
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.gff", tad_folder + "/test_multiNone_boundaries.gff")
     assert are_files_equal(ROOT + "find_TADs/None/multiNone_score.bedgraph", tad_folder + "/test_multiNone_score.bedgraph")
 
     shutil.rmtree(tad_folder)
+
+
+def test_compute_matrix_same_as_cut_weight():
+    # the band integral gives the same diamond means as slicing the matrix
+    hic_ma = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    bin_size = hic_ma.getBinSize()
+    bins_list = list(range(5000, 5100)) + list(range(hic_ma.matrix.shape[0] - 20, hic_ma.matrix.shape[0]))
+    hicFindTADs.init_worker(hicFindTADs.SharedBandMatrix(hic_ma))
+    chrom, chr_start, chr_end, matrix = hicFindTADs.compute_matrix(bins_list, min_win_size=3 * bin_size,
+                                                                   max_win_size=10 * bin_size, step_len=1.5 * bin_size)
+    window_sizes = hicFindTADs.get_incremental_step_size(3 * bin_size, 10 * bin_size, 1.5 * bin_size)
+    assert len(chrom) == len(bins_list)
+    for row, cut in enumerate(bins_list):
+        assert chr_start[row] == hic_ma.cut_intervals[cut][1]
+        expected = [hicFindTADs.get_cut_weight(hic_ma, cut, window_size, return_mean=True) for window_size in window_sizes]
+        nt.assert_allclose(matrix[row], expected)
+
+
+def test_compute_matrix_spawn():
+    # the workers read the shared matrix also if they are not forked
+    hic_ma = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    bin_size = hic_ma.getBinSize()
+    shared_matrix = hicFindTADs.SharedBandMatrix(hic_ma)
+    tasks = [(bins, 3 * bin_size, 10 * bin_size, 1.5 * bin_size) for bins in shared_matrix.get_tasks(pBinsPerTask=2000)]
+    assert len(tasks) > 2
+    pool = multiprocessing.get_context('spawn').Pool(2, initializer=hicFindTADs.init_worker, initargs=(shared_matrix,))
+    result = pool.map(hicFindTADs.compute_matrix_wrapper, tasks)
+    pool.close()
+    pool.join()
+    hicFindTADs.init_worker(shared_matrix)
+    for task, (chrom, chr_start, chr_end, matrix) in zip(tasks, result):
+        expected = hicFindTADs.compute_matrix_wrapper(task)
+        assert list(chr_start) == list(expected[1])
+        nt.assert_equal(matrix, expected[3])
+
+
+def test_compute_pvalues_same_as_ranksums():
+    from scipy.stats import ranksums
+    hic_ma = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    window_len = 3 * hic_ma.getBinSize()
+    bins_list = list(range(5000, 5050)) + [hic_ma.matrix.shape[0] - 1]
+    hicFindTADs.init_worker(hicFindTADs.SharedBandMatrix(hic_ma))
+    pvalues = hicFindTADs.compute_pvalues(bins_list, window_len)
+    for cut, pvalue in zip(bins_list, pvalues):
+        left_idx, right_idx = hicFindTADs.get_idx_of_bins_at_given_distance(hic_ma, cut, window_len)
+        boundary = hicFindTADs.get_cut_weight(hic_ma, cut, window_len)
+        left = hicFindTADs.get_cut_weight(hic_ma, left_idx, window_len)
+        right = hicFindTADs.get_cut_weight(hic_ma, right_idx, window_len)
+        if len(boundary) == 0 or len(left) == 0 or len(right) == 0:
+            assert np.isnan(pvalue)
+        else:
+            nt.assert_allclose(pvalue, min(ranksums(boundary, left)[1], ranksums(boundary, right)[1]), rtol=1e-10)
+
+
+def test_find_TADs_single_processor():
+    # the p-values of the boundary candidates are computed in the main process
+    matrix = ROOT + "small_test_matrix.h5"
+    tad_folder = mkdtemp(prefix="test_case_find_tads_single_processor")
+    shutil.copy(ROOT + "find_TADs/None/multiNone_tad_score.bm", tad_folder + "/test_multiNone_tad_score.bm")
+    shutil.copy(ROOT + 'find_TADs/None/multiNone_zscore_matrix.h5', tad_folder + "/test_multiNone_zscore_matrix.h5")
+    args = "--matrix {} --minDepth 60000 --maxDepth 180000 --numberOfProcessors 1 --step 20000 \
+    --outPrefix {}/test_multiNone --minBoundaryDistance 20000 \
+    --correctForMultipleTesting None --thresholdComparisons 1.0".format(matrix, tad_folder).split()
+
+    compute(hicFindTADs.main, args, 5)
+
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_boundaries.bed", tad_folder + "/test_multiNone_boundaries.bed")
+    assert are_files_equal(ROOT + "find_TADs/None/multiNone_domains.bed", tad_folder + "/test_multiNone_domains.bed")
+
+    shutil.rmtree(tad_folder)
+
+
+def test_min_pvalue_last_bin():
+    # a minimum in the last bin of a chromosome is tested as well
+    hic_ma = hm.hiCMatrix(ROOT + "small_test_matrix.h5")
+    tads = hicFindTADs.HicFindTads(hic_ma, num_processors=1, min_depth=3 * hic_ma.getBinSize(),
+                                   max_depth=10 * hic_ma.getBinSize(), step=hic_ma.getBinSize(),
+                                   p_correct_for_multiple_testing='None')
+    chrom, start, end, _ = zip(*hic_ma.cut_intervals)
+    tads.bedgraph_matrix = {'chrom': np.array(chrom),
+                            'chr_start': np.array(start),
+                            'chr_end': np.array(end),
+                            'matrix': np.zeros((len(chrom), 1))}
+    first_chromosome = list(hic_ma.chrBinBoundaries)[0]
+    last_bin = hic_ma.chrBinBoundaries[first_chromosome][1] - 1
+    pvalues = tads.min_pvalue([last_bin - 10, last_bin])
+    assert list(pvalues) == [last_bin - 10, last_bin]
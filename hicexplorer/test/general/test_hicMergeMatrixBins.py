@@ -2,10 +2,12 @@ import warnings
 warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 from hicexplorer import hicMergeMatrixBins
+from hicexplorer import hicCorrectMatrix
 from hicmatrix import HiCMatrix as hm
 from tempfile import NamedTemporaryFile
 import os
 import numpy.testing as nt
+import pytest
 from hicexplorer.test.test_compute_function import compute
 
 
@@ -27,3 +29,22 @@ def test_correct_matrix():
     nt.assert_equal(test.cut_intervals, new.cut_intervals)
 
     os.unlink(outfile.name)
+
+
+def test_correction_factors_only():
+    factors_only = NamedTemporaryFile(suffix='.h5', delete=False)
+    factors_only.close()
+    outfile = NamedTemporaryFile(suffix='.h5', delete=False)
+    outfile.close()
+    args = "correct --matrix {} --correctionMethod ICE --chromosomes chrUextra chr3LHet --iterNum 500 "\
+           "--filterThreshold -1.5 5.0 --correctionFactorsOnly --outFileName {}".format(ROOT + "small_test_matrix.h5",
+                                                                                        factors_only.name).split()
+    compute(hicCorrectMatrix.main, args, 5)
+
+    # the correction factors are not valid for the merged bins
+    args = "--matrix {} --numBins 5 --outFileName {}".format(factors_only.name, outfile.name).split()
+    with pytest.raises(SystemExit):
+        hicMergeMatrixBins.main(args)
+
+    os.unlink(factors_only.name)
+    os.unlink(outfile.name)
@@ -5,8 +5,9 @@ from hicexplorer import hicTransform
 from hicmatrix import HiCMatrix as hm
 import numpy.testing as nt
 
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 import os
+import shutil
 from hicexplorer.test.test_compute_function import compute
 
 
@@ -80,6 +81,27 @@ def test_hic_transfer_obs_exp_non_zero_perChromosome():
     os.unlink(outfile.name)
 
 
+def test_hic_transfer_obs_exp_non_zero_perChromosome_cache():
+
+    outfile = NamedTemporaryFile(suffix='obs_exp_.cool', delete=False)
+    outfile.close()
+    cache_directory = mkdtemp()
+
+    # the second run reads the expected interactions stored by the first one
+    args = "--matrix {} --outFileName {} --method obs_exp_non_zero --perChromosome --cacheDirectory {}".format(
+        original_matrix_cool, outfile.name, cache_directory).split()
+    hicTransform.main(args)
+    assert len(os.listdir(cache_directory)) > 0
+    hicTransform.main(args)
+
+    test = hm.hiCMatrix(ROOT + "hicTransform/obs_exp_non_zero_per_chromosome.cool")
+
+    new = hm.hiCMatrix(outfile.name)
+    nt.assert_array_almost_equal(test.matrix.data, new.matrix.data, decimal=DELTA_DECIMAL)
+    os.unlink(outfile.name)
+    shutil.rmtree(cache_directory)
+
+
 def test_hic_transfer_obs_exp_lieberman():
     outfile = NamedTemporaryFile(suffix='obs_exp_lieberman_.h5', delete=False)
     outfile.close()
@@ -3,15 +3,23 @@ warnings.simplefilter(action="ignore", category=RuntimeWarning)
 warnings.simplefilter(action="ignore", category=PendingDeprecationWarning)
 import sys
 import numpy as np
+from scipy.stats import rankdata, norm
 import argparse
 from matplotlib import use as mplt_use
 mplt_use('Agg')
 from unidecode import unidecode
 import cooler
+import tables
+from hicmatrix import HiCMatrix as hm
+from hicexplorer.expectedInteractions import matrix_distance_sums, expected_per_distance
 from copy import deepcopy
 import time
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 import traceback
+import hashlib
+import json
+import os
 import logging
 log = logging.getLogger(__name__)
 
@@ -290,171 +298,119 @@ def getUserRegion(chromSizes, regionString, max_chunk_size=1e6):
     return (chromSizes, regionStart, regionEnd, int(chunkSize))
 
 
-def expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix):
+class PipeQueue(object):
     """
-        Computes the function I_chrom(s) for a given chromosome.
+    Minimal queue interface on top of the sending end of a pipe. It is given to the
+    worker functions of `run_tasks` instead of a multiprocessing.Queue, the workers use it
+    as before with `pQueue.put(result)`.
     """
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
-
-    count_times_i = np.arange(float(len(expected_interactions)))
-    pChromosome_count = np.int32(pChromosome_count)
-    pLength_chromosome = np.int32(pLength_chromosome)
-    count_times_i *= pChromosome_count
-    count_times_i -= pLength_chromosome
-    count_times_i *= np.int32(-1)
 
-    expected_interactions = np.divide(expected_interactions, count_times_i)
-    # log.debug('exp_obs_matrix_lieberman {}'.format(expected_interactions))
+    def __init__(self, pConnection):
+        self.connection = pConnection
 
-    return expected_interactions
+    def put(self, pItem):
+        self.connection.send(pItem)
 
 
-def expected_interactions_non_zero(pSubmatrix):
+def run_tasks(pTarget, pTaskArguments, pThreads=None, pQueueArgumentName='pQueue'):
     """
-        Computes the expected number of interactions per distance
+    Runs 'pTarget' once per task, each task in its own process. The processes are created via fork, i.e. large
+    read-only data like a Hi-C matrix is shared and not copied. At most 'pThreads' processes are running at the same time,
+    a new task is started as soon as a running one has finished.
+
+    The main process does not poll: it blocks on the result pipes of all running tasks
+    and wakes up as soon as any of them has delivered its result.
+
+    Parameters
+    ----------
+    pTarget : function which is executed per task. It needs to put exactly one result into the queue given
+            as keyword argument 'pQueueArgumentName'.
+    pTaskArguments : list of dicts, the keyword arguments of 'pTarget' per task (without the queue).
+    pThreads : integer, maximal number of processes running at the same time. If None, all tasks are started at once.
+    pQueueArgumentName : string, name of the keyword argument of 'pTarget' for the result queue.
+
+    Returns
+    -------
+    Generator of tuples (task index, result) in the order the tasks finish. If a process
+    exits without delivering a result, the result is a string starting with 'Fail: '.
+
+    >>> def square(pValue, pQueue):
+    ...     pQueue.put(pValue * pValue)
+    >>> sorted(run_tasks(square, [{'pValue': i} for i in range(5)], pThreads=2))
+    [(0, 0), (1, 1), (2, 4), (3, 9), (4, 16)]
     """
+    if pThreads is None or pThreads < 1:
+        pThreads = max(1, len(pTaskArguments))
 
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-
-    occurences = np.zeros(pSubmatrix.shape[0])
-    # data_type = type(pSubmatrix.data[0])
-    for i, distance_ in enumerate(distance):
-        expected_interactions[distance_] += pSubmatrix.data[i]
-        occurences[distance_] += 1
-    expected_interactions = np.divide(expected_interactions, occurences)
-
-    mask = np.isnan(expected_interactions)
-    expected_interactions[mask] = 0
-    mask = np.isinf(expected_interactions)
-    expected_interactions[mask] = 0
-
-    return expected_interactions
-
-
-def expected_interactions_thread(pData, pDistances, pMinDistance, pMaxDistance, pSize, pQueue):
+    next_task = 0
+    running = {}
     try:
-        expected_interactions = np.zeros(pSize)
-
-        for i in range(pMinDistance, pMaxDistance, 1):
-            mask = pDistances == i
-            expected_interactions[i] = np.sum(pData[mask])
+        while next_task < len(pTaskArguments) or len(running) > 0:
+            while next_task < len(pTaskArguments) and len(running) < pThreads:
+                reader, writer = Pipe(duplex=False)
+                kwargs = dict(pTaskArguments[next_task])
+                kwargs[pQueueArgumentName] = PipeQueue(writer)
+                process = Process(target=pTarget, kwargs=kwargs)
+                process.start()
+                # close the writing end in the main process, such that a crashed
+                # worker is detected as end of file on the reading end
+                writer.close()
+                running[reader] = (next_task, process)
+                next_task += 1
+
+            for reader in wait(list(running.keys())):
+                task_index, process = running.pop(reader)
+                try:
+                    result = reader.recv()
+                except EOFError:
+                    process.join()
+                    result = 'Fail: process of task {} exited with code {} without a result.'.format(task_index, process.exitcode)
+                reader.close()
+                process.join()
+                yield task_index, result
+    finally:
+        # the consumer stopped early, e.g. because of a failed task
+        for reader, (task_index, process) in running.items():
+            process.terminate()
+            process.join()
+            reader.close()
+
+
+def expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix, pDistanceSums=None):
+    """
+        Computes the function I_chrom(s) for a given chromosome.
 
-        pQueue.put(expected_interactions)
-        return
-    except Exception as exp:
-        pQueue.put('Fail: ' + str(exp) + traceback.format_exc())
-        return
+        pDistanceSums are the sums and counts per distance of pSubmatrix, e.g. from an ExpectedCache,
+        they are computed if not given.
+    """
+    if pDistanceSums is None:
+        pDistanceSums = matrix_distance_sums(pSubmatrix)
+    return expected_per_distance(*pDistanceSums, pMethod='lieberman', pGenomeLength=pLength_chromosome,
+                                 pChromosomeCount=pChromosome_count)
 
 
-def expected_interactions(pSubmatrix, pThreads=None):
+def expected_interactions_non_zero(pSubmatrix, pDistanceSums=None):
     """
         Computes the expected number of interactions per distance
+        as the mean of the non-zero interactions.
     """
-    expected_interactions = np.zeros(pSubmatrix.shape[0])
-
-    row, col = pSubmatrix.nonzero()
-    distance = np.absolute(row - col)
-    occurrences = np.arange(pSubmatrix.shape[0] + 1, 1, -1)
-    # occurences = np.zeros(pSubmatrix.shape[0])
-
-    if len(distance) == 0:
-        return None
-    min_distance = distance.min()
-    max_distance = distance.max()
-    # time_start = time.time()
-    if pThreads is not None and pThreads:
-        queue = [None] * pThreads
-        process = [None] * pThreads
-        distances_per_threads = (max_distance - min_distance) // pThreads
-        all_data_collected = False
-        thread_done = [False] * pThreads
-
-        for i in range(pThreads):
-
-            if i < pThreads - 1:
-                min_distance_thread = min_distance + (i * distances_per_threads)
-                max_distance_thread = min_distance + ((i + 1) * distances_per_threads)
-            else:
-                min_distance_thread = min_distance + (i * distances_per_threads)
-                max_distance_thread = max_distance + 1
-            queue[i] = Queue()
-            process[i] = Process(target=expected_interactions_thread, kwargs=dict(
-                pData=pSubmatrix.data,
-                pDistances=distance,
-                pMinDistance=min_distance_thread,
-                pMaxDistance=max_distance_thread,
-                pSize=pSubmatrix.shape[0],
-                pQueue=queue[i]
-            )
-            )
-
-            process[i].start()
-        fail_flag = False
-        fail_message = ''
-        while not all_data_collected:
-            for i in range(pThreads):
-                if queue[i] is not None and not queue[i].empty():
-                    expected_interactions_thread_ = queue[i].get()
-                    if isinstance(expected_interactions_thread_, str) and 'Fail: ' in expected_interactions_thread_:
-                        fail_flag = True
-                        fail_message = expected_interactions_thread_
-                    else:
-                        expected_interactions += expected_interactions_thread_
-                    queue[i] = None
-                    process[i].join()
-                    process[i].terminate()
-                    process[i] = None
-                    thread_done[i] = True
-            all_data_collected = True
-            for thread in thread_done:
-                if not thread:
-                    all_data_collected = False
-            time.sleep(1)
-        if fail_flag:
-            return fail_message
-    else:
-
-        for i in range(min_distance, max_distance + 1, 1):
-            mask = distance == i
-            expected_interactions[i] = np.sum(pSubmatrix.data[mask])
-    # log.info('exp inter: {}'.format(time.time() - time_start))
-    # for i, distance_ in enumerate(distance):
-    #     expected_interactions[distance_] += pSubmatrix.data[i]
-        # occurences[distance_] += 1
-    expected_interactions = np.divide(expected_interactions, occurrences)
-
-    mask = np.isnan(expected_interactions)
-    expected_interactions[mask] = 0
-    mask = np.isinf(expected_interactions)
-    expected_interactions[mask] = 0
+    if pDistanceSums is None:
+        pDistanceSums = matrix_distance_sums(pSubmatrix)
+    return expected_per_distance(*pDistanceSums, pMethod='nonzero')
 
-    del row
-    del col
-    del distance
-    del occurrences
-    del mask
-
-    return expected_interactions
-
-# def expected_interactions(pSubmatrix):
 
-#     instances, features = pSubmatrix.nonzero()
-#     distances = np.absolute(instances - features)
-#     sum_per_distance = np.ones(pSubmatrix.shape[0])
-#     binary_interactions_per_distance = np.ones(pSubmatrix.shape[0])
-
-#     for i, distance in enumerate(distances):
-#         sum_per_distance[distance] += pSubmatrix.data[i]
-#         binary_interactions_per_distance[distance] += 1
+def expected_interactions(pSubmatrix, pThreads=None, pDistanceSums=None):
+    """
+        Computes the expected number of interactions per distance
 
-#     return sum_per_distance / binary_interactions_per_distance
+        The sums per distance need one pass over the values, pThreads is not used
+        anymore and only kept for compatibility.
+    """
+    if pSubmatrix.count_nonzero() == 0:
+        return None
+    if pDistanceSums is None:
+        pDistanceSums = matrix_distance_sums(pSubmatrix)
+    return expected_per_distance(*pDistanceSums, pMethod='mean')
 
 
 def compute_zscore(pSubmatrix, pDepth, pThreads):
@@ -485,7 +441,7 @@ def compute_zscore(pSubmatrix, pDepth, pThreads):
     return pSubmatrix
 
 
-def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
+def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count, pDistanceSums=None):
     """
         Creates normalized contact matrix M* by
         dividing each entry by the gnome-wide
@@ -493,7 +449,8 @@ def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
         that genomic distance. Method: Lieberman-Aiden 2009
     """
 
-    expected_interactions_in_distance_ = expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix)
+    expected_interactions_in_distance_ = expected_interactions_in_distance(pLength_chromosome, pChromosome_count, pSubmatrix,
+                                                                           pDistanceSums)
     row, col = pSubmatrix.nonzero()
     distance = np.ceil(np.absolute(row - col) / 2).astype(np.int32)
 
@@ -507,7 +464,8 @@ def obs_exp_matrix_lieberman(pSubmatrix, pLength_chromosome, pChromosome_count):
     return pSubmatrix
 
 
-def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pToEpsilon=False, pThreads=None):
+def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pToEpsilon=False, pThreads=None,
+                            pDistanceSums=None):
     """
         Creates normalized contact matrix M* by
         dividing each entry by the gnome-wide
@@ -523,21 +481,21 @@ def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pT
         submatrix = pSubmatrix
     else:
         submatrix = deepcopy(pSubmatrix)
-    expected_interactions_in_distance = expected_interactions_non_zero(submatrix)
+    expected_interactions_in_distance = expected_interactions_non_zero(submatrix, pDistanceSums)
 
     row_sums = np.array(submatrix.sum(axis=1).T).flatten()
     total_interactions = submatrix.sum()
 
+    # the positions of the values are in the same order as the values
+    submatrix.eliminate_zeros()
     row, col = submatrix.nonzero()
 
     submatrix.data = submatrix.data.astype(np.float32)
 
-    for i in range(len(row)):
-        expected = expected_interactions_in_distance[np.absolute(row[i] - col[i])]
-        if ligation_factor:
-            expected *= row_sums[row[i]] * row_sums[col[i]] / total_interactions
-
-        submatrix.data[i] = np.divide(submatrix.data[i], expected)
+    expected = expected_interactions_in_distance[np.absolute(row - col)]
+    if ligation_factor:
+        expected *= row_sums[row] * row_sums[col] / total_interactions
+    submatrix.data = np.divide(submatrix.data, expected).astype(np.float32)
 
     if pToEpsilon:
         epsilon = 0.000000001
@@ -551,7 +509,7 @@ def obs_exp_matrix_non_zero(pSubmatrix, ligation_factor=False, pInplace=True, pT
     return submatrix
 
 
-def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pThreads=None, pDistance=None):
+def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pThreads=None, pDistance=None, pDistanceSums=None):
     """
         Creates normalized contact matrix M* by
         dividing each entry by the gnome-wide
@@ -559,6 +517,9 @@ def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pThreads=None, p
         that genomic distance.
         exp_i,j = sum(interactions at distance abs(i-j)) / number of non-zero
         interactions at abs(i-j)
+
+        pDistanceSums are the sums and counts per distance of pSubmatrix before
+        the values with a distance of pDistance or more are removed.
     """
     # time_start = time.time()
     if pDistance is not None:
@@ -568,7 +529,7 @@ def obs_exp_matrix(pSubmatrix, pInplace=True, pToEpsilon=False, pThreads=None, p
         pSubmatrix.data[mask] = 0
         pSubmatrix.eliminate_zeros()
 
-    expected_interactions_in_distance_ = expected_interactions(pSubmatrix, pThreads)
+    expected_interactions_in_distance_ = expected_interactions(pSubmatrix, pThreads, pDistanceSums)
     if expected_interactions_in_distance_ is None:
         return None
     # log.info('time exp: {}'.format(time.time() - time_start))
@@ -714,6 +675,101 @@ def check_cooler(pFileName):
     return False
 
 
+def mark_correction_factors_only(pFileName):
+    """
+    Marks an h5 matrix file whose counts are not corrected and whose
+    'correction_factors' are multiplicative weights, i.e. the corrected value
+    of a pixel is count[i, j] * correction_factors[i] * correction_factors[j].
+    Cool files need no mark, the 'weight' column has this meaning by definition.
+    """
+    with tables.open_file(pFileName, 'r+') as matrix_file:
+        matrix_file.root._v_attrs.correction_factors_only = True
+
+
+def read_correction_factors_only(pFileName):
+    """
+    Returns the correction factors of an h5 matrix file marked by
+    mark_correction_factors_only, None for all other files.
+    """
+    if check_cooler(pFileName):
+        return None
+    with tables.open_file(pFileName, 'r') as matrix_file:
+        if 'correction_factors_only' not in matrix_file.root._v_attrs or \
+                not hasattr(matrix_file.root, 'correction_factors'):
+            return None
+        correction_factors = np.array(matrix_file.root.correction_factors.read(), dtype=np.float64)
+    correction_factors[~np.isfinite(correction_factors)] = 0
+    return correction_factors
+
+
+def read_bins(pMatrixFile):
+    """
+    Returns the bins of a cool or h5 matrix file as (chromosome, start, end),
+    without loading the matrix.
+    """
+    if check_cooler(pMatrixFile):
+        bins = cooler.Cooler(pMatrixFile).bins()[['chrom', 'start', 'end']][:]
+        return list(zip(bins['chrom'].astype(str), bins['start'].astype(int), bins['end'].astype(int)))
+    with tables.open_file(pMatrixFile, 'r') as matrix_file:
+        intervals = matrix_file.root.intervals
+        return list(zip(toString(intervals.chr_list.read().tolist()),
+                        intervals.start_list.read().astype(int).tolist(),
+                        intervals.end_list.read().astype(int).tolist()))
+
+
+def match_correction_factors(pMatrixFile, pBins):
+    """
+    The correction factors of pMatrixFile, see read_correction_factors_only, for the
+    bins pBins given as (chromosome, start, end, ...). They are matched by the bin
+    coordinates, hiCMatrix keeps them in the order of the bins while masking bins,
+    but not when it reorders or removes bins. Bins without factor get 0.
+    """
+    correction_factors = read_correction_factors_only(pMatrixFile)
+    factor_per_bin = dict(zip(read_bins(pMatrixFile), correction_factors))
+    return np.array([factor_per_bin.get((toString(bin_[0]), int(bin_[1]), int(bin_[2])), 0)
+                     for bin_ in pBins], dtype=np.float64)
+
+
+def load_matrix(pMatrixFile, pApplyCorrection=True, **pKwargs):
+    """
+    Loads a Hi-C matrix, the keyword arguments are the ones of hiCMatrix.
+
+    Matrices that store the uncorrected counts together with correction
+    factors are corrected while loading and only the loaded part, e.g. the
+    region given by pChrnameList, is corrected. For cool files this is done
+    by the cool loader with the 'weight' column, for h5 files marked by
+    mark_correction_factors_only here.
+
+    :param pApplyCorrection: False to keep the counts of a marked h5 file, e.g. to
+                             store them again with save_matrix
+    """
+    hic_matrix = hm.hiCMatrix(pMatrixFile, **pKwargs)
+    correction_factors = read_correction_factors_only(pMatrixFile)
+    if correction_factors is None or not hasattr(hic_matrix.matrix, 'indptr') \
+            or len(correction_factors) != hic_matrix.matrix.shape[0]:
+        return hic_matrix
+    if pApplyCorrection:
+        matrix = hic_matrix.matrix.astype(np.float64)
+        rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        matrix.data *= correction_factors[rows] * correction_factors[matrix.indices]
+        matrix.eliminate_zeros()
+        hic_matrix.matrix = matrix
+    # hiCMatrix does not keep the correction factors of h5 files
+    hic_matrix.correction_factors = correction_factors
+    return hic_matrix
+
+
+def save_matrix(pHiCMatrix, pMatrixFile, pCorrectionFactorsOnly=False):
+    """
+    Saves a Hi-C matrix. With pCorrectionFactorsOnly the counts of pHiCMatrix
+    are uncorrected and its correction factors are multiplicative weights, an
+    h5 file is marked by mark_correction_factors_only.
+    """
+    pHiCMatrix.save(pMatrixFile, pApplyCorrection=False)
+    if pCorrectionFactorsOnly and not check_cooler(pMatrixFile):
+        mark_correction_factors_only(pMatrixFile)
+
+
 def in_units(pBasePosition):
     pBasePosition = float(pBasePosition)
     # log.debug("pBasePosition {}".format(pBasePosition))
@@ -727,3 +783,46 @@ def in_units(pBasePosition):
         labels = "{:.2f} ".format((pBasePosition))
         labels += " bp"
     return labels
+
+
+def get_cache_prefix(pMatrix, pCacheDirectory, pParameters):
+    """
+    Prefix of cached files computed from a matrix file. The name is the SHA-256
+    checksum of the file content together with the parameters used for the
+    computation, such that a changed file or changed parameters never reuse
+    an old result.
+    """
+    matrix_file = pMatrix.split('::')[0]
+    checksum = hashlib.sha256()
+    with open(matrix_file, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 24), b''):
+            checksum.update(block)
+    parameters = dict(pParameters)
+    # the matrix within a .mcool file
+    parameters['uri'] = pMatrix.split('::')[1:]
+    checksum.update(json.dumps(parameters, sort_keys=True).encode())
+    return os.path.join(pCacheDirectory, checksum.hexdigest())
+
+
+def ranksums_rows(x, y):
+    """
+    Wilcoxon rank-sum test of every row of x against the same row of y, like
+    scipy.stats.ranksums(x[i], y[i]) for all rows at once.
+
+    :param x: array of shape (number of tests, n1)
+    :param y: array of shape (number of tests, n2)
+    :return: two-sided p-values, nan for rows with nan values
+
+    >>> from scipy.stats import ranksums
+    >>> x = np.array([[1., 2., 3., 2.], [0., 0., 0., 0.]])
+    >>> y = np.array([[4., 2., 6.], [0., 0., 0.]])
+    >>> np.allclose(ranksums_rows(x, y), [ranksums(x[0], y[0])[1], ranksums(x[1], y[1])[1]])
+    True
+    """
+    n1 = x.shape[1]
+    n2 = y.shape[1]
+    ranks = rankdata(np.hstack([x, y]), axis=1)
+    rank_sum = ranks[:, :n1].sum(axis=1)
+    expected = n1 * (n1 + n2 + 1) / 2.0
+    z = (rank_sum - expected) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    return 2 * norm.sf(np.abs(z))